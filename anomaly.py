@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Cost anomaly detection over daily cost series.
+
+Daily costs are laid out as one matrix of series x days, and every series is compared with a
+rolling baseline of its own previous days in a single vectorized pass: the median of the
+window, with the median absolute deviation (MAD) as the scale. Days whose cost exceeds the
+baseline by more than ``threshold`` robust standard deviations, and by at least ``min_delta``,
+are flagged, e.g. an airflow-worker or elasticsearch-indexer group scaling up overnight.
+
+"""
+
+import collections
+import datetime
+
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+
+import stats
+
+
+DEFAULT_WINDOW = 14
+DEFAULT_THRESHOLD = 4.0
+DEFAULT_MIN_DELTA = 10.0
+
+# Scales a MAD to a standard deviation for normally distributed costs
+_MAD_SCALE = 1.4826
+
+# Floor of the scale, relative to the baseline, so that perfectly flat series are not flagged on
+# rounding noise
+_RELATIVE_SCALE_FLOOR = 0.05
+
+Anomaly = collections.namedtuple('Anomaly', ['day', 'key', 'cost', 'baseline', 'delta', 'score'])
+
+
+def series_matrix(rows):
+  """
+  Lays out daily cost rows as a dense matrix over every day from the first to the last; days a
+  series has no row for cost zero, so that rolling windows span calendar days.
+
+  :param rows: Tuples of (day as YYYY-MM-DD, key fields..., cost)
+  :return: A tuple of (list of series keys, list of days, series x days numpy array)
+  """
+  keys = {}
+  days = []
+  if rows:
+    first = datetime.date.fromisoformat(min(row[0] for row in rows))
+    last = datetime.date.fromisoformat(max(row[0] for row in rows))
+    days = [(first + datetime.timedelta(days=n)).isoformat()
+            for n in range((last - first).days + 1)]
+  columns = {day: i for i, day in enumerate(days)}
+  entries = []
+  for row in rows:
+    series = keys.setdefault(tuple(row[1:-1]), len(keys))
+    entries.append((series, columns[row[0]], row[-1]))
+
+  matrix = numpy.zeros((len(keys), len(days)))
+  if entries:
+    series, column, cost = (numpy.array(a) for a in zip(*entries))
+    numpy.add.at(matrix, (series.astype(int), column.astype(int)), cost.astype(float))
+  return list(keys), days, matrix
+
+
+def detect(rows, window=DEFAULT_WINDOW, threshold=DEFAULT_THRESHOLD, min_delta=DEFAULT_MIN_DELTA,
+           last_days=1):
+  """
+  Flags days whose cost jumps above the rolling baseline of their series.
+
+  :param rows: Tuples of (day, key fields..., cost), e.g. cube or Cost Explorer rows
+  :param window: The number of previous days each day is compared with
+  :param threshold: The number of robust standard deviations above baseline that is anomalous
+  :param min_delta: The minimum cost increase over baseline that is anomalous
+  :param last_days: Only report anomalies on this many most recent days
+  :return: A list of :py:class:`Anomaly`, largest increase first
+  """
+  with stats.span('anomaly.detect'):
+    keys, days, matrix = series_matrix(rows)
+    if len(days) <= window:
+      return []
+
+    # Each day is compared with the window of days before it, never with itself
+    history = sliding_window_view(matrix[:, :-1], window, axis=1)
+    current = matrix[:, window:]
+    baseline = numpy.median(history, axis=2)
+    mad = numpy.median(numpy.abs(history - baseline[:, :, None]), axis=2)
+    scale = numpy.maximum(_MAD_SCALE * mad, _RELATIVE_SCALE_FLOOR * numpy.abs(baseline))
+    delta = current - baseline
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      score = numpy.where(scale > 0, delta / scale, numpy.inf)
+
+    flagged = (score > threshold) & (delta >= min_delta)
+    if last_days:
+      flagged[:, :-last_days] = False
+    series, offset = numpy.nonzero(flagged)
+
+  stats.incr('anomaly_series', len(keys))
+  stats.incr('anomalies', len(series))
+  anomalies = [Anomaly(days[o + window], keys[s], float(current[s, o]), float(baseline[s, o]),
+                       float(delta[s, o]), float(score[s, o]))
+               for s, o in zip(series.tolist(), offset.tolist())]
+  return sorted(anomalies, key=lambda a: a.delta, reverse=True)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Auto Scaling group aware aggregation of the inventory.
+
+Searchers, indexers and workers run as Auto Scaling groups of hundreds of interchangeable nodes,
+which swamp a one-row-per-instance report. Group membership is fetched in a few
+describe_auto_scaling_groups pages (falling back to the ``aws:autoscaling:groupName`` tag), and
+the members of each group are folded into one summary row in a single pass: member count by
+state and instance type, first and last launch, and summed cost. Everything else, and the members
+of any group drilled down into, stays one row per instance.
+
+"""
+
+import collections
+
+import pricing
+import stats
+import utils
+
+
+GROUP_TAG = 'aws:autoscaling:groupName'
+
+GroupSummary = collections.namedtuple('GroupSummary', [
+  'name', 'env', 'purpose', 'count',
+  # Counters of member states and instance types
+  'states', 'types',
+  'first_launch', 'last_launch',
+  # Summed month-to-date cost and estimated monthly cost; None unless costs or prices were given
+  'cost', 'monthly_cost',
+])
+
+SUMMARY_COLUMNS = ['Auto Scaling Group', 'Environment', 'Purpose', 'Instances', 'States',
+                   'Instance Types', 'First Launch', 'Last Launch']
+
+
+def membership(groups):
+  """
+  :param groups: ``AutoScalingGroups`` entries, e.g. from
+      :py:meth:`engine.Engine.fetch_auto_scaling_groups`
+  :return: A dict of {instance ID: group name}
+  """
+  return {member['InstanceId']: group['AutoScalingGroupName']
+          for group in groups for member in group.get('Instances', [])}
+
+
+class _Summary(object):
+  # The running totals of one group
+
+  def __init__(self, name, instance):
+    attributes = utils.get_instance_attributes(instance)
+    self.name = name
+    self.env = attributes['env']
+    self.purpose = attributes['purpose']
+    self.states = collections.Counter()
+    self.types = collections.Counter()
+    self.first_launch = self.last_launch = None
+    self.cost = None
+    self.monthly_cost = None
+
+  def add(self, instance, resource_costs, catalog):
+    self.states[instance['State']['Name']] += 1
+    self.types[instance.get('InstanceType', '')] += 1
+    launched = instance.get('LaunchTime')
+    if launched is not None:
+      if self.first_launch is None or launched < self.first_launch:
+        self.first_launch = launched
+      if self.last_launch is None or launched > self.last_launch:
+        self.last_launch = launched
+    if resource_costs is not None:
+      self.cost = (self.cost or 0.0) + utils.get_instance_cost(instance, resource_costs)
+    if catalog is not None:
+      # As in utils.get_price_columns: nothing unless running; members without a price are skipped
+      price = catalog.instance_price(instance)
+      running = instance['State']['Name'] == 'running'
+      monthly = price * pricing.HOURS_PER_MONTH if price is not None and running else 0.0
+      self.monthly_cost = (self.monthly_cost or 0.0) + monthly
+
+  def freeze(self):
+    return GroupSummary(self.name, self.env, self.purpose, sum(self.states.values()), self.states,
+                        self.types, self.first_launch, self.last_launch, self.cost,
+                        self.monthly_cost)
+
+
+def aggregate(instances, groups=None, drilldown=(), resource_costs=None, catalog=None):
+  """
+  Folds Auto Scaling group members into one summary per group.
+
+  :param instances: Instance dicts, as returned by describe_instances
+  :param groups: ``AutoScalingGroups`` entries; instances not listed in any are grouped by their
+      ``aws:autoscaling:groupName`` tag
+  :param drilldown: Names of groups whose members are kept as instances rather than summarized
+  :param resource_costs: A dict of month-to-date cost per instance and volume ID, to sum
+  :param catalog: A :py:class:`pricing.PriceCatalog`, to sum the estimated monthly cost with
+  :return: A tuple of (list of :py:class:`GroupSummary`, largest first, list of the instances
+      not summarized)
+  """
+  members = membership(groups or [])
+  drilldown = set(drilldown)
+  summaries = {}
+  ungrouped = []
+  with stats.span('asg.aggregate'):
+    for instance in instances:
+      name = members.get(instance['InstanceId'])
+      if name is None:
+        name = utils.get_tags(instance).get(GROUP_TAG)
+      if name is None or name in drilldown:
+        ungrouped.append(instance)
+        continue
+      summary = summaries.get(name)
+      if summary is None:
+        summary = summaries[name] = _Summary(name, instance)
+      summary.add(instance, resource_costs, catalog)
+  stats.incr('asg_groups', len(summaries))
+  stats.incr('asg_members', len(instances) - len(ungrouped))
+  return (sorted((s.freeze() for s in summaries.values()), key=lambda s: (-s.count, s.name)),
+          ungrouped)
+
+
+def _counts(counter):
+  return ','.join('%s:%d' % item for item in sorted(counter.items(), key=lambda i: (-i[1], i[0])))
+
+
+def summary_header(resource_costs=None, catalog=None):
+  """
+  :return: The column names of :py:func:`summary_row`
+  """
+  header = list(SUMMARY_COLUMNS)
+  if resource_costs is not None:
+    header.append('Month-to-date Cost')
+  if catalog is not None:
+    header.append('Est. Monthly Cost')
+  return header
+
+
+def summary_row(summary, resource_costs=None, catalog=None):
+  """
+  :param summary: A :py:class:`GroupSummary`
+  :return: The summary's columns, formatted for output
+  """
+  def day(value):
+    return value.strftime('%Y-%m-%d %H:%M:%S GMT') if value is not None else ''
+
+  row = [summary.name, summary.env, summary.purpose, str(summary.count), _counts(summary.states),
+         _counts(summary.types), day(summary.first_launch), day(summary.last_launch)]
+  if resource_costs is not None:
+    row.append('%.2f' % (summary.cost or 0.0))
+  if catalog is not None:
+    row.append('%.2f' % (summary.monthly_cost or 0.0))
+  return row
@@ -5,68 +5,64 @@ A sample script to create cost report usage per instance type
 """
 
 import argparse
-import boto3
 import datetime
+import json
 import operator
+import os
+import sys
 import time
 import utils
 
 import matplotlib.pyplot as plt
-from matplotlib import colors
 
 from boto.ec2.instance import Instance
 from boto.ec2.ec2object import TaggedEC2Object
+import anomaly
+import asg
+import backend
 import config
-from boto.exception import EC2ResponseError
+import cube
+import cur
+import cur_manifest
+import daemon
+import engine
+import export
+import filters
+import history
+import images
+import inventory
+import lookup
+import network
+import pipeline
+import pricing
+import reservations
+import roledefs
+import route53
+import stats
+import topk
+import utilization
 
 
-def _query_filters(environment=None, purpose=None, user=None, zone=None):
-  filters = []
+COST_QUERY = {
+  'granularity': 'WEEKLY',
+  'metrics': ['UnblendedCost'],
+  'group_by': [{'Type': 'DIMENSION', 'Key': 'LINKED_ACCOUNT'}, {'Type': 'DIMENSION', 'Key': 'INSTANCE_TYPE'}],
+}
 
-  if environment:
-    filters.append({'Name':'tag:'+config.INSTANCE_ENVIRONMENT_KEY, 'Values':[environment]})
-    # filters['tag:' + config.INSTANCE_ENVIRONMENT_KEY] = environment
-  if purpose:
-    filters.append({'Name':'tag:'+config.INSTANCE_PURPOSE_KEY, 'Values':[purpose]})
-    # filters['tag:' + config.INSTANCE_PURPOSE_KEY] = purpose.replace('_', '-')
-  if user:
-    filters.append({'Name':'tag:'+config.INSTANCE_USER_KEY, 'Values':[user]})
-    # filters['tag:' + config.INSTANCE_USER_KEY] = user
-  if zone:
-    filters.append({'Name':'availabilityZone:', 'Values':[zone]})
-    # filters['availabilityZone'] = zone
-
-  return filters
 
-def _instance_query(environment=None, purpose=None, user=None):
+def _instance_query(api_filters=None):
   print("Running instance query")
-  filters = _query_filters(environment=environment, purpose=purpose, user=user)
-  interval_secs = 5
-  checks = 0
-  max_timeout = 60
-  ran = False
-  response = None
-
-  while not ran and checks * interval_secs < max_timeout:
-    try:
-      ec2 = boto3.client('ec2')
-      # if filters:
-      #   response = ec2.describe_instances(Filters=filters)
-      # else:
-      response = ec2.describe_instances()
-      ran = True
-    except EC2ResponseError as error:
-      print(error.error_message)
-      time.sleep(interval_secs)
-    checks = checks + 1
-  
-  instances = []
-  for reservation in response['Reservations']:
-    instances.extend(reservation['Instances'])
-  return instances
+  eng = engine.Engine()
+  return eng.run(instances=eng.fetch_instances(api_filters))['instances']
 
+def _cost_query(start, end):
+  eng = engine.Engine()
+  return eng.run(cost=eng.fetch_cost(start, end, **COST_QUERY))['cost']
 
-def instance_query(environment=None, purpose=None, user=None, running=False, raw_output=False, fname=None):
+
+def instance_query(environment=None, purpose=None, user=None, running=False, raw_output=False, fname=None,
+                   instances=None, resource_costs=None, catalog=None, usage=None, where=None,
+                   network_cache=None, image_cache=None):
   """
   Queries AWS for any instances matching the specified parameters.
 
@@ -76,61 +72,756 @@ def instance_query(environment=None, purpose=None, user=None, running=False, raw
   :param running: Whether to match only instances that are currently running
   :param raw_output: Whether the output should only be a list of host names, one per line, or
       a complete table including environment, purpose, role and host.
+  :param instances: Instances already fetched (e.g. concurrently with other fetches), to use
+      instead of querying AWS
+  :param resource_costs: Month-to-date cost per instance and volume ID, to add to the detail file
+  :param catalog: A :py:class:`pricing.PriceCatalog` to estimate each instance's cost with
+  :param usage: Utilization per instance ID, to add to the detail file
+  :param where: A :py:mod:`filters` expression matching instances must also satisfy
+  :param network_cache: A :py:class:`network.NetworkCache` to add subnet columns to the detail
+      file from
+  :param image_cache: An :py:class:`images.ImageCache` to add AMI columns to the detail file from
   :return: A list of boto.ec2.instance.Instance objects
   """
-
-  instances = [
-    i for i in _instance_query(environment, purpose, user) if not running or i['State']['Name'] == 'running'
-  ]
+  query = filters.Filter(filters.conjoin(
+    where, env=environment, purpose=purpose, user=user, state='running' if running else None))
+  fetched = instances is None
+  if fetched:
+    with stats.span('instance_query.describe_instances'):
+      instances = _instance_query(query.api_filters)
+  with stats.span('instance_query.filter'):
+    instances = list(query.apply(instances, fetched_with_api_filters=fetched))
+  stats.incr('instances', len(instances))
   
   if not instances:
-    print(colors.red('No instances matching specified query.'))
+    print('No instances matching specified query.', file=sys.stderr)
   if environment:
     print('\tenvironment = %s' % environment)
   if purpose:
     print('\tpurpose = %s' % purpose)
   if user:
     print('\tuser = %s' % user)
-  elif raw_output:
-    for instance in instances:
-      print(utils.generate_host(instance))
-  else:
+  if where:
+    print('\tfilter = %s' % where)
+  if raw_output:
+    with stats.span('instance_query.raw_output'):
+      for instance in instances:
+        print(utils.generate_host(instance))
+  elif fname:
     # print(utils.create_instance_details_table(instances).get_string(sortby='Launch date'))
-    if fname:
-      utils.create_instance_detail_file(instances, fname)
+    with stats.span('instance_query.detail_file'):
+      utils.create_instance_detail_file(instances, fname, resource_costs, catalog, usage,
+                                        network_cache, image_cache)
 
   return instances
 
-def print_pricing_per_instance_type(start, end):
-  token = None
-  results = []
-  while True:
-    if token:
-      kwargs = {'NextPageToken': token}
+def print_pricing_per_instance_type(start, end, results=None):
+  if results is None:
+    with stats.span('pricing.get_cost_and_usage'):
+      results = _cost_query(start, end)
+
+  with stats.span('pricing.print'):
+    print('\t'.join(['TimePeriod', 'LinkedAccount', 'InstanceType', 'Amount', 'Unit', 'Estimated']))
+    for result_by_time in results:
+      for group in result_by_time['Groups']:
+        amount = group['Metrics']['UnblendedCost']['Amount']
+        unit = group['Metrics']['UnblendedCost']['Unit']
+        print(result_by_time['TimePeriod']['Start'], '\t', '\t'.join(group['Keys']), '\t', amount, '\t', unit, '\t', result_by_time['Estimated'])
+
+def print_cur_costs(totals, group_by):
+  """
+  Prints CUR cost aggregates, most expensive first.
+
+  :param totals: A dict of cost keyed by group, as returned by :py:func:`cur.ingest`
+  :param group_by: The fields the totals are grouped by
+  """
+  with stats.span('cur.print'):
+    print('\t'.join(list(group_by) + ['UnblendedCost']))
+    for key, cost in sorted(totals.items(), key=operator.itemgetter(1), reverse=True):
+      print('\t'.join(list(key) + ['%.6f' % cost]))
+
+def update_cube(rollup, days=None, cur_paths=None, processes=None):
+  """
+  Appends the days missing from a cost cube, either from CUR files or from Cost Explorer.
+
+  :param rollup: A :py:class:`cube.Cube`
+  :param days: How many days to load into an empty cube from Cost Explorer
+  :param cur_paths: CUR files to load from, instead of Cost Explorer
+  :param processes: The number of worker processes used to parse CUR files
+  """
+  # The last day in the cube may have been partial, so it is always reloaded
+  since = rollup.last_day()
+  if cur_paths:
+    totals = cur.ingest(cur_paths, cube.cur_query(since), processes=processes)
+    rollup.update(cube.rows_from_cur(totals), source='cur')
+    return
+  now = datetime.datetime.utcnow()
+  start = since or (now - datetime.timedelta(days=days or 90)).strftime('%Y-%m-%d')
+  end = now.strftime('%Y-%m-%d')
+  if start >= end:
+    return
+  eng = engine.Engine()
+  results = eng.run(cost=eng.fetch_cost(start, end, **cube.COST_QUERY))['cost']
+  rollup.update(cube.rows_from_cost_results(results), source='ce')
+
+def print_cube_rollup(rollup, group_by, since=None, until=None, where=None):
+  rows = rollup.query(group_by, since=since, until=until, **(where or {}))
+  print('\t'.join(list(group_by) + ['UnblendedCost']))
+  for row in rows:
+    print('\t'.join([str(v) for v in row[:-1]] + ['%.6f' % row[-1]]))
+
+def print_top_costs(k, fields, days=30, cur_paths=None, line_item_types=None, processes=None,
+                    capacity=topk.DEFAULT_CAPACITY):
+  """
+  Prints the k most expensive groups, streaming cost rows through a bounded summary.
+
+  :param k: The number of groups to print
+  :param fields: The fields to group by: CUR fields (see :py:func:`cur.column_name`) with
+      cur_paths, otherwise Cost Explorer dimensions or ``tag:<Key>``
+  :param days: The number of days of Cost Explorer data to rank
+  :param cur_paths: CUR files to rank instead of Cost Explorer data
+  :param line_item_types: Only include these CUR line item types
+  :param processes: The number of worker processes used to parse CUR files
+  :param capacity: The number of groups tracked; beyond it, costs are estimated
+  """
+  summary = topk.SpaceSaving(k, capacity)
+  with stats.span('top'):
+    if cur_paths:
+      query = cur.Query(group_by=fields, line_item_types=line_item_types)
+      for partial in cur.iter_partials(cur_paths, query, processes=processes):
+        summary.update(partial)
     else:
-      kwargs = {}
-    data = boto3.client('ce').get_cost_and_usage(TimePeriod={'Start': start, 'End':  end}, Granularity='WEEKLY', Metrics=['UnblendedCost'], GroupBy=[{'Type': 'DIMENSION', 'Key': 'LINKED_ACCOUNT'}, {'Type': 'DIMENSION', 'Key': 'INSTANCE_TYPE'}], **kwargs)
-    results += data['ResultsByTime']
-    token = data.get('NextPageToken')
-    if not token:
-      break
+      now = datetime.datetime.utcnow()
+      eng = engine.Engine()
+      eng.run(cost=eng.fetch_cost(
+        (now - datetime.timedelta(days=days)).strftime('%Y-%m-%d'), now.strftime('%Y-%m-%d'),
+        granularity='MONTHLY', group_by=topk.cost_explorer_group_by(fields),
+        on_result=topk.cost_explorer_updater(summary)))
+
+  print('\t'.join(list(fields) + ['UnblendedCost', 'MaxError']))
+  for key, cost, error in summary.top():
+    print('\t'.join(list(key) + ['%.6f' % cost, '%.6f' % error]))
 
-  print('\t'.join(['TimePeriod', 'LinkedAccount', 'InstanceType', 'Amount', 'Unit', 'Estimated']))
-  for result_by_time in results:
-    for group in result_by_time['Groups']:
-      amount = group['Metrics']['UnblendedCost']['Amount']
-      unit = group['Metrics']['UnblendedCost']['Unit']
-      print(result_by_time['TimePeriod']['Start'], '\t', '\t'.join(group['Keys']), '\t', amount, '\t', unit, '\t', result_by_time['Estimated'])
+
+def print_anomalies(rollup=None, window=anomaly.DEFAULT_WINDOW,
+                    threshold=anomaly.DEFAULT_THRESHOLD, min_delta=anomaly.DEFAULT_MIN_DELTA,
+                    last_days=1):
+  """
+  Prints daily cost series whose most recent days jump above their rolling baseline.
+
+  Series are per account, instance type, environment and purpose when read from a cube built
+  from CUR files; from Cost Explorer they are per account and instance type only.
+
+  :param rollup: A :py:class:`cube.Cube` to read the series from, instead of Cost Explorer
+  :param window: The number of previous days each day is compared with
+  :param threshold: Robust standard deviations above baseline that count as anomalous
+  :param min_delta: The minimum cost increase over baseline that counts as anomalous
+  :param last_days: Only report anomalies on this many most recent days
+  """
+  fields = ['account', 'instance_type', 'env', 'purpose']
+  end = datetime.datetime.utcnow().date()
+  if rollup is not None and rollup.last_day():
+    end = datetime.datetime.strptime(rollup.last_day(), '%Y-%m-%d').date() + datetime.timedelta(1)
+  since = (end - datetime.timedelta(days=last_days + window)).isoformat()
+  if rollup is not None:
+    rows = rollup.query(['day'] + fields, since=since)
+  else:
+    eng = engine.Engine()
+    results = eng.run(cost=eng.fetch_cost(since, end.isoformat(), **cube.COST_QUERY))
+    rows = [row[:3] + row[-1:] for row in cube.rows_from_cost_results(results['cost'])]
+    fields = fields[:2]
+
+  print('\t'.join(['Day'] + fields + ['Cost', 'Baseline', 'Delta', 'Score']))
+  for a in anomaly.detect(rows, window=window, threshold=threshold, min_delta=min_delta,
+                          last_days=last_days):
+    print('\t'.join([a.day] + list(a.key) + ['%.2f' % a.cost, '%.2f' % a.baseline,
+                                              '%.2f' % a.delta, '%.1f' % a.score]))
+
+
+def print_coverage(instances, reserved_instances, savings_plans, catalog=None,
+                   all_instances=None):
+  """
+  Prints the instance-hours per day covered by reserved instances and Savings Plans, and those
+  left uncovered, by environment and purpose.
+
+  :param instances: The instances to report on, e.g. those matching --env and --filter
+  :param catalog: A :py:class:`pricing.PriceCatalog`; Savings Plans are only applied with one
+  :param all_instances: The whole fleet, which the account's reservations and Savings Plans are
+      applied to; defaults to instances
+  """
+  result = reservations.match(all_instances if all_instances is not None else instances,
+                              reserved_instances, savings_plans, catalog)
+  print('\t'.join(['Environment', 'Purpose', 'Instances', 'Reserved Hours', 'Savings Plan Hours',
+                   'Uncovered Hours']))
+  for env, purpose, count, reserved, saved, uncovered in reservations.summarize(instances, result):
+    print('\t'.join([env, purpose, str(count), '%.1f' % reserved, '%.1f' % saved,
+                     '%.1f' % uncovered]))
+  for family, units in sorted(result.unused_units.items()):
+    print('Unused regional reservations: %s, %.1f normalized units' % (family, units))
+  for instance_type, count in sorted(result.unused_instances.items()):
+    print('Unused reservations: %d x %s' % (count, instance_type))
+  if result.unused_commitment:
+    print('Unused Savings Plans commitment: $%.2f/hour' % result.unused_commitment)
+  if savings_plans and catalog is None:
+    print('Savings Plans were not applied; pass --price_catalog to include them')
+
+
+def print_instance_hours(states, group_by, since=None, until=None):
+  """
+  Prints the instance-hours spent running per role, owner or type, from the state history.
+
+  :param states: A :py:class:`history.StateHistory`
+  :param group_by: One of :py:data:`history.ATTRIBUTES`
+  :param since: The first day to count, YYYY-MM-DD; defaults to the beginning of history
+  :param until: The day to count up to (exclusive), YYYY-MM-DD; defaults to the last snapshot
+  """
+  def timestamp(day):
+    return datetime.datetime.strptime(day, '%Y-%m-%d').replace(
+      tzinfo=datetime.timezone.utc).timestamp() if day else None
+
+  hours = states.instance_hours(timestamp(since), timestamp(until), group_by=group_by)
+  print('\t'.join([group_by.capitalize(), 'Instance Hours']))
+  for value, total in sorted(hours.items(), key=lambda item: item[1], reverse=True):
+    print('\t'.join([value or '(none)', '%.1f' % total]))
+
+
+def parse_as_of(as_of, where=None):
+  """
+  :param as_of: YYYY-MM-DD or YYYY-MM-DDTHH:MM, in UTC
+  :param where: Comma separated column=value filters, or None
+  :return: A tuple of (UTC datetime, dict of filters on :py:data:`inventory.WHERE_COLUMNS`)
+  :raises ValueError: If either is malformed
+  """
+  try:
+    at = datetime.datetime.strptime(as_of, '%Y-%m-%dT%H:%M' if 'T' in as_of else '%Y-%m-%d')
+  except ValueError:
+    raise ValueError('--as_of must be YYYY-MM-DD or YYYY-MM-DDTHH:MM, not %r' % as_of)
+  filters = {}
+  for term in where.split(',') if where else []:
+    column, equals, value = term.partition('=')
+    if not equals or column not in inventory.WHERE_COLUMNS:
+      raise ValueError('--as_of_where terms must be column=value, column one of %s, not %r' % (
+        ', '.join(inventory.WHERE_COLUMNS), term))
+    filters[column] = value
+  return at.replace(tzinfo=datetime.timezone.utc), filters
+
+
+def print_inventory_as_of(inv, at, where=None):
+  """
+  Prints the inventory as it was at a point in time.
+
+  :param inv: An :py:class:`inventory.Inventory`
+  :param at: A UTC datetime
+  :param where: Equality filters on :py:data:`inventory.WHERE_COLUMNS`
+  """
+  rows = inv.as_of(at, **(where or {}))
+  if rows:
+    print('Snapshot of %s' % datetime.datetime.fromtimestamp(
+      rows[0].taken_at, datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC'))
+  print('\t'.join(inventory.COLUMNS))
+  for row in rows:
+    print('\t'.join(row[1:]))
+
+
+def print_lookup(index, expression):
+  """
+  Prints the instances matching a lookup, answered from an inventory index.
+
+  :param index: A :py:class:`lookup.InventoryIndex`
+  :param expression: See :py:func:`lookup.search`
+  """
+  def day(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime(
+      '%Y-%m-%d %H:%M:%S') if timestamp is not None else ''
+
+  with stats.span('lookup.search'):
+    entries = lookup.search(index, expression)
+  print('Snapshot of %s UTC, %d instances' % (day(index.taken_at), len(index)))
+  print('\t'.join(['ID', 'Hostname', 'Private IP', 'State', 'Instance Type', 'Zone', 'Launch date',
+                   'Stopped Time', 'Owner']))
+  for e in entries:
+    print('\t'.join([e.instance_id, e.host, e.private_ip, e.state, e.instance_type, e.zone,
+                     day(e.launch_time), day(e.stopped_time),
+                     e.tags.get(config.INSTANCE_OWNER_KEY, '')]))
+
+
+def print_subnet_mismatches(instances, network_cache):
+  """
+  Prints the pending, running and stopped instances whose subnet does not match
+  SUBNET_COMPATIBILITY_MAP.
+
+  :param network_cache: A :py:class:`network.NetworkCache` refreshed for the instances
+  """
+  mismatches = []
+  with stats.span('network.check'):
+    for instance in instances:
+      if instance['State']['Name'] not in network.CHECKED_STATES:
+        continue
+      expected = network_cache.check_subnet(instance)
+      if expected not in (network.SUBNET_OK, network.SUBNET_UNKNOWN):
+        subnet = network_cache.subnet(instance['SubnetId'])
+        mismatches.append([instance['InstanceId'], utils.generate_host(instance),
+                           instance['State']['Name'], subnet['name'], expected])
+  stats.incr('subnet_mismatches', len(mismatches))
+  if not mismatches:
+    return
+  print('%d instances are outside their expected subnets' % len(mismatches))
+  print('\t'.join(['ID', 'Hostname', 'State', 'Subnet', 'Expected Subnet']))
+  for row in mismatches:
+    print('\t'.join(row))
+
+
+def print_dns_plan(dns_plan, zone):
+  """
+  Prints the changes that reconcile the managed zone with the inventory.
+
+  :param dns_plan: A :py:class:`route53.Plan`
+  :param zone: The zone name
+  """
+  print('%s: %d to create, %d to update, %d to delete, %d up to date' % (
+    zone, dns_plan.creates, dns_plan.updates, dns_plan.deletes, dns_plan.unchanged))
+  for change in dns_plan.changes:
+    record_set = change['ResourceRecordSet']
+    print('\t'.join([change['Action'], record_set['Name'],
+                     ','.join(r['Value'] for r in record_set.get('ResourceRecords', []))]))
+  if dns_plan.skipped:
+    print('%d instances get no record, their generated name not being a valid managed name:' %
+          len(dns_plan.skipped), file=sys.stderr)
+    for name in dns_plan.skipped:
+      print('\t%s' % name, file=sys.stderr)
+
+
+def print_asg_summary(summaries, fname=None, resource_costs=None, catalog=None):
+  """
+  Prints one row per Auto Scaling group, or writes them to a TSV file.
+
+  :param summaries: :py:class:`asg.GroupSummary` tuples
+  :param fname: The file to write to instead of printing
+  """
+  with stats.span('asg.print'):
+    lines = ['\t'.join(asg.summary_header(resource_costs, catalog))]
+    lines.extend('\t'.join(asg.summary_row(s, resource_costs, catalog)) for s in summaries)
+    if fname:
+      with open(fname, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    else:
+      print('\n'.join(lines))
 
 
 parser = argparse.ArgumentParser()
-# parser.add_argument('--days', type=int, default=30)
+parser.add_argument('--days', type=int, default=None,
+                    help='Also print the cost per instance type for the last N days')
 parser.add_argument('--output_file', type=str, default=None)
-parser.add_argument('--env', type=str, default="staging")
+parser.add_argument('--env', type=str, default=None)
+parser.add_argument('--fixture', type=str, default=None,
+                    help='Replay AWS responses from a recorded JSON fixture instead of calling AWS')
+parser.add_argument('--record', type=str, default=None,
+                    help='Record all AWS responses to a JSON fixture for later replay')
+parser.add_argument('--fake_page_size', type=int, default=100)
+parser.add_argument('--fake_latency', type=float, default=0.0)
+parser.add_argument('--fake_throttle_rate', type=float, default=0.0)
+parser.add_argument('--stats', action='store_true', help='Print per-stage timings and API stats')
+parser.add_argument('--stats_format', choices=('text', 'json', 'prometheus'), default='text')
+parser.add_argument('--stats_file', type=str, default=None,
+                    help='Write the stats to this file instead of stderr')
+parser.add_argument('--daemon', action='store_true',
+                    help='Keep the inventory in memory and serve queries over HTTP')
+parser.add_argument('--port', type=int, default=8080)
+parser.add_argument('--refresh_interval', type=int, default=300,
+                    help='Seconds between inventory refreshes in --daemon mode')
+parser.add_argument('--cur', type=str, nargs='+', default=None,
+                    help='Aggregate locally downloaded CUR files (.csv.gz or .parquet) instead of '
+                         'querying the instance inventory')
+parser.add_argument('--cur_group_by', type=str, default=','.join(cur.DEFAULT_GROUP_BY),
+                    help='Comma separated CUR fields to group by, e.g. usage_date,tag:InstanceOwner')
+parser.add_argument('--cur_line_item_types', type=str, default=None,
+                    help='Comma separated line item types to include, e.g. Usage,DiscountedUsage')
+parser.add_argument('--cur_manifest', type=str, nargs='+', default=None,
+                    help='Incrementally fold the CUR assemblies of these local manifests into '
+                         '--cur_state, parsing only report files whose content changed')
+parser.add_argument('--cur_state', type=str, default='cur_state.json',
+                    help='The file incremental CUR aggregates are kept in')
+parser.add_argument('--cur_costs', type=str, nargs='+', default=None,
+                    help='Add each instance\'s month-to-date cost (compute and EBS) from these CUR '
+                         'files to --output_file')
+parser.add_argument('--cube', type=str, default=None,
+                    help='A SQLite cost cube to update and/or query instead of the instance inventory')
+parser.add_argument('--cube_update', action='store_true',
+                    help='Append the days missing from --cube, from --cur files if given, otherwise '
+                         'from Cost Explorer (the last --days days for a new cube)')
+parser.add_argument('--cube_group_by', type=str, default=None,
+                    help='Comma separated cube dimensions to roll up to, e.g. env,purpose')
+parser.add_argument('--cube_where', type=str, default=None,
+                    help='Comma separated dimension=value slices, e.g. env=staging,owner=team-search')
+parser.add_argument('--cube_since', type=str, default=None, help='First day to roll up, YYYY-MM-DD')
+parser.add_argument('--cube_until', type=str, default=None, help='Day to stop before, YYYY-MM-DD')
+parser.add_argument('--top', type=int, default=None,
+                    help='Print the N most expensive groups (see --top_by) over --days days of '
+                         'Cost Explorer data, or over the --cur files if given')
+parser.add_argument('--top_by', type=str, default=None,
+                    help='Comma separated fields to rank: Cost Explorer dimensions or tag:<Key>, '
+                         'or CUR fields with --cur, e.g. resource_id or tag:InstanceOwner; '
+                         'defaults to INSTANCE_TYPE, or instance_type with --cur')
+parser.add_argument('--top_capacity', type=int, default=topk.DEFAULT_CAPACITY,
+                    help='Groups tracked by --top; with more groups, costs are estimated and '
+                         'MaxError is non-zero')
+parser.add_argument('--anomalies', action='store_true',
+                    help='Print cost series that jumped above their rolling baseline, from --cube '
+                         'if given, otherwise from Cost Explorer')
+parser.add_argument('--anomaly_days', type=int, default=1,
+                    help='Report anomalies on this many most recent days')
+parser.add_argument('--anomaly_window', type=int, default=anomaly.DEFAULT_WINDOW,
+                    help='Days of history each day is compared with')
+parser.add_argument('--anomaly_threshold', type=float, default=anomaly.DEFAULT_THRESHOLD,
+                    help='Robust standard deviations above baseline that count as anomalous')
+parser.add_argument('--anomaly_min_delta', type=float, default=anomaly.DEFAULT_MIN_DELTA,
+                    help='Minimum cost increase over baseline that counts as anomalous')
+parser.add_argument('--price_catalog', type=str, default=None,
+                    help='A binary price catalog to add estimated hourly and monthly cost columns '
+                         'to --output_file from')
+parser.add_argument('--build_price_catalog', type=str, default=None,
+                    help='Build --price_catalog from this local EC2 bulk pricing offer file (JSON)')
+parser.add_argument('--coverage', action='store_true',
+                    help='Print reserved instance and Savings Plans coverage of the running '
+                         'instances by environment and purpose')
+parser.add_argument('--utilization', action='store_true',
+                    help='Add CloudWatch CPU/network utilization and rightsizing suggestions to '
+                         '--output_file')
+parser.add_argument('--utilization_days', type=int, default=utilization.DEFAULT_DAYS)
+parser.add_argument('--utilization_cache', type=str, default='utilization_cache.json',
+                    help='The file CloudWatch datapoints are cached in between runs')
+parser.add_argument('--history', type=str, default=None,
+                    help='A state history file each inventory snapshot is recorded into')
+parser.add_argument('--instance_hours', type=str, default=None, choices=history.ATTRIBUTES,
+                    help='Print the instance-hours spent running per role, owner, type, env or '
+                         'purpose from --history')
+parser.add_argument('--hours_since', type=str, default=None, help='YYYY-MM-DD')
+parser.add_argument('--hours_until', type=str, default=None, help='YYYY-MM-DD, exclusive')
+parser.add_argument('--inventory', type=str, default=None,
+                    help='A SQLite file each inventory snapshot is recorded into')
+parser.add_argument('--as_of', type=str, default=None,
+                    help='Print the inventory recorded in --inventory as of YYYY-MM-DD[THH:MM] UTC')
+parser.add_argument('--as_of_where', type=str, default=None,
+                    help='Comma separated column=value filters of --as_of, e.g. '
+                         'instance_id=i-0123456789abcdef0 or env=staging,owner=bob')
+parser.add_argument('--export_dir', type=str, default=None,
+                    help='Also append the inventory and cost to partitioned Parquet datasets under '
+                         'this directory (requires pyarrow)')
+parser.add_argument('--filter', type=str, default=None,
+                    help='Only report instances matching a filter expression, e.g. '
+                         '"owner=~team-* and state=stopped and stopped_days>30 and type in (m3.*)"')
+parser.add_argument('--lookup_index', type=str, default=None,
+                    help='A file the indexed inventory snapshot is saved to on every fetch, and '
+                         '--lookup answers from')
+parser.add_argument('--lookup', type=str, default=None,
+                    help='Look up an instance ID, private IP or hostname, or comma separated '
+                         'conditions such as env=staging,purpose=bastion or owner=bob,'
+                         'stopped<2024-01-01, in --lookup_index without fetching the inventory')
+parser.add_argument('--outputs', type=str, default=None,
+                    help='Also stream the inventory to several outputs from the same fetch: comma '
+                         'separated kind=path pairs, kind one of %s and path - for stdout, e.g. '
+                         'tsv=instances.tsv,hosts=-,json=instances.json,sqlite=inventory.sqlite'
+                         % ', '.join(pipeline.KINDS))
+parser.add_argument('--output_buffer_pages', type=int, default=pipeline.DEFAULT_BUFFER_PAGES,
+                    help='Pages of instances each --outputs output may fall behind the fetch by')
+parser.add_argument('--roledefs', type=str, default=None,
+                    help='Print Fabric roledefs of the running instances, merged with the static '
+                         'ones, as JSON; they are cached in this file for --roledefs_ttl seconds')
+parser.add_argument('--roledefs_ttl', type=int, default=roledefs.DEFAULT_TTL)
+parser.add_argument('--roledefs_refresh', action='store_true',
+                    help='Rebuild --roledefs even if the cached ones are recent')
+parser.add_argument('--reconcile_dns', action='store_true',
+                    help='Print the Route 53 changes that make the %s records match the '
+                         'inventory: one A record per instance, from its hostname to its private IP'
+                         % config.MANAGED_SUBDOMAIN)
+parser.add_argument('--apply_dns', action='store_true',
+                    help='Apply the --reconcile_dns changes in batched '
+                         'ChangeResourceRecordSets calls')
+parser.add_argument('--dns_ttl', type=int, default=route53.DEFAULT_TTL)
+parser.add_argument('--network', action='store_true',
+                    help='Add zone, subnet, VPC and security group columns to --output_file, and '
+                         'print the instances outside the subnets SUBNET_COMPATIBILITY_MAP expects')
+parser.add_argument('--network_cache', type=str, default='network_cache.json',
+                    help='The file subnets, VPCs and security groups are cached in between runs')
+parser.add_argument('--network_max_age', type=int, default=network.DEFAULT_MAX_AGE_DAYS,
+                    help='Days after which cached subnets, VPCs and security groups are refetched')
+parser.add_argument('--images', action='store_true',
+                    help='Add the name, creation date and age of each instance\'s AMI to '
+                         '--output_file')
+parser.add_argument('--image_cache', type=str, default='image_cache.json',
+                    help='The file AMI metadata is cached in, permanently')
+parser.add_argument('--image_recheck_days', type=int, default=images.MISSING_RECHECK_DAYS,
+                    help='Days after which AMIs describe_images did not return are asked for again')
+parser.add_argument('--asg', action='store_true',
+                    help='Summarize the members of each Auto Scaling group in one row instead of '
+                         'listing them in --output_file')
+parser.add_argument('--asg_output', type=str, default=None,
+                    help='Write the --asg summary to this TSV file instead of printing it')
+parser.add_argument('--asg_drilldown', type=str, default=None,
+                    help='Comma separated Auto Scaling groups whose members are still listed one '
+                         'per row in --output_file')
+parser.add_argument('--processes', type=int, default=None)
 args = parser.parse_args()
-instance_query(environment=args.env, fname=args.output_file)
+if args.build_price_catalog and not args.price_catalog:
+  parser.error('--build_price_catalog needs --price_catalog to write to')
+if args.instance_hours and not args.history:
+  parser.error('--instance_hours needs --history to read from')
+if args.as_of and not args.inventory:
+  parser.error('--as_of needs --inventory to read from')
+if args.as_of:
+  try:
+    as_of_at, as_of_where = parse_as_of(args.as_of, args.as_of_where)
+  except ValueError as e:
+    parser.error(str(e))
+if args.top:
+  if args.top_by is None:
+    args.top_by = 'instance_type' if args.cur else 'INSTANCE_TYPE'
+  try:
+    if args.cur:
+      for field in args.top_by.split(','):
+        cur.column_name(field)
+    else:
+      topk.cost_explorer_group_by(args.top_by.split(','))
+  except ValueError as e:
+    parser.error(str(e))
+if args.lookup and not args.lookup_index:
+  parser.error('--lookup needs --lookup_index to read from')
+if args.apply_dns and not args.reconcile_dns:
+  parser.error('--apply_dns needs --reconcile_dns')
+if args.reconcile_dns and (args.filter or args.env):
+  # Records of the instances filtered out would be deleted
+  parser.error('--reconcile_dns needs the whole inventory, without --filter or --env')
 
-# now = datetime.datetime.utcnow()
-# start = (now - datetime.timedelta(days=args.days)).strftime('%Y-%m-%d')
-# end = now.strftime('%Y-%m-%d')
+if args.fixture:
+  backend.set_backend(backend.FakeBackend.from_fixture(
+    args.fixture, page_size=args.fake_page_size, latency=args.fake_latency,
+    throttle_rate=args.fake_throttle_rate))
+elif args.record:
+  backend.set_backend(backend.RecordingBackend())
+backend.set_backend(backend.InstrumentedBackend(backend.get_backend()))
+
+if args.build_price_catalog:
+  print('Wrote %d prices to %s' % (
+    pricing.build_catalog(args.build_price_catalog, args.price_catalog), args.price_catalog))
+
+if args.daemon:
+  daemon.Daemon(port=args.port, refresh_interval=args.refresh_interval,
+                days=args.days or 30).serve_forever()
+  sys.exit(0)
+
+if args.roledefs:
+  print(json.dumps(roledefs.RoledefCache(args.roledefs, ttl=args.roledefs_ttl).get(
+    refresh=args.roledefs_refresh), indent=2, sort_keys=True))
+  sys.exit(0)
+
+if args.cube:
+  rollup = cube.Cube(args.cube)
+  if args.cube_update:
+    update_cube(rollup, days=args.days, cur_paths=args.cur, processes=args.processes)
+  if args.cube_group_by is not None or args.cube_where:
+    print_cube_rollup(rollup, args.cube_group_by.split(',') if args.cube_group_by else [],
+                      since=args.cube_since, until=args.cube_until,
+                      where=dict(term.split('=', 1) for term in args.cube_where.split(','))
+                      if args.cube_where else None)
+if args.anomalies:
+  print_anomalies(rollup if args.cube else None, window=args.anomaly_window,
+                  threshold=args.anomaly_threshold, min_delta=args.anomaly_min_delta,
+                  last_days=args.anomaly_days)
+if args.cube:
+  rollup.close()
+
+if args.top:
+  print_top_costs(args.top, args.top_by.split(','), days=args.days or 30, cur_paths=args.cur,
+                  line_item_types=args.cur_line_item_types.split(',')
+                  if args.cur_line_item_types else None, processes=args.processes,
+                  capacity=args.top_capacity)
+
+cur_group_by = args.cur_group_by.split(',')
+cur_query = cur.Query(group_by=cur_group_by, line_item_types=(
+  args.cur_line_item_types.split(',') if args.cur_line_item_types else None))
+if args.cur and not args.top and not args.cube:
+  print_cur_costs(cur.ingest(args.cur, cur_query, processes=args.processes), cur_group_by)
+if args.cur_manifest:
+  incremental = cur_manifest.IncrementalCur(args.cur_state, cur_query)
+  incremental.refresh(args.cur_manifest, processes=args.processes)
+  incremental.save()
+  print_cur_costs(incremental.totals, cur_group_by)
+
+# The filter is compiled once; its equality terms narrow the inventory fetch on the API side,
+# unless the inventory is being recorded: instances filtered out of a snapshot would look
+# terminated to the history, inventory and lookup index, so those always get the whole fleet.
+# So does coverage, as reservations and Savings Plans apply to the whole account.
+instance_filter = filters.Filter(filters.conjoin(args.filter, env=args.env))
+sinks = []
+
+fetch_inventory = not (args.cur or args.cur_manifest or args.cube or args.top or args.anomalies or
+                       args.instance_hours or args.as_of or args.lookup)
+resource_costs = None
+if fetch_inventory and args.cur_costs and (args.output_file or args.export_dir or args.outputs or
+                                           args.asg):
+  with stats.span('cur.resource_costs'):
+    resource_costs = cur.resource_costs(args.cur_costs, since=datetime.datetime.utcnow().strftime(
+      '%Y-%m-01'), processes=args.processes)
+catalog = pricing.PriceCatalog(args.price_catalog) if args.price_catalog else None
+if fetch_inventory and args.outputs:
+  sinks = pipeline.from_spec(args.outputs, resource_costs=resource_costs, catalog=catalog,
+                             at=time.time())
+records_inventory = bool(args.history or args.inventory or args.lookup_index or
+                         any(sink.records for sink in sinks))
+api_filters = None if records_inventory or args.coverage else instance_filter.api_filters
+
+# The inventory and cost fetches are independent, so they run concurrently.
+eng = engine.Engine()
+fetches = {}
+fan_out = None
+# With nothing but --outputs to write, the instances are streamed to them and never held in full
+keep_instances = not sinks or bool(args.output_file or args.export_dir or args.asg or
+                                   args.reconcile_dns or args.network or args.images or
+                                   args.coverage or args.history or args.inventory or
+                                   args.lookup_index)
+kept_instances = []
+if fetch_inventory:
+  print("Running instance query")
+  on_page = None
+  if sinks:
+    # Every --outputs artifact is written from the pages of this one fetch, as they arrive
+    fan_out = pipeline.FanOut(sinks, buffer_pages=args.output_buffer_pages,
+                              select=lambda page: list(instance_filter.apply(
+                                page, fetched_with_api_filters=api_filters is not None)))
+    fan_out.open()
+
+    async def on_page(page):
+      if keep_instances:
+        kept_instances.extend(page)
+      await fan_out.write(page)
+  fetches['instances'] = eng.fetch_instances(api_filters, on_page=on_page)
+  if args.reconcile_dns:
+    fetches['zone'] = eng.fetch_zone(config.MANAGED_SUBDOMAIN)
+  if args.asg:
+    fetches['asgs'] = eng.fetch_auto_scaling_groups()
+if args.coverage:
+  fetches['reservations'] = eng.fetch_reservations()
+  fetches['savings_plans'] = eng.fetch_savings_plans()
+if args.days and not args.top:
+  now = datetime.datetime.utcnow()
+  start = (now - datetime.timedelta(days=args.days)).strftime('%Y-%m-%d')
+  end = now.strftime('%Y-%m-%d')
+  fetches['cost'] = eng.fetch_cost(start, end, **COST_QUERY)
+results = {}
+if fetches:
+  with stats.span('fetch'):
+    try:
+      results = eng.run(**fetches)
+    except BaseException:
+      # Rolls back the SQLite output and stops the sink threads rather than leave them waiting
+      if fan_out is not None:
+        fan_out.abort()
+      raise
+if fan_out is not None:
+  with stats.span('pipeline.close'):
+    fan_out.close()
+  if keep_instances:
+    results['instances'] = kept_instances
+  else:
+    del results['instances']
+
+if 'instances' in results:
+  # Everything below reports on the instances matching --env and --filter only, except the
+  # inventory stores, which record the whole fleet
+  all_instances = results['instances']
+  with stats.span('filter'):
+    results['instances'] = list(instance_filter.apply(
+      all_instances, fetched_with_api_filters=api_filters is not None))
+  usage = None
+  if args.utilization and (args.output_file or args.export_dir):
+    with stats.span('utilization'):
+      usage = utilization.collect(results['instances'], days=args.utilization_days,
+                                  cache=utilization.MetricCache(args.utilization_cache))
+  network_cache = None
+  if args.network:
+    with stats.span('network'):
+      network_cache = network.NetworkCache(args.network_cache, max_age_days=args.network_max_age)
+      network_cache.refresh(results['instances'], eng)
+      network_cache.save()
+  image_cache = None
+  if args.images:
+    with stats.span('images'):
+      image_cache = images.ImageCache(args.image_cache,
+                                      missing_recheck_days=args.image_recheck_days)
+      image_cache.refresh(results['instances'], eng)
+      image_cache.save()
+  detailed = results['instances']
+  if 'asgs' in results:
+    # Group members are reported as one summary per group; only the rest go to --output_file
+    summaries, detailed = asg.aggregate(
+      results['instances'], results['asgs'], resource_costs=resource_costs, catalog=catalog,
+      drilldown=args.asg_drilldown.split(',') if args.asg_drilldown else ())
+    print_asg_summary(summaries, fname=args.asg_output, resource_costs=resource_costs,
+                      catalog=catalog)
+  instance_query(fname=args.output_file, instances=detailed,
+                 resource_costs=resource_costs, catalog=catalog, usage=usage,
+                 network_cache=network_cache, image_cache=image_cache)
+  if network_cache is not None:
+    print_subnet_mismatches(results['instances'], network_cache)
+  if args.export_dir:
+    export.export_instances(results['instances'], os.path.join(args.export_dir, 'instances'),
+                            resource_costs=resource_costs, catalog=catalog, utilization=usage)
+
+if 'zone' in results:
+  zone_id, record_sets = results['zone']
+  dns_plan = route53.plan(results['instances'], record_sets, ttl=args.dns_ttl)
+  print_dns_plan(dns_plan, config.MANAGED_SUBDOMAIN)
+  if args.apply_dns and dns_plan.changes:
+    dns_batches = route53.batches(dns_plan.changes)
+    eng.run(changes=eng.change_record_sets(zone_id, dns_batches,
+                                           comment='aws-cost-and-usage-report --reconcile_dns'))
+    print('Applied %d changes in %d batches' % (len(dns_plan.changes), len(dns_batches)))
+
+if args.lookup_index and 'instances' in results:
+  lookup.InventoryIndex.from_instances(all_instances).save(args.lookup_index)
+
+if args.lookup:
+  try:
+    print_lookup(lookup.InventoryIndex.load(args.lookup_index), args.lookup)
+  except ValueError as e:
+    parser.error(str(e))
+
+if args.history and 'instances' in results:
+  states = history.StateHistory(args.history)
+  states.record(all_instances, time.time())
+  states.save()
+
+if args.inventory and 'instances' in results:
+  inv = inventory.Inventory(args.inventory)
+  inv.record(all_instances, time.time())
+  inv.close()
+
+if args.as_of:
+  inv = inventory.Inventory(args.inventory)
+  print_inventory_as_of(inv, as_of_at, where=as_of_where)
+  inv.close()
+
+if args.instance_hours:
+  print_instance_hours(history.StateHistory(args.history), args.instance_hours,
+                       since=args.hours_since, until=args.hours_until)
+
+if args.coverage and 'instances' in results:
+  with stats.span('coverage'):
+    print_coverage(results['instances'], results['reservations'], results['savings_plans'],
+                   catalog=catalog, all_instances=all_instances)
+
+if 'cost' in results:
+  print_pricing_per_instance_type(start, end, results=results['cost'])
+  if args.export_dir:
+    export.export_cost(results['cost'], os.path.join(args.export_dir, 'cost'))
+
+if args.record:
+  backend.get_backend().save(args.record)
+
+if args.stats or args.stats_file:
+  if args.stats_file:
+    with open(args.stats_file, 'w') as f:
+      f.write(stats.REGISTRY.render(args.stats_format))
+  else:
+    print(stats.REGISTRY.render(args.stats_format), file=sys.stderr)
 
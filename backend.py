@@ -0,0 +1,818 @@
+#!/usr/bin/env python3
+"""
+Pluggable AWS backends for the cost and usage report scripts.
+
+Every AWS call goes through ``get_backend().client(service)``. By default this hands out real
+boto3 clients, but a :py:class:`FakeBackend` can be installed with :py:func:`set_backend` to
+serve recorded or synthetic pages locally, so that pagination and concurrency work can be
+measured reproducibly without credentials or network access.
+
+"""
+
+import bisect
+import collections
+import datetime
+import fnmatch
+import functools
+import json
+import random
+import re
+import threading
+import time
+import zlib
+
+import boto3
+from botocore.exceptions import ClientError
+
+import config
+import fleet
+import stats
+
+
+FAKE_ACCOUNT_ID = '123456789012'
+
+_backend = None
+
+_DATETIME_RE = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?([+-]\d{2}:\d{2})?$')
+
+
+class Boto3Backend(object):
+  """
+  Hands out real boto3 clients, creating one per service on first use.
+  """
+
+  def __init__(self, **client_kwargs):
+    self.client_kwargs = client_kwargs
+    self._clients = {}
+    self._lock = threading.Lock()
+
+  def client(self, service):
+    with self._lock:
+      if service not in self._clients:
+        self._clients[service] = boto3.client(service, **self.client_kwargs)
+      return self._clients[service]
+
+
+class RecordingBackend(object):
+  """
+  Wraps another backend and records every response so that it can be replayed later with
+  :py:meth:`FakeBackend.from_fixture`.
+  """
+
+  def __init__(self, backend=None):
+    self.backend = backend or Boto3Backend()
+    self.responses = collections.defaultdict(lambda: collections.defaultdict(list))
+    self._lock = threading.Lock()
+
+  def client(self, service):
+    return _RecordingClient(self, service, self.backend.client(service))
+
+  def record(self, service, operation, response):
+    response = {k: v for k, v in response.items() if k != 'ResponseMetadata'}
+    with self._lock:
+      self.responses[service][operation].append(response)
+
+  def save(self, fname):
+    """
+    Writes the recorded responses to a JSON fixture file.
+
+    :param fname: The fixture file to write
+    """
+    with open(fname, 'w') as f:
+      json.dump(self.responses, f, default=_json_default, indent=1, sort_keys=True)
+
+
+class _RecordingClient(object):
+
+  def __init__(self, recorder, service, client):
+    self._recorder = recorder
+    self._service = service
+    self._client = client
+
+  def __getattr__(self, name):
+    method = getattr(self._client, name)
+    if not callable(method):
+      return method
+
+    @functools.wraps(method)
+    def call(*args, **kwargs):
+      response = method(*args, **kwargs)
+      if isinstance(response, dict):
+        self._recorder.record(self._service, name, response)
+      return response
+    return call
+
+
+class InstrumentedBackend(object):
+  """
+  Wraps another backend and records every API call in :py:mod:`stats`: call and error counts,
+  response bytes (when the HTTP headers report them) and a latency histogram per operation.
+  """
+
+  def __init__(self, backend):
+    self.backend = backend
+
+  def __getattr__(self, name):
+    return getattr(self.backend, name)
+
+  def client(self, service):
+    return _InstrumentedClient(service, self.backend.client(service))
+
+
+class _InstrumentedClient(object):
+
+  def __init__(self, service, client):
+    self._service = service
+    self._client = client
+
+  def __getattr__(self, name):
+    method = getattr(self._client, name)
+    if not callable(method) or name.startswith(('get_paginator', 'get_waiter', 'can_paginate')):
+      return method
+
+    @functools.wraps(method)
+    def call(*args, **kwargs):
+      labels = {'service': self._service, 'operation': name}
+      stats.incr('api_calls', **labels)
+      start = time.perf_counter()
+      try:
+        response = method(*args, **kwargs)
+      except Exception:
+        stats.incr('api_errors', **labels)
+        raise
+      finally:
+        stats.observe('api_latency_seconds', time.perf_counter() - start, **labels)
+      headers = response.get('ResponseMetadata', {}).get('HTTPHeaders', {}) \
+        if isinstance(response, dict) else {}
+      if 'content-length' in headers:
+        stats.incr('api_bytes', int(headers['content-length']), **labels)
+      return response
+    return call
+
+
+class FakeBackend(object):
+  """
+  Serves ``describe_instances``, ``describe_reserved_instances``, ``describe_savings_plans``,
+  ``get_cost_and_usage`` and ``get_metric_data`` pages from memory. Metric datapoints are
+  always synthesized, AMIs are synthesized from their IDs (some as deregistered), Auto Scaling
+  groups are made up of the instances tagged with their name, and VPCs, subnets and security
+  groups default to those of :py:func:`fleet.generate_network`. Route 53 hosted zones are kept in
+  memory too, and ``change_resource_record_sets`` applies changes to them.
+
+  :param instances: Instance dicts, shaped like the ``Instances`` entries of a describe_instances
+      response
+  :param cost_results: ``ResultsByTime`` entries to serve from get_cost_and_usage. If None, costs
+      are synthesized from the running instances for whatever period is requested.
+  :param reserved_instances: ``ReservedInstances`` entries to serve from describe_reserved_instances
+  :param savings_plans: ``savingsPlans`` entries to serve from describe_savings_plans
+  :param network: A tuple of lists of (``Vpcs``, ``Subnets``, ``SecurityGroups``) entries to serve
+      from describe_vpcs, describe_subnets and describe_security_groups
+  :param hosted_zones: A dict of {zone name: [ResourceRecordSets entries]}. Defaults to the
+      :py:data:`config.MANAGED_SUBDOMAIN` zone with just its
+      :py:data:`config.MANAGED_SUBDOMAIN_RECORDS`.
+  :param page_size: The maximum number of instances or cost groups returned per page
+  :param latency: Seconds to sleep on every API call
+  :param throttle_rate: Probability (0-1) that any API call fails with a Throttling error
+  :param seed: Seed for the throttling decisions, so that runs are reproducible
+  """
+
+  def __init__(self, instances=None, cost_results=None, reserved_instances=None,
+               savings_plans=None, network=None, hosted_zones=None, page_size=100, latency=0.0,
+               throttle_rate=0.0, seed=0):
+    self.instances = list(instances or [])
+    self.vpcs, self.subnets, self.security_groups = network or fleet.generate_network()
+    self.cost_results = cost_results
+    self.reserved_instances = list(reserved_instances or [])
+    self.savings_plans = list(savings_plans or [])
+    self.page_size = page_size
+    self.latency = latency
+    self.throttle_rate = throttle_rate
+    self.calls = collections.Counter()
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+    self._clients = {
+      'ec2': FakeEC2Client(self),
+      'ce': FakeCEClient(self),
+      'savingsplans': FakeSavingsPlansClient(self),
+      'cloudwatch': FakeCloudWatchClient(self),
+      'autoscaling': FakeAutoScalingClient(self),
+      'route53': FakeRoute53Client(self, hosted_zones if hosted_zones is not None else {
+        config.MANAGED_SUBDOMAIN: [
+          dict(r, ResourceRecords=[{'Value': v} for v in r['ResourceRecords']])
+          for r in config.MANAGED_SUBDOMAIN_RECORDS]}),
+    }
+
+  @classmethod
+  def from_fixture(cls, fname, **kwargs):
+    """
+    Creates a backend that replays the responses recorded by :py:class:`RecordingBackend`.
+
+    :param fname: The JSON fixture file to load
+    :param kwargs: Any other :py:class:`FakeBackend` arguments (page size, latency, ...)
+    :return: A :py:class:`FakeBackend`
+    """
+    with open(fname) as f:
+      fixture = json.load(f, object_hook=_json_object_hook)
+
+    instances = []
+    for page in fixture.get('ec2', {}).get('describe_instances', []):
+      for reservation in page.get('Reservations', []):
+        instances.extend(reservation['Instances'])
+
+    cost_results = None
+    cost_pages = fixture.get('ce', {}).get('get_cost_and_usage')
+    if cost_pages:
+      cost_results = []
+      for page in cost_pages:
+        cost_results.extend(page.get('ResultsByTime', []))
+
+    reserved_instances = []
+    for page in fixture.get('ec2', {}).get('describe_reserved_instances', []):
+      reserved_instances.extend(page.get('ReservedInstances', []))
+    savings_plans = []
+    for page in fixture.get('savingsplans', {}).get('describe_savings_plans', []):
+      savings_plans.extend(page.get('savingsPlans', []))
+
+    network = None
+    if any(fixture.get('ec2', {}).get(op) for op in _NETWORK_OPERATIONS.values()):
+      network = tuple([item for page in fixture['ec2'].get(op, []) for item in page.get(key, [])]
+                      for key, op in _NETWORK_OPERATIONS.items())
+
+    # Recorded record sets are put back in the zone of the SOA record listed with them
+    hosted_zones = None
+    record_sets = [r for page in fixture.get('route53', {}).get('list_resource_record_sets', [])
+                   for r in page.get('ResourceRecordSets', [])]
+    if record_sets:
+      hosted_zones = collections.defaultdict(list)
+      apexes = [r['Name'] for r in record_sets if r['Type'] == 'SOA']
+      for record_set in record_sets:
+        zone = max((a for a in apexes if _in_zone(record_set['Name'], a)), key=len, default=None)
+        if zone is not None:
+          hosted_zones[zone].append(record_set)
+
+    return cls(instances=instances, cost_results=cost_results,
+               reserved_instances=reserved_instances, savings_plans=savings_plans,
+               network=network, hosted_zones=hosted_zones, **kwargs)
+
+  def client(self, service):
+    if service not in self._clients:
+      raise ValueError('FakeBackend does not serve the %r service' % service)
+    return self._clients[service]
+
+  def call(self, operation):
+    """
+    Accounts for a single API call, applying the configured latency and throttling.
+
+    :param operation: The API operation name, e.g. DescribeInstances
+    """
+    with self._lock:
+      self.calls[operation] += 1
+      throttled = self.throttle_rate and self._random.random() < self.throttle_rate
+    if self.latency:
+      time.sleep(self.latency)
+    if throttled:
+      raise ClientError({'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}}, operation)
+
+  def paginate(self, items, token, max_results=None):
+    """
+    Slices one page out of a list of items.
+
+    :param items: The full list of items
+    :param token: The token returned with the previous page, or None for the first page
+    :param max_results: The caller's requested page size, capped at the backend's page size
+    :return: A tuple of (page items, next token or None)
+    """
+    start = int(token) if token else 0
+    size = min(max_results, self.page_size) if max_results else self.page_size
+    end = start + size
+    return items[start:end], (str(end) if end < len(items) else None)
+
+
+class FakeEC2Client(object):
+
+  def __init__(self, backend):
+    self.backend = backend
+
+  def describe_instances(self, Filters=None, InstanceIds=None, MaxResults=None, NextToken=None):
+    self.backend.call('DescribeInstances')
+    instances = self.backend.instances
+    if InstanceIds:
+      ids = set(InstanceIds)
+      instances = [i for i in instances if i['InstanceId'] in ids]
+    for f in Filters or []:
+      instances = [i for i in instances if _match_filter(i, f['Name'], f['Values'])]
+
+    page, token = self.backend.paginate(instances, NextToken, MaxResults)
+    response = {'Reservations': [
+      {
+        'ReservationId': 'r-' + instance['InstanceId'].split('-')[-1],
+        'OwnerId': FAKE_ACCOUNT_ID,
+        'Instances': [instance],
+      } for instance in page
+    ]}
+    if token:
+      response['NextToken'] = token
+    return response
+
+  def describe_reserved_instances(self, Filters=None, ReservedInstancesIds=None):
+    self.backend.call('DescribeReservedInstances')
+    reservations = self.backend.reserved_instances
+    if ReservedInstancesIds:
+      ids = set(ReservedInstancesIds)
+      reservations = [r for r in reservations if r['ReservedInstancesId'] in ids]
+    for f in Filters or []:
+      if f['Name'] == 'state':
+        reservations = [r for r in reservations if r['State'] in f['Values']]
+    return {'ReservedInstances': reservations}
+
+  def _describe(self, operation, resources, result_key, id_key, ids, Filters, MaxResults,
+                NextToken):
+    self.backend.call(operation)
+    if ids:
+      ids = set(ids)
+      resources = [r for r in resources if r[id_key] in ids]
+    for f in Filters or []:
+      key = _NETWORK_FILTERS.get(f['Name'])
+      if key is None:
+        raise ValueError('FakeBackend does not support the %r filter' % f['Name'])
+      resources = [r for r in resources if r.get(key) in f['Values']]
+    page, token = self.backend.paginate(resources, NextToken, MaxResults)
+    response = {result_key: page}
+    if token:
+      response['NextToken'] = token
+    return response
+
+  def describe_images(self, Filters=None, ImageIds=None, Owners=None, MaxResults=None,
+                      NextToken=None):
+    self.backend.call('DescribeImages')
+    ids = set(ImageIds or [])
+    for f in Filters or []:
+      if f['Name'] != 'image-id':
+        raise ValueError('FakeBackend does not support the %r filter' % f['Name'])
+      ids = ids.intersection(f['Values']) if ids else set(f['Values'])
+    images = [image for image in (_synthesize_image(i) for i in sorted(ids)) if image]
+    page, token = self.backend.paginate(images, NextToken, MaxResults)
+    response = {'Images': page}
+    if token:
+      response['NextToken'] = token
+    return response
+
+  def describe_subnets(self, Filters=None, SubnetIds=None, MaxResults=None, NextToken=None):
+    return self._describe('DescribeSubnets', self.backend.subnets, 'Subnets', 'SubnetId',
+                          SubnetIds, Filters, MaxResults, NextToken)
+
+  def describe_vpcs(self, Filters=None, VpcIds=None, MaxResults=None, NextToken=None):
+    return self._describe('DescribeVpcs', self.backend.vpcs, 'Vpcs', 'VpcId', VpcIds, Filters,
+                          MaxResults, NextToken)
+
+  def describe_security_groups(self, Filters=None, GroupIds=None, MaxResults=None, NextToken=None):
+    return self._describe('DescribeSecurityGroups', self.backend.security_groups, 'SecurityGroups',
+                          'GroupId', GroupIds, Filters, MaxResults, NextToken)
+
+
+class FakeSavingsPlansClient(object):
+
+  def __init__(self, backend):
+    self.backend = backend
+
+  def describe_savings_plans(self, states=None, nextToken=None, maxResults=None):
+    self.backend.call('DescribeSavingsPlans')
+    plans = [p for p in self.backend.savings_plans if not states or p['state'] in states]
+    page, token = self.backend.paginate(plans, nextToken, maxResults)
+    response = {'savingsPlans': page}
+    if token:
+      response['nextToken'] = token
+    return response
+
+
+class FakeAutoScalingClient(object):
+
+  # DescribeAutoScalingGroups limit
+  MAX_RECORDS = 100
+
+  def __init__(self, backend):
+    self.backend = backend
+
+  def _groups(self):
+    groups = collections.OrderedDict()
+    for instance in self.backend.instances:
+      name = _tags(instance).get('aws:autoscaling:groupName')
+      if not name or instance['State']['Name'] in ('shutting-down', 'terminated'):
+        continue
+      if name not in groups:
+        groups[name] = {
+          'AutoScalingGroupName': name,
+          'AutoScalingGroupARN': 'arn:aws:autoscaling:us-east-1:%s:autoScalingGroup:%s' % (
+            FAKE_ACCOUNT_ID, name),
+          'MinSize': 0, 'MaxSize': 0, 'DesiredCapacity': 0,
+          'AvailabilityZones': [], 'Instances': [],
+          'Tags': [{'Key': 'Name', 'Value': name, 'PropagateAtLaunch': True}],
+        }
+      group = groups[name]
+      zone = instance.get('Placement', {}).get('AvailabilityZone', '')
+      if zone not in group['AvailabilityZones']:
+        group['AvailabilityZones'].append(zone)
+      group['Instances'].append({
+        'InstanceId': instance['InstanceId'], 'InstanceType': instance.get('InstanceType'),
+        'AvailabilityZone': zone, 'HealthStatus': 'Healthy', 'ProtectedFromScaleIn': False,
+        'LifecycleState': 'InService' if instance['State']['Name'] == 'running' else 'Standby',
+      })
+    for group in groups.values():
+      group['MinSize'] = group['DesiredCapacity'] = len(group['Instances'])
+      group['MaxSize'] = 2 * len(group['Instances'])
+    return sorted(groups.values(), key=lambda g: g['AutoScalingGroupName'])
+
+  def describe_auto_scaling_groups(self, AutoScalingGroupNames=None, MaxRecords=None,
+                                   NextToken=None):
+    self.backend.call('DescribeAutoScalingGroups')
+    groups = self._groups()
+    if AutoScalingGroupNames:
+      groups = [g for g in groups if g['AutoScalingGroupName'] in AutoScalingGroupNames]
+    page, token = self.backend.paginate(groups, NextToken,
+                                        min(MaxRecords or self.MAX_RECORDS, self.MAX_RECORDS))
+    response = {'AutoScalingGroups': page}
+    if token:
+      response['NextToken'] = token
+    return response
+
+
+class FakeCloudWatchClient(object):
+
+  # GetMetricData limits
+  MAX_QUERIES = 500
+  MAX_DATAPOINTS = 100800
+
+  def __init__(self, backend):
+    self.backend = backend
+
+  def get_metric_data(self, MetricDataQueries, StartTime, EndTime, NextToken=None,
+                      ScanBy='TimestampDescending', MaxDatapoints=None):
+    self.backend.call('GetMetricData')
+    if len(MetricDataQueries) > self.MAX_QUERIES:
+      raise ClientError({'Error': {'Code': 'ValidationError', 'Message':
+                                   'The collection MetricDataQueries must not have a size greater '
+                                   'than %d.' % self.MAX_QUERIES}}, 'GetMetricData')
+
+    # Pages are cut between queries once the datapoint limit is reached
+    limit = min(MaxDatapoints or self.MAX_DATAPOINTS, self.MAX_DATAPOINTS)
+    position = int(NextToken) if NextToken else 0
+    results = []
+    datapoints = 0
+    while position < len(MetricDataQueries):
+      query = MetricDataQueries[position]
+      stat = query['MetricStat']
+      timestamps, values = _synthesize_datapoints(stat, StartTime, EndTime)
+      if results and datapoints + len(values) > limit:
+        break
+      results.append({'Id': query['Id'], 'Label': stat['Metric']['MetricName'],
+                      'Timestamps': timestamps, 'Values': values, 'StatusCode': 'Complete'})
+      datapoints += len(values)
+      position += 1
+
+    response = {'MetricDataResults': results, 'Messages': []}
+    if position < len(MetricDataQueries):
+      response['NextToken'] = str(position)
+    return response
+
+
+def _fqdn(name):
+  return name.lower().rstrip('.') + '.'
+
+
+def _in_zone(name, zone):
+  name, zone = _fqdn(name), _fqdn(zone)
+  return name == zone or name.endswith('.' + zone)
+
+
+def _record_key(name, type_, identifier=None):
+  # Route 53 lists record sets by name with its labels reversed, then by type
+  return (tuple(reversed(_fqdn(name).rstrip('.').split('.'))), type_, identifier or '')
+
+
+class FakeRoute53Client(object):
+
+  # ListResourceRecordSets and ChangeResourceRecordSets limits
+  MAX_ITEMS = 300
+  MAX_CHANGE_RECORDS = 1000
+  MAX_CHANGE_VALUE_CHARS = 32000
+
+  def __init__(self, backend, hosted_zones):
+    self.backend = backend
+    # zone ID -> (zone name, {record key: record set})
+    self.zones = {}
+    self._sorted_keys = {}
+    for name, record_sets in hosted_zones.items():
+      zone_id = '/hostedzone/Z%012X' % zlib.crc32(_fqdn(name).encode('utf-8'))
+      self.zones[zone_id] = (_fqdn(name), {
+        _record_key(r['Name'], r['Type'], r.get('SetIdentifier')): dict(r, Name=_fqdn(r['Name']))
+        for r in record_sets})
+
+  def _zone(self, zone_id, operation):
+    zone_id = zone_id if zone_id.startswith('/hostedzone/') else '/hostedzone/' + zone_id
+    if zone_id not in self.zones:
+      raise ClientError({'Error': {
+        'Code': 'NoSuchHostedZone', 'Message': 'No hosted zone found with ID: %s' % zone_id}},
+        operation)
+    return zone_id, self.zones[zone_id]
+
+  def list_hosted_zones_by_name(self, DNSName=None, HostedZoneId=None, MaxItems=None):
+    self.backend.call('ListHostedZonesByName')
+    zones = sorted((_record_key(name, '')[0], zone_id, name, len(records))
+                   for zone_id, (name, records) in self.zones.items())
+    if DNSName:
+      zones = [z for z in zones if z[0] >= _record_key(DNSName, '')[0]]
+    zones = zones[:int(MaxItems or 100)]
+    return {'HostedZones': [{'Id': zone_id, 'Name': name, 'ResourceRecordSetCount': count,
+                             'Config': {'PrivateZone': False}}
+                            for _, zone_id, name, count in zones],
+            'IsTruncated': False, 'MaxItems': str(MaxItems or 100)}
+
+  def list_resource_record_sets(self, HostedZoneId, StartRecordName=None, StartRecordType=None,
+                                StartRecordIdentifier=None, MaxItems=None):
+    self.backend.call('ListResourceRecordSets')
+    zone_id, (_, records) = self._zone(HostedZoneId, 'ListResourceRecordSets')
+    if zone_id not in self._sorted_keys:
+      self._sorted_keys[zone_id] = sorted(records)
+    keys = self._sorted_keys[zone_id]
+    start = 0
+    if StartRecordName:
+      start = bisect.bisect_left(
+        keys, _record_key(StartRecordName, StartRecordType or '', StartRecordIdentifier))
+    size = min(int(MaxItems) if MaxItems else self.MAX_ITEMS, self.MAX_ITEMS)
+    page = keys[start:start + size]
+    response = {'ResourceRecordSets': [records[k] for k in page],
+                'IsTruncated': start + size < len(keys), 'MaxItems': str(size)}
+    if response['IsTruncated']:
+      following = records[keys[start + size]]
+      response['NextRecordName'] = following['Name']
+      response['NextRecordType'] = following['Type']
+      if following.get('SetIdentifier'):
+        response['NextRecordIdentifier'] = following['SetIdentifier']
+    return response
+
+  def change_resource_record_sets(self, HostedZoneId, ChangeBatch):
+    self.backend.call('ChangeResourceRecordSets')
+    zone_id, (zone, records) = self._zone(HostedZoneId, 'ChangeResourceRecordSets')
+
+    def invalid(message):
+      return ClientError({'Error': {'Code': 'InvalidChangeBatch', 'Message': message}},
+                         'ChangeResourceRecordSets')
+
+    changes = ChangeBatch['Changes']
+    values = [v['Value'] for c in changes
+              for v in c['ResourceRecordSet'].get('ResourceRecords', [])]
+    # UPSERTs count twice against the limits
+    weight = sum(2 if c['Action'] == 'UPSERT' else 1 for c in changes
+                 for _ in c['ResourceRecordSet'].get('ResourceRecords', [None]))
+    if weight > self.MAX_CHANGE_RECORDS:
+      raise invalid('Number of records limit of %d exceeded.' % self.MAX_CHANGE_RECORDS)
+    if sum(len(v) for v in values) > self.MAX_CHANGE_VALUE_CHARS:
+      raise invalid('Number of characters limit of %d exceeded.' % self.MAX_CHANGE_VALUE_CHARS)
+
+    # A batch is applied all or nothing
+    updated = dict(records)
+    for change in changes:
+      record_set = change['ResourceRecordSet']
+      record_set = dict(record_set, Name=_fqdn(record_set['Name']))
+      key = _record_key(record_set['Name'], record_set['Type'], record_set.get('SetIdentifier'))
+      if not _in_zone(record_set['Name'], zone):
+        raise invalid('%s is not in the %s zone' % (record_set['Name'], zone))
+      if change['Action'] == 'CREATE':
+        if key in updated:
+          raise invalid('Tried to create resource record set [name=\'%s\', type=\'%s\'] but it '
+                        'already exists' % (record_set['Name'], record_set['Type']))
+        updated[key] = record_set
+      elif change['Action'] == 'DELETE':
+        if updated.get(key) != record_set:
+          raise invalid('Tried to delete resource record set [name=\'%s\', type=\'%s\'] but '
+                        'the values provided do not match the current values' % (
+                          record_set['Name'], record_set['Type']))
+        del updated[key]
+      elif change['Action'] == 'UPSERT':
+        updated[key] = record_set
+      else:
+        raise invalid('Unknown action %s' % change['Action'])
+    records.clear()
+    records.update(updated)
+    self._sorted_keys.pop(zone_id, None)
+    change_id = '/change/C%012X' % zlib.crc32(json.dumps(changes, sort_keys=True).encode('utf-8'))
+    return {'ChangeInfo': {'Id': change_id, 'Status': 'PENDING',
+                           'SubmittedAt': datetime.datetime.now(datetime.timezone.utc),
+                           'Comment': ChangeBatch.get('Comment', '')}}
+
+
+class FakeCEClient(object):
+
+  def __init__(self, backend):
+    self.backend = backend
+
+  def get_cost_and_usage(self, TimePeriod, Granularity, Metrics, GroupBy=None, Filter=None,
+                         NextPageToken=None):
+    self.backend.call('GetCostAndUsage')
+    if self.backend.cost_results is None:
+      results = _synthesize_cost_results(self.backend.instances, TimePeriod, Granularity, Metrics,
+                                         GroupBy or [])
+    else:
+      results = [r for r in self.backend.cost_results
+                 if TimePeriod['Start'] <= r['TimePeriod']['Start'] < TimePeriod['End']]
+
+    # Pages are cut by number of groups, so a single period may be split over several pages.
+    flattened = [(result, group) for result in results for group in result['Groups']]
+    page, token = self.backend.paginate(flattened, NextPageToken)
+    by_time = collections.OrderedDict()
+    for result, group in page:
+      start = result['TimePeriod']['Start']
+      if start not in by_time:
+        by_time[start] = {
+          'TimePeriod': result['TimePeriod'],
+          'Total': result.get('Total', {}),
+          'Groups': [],
+          'Estimated': result.get('Estimated', False),
+        }
+      by_time[start]['Groups'].append(group)
+
+    response = {
+      'GroupDefinitions': GroupBy or [],
+      'ResultsByTime': list(by_time.values()),
+    }
+    if token:
+      response['NextPageToken'] = token
+    return response
+
+
+def get_backend():
+  """
+  :return: The backend all AWS calls should go through, a :py:class:`Boto3Backend` by default
+  """
+  global _backend
+  if _backend is None:
+    _backend = Boto3Backend()
+  return _backend
+
+
+def set_backend(backend):
+  """
+  Installs the backend returned by :py:func:`get_backend`.
+
+  :param backend: Any object with a ``client(service)`` method
+  """
+  global _backend
+  _backend = backend
+
+
+# Result key -> describe operation of the network resources, in FakeBackend's network order
+_NETWORK_OPERATIONS = collections.OrderedDict([
+  ('Vpcs', 'describe_vpcs'),
+  ('Subnets', 'describe_subnets'),
+  ('SecurityGroups', 'describe_security_groups'),
+])
+
+# The network describe filters FakeBackend supports, and the keys they match
+_NETWORK_FILTERS = {
+  'subnet-id': 'SubnetId',
+  'vpc-id': 'VpcId',
+  'group-id': 'GroupId',
+  'availability-zone': 'AvailabilityZone',
+}
+
+
+def _tags(instance):
+  return {t['Key']: t['Value'] for t in instance.get('Tags', [])}
+
+
+def _match_filter(instance, name, values):
+  if name.startswith('tag:'):
+    actual = _tags(instance).get(name[len('tag:'):])
+  elif name == 'tag-key':
+    return any(fnmatch.fnmatchcase(k, v) for k in _tags(instance) for v in values)
+  elif name == 'instance-state-name':
+    actual = instance['State']['Name']
+  elif name == 'instance-type':
+    actual = instance.get('InstanceType')
+  elif name == 'instance-id':
+    actual = instance['InstanceId']
+  elif name == 'availability-zone':
+    actual = instance.get('Placement', {}).get('AvailabilityZone')
+  elif name == 'image-id':
+    actual = instance.get('ImageId')
+  elif name == 'subnet-id':
+    actual = instance.get('SubnetId')
+  elif name == 'vpc-id':
+    actual = instance.get('VpcId')
+  elif name == 'key-name':
+    actual = instance.get('KeyName')
+  else:
+    raise ValueError('FakeBackend does not support the %r filter' % name)
+  return actual is not None and any(fnmatch.fnmatchcase(actual, v) for v in values)
+
+
+def _synthetic_hourly_rate(instance_type):
+  # Deterministic but varied, so that cost orderings are stable between runs.
+  return 0.01 * (1 + zlib.crc32(instance_type.encode('utf-8')) % 100)
+
+
+def _synthesize_datapoints(stat, start, end):
+  # Each instance gets a stable utilization level and burstiness, so that some are idle, some
+  # oversized and a few saturated.
+  dimensions = {d['Name']: d['Value'] for d in stat['Metric'].get('Dimensions', [])}
+  seed = zlib.crc32(dimensions.get('InstanceId', '').encode('utf-8'))
+  rng = random.Random(seed ^ zlib.crc32(stat['Metric']['MetricName'].encode('utf-8')))
+  level = (seed % 1000) / 1000.0
+  level = level ** 3
+  period = datetime.timedelta(seconds=stat['Period'])
+  timestamps = []
+  values = []
+  timestamp = end - period
+  while timestamp >= start:
+    burst = rng.random() ** 30
+    if stat['Metric']['MetricName'] == 'CPUUtilization':
+      value = min(100.0, 100.0 * (level + (1 - level) * burst * 0.5) * rng.uniform(0.8, 1.2))
+    else:
+      value = 1e9 * stat['Period'] / 3600.0 * (level + burst) * rng.uniform(0.5, 1.5)
+    timestamps.append(timestamp)
+    values.append(value)
+    timestamp -= period
+  return timestamps, values
+
+
+def _synthesize_image(image_id):
+  # Stable per ID: one in 20 is deregistered, the others were built up to ~3 years ago
+  seed = zlib.crc32(image_id.encode('utf-8'))
+  if seed % 20 == 0:
+    return None
+  created = fleet.EPOCH - datetime.timedelta(days=seed % 1100, seconds=seed % 86400)
+  return {
+    'ImageId': image_id,
+    'Name': 'ubuntu-%s-base-%s' % (('trusty', 'xenial', 'bionic')[seed % 3],
+                                   created.strftime('%Y%m%d%H%M')),
+    'CreationDate': created.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+    'OwnerId': FAKE_ACCOUNT_ID,
+    'State': 'available',
+    'Architecture': 'x86_64',
+    'ImageType': 'machine',
+    'RootDeviceType': 'ebs',
+  }
+
+
+def _periods(start, end, granularity):
+  start = datetime.datetime.strptime(start, '%Y-%m-%d').date()
+  end = datetime.datetime.strptime(end, '%Y-%m-%d').date()
+  while start < end:
+    if granularity == 'MONTHLY':
+      following = (start.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+    elif granularity == 'WEEKLY':
+      following = start + datetime.timedelta(days=7)
+    else:
+      following = start + datetime.timedelta(days=1)
+    following = min(following, end)
+    yield start, following
+    start = following
+
+
+def _group_key(instance, group_by):
+  if group_by['Type'] == 'TAG':
+    return '%s$%s' % (group_by['Key'], _tags(instance).get(group_by['Key'], ''))
+  if group_by['Key'] == 'INSTANCE_TYPE':
+    return instance.get('InstanceType', 'NoInstanceType')
+  if group_by['Key'] == 'LINKED_ACCOUNT':
+    return FAKE_ACCOUNT_ID
+  if group_by['Key'] == 'REGION':
+    return instance.get('Placement', {}).get('AvailabilityZone', 'us-east-1a')[:-1]
+  return 'NoValue'
+
+
+def _synthesize_cost_results(instances, time_period, granularity, metrics, group_by):
+  hourly = collections.defaultdict(float)
+  for instance in instances:
+    if instance['State']['Name'] == 'running':
+      key = tuple(_group_key(instance, g) for g in group_by)
+      hourly[key] += _synthetic_hourly_rate(instance.get('InstanceType', ''))
+
+  results = []
+  for start, end in _periods(time_period['Start'], time_period['End'], granularity):
+    hours = (end - start).days * 24
+    results.append({
+      'TimePeriod': {'Start': start.isoformat(), 'End': end.isoformat()},
+      'Total': {},
+      'Groups': [
+        {
+          'Keys': list(key),
+          'Metrics': {m: {'Amount': '%.10f' % (rate * hours), 'Unit': 'USD'} for m in metrics},
+        } for key, rate in sorted(hourly.items())
+      ],
+      'Estimated': end >= datetime.date.today(),
+    })
+  return results
+
+
+def _json_default(obj):
+  if isinstance(obj, (datetime.datetime, datetime.date)):
+    return obj.isoformat()
+  raise TypeError('%r is not JSON serializable' % obj)
+
+
+def _json_object_hook(obj):
+  for key, value in obj.items():
+    if key.endswith('Time') and isinstance(value, str) and _DATETIME_RE.match(value):
+      obj[key] = datetime.datetime.fromisoformat(value)
+  return obj
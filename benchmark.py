@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the inventory report stages against synthetic fleets.
+
+Each fleet size runs in a fresh process, so that peak RSS is measured per size. Results can be
+saved as a baseline and later runs compared against it:
+
+    $ ./benchmark.py --sizes=1000,10000,100000 --save_baseline=bench_baseline.json
+    $ ./benchmark.py --sizes=1000,10000,100000 --baseline=bench_baseline.json
+
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import fleet
+import utils
+
+
+STAGES = ('generate', 'metadata', 'generate_host', 'detail_file', 'details_table')
+
+
+def _peak_rss_mb():
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+  return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def run_size(size, stages=STAGES, seed=0):
+  """
+  Runs the selected stages against a synthetic fleet of the given size.
+
+  :param size: The number of instances in the fleet
+  :param stages: The stages to run; 'generate' always runs
+  :param seed: The fleet's random seed
+  :return: A dict with per-stage timings, throughput and peak RSS
+  """
+  timings = {}
+
+  start = time.perf_counter()
+  instances = list(fleet.generate_fleet(size, seed=seed))
+  timings['generate'] = time.perf_counter() - start
+
+  if 'metadata' in stages:
+    start = time.perf_counter()
+    utils._get_instance_metadata(instances)
+    timings['metadata'] = time.perf_counter() - start
+
+  if 'generate_host' in stages:
+    start = time.perf_counter()
+    for instance in instances:
+      utils.generate_host(instance)
+    timings['generate_host'] = time.perf_counter() - start
+
+  if 'detail_file' in stages:
+    fd, fname = tempfile.mkstemp(suffix='.tsv')
+    os.close(fd)
+    try:
+      start = time.perf_counter()
+      utils.create_instance_detail_file(instances, fname)
+      timings['detail_file'] = time.perf_counter() - start
+    finally:
+      os.remove(fname)
+
+  if 'details_table' in stages:
+    start = time.perf_counter()
+    utils.create_instance_details_table(instances).get_string()
+    timings['details_table'] = time.perf_counter() - start
+
+  return {
+    'size': size,
+    'seconds': timings,
+    'throughput': {stage: size / secs if secs else 0.0 for stage, secs in timings.items()},
+    'peak_rss_mb': _peak_rss_mb(),
+  }
+
+
+def run(sizes, stages=STAGES, seed=0):
+  """
+  Runs every size in its own process.
+
+  :return: A list of :py:func:`run_size` results, one per size
+  """
+  context = multiprocessing.get_context('spawn')
+  results = []
+  for size in sizes:
+    with context.Pool(1) as pool:
+      results.append(pool.apply(run_size, (size, stages, seed)))
+  return results
+
+
+def compare(results, baseline, tolerance):
+  """
+  Compares results against a stored baseline.
+
+  :param results: The results of :py:func:`run`
+  :param baseline: Previously saved results
+  :param tolerance: The allowed relative slowdown (or RSS growth), e.g. 0.25 for 25%
+  :return: A list of human readable regression descriptions
+  """
+  previous = {r['size']: r for r in baseline}
+  regressions = []
+  for result in results:
+    before = previous.get(result['size'])
+    if not before:
+      continue
+    for stage, secs in result['seconds'].items():
+      old = before['seconds'].get(stage)
+      if old and secs > old * (1 + tolerance):
+        regressions.append('%d instances, %s: %.3fs -> %.3fs (+%.0f%%)' % (
+          result['size'], stage, old, secs, 100 * (secs / old - 1)))
+    old = before.get('peak_rss_mb')
+    if old and result['peak_rss_mb'] > old * (1 + tolerance):
+      regressions.append('%d instances, peak RSS: %.1fMB -> %.1fMB' % (
+        result['size'], old, result['peak_rss_mb']))
+  return regressions
+
+
+def print_results(results):
+  print('\t'.join(['Size', 'Stage', 'Seconds', 'Instances/sec', 'Peak RSS (MB)']))
+  for result in results:
+    for stage, secs in result['seconds'].items():
+      print('\t'.join([str(result['size']), stage, '%.4f' % secs,
+                       '%.0f' % result['throughput'][stage], '%.1f' % result['peak_rss_mb']]))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--sizes', type=str, default='1000,10000,100000',
+                      help='Comma separated fleet sizes, e.g. 1000,10000,100000,1000000')
+  parser.add_argument('--stages', type=str, default=','.join(STAGES))
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--baseline', type=str, default=None,
+                      help='Compare against a saved baseline and exit 1 on regressions')
+  parser.add_argument('--save_baseline', type=str, default=None)
+  parser.add_argument('--tolerance', type=float, default=0.25)
+  args = parser.parse_args()
+
+  results = run([int(s) for s in args.sizes.split(',')], args.stages.split(','), args.seed)
+  print_results(results)
+
+  if args.save_baseline:
+    with open(args.save_baseline, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      regressions = compare(results, json.load(f), args.tolerance)
+    for regression in regressions:
+      print('REGRESSION: ' + regression)
+    if regressions:
+      sys.exit(1)
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+A persistent cost rollup cube.
+
+Daily cost is stored pre-aggregated by day, account, instance type, environment, purpose and
+owner in a local SQLite file, so that roll-ups and slices ("staging cost by purpose over the
+last 90 days", "owner X this month") are answered without API calls or rescans of reports.
+
+Days are also rolled up into months as they are written; a query over a long range reads whole
+months from the monthly roll-up and only the partial months at either end from the daily rows.
+
+Cost Explorer can only group by two dimensions at a time, so a cube built from it carries the
+account and instance type only; one built from CUR files also carries the
+``config.INSTANCE_*_KEY`` tags. A cube is fed from one source only, so the two are never summed.
+
+    c = cube.Cube('cube.sqlite')
+    c.update(cube.rows_from_cur(totals), source='cur')
+    c.query(group_by=('purpose',), since='2019-04-01', env='staging')
+
+"""
+
+import collections
+import datetime
+import sqlite3
+
+import cur
+import stats
+
+
+DIMENSIONS = ('day', 'account', 'instance_type', 'env', 'purpose', 'owner')
+
+# The CUR fields each dimension is built from
+CUR_GROUP_BY = ('usage_date', 'usage_account', 'instance_type', 'environment', 'purpose', 'owner')
+
+# The Cost Explorer query the cube is built from: daily cost by account and instance type
+COST_QUERY = {
+  'granularity': 'DAILY',
+  'metrics': ['UnblendedCost'],
+  'group_by': [{'Type': 'DIMENSION', 'Key': 'LINKED_ACCOUNT'},
+               {'Type': 'DIMENSION', 'Key': 'INSTANCE_TYPE'}],
+}
+
+_MONTH_DIMENSIONS = ('account', 'instance_type', 'env', 'purpose', 'owner')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS cost (
+  day TEXT NOT NULL,
+  account TEXT NOT NULL,
+  instance_type TEXT NOT NULL,
+  env TEXT NOT NULL,
+  purpose TEXT NOT NULL,
+  owner TEXT NOT NULL,
+  amount REAL NOT NULL,
+  PRIMARY KEY (day, account, instance_type, env, purpose, owner)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cost_env_day ON cost (env, day);
+CREATE INDEX IF NOT EXISTS cost_owner_day ON cost (owner, day);
+CREATE TABLE IF NOT EXISTS cost_monthly (
+  month TEXT NOT NULL,
+  account TEXT NOT NULL,
+  instance_type TEXT NOT NULL,
+  env TEXT NOT NULL,
+  purpose TEXT NOT NULL,
+  owner TEXT NOT NULL,
+  amount REAL NOT NULL,
+  PRIMARY KEY (month, account, instance_type, env, purpose, owner)
+) WITHOUT ROWID;
+"""
+
+
+def rows_from_cost_results(results):
+  """
+  :param results: Cost Explorer ResultsByTime entries of a :py:data:`COST_QUERY` fetch
+  :return: Cube rows of (day, account, instance type, '', '', '', cost)
+  """
+  rows = []
+  for result in results:
+    day = result['TimePeriod']['Start']
+    for group in result['Groups']:
+      keys = list(group['Keys']) + ['', '']
+      rows.append((day, keys[0], keys[1], '', '', '',
+                   float(group['Metrics']['UnblendedCost']['Amount'])))
+  return rows
+
+
+def rows_from_cur(totals):
+  """
+  :param totals: CUR aggregates grouped by :py:data:`CUR_GROUP_BY`, e.g. from :py:func:`cur.ingest`
+  :return: Cube rows of (day, account, instance type, env, purpose, owner, cost)
+  """
+  return [key + (cost,) for key, cost in totals.items()]
+
+
+def cur_query(since=None):
+  """
+  :param since: Only aggregate line items on or after this YYYY-MM-DD day
+  :return: The :py:class:`cur.Query` cube rows are aggregated with
+  """
+  return cur.Query(group_by=CUR_GROUP_BY, since=since)
+
+
+class Cube(object):
+  """
+  A daily cost cube kept in a SQLite file.
+
+  :param fname: The SQLite file; created if missing
+  """
+
+  def __init__(self, fname):
+    self.fname = fname
+    self.db = sqlite3.connect(fname)
+    self.db.executescript(_SCHEMA)
+
+  def close(self):
+    self.db.close()
+
+  @property
+  def source(self):
+    """
+    The source the cube was built from (ce or cur), or None while it is empty.
+    """
+    row = self.db.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+    return row[0] if row else None
+
+  def last_day(self):
+    """
+    :return: The most recent day in the cube, as YYYY-MM-DD, or None if it is empty
+    """
+    return self.db.execute('SELECT MAX(day) FROM cost').fetchone()[0]
+
+  def update(self, rows, source):
+    """
+    Adds days to the cube. Days already in the cube are replaced as a whole, so refetching a
+    partial or restated day (e.g. an estimated Cost Explorer day) never double counts.
+
+    :param rows: Tuples of (day, account, instance type, env, purpose, owner, cost)
+    :param source: Where the rows come from, ce or cur
+    :return: The number of days written
+    """
+    current = self.source
+    if current is not None and current != source:
+      raise ValueError('%s was built from %s data; it cannot be updated from %s' % (
+        self.fname, current, source))
+
+    merged = collections.OrderedDict()
+    for row in rows:
+      key = tuple(row[:-1])
+      merged[key] = merged.get(key, 0.0) + row[-1]
+    days = sorted(set(key[0] for key in merged))
+
+    with stats.span('cube.update'), self.db:
+      self.db.execute("INSERT OR REPLACE INTO meta VALUES ('source', ?)", (source,))
+      self.db.executemany('DELETE FROM cost WHERE day = ?', [(day,) for day in days])
+      self.db.executemany('INSERT INTO cost VALUES (?, ?, ?, ?, ?, ?, ?)',
+                          [key + (cost,) for key, cost in merged.items()])
+      for month in sorted(set(day[:7] for day in days)):
+        self._roll_up_month(month)
+    stats.incr('cube_days_written', len(days))
+    return len(days)
+
+  def _roll_up_month(self, month):
+    start, end = _month_bounds(month)
+    dimensions = ', '.join(_MONTH_DIMENSIONS)
+    self.db.execute('DELETE FROM cost_monthly WHERE month = ?', (month,))
+    self.db.execute(
+      'INSERT INTO cost_monthly SELECT ?, %s, SUM(amount) FROM cost WHERE day >= ? AND day < ? '
+      'GROUP BY %s' % (dimensions, dimensions), (month, start, end))
+
+  def query(self, group_by=(), since=None, until=None, **where):
+    """
+    Rolls the cube up to the given dimensions, optionally sliced.
+
+    :param group_by: The dimensions to keep; see :py:data:`DIMENSIONS`
+    :param since: The first day to include, as YYYY-MM-DD
+    :param until: The day to stop before, as YYYY-MM-DD
+    :param where: Exact matches on any dimension, e.g. env='staging'
+    :return: A list of (dimension values..., cost) tuples, most expensive first
+    """
+    group_by = list(group_by)
+    unknown = [d for d in group_by + list(where) if d not in DIMENSIONS]
+    if unknown:
+      raise ValueError('Unknown cube dimension(s) %s; expected one of %s' % (
+        ', '.join(unknown), ', '.join(DIMENSIONS)))
+
+    slices = []
+    params = []
+    for dimension, value in sorted(where.items()):
+      slices.append('%s = ?' % dimension)
+      params.append(value)
+
+    # (table, first day, day to stop before) ranges that together cover [since, until)
+    if 'day' in group_by or 'day' in where:
+      ranges = [('cost', since, until)]
+    else:
+      ranges = _split_months(since, until)
+
+    selects = []
+    select_params = []
+    for table, start, end in ranges:
+      column = 'day' if table == 'cost' else 'month'
+      conditions = list(slices)
+      select_params.extend(params)
+      if start:
+        conditions.append('%s >= ?' % column)
+        select_params.append(start if table == 'cost' else start[:7])
+      if end:
+        conditions.append('%s < ?' % column)
+        select_params.append(end if table == 'cost' else end[:7])
+      sql = 'SELECT %s FROM %s' % (', '.join(group_by + ['amount']), table)
+      if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+      selects.append(sql)
+
+    sql = 'SELECT %s FROM (%s)' % (', '.join(group_by + ['SUM(amount)']),
+                                   ' UNION ALL '.join(selects))
+    if group_by:
+      sql += ' GROUP BY ' + ', '.join(group_by)
+    sql += ' ORDER BY %d DESC' % (len(group_by) + 1)
+    with stats.span('cube.query'):
+      return [row for row in self.db.execute(sql, select_params) if row[-1] is not None]
+
+
+def _month_bounds(month):
+  """
+  :param month: YYYY-MM
+  :return: The month's first day and the first day of the following month, as YYYY-MM-DD
+  """
+  first = datetime.date(int(month[:4]), int(month[5:7]), 1)
+  following = (first + datetime.timedelta(days=32)).replace(day=1)
+  return first.isoformat(), following.isoformat()
+
+
+def _split_months(since, until):
+  # Whole months are read from the monthly roll-up, the days around them from the daily rows
+  first = since if since is None or since.endswith('-01') else _month_bounds(since[:7])[1]
+  last = until if until is None or until.endswith('-01') else until[:7] + '-01'
+  if first is not None and last is not None and first >= last:
+    return [('cost', since, until)]
+  ranges = [('cost_monthly', first, last)]
+  if since and since != first:
+    ranges.append(('cost', since, first))
+  if until and until != last:
+    ranges.append(('cost', last, until))
+  return ranges
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""
+Streaming ingestion of locally downloaded Cost and Usage Report (CUR) files.
+
+Both gzip CSV and Parquet reports are supported. Only the needed columns are projected, rows are
+aggregated as they stream, and the work is spread over a process pool: one task per file when
+there are enough files, otherwise one task per block of lines (CSV) or row group (Parquet). At
+most a few blocks are in flight at a time, so memory stays bounded however large the report is.
+
+"""
+
+import collections
+import concurrent.futures
+import csv
+import gzip
+import io
+import multiprocessing
+import operator
+import os
+import re
+
+import config
+import stats
+
+try:
+  import pyarrow
+  import pyarrow.compute
+  import pyarrow.parquet
+except ImportError:
+  pyarrow = None
+
+
+# Projected fields and their CSV column names. Parquet column names are derived from these.
+FIELDS = collections.OrderedDict([
+  ('line_item_type', 'lineItem/LineItemType'),
+  ('usage_account', 'lineItem/UsageAccountId'),
+  ('resource_id', 'lineItem/ResourceId'),
+  ('usage_type', 'lineItem/UsageType'),
+  ('usage_start', 'lineItem/UsageStartDate'),
+  ('instance_type', 'product/instanceType'),
+  ('unblended_cost', 'lineItem/UnblendedCost'),
+  ('environment', 'resourceTags/user:' + config.INSTANCE_ENVIRONMENT_KEY),
+  ('purpose', 'resourceTags/user:' + config.INSTANCE_PURPOSE_KEY),
+  ('owner', 'resourceTags/user:' + config.INSTANCE_OWNER_KEY),
+  ('user', 'resourceTags/user:' + config.INSTANCE_USER_KEY),
+])
+
+# Derived from usage_start
+USAGE_DATE = 'usage_date'
+
+DEFAULT_GROUP_BY = ('usage_account', 'usage_type')
+
+# Resource ID prefixes of the line items that can be attributed to an instance: the instance
+# itself and its EBS volumes
+INSTANCE_RESOURCE_PREFIXES = ('i-', 'vol-')
+
+CHUNK_BYTES = 32 * 1024 * 1024
+
+_CAMEL_RE = re.compile(r'(?<=[a-z0-9])(?=[A-Z])')
+
+# Workers are forked where possible: the report script has no __main__ guard, so spawned workers
+# would re-run it.
+_POOL_CONTEXT = multiprocessing.get_context('fork') \
+  if 'fork' in multiprocessing.get_all_start_methods() else None
+
+
+def column_name(field):
+  """
+  :param field: A key of :py:data:`FIELDS`, ``usage_date``, or ``tag:<Key>`` for any user tag
+  :return: The CSV column holding that field
+  """
+  if field == USAGE_DATE:
+    return FIELDS['usage_start']
+  if field.startswith('tag:'):
+    return 'resourceTags/user:' + field[len('tag:'):]
+  if field not in FIELDS:
+    raise ValueError('Unknown CUR field %r; expected one of %s, usage_date or tag:<Key>' % (
+      field, ', '.join(FIELDS)))
+  return FIELDS[field]
+
+
+def parquet_column_name(csv_column):
+  """
+  Converts a CSV column name to the name Athena-compatible Parquet reports use, e.g.
+  lineItem/UsageAccountId -> line_item_usage_account_id.
+  """
+  category, name = csv_column.split('/', 1)
+  name = name.replace(':', '_')
+  return '_'.join(_CAMEL_RE.sub('_', part).lower() for part in (category, name))
+
+
+class Query(object):
+  """
+  What to aggregate: the group-by fields and the line item filters.
+
+  :param group_by: Fields to group costs by; see :py:func:`column_name`
+  :param line_item_types: Only include these line item types, e.g. ('Usage',)
+  :param since: Only include line items whose usage date is on or after this YYYY-MM-DD date
+  :param until: Only include line items whose usage date is before this YYYY-MM-DD date
+  :param resource_prefixes: Only include resource IDs with one of these prefixes, e.g. ('i-',)
+  """
+
+  def __init__(self, group_by=DEFAULT_GROUP_BY, line_item_types=None, since=None, until=None,
+               resource_prefixes=None):
+    self.group_by = tuple(group_by)
+    self.line_item_types = frozenset(line_item_types) if line_item_types else None
+    self.since = since
+    self.until = until
+    self.resource_prefixes = tuple(resource_prefixes) if resource_prefixes else None
+
+  def columns(self):
+    """
+    :return: The CSV columns needed to answer the query
+    """
+    columns = [FIELDS['unblended_cost']] + [column_name(f) for f in self.group_by]
+    if self.line_item_types:
+      columns.append(FIELDS['line_item_type'])
+    if self.since or self.until:
+      columns.append(FIELDS['usage_start'])
+    if self.resource_prefixes:
+      columns.append(FIELDS['resource_id'])
+    return list(collections.OrderedDict.fromkeys(columns))
+
+  def to_dict(self):
+    """
+    :return: The query as a JSON serializable dict, equal for equal queries
+    """
+    return {
+      'group_by': list(self.group_by),
+      'line_item_types': sorted(self.line_item_types) if self.line_item_types else None,
+      'since': self.since,
+      'until': self.until,
+      'resource_prefixes': list(self.resource_prefixes) if self.resource_prefixes else None,
+    }
+
+
+def merge(total, partial):
+  """
+  Adds a partial aggregate into a running total, in place.
+
+  :return: The total
+  """
+  for key, cost in partial.items():
+    total[key] = total.get(key, 0.0) + cost
+  return total
+
+
+def iter_partials(paths, query=None, processes=None, chunk_bytes=CHUNK_BYTES):
+  """
+  Aggregates CUR files in a process pool, yielding one partial aggregate per task as soon as it
+  completes. Callers that only need a summary (e.g. a top-K) never hold the full result.
+
+  :param paths: CUR files (.csv, .csv.gz or .parquet)
+  :param query: A :py:class:`Query`; defaults to cost by usage account and usage type
+  :param processes: The pool size; defaults to the number of CPUs
+  :param chunk_bytes: The size of the line blocks a single CSV file is split into
+  :return: A generator of {group key tuple: cost} dicts
+  """
+  query = query or Query()
+  processes = processes or os.cpu_count() or 1
+  tasks = _tasks(list(paths), query, processes, chunk_bytes)
+  max_in_flight = 2 * processes
+
+  with concurrent.futures.ProcessPoolExecutor(max_workers=processes,
+                                              mp_context=_POOL_CONTEXT) as pool:
+    in_flight = set()
+    for task in tasks:
+      in_flight.add(pool.submit(*task))
+      if len(in_flight) >= max_in_flight:
+        done, in_flight = concurrent.futures.wait(
+          in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          stats.incr('cur_tasks')
+          yield future.result()
+    for future in concurrent.futures.as_completed(in_flight):
+      stats.incr('cur_tasks')
+      yield future.result()
+
+
+def ingest(paths, query=None, processes=None, chunk_bytes=CHUNK_BYTES):
+  """
+  Aggregates CUR files into a single {group key tuple: cost} dict.
+
+  See :py:func:`iter_partials` for the parameters.
+  """
+  total = {}
+  with stats.span('cur.ingest'):
+    for partial in iter_partials(paths, query, processes, chunk_bytes):
+      merge(total, partial)
+  return total
+
+
+def ingest_each(paths, query=None, processes=None):
+  """
+  Aggregates each CUR file separately, one file per worker.
+
+  :param paths: CUR files (.csv, .csv.gz or .parquet)
+  :param query: A :py:class:`Query`; defaults to cost by usage account and usage type
+  :param processes: The pool size; defaults to the number of CPUs
+  :return: A dict of {path: {group key tuple: cost}}
+  """
+  query = query or Query()
+  paths = list(paths)
+  if not paths:
+    return {}
+  processes = min(processes or os.cpu_count() or 1, len(paths))
+  with stats.span('cur.ingest_each'):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes,
+                                                mp_context=_POOL_CONTEXT) as pool:
+      futures = {
+        (pool.submit(_aggregate_parquet, path, None, query) if _is_parquet(path)
+         else pool.submit(_aggregate_csv_file, path, query)): path
+        for path in paths
+      }
+      return {futures[f]: f.result() for f in concurrent.futures.as_completed(futures)}
+
+
+def resource_costs(paths, since=None, until=None, processes=None):
+  """
+  Sums the cost of each instance and EBS volume in CUR files.
+
+  :param paths: CUR files (.csv, .csv.gz or .parquet)
+  :param since: Only include line items whose usage date is on or after this YYYY-MM-DD date
+  :param until: Only include line items whose usage date is before this YYYY-MM-DD date
+  :param processes: The pool size; defaults to the number of CPUs
+  :return: A dict of {resource ID: cost}
+  """
+  query = Query(group_by=('resource_id',), since=since, until=until,
+                resource_prefixes=INSTANCE_RESOURCE_PREFIXES)
+  return {key[0]: cost for key, cost in ingest(paths, query, processes).items()}
+
+
+def _is_parquet(path):
+  return path.endswith('.parquet') or path.endswith('.snappy.parquet')
+
+
+def _open(path):
+  return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+def _tasks(paths, query, processes, chunk_bytes):
+  if len(paths) >= processes:
+    for path in paths:
+      if _is_parquet(path):
+        yield _aggregate_parquet, path, None, query
+      else:
+        yield _aggregate_csv_file, path, query
+    return
+
+  for path in paths:
+    if _is_parquet(path):
+      if pyarrow is None:
+        raise RuntimeError('pyarrow is required to read Parquet CUR files')
+      for row_group in range(pyarrow.parquet.ParquetFile(path).num_row_groups):
+        yield _aggregate_parquet, path, row_group, query
+      continue
+    with _open(path) as f:
+      header = f.readline()
+      while True:
+        block = f.read(chunk_bytes)
+        if not block:
+          break
+        # Never split a line between two blocks
+        block += f.readline()
+        stats.incr('cur_bytes', len(block))
+        yield _aggregate_csv_block, header, block, query
+
+
+def _csv_projection(header, query):
+  names = next(csv.reader([header]))
+  positions = {name: i for i, name in enumerate(names)}
+
+  missing = [c for c in query.columns() if c in FIELDS.values() and c not in positions
+             and not c.startswith('resourceTags/')]
+  if missing:
+    raise ValueError('CUR file is missing the %s column(s)' % ', '.join(missing))
+
+  return (
+    positions[FIELDS['unblended_cost']],
+    [(positions.get(column_name(f)), f == USAGE_DATE) for f in query.group_by],
+    positions.get(FIELDS['line_item_type']),
+    positions.get(FIELDS['usage_start']),
+    positions.get(FIELDS['resource_id']),
+  )
+
+
+def _aggregate_rows(rows, projection, query, totals):
+  cost_at, key_at, type_at, start_at, resource_at = projection
+  line_item_types = query.line_item_types
+  since, until = query.since, query.until
+  prefixes = query.resource_prefixes
+  make_key = _key_function(key_at)
+
+  for row in rows:
+    if not row:
+      continue
+    if line_item_types is not None and row[type_at] not in line_item_types:
+      continue
+    if since or until:
+      day = row[start_at][:10]
+      if (since and day < since) or (until and day >= until):
+        continue
+    if prefixes is not None and not row[resource_at].startswith(prefixes):
+      continue
+    key = make_key(row)
+    cost = row[cost_at]
+    totals[key] = totals.get(key, 0.0) + (float(cost) if cost else 0.0)
+  return totals
+
+
+def _key_function(key_at):
+  # Plain columns are picked with a single itemgetter; only dates and missing columns need more
+  if key_at and all(at is not None and not is_date for at, is_date in key_at):
+    if len(key_at) == 1:
+      at = key_at[0][0]
+      return lambda row: (row[at],)
+    return operator.itemgetter(*[at for at, _ in key_at])
+  return lambda row: tuple(('' if at is None else (row[at][:10] if is_date else row[at]))
+                           for at, is_date in key_at)
+
+
+def _aggregate_csv_block(header, block, query):
+  header = header.decode('utf-8')
+  rows = csv.reader(io.StringIO(block.decode('utf-8')))
+  return _aggregate_rows(rows, _csv_projection(header, query), query, {})
+
+
+def _aggregate_csv_file(path, query):
+  totals = {}
+  with _open(path) as raw:
+    f = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+    header = f.readline()
+    _aggregate_rows(csv.reader(f), _csv_projection(header, query), query, totals)
+  return totals
+
+
+def _aggregate_parquet(path, row_group, query):
+  if pyarrow is None:
+    raise RuntimeError('pyarrow is required to read Parquet CUR files')
+  compute = pyarrow.compute
+  parquet = pyarrow.parquet.ParquetFile(path)
+  available = set(parquet.schema_arrow.names)
+  wanted = [parquet_column_name(c) for c in query.columns()]
+  columns = [c for c in wanted if c in available]
+  if row_group is None:
+    table = parquet.read(columns=columns)
+  else:
+    table = parquet.read_row_group(row_group, columns=columns)
+
+  def column(csv_column):
+    name = parquet_column_name(csv_column)
+    if name in available:
+      values = table.column(name)
+      return compute.cast(values, pyarrow.string()) if values.type != pyarrow.string() \
+        else values
+    return pyarrow.nulls(len(table), pyarrow.string())
+
+  mask = None
+
+  def conjoin(mask, condition):
+    return condition if mask is None else compute.and_(mask, condition)
+
+  if query.line_item_types:
+    mask = conjoin(mask, compute.is_in(column(FIELDS['line_item_type']),
+                                       value_set=pyarrow.array(sorted(query.line_item_types))))
+  if query.since or query.until:
+    days = compute.utf8_slice_codeunits(column(FIELDS['usage_start']), 0, 10)
+    if query.since:
+      mask = conjoin(mask, compute.greater_equal(days, query.since))
+    if query.until:
+      mask = conjoin(mask, compute.less(days, query.until))
+  if query.resource_prefixes:
+    resources = column(FIELDS['resource_id'])
+    matches = None
+    for prefix in query.resource_prefixes:
+      condition = compute.starts_with(resources, prefix)
+      matches = condition if matches is None else compute.or_(matches, condition)
+    mask = conjoin(mask, matches)
+
+  keys = []
+  arrays = {}
+  for i, field in enumerate(query.group_by):
+    values = column(column_name(field))
+    if field == USAGE_DATE:
+      values = compute.utf8_slice_codeunits(values, 0, 10)
+    arrays['k%d' % i] = compute.fill_null(values, '')
+    keys.append('k%d' % i)
+  cost_name = parquet_column_name(FIELDS['unblended_cost'])
+  arrays['cost'] = compute.cast(table.column(cost_name), pyarrow.float64()) \
+    if cost_name in available else pyarrow.nulls(len(table), pyarrow.float64())
+
+  grouped = pyarrow.table(arrays)
+  if mask is not None:
+    grouped = grouped.filter(compute.fill_null(mask, False))
+  grouped = grouped.group_by(keys).aggregate([('cost', 'sum')])
+  key_columns = [grouped.column(k).to_pylist() for k in keys]
+  costs = grouped.column('cost_sum').to_pylist()
+  return {tuple(k[i] for k in key_columns): (costs[i] or 0.0) for i in range(len(costs))}
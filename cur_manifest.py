@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Manifest-driven incremental CUR processing.
+
+AWS rewrites the report files of the current billing period several times a day, each time as
+a new "assembly" listed in a manifest. :py:class:`IncrementalCur` keeps local aggregates along
+with what every report file (identified by content hash) contributed to them. On refresh only
+files with new content are parsed; files superseded by a newer assembly have their contribution
+retracted, and files whose content is unchanged (even under a new assembly ID or key) are reused
+without being read again.
+
+"""
+
+import collections
+import hashlib
+import json
+import os
+
+import cur
+import stats
+
+
+STATE_VERSION = 2
+
+_KEY_SEPARATOR = '\x1f'
+
+_HASH_BLOCK = 1024 * 1024
+
+
+def read_manifest(fname):
+  """
+  Reads a CUR manifest and resolves its report keys to local files.
+
+  Report files are looked up relative to the directory mirroring the bucket root (i.e. the key as
+  is), then next to the manifest under the assembly ID, then next to the manifest itself.
+
+  :param fname: A downloaded <report>-Manifest.json
+  :return: A tuple of (billing period, assembly ID, list of local report file paths)
+  """
+  with open(fname) as f:
+    manifest = json.load(f)
+  directory = os.path.dirname(os.path.abspath(fname))
+  period = manifest['billingPeriod']['start'][:8]
+  assembly_id = manifest['assemblyId']
+
+  paths = []
+  for key in manifest['reportKeys']:
+    candidates = [
+      key,
+      os.path.join(directory, assembly_id, os.path.basename(key)),
+      os.path.join(directory, os.path.basename(key)),
+    ]
+    for candidate in candidates:
+      if os.path.exists(candidate):
+        paths.append(candidate)
+        break
+    else:
+      raise IOError('Report file %s of assembly %s was not found locally' % (key, assembly_id))
+  return period, assembly_id, paths
+
+
+class IncrementalCur(object):
+  """
+  Local CUR aggregates that are kept up to date from successive manifests.
+
+  :param fname: The JSON file the state is kept in
+  :param query: The :py:class:`cur.Query` aggregates are built with. It must not change between
+      runs sharing the same state file.
+  """
+
+  def __init__(self, fname, query=None):
+    self.fname = fname
+    self.query = query or cur.Query()
+    self.totals = {}
+    # period -> {'assembly_id': ..., 'hashes': [content hash, ...]}
+    self.periods = {}
+    # content hash -> {group key: cost}
+    self.contributions = {}
+    # path -> [size, mtime, content hash], to avoid re-hashing unchanged files
+    self.hashes = {}
+    if os.path.exists(fname):
+      self._load()
+
+  def _load(self):
+    with open(self.fname) as f:
+      state = json.load(f)
+    if state.get('version') != STATE_VERSION:
+      raise ValueError('%s has an unsupported state version' % self.fname)
+    # Totals of different queries cannot be mixed
+    query = self.query.to_dict()
+    differing = sorted(k for k in query if state['query'].get(k) != query[k])
+    if differing:
+      raise ValueError('%s was built with a different %s: %s, not %s' % (
+        self.fname, ', '.join(differing), [state['query'].get(k) for k in differing],
+        [query[k] for k in differing]))
+    self.totals = _decode(state['totals'])
+    self.periods = state['periods']
+    self.contributions = {h: _decode(c) for h, c in state['contributions'].items()}
+    self.hashes = state['hashes']
+
+  def save(self):
+    state = {
+      'version': STATE_VERSION,
+      'query': self.query.to_dict(),
+      'totals': _encode(self.totals),
+      'periods': self.periods,
+      'contributions': {h: _encode(c) for h, c in self.contributions.items()},
+      'hashes': self.hashes,
+    }
+    tmp = self.fname + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump(state, f)
+    os.replace(tmp, self.fname)
+
+  def content_hash(self, path):
+    """
+    :return: The SHA-256 of a file, reusing the previous hash if its size and mtime are unchanged
+    """
+    st = os.stat(path)
+    cached = self.hashes.get(path)
+    if cached and cached[0] == st.st_size and cached[1] == st.st_mtime:
+      return cached[2]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+      for block in iter(lambda: f.read(_HASH_BLOCK), b''):
+        digest.update(block)
+    self.hashes[path] = [st.st_size, st.st_mtime, digest.hexdigest()]
+    return digest.hexdigest()
+
+  def refresh(self, manifests, processes=None):
+    """
+    Folds the assemblies described by the given manifests into the aggregates.
+
+    :param manifests: Local manifest files, at most one per billing period
+    :param processes: The number of worker processes used to parse new files
+    :return: The number of report files that had to be parsed
+    """
+    updates = {}
+    for fname in manifests:
+      period, assembly_id, paths = read_manifest(fname)
+      hashes = {path: self.content_hash(path) for path in paths}
+      updates[period] = (assembly_id, hashes)
+
+    # Only content never seen before needs parsing
+    pending = {}
+    for assembly_id, hashes in updates.values():
+      for path, content in hashes.items():
+        if content not in self.contributions and content not in pending.values():
+          pending[path] = content
+    with stats.span('cur_manifest.ingest'):
+      for path, aggregate in cur.ingest_each(list(pending), self.query, processes).items():
+        self.contributions[pending[path]] = aggregate
+    stats.incr('cur_files_parsed', len(pending))
+
+    for period, (assembly_id, hashes) in updates.items():
+      previous = collections.Counter(self.periods.get(period, {}).get('hashes', []))
+      current = collections.Counter(hashes.values())
+      for content, count in (previous - current).items():
+        self._apply(self.contributions[content], -count)
+      for content, count in (current - previous).items():
+        self._apply(self.contributions[content], count)
+      self.periods[period] = {'assembly_id': assembly_id, 'hashes': sorted(current.elements())}
+
+    # Forget contributions no period refers to anymore
+    active = set(h for p in self.periods.values() for h in p['hashes'])
+    self.contributions = {h: c for h, c in self.contributions.items() if h in active}
+    return len(pending)
+
+  def _apply(self, contribution, sign):
+    totals = self.totals
+    for key, cost in contribution.items():
+      total = totals.get(key, 0.0) + sign * cost
+      if abs(total) < 1e-9:
+        totals.pop(key, None)
+      else:
+        totals[key] = total
+
+
+def _encode(aggregate):
+  return {_KEY_SEPARATOR.join(key): cost for key, cost in aggregate.items()}
+
+
+def _decode(encoded):
+  return {tuple(key.split(_KEY_SEPARATOR)): cost for key, cost in encoded.items()}
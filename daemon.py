@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Long-running inventory daemon.
+
+Keeps the instance inventory and recent cost data in memory, refreshes them in the background,
+and answers filtered queries over a small local HTTP API:
+
+    GET /instances?env=staging&purpose=searcher&owner=team-search&state=stopped&stopped_days=30
+    GET /instances?env=staging&format=hosts
+    GET /cost?instance_type=m5.large
+    GET /health
+
+"""
+
+import datetime
+import http.server
+import json
+import threading
+import time
+import traceback
+import urllib.parse
+
+import config
+import engine
+import stats
+import utils
+
+
+# Query parameters that are answered from an exact-match index
+INDEXED_FIELDS = ('env', 'purpose', 'user', 'owner', 'state', 'type')
+
+
+class InventoryStore(object):
+  """
+  An immutable-per-refresh snapshot of the inventory, with an index per queryable field.
+
+  Each refresh builds a complete new set of records and indexes and swaps them in at once, so
+  queries never see a half-updated inventory and never need to take a lock.
+  """
+
+  def __init__(self):
+    self.snapshot = ([], {field: {} for field in INDEXED_FIELDS})
+    self.cost = []
+    self.cost_json = b'[]'
+    self.refreshed_at = None
+    self.refresh_seconds = None
+
+  def update(self, instances, cost=None):
+    """
+    Replaces the stored inventory (and cost results, if given).
+
+    :param instances: Instance dicts, as returned by describe_instances
+    :param cost: Cost Explorer ResultsByTime entries, or None to keep the current ones
+    """
+    records = []
+    indexes = {field: {} for field in INDEXED_FIELDS}
+    for instance in instances:
+      record = _record(instance)
+      position = len(records)
+      records.append(record)
+      for field in INDEXED_FIELDS:
+        indexes[field].setdefault(record[field], []).append(position)
+
+    self.snapshot = (records, indexes)
+    if cost is not None:
+      self.cost = _cost_rows(cost)
+      self.cost_json = json.dumps(self.cost).encode('utf-8')
+    self.refreshed_at = datetime.datetime.utcnow()
+
+  def query(self, stopped_days=None, **terms):
+    """
+    Finds instances matching every given term.
+
+    :param stopped_days: Only match instances stopped at least this many days ago
+    :param terms: Exact matches on any of :py:data:`INDEXED_FIELDS`
+    :return: A list of matching records
+    """
+    records, indexes = self.snapshot
+    positions = None
+    # Intersect the smallest posting lists first
+    postings = sorted((indexes[field].get(value, []) for field, value in terms.items()
+                       if value is not None), key=len)
+    for posting in postings:
+      positions = set(posting) if positions is None else positions.intersection(posting)
+      if not positions:
+        return []
+
+    matches = records if positions is None else [records[p] for p in sorted(positions)]
+    if stopped_days is not None:
+      cutoff = time.time() - stopped_days * 86400
+      matches = [r for r in matches if r['stopped_at'] is not None and r['stopped_at'] <= cutoff]
+    return matches
+
+
+class Daemon(object):
+  """
+  Refreshes an :py:class:`InventoryStore` on a schedule and serves it over HTTP.
+
+  :param port: The local port to listen on
+  :param refresh_interval: Seconds between refreshes
+  :param days: The number of days of cost data to keep
+  :param host: The address to bind; local only by default
+  """
+
+  def __init__(self, port=8080, refresh_interval=300, days=30, host='127.0.0.1'):
+    self.store = InventoryStore()
+    self.refresh_interval = refresh_interval
+    self.days = days
+    self.server = http.server.ThreadingHTTPServer((host, port), _handler(self.store))
+    self._stop = threading.Event()
+
+  def refresh(self):
+    start = time.perf_counter()
+    now = datetime.datetime.utcnow()
+    eng = engine.Engine()
+    with stats.span('daemon.refresh'):
+      results = eng.run(
+        instances=eng.fetch_instances(),
+        cost=eng.fetch_cost((now - datetime.timedelta(days=self.days)).strftime('%Y-%m-%d'),
+                            now.strftime('%Y-%m-%d'), granularity='DAILY',
+                            group_by=[{'Type': 'DIMENSION', 'Key': 'LINKED_ACCOUNT'},
+                                      {'Type': 'DIMENSION', 'Key': 'INSTANCE_TYPE'}]))
+      self.store.update(results['instances'], results['cost'])
+    self.store.refresh_seconds = time.perf_counter() - start
+
+  def _refresh_loop(self):
+    while not self._stop.wait(self.refresh_interval):
+      try:
+        self.refresh()
+      except Exception:
+        # Keep serving the last good inventory
+        traceback.print_exc()
+
+  def serve_forever(self):
+    """
+    Loads the inventory once, then serves queries while refreshing in the background.
+    """
+    self.refresh()
+    refresher = threading.Thread(target=self._refresh_loop, name='refresh', daemon=True)
+    refresher.start()
+    print('Serving inventory on http://%s:%d' % self.server.server_address)
+    try:
+      self.server.serve_forever()
+    finally:
+      self._stop.set()
+      self.server.server_close()
+
+
+def _record(instance):
+  tags = utils.get_tags(instance)
+  stopped_time = utils.get_stopped_time(instance)
+  stopped_at = None
+  if stopped_time:
+    stopped_at = datetime.datetime.strptime(stopped_time, utils.STOPPED_TIME_FORMAT).replace(
+      tzinfo=datetime.timezone.utc).timestamp()
+  record = {
+    'id': instance['InstanceId'],
+    'host': utils.generate_host(instance),
+    'role': utils.generate_role(instance),
+    'env': tags.get(config.INSTANCE_ENVIRONMENT_KEY, ''),
+    'purpose': tags.get(config.INSTANCE_PURPOSE_KEY, ''),
+    'user': tags.get(config.INSTANCE_USER_KEY, ''),
+    'owner': utils.strip(tags.get(config.INSTANCE_OWNER_KEY, '')),
+    'state': instance['State']['Name'],
+    'type': instance.get('InstanceType', ''),
+    'private_ip': instance.get('PrivateIpAddress', ''),
+    'launch_time': instance['LaunchTime'].strftime(utils.STOPPED_TIME_FORMAT),
+    'stopped_time': stopped_time,
+    'stopped_at': stopped_at,
+  }
+  # Encoded once per refresh, so that answering a query is a join of bytes
+  record['json'] = json.dumps({k: v for k, v in record.items() if k != 'stopped_at'}).encode(
+    'utf-8')
+  return record
+
+
+def _cost_rows(results):
+  rows = []
+  for result in results:
+    for group in result['Groups']:
+      metric = group['Metrics']['UnblendedCost']
+      rows.append({
+        'start': result['TimePeriod']['Start'],
+        'account': group['Keys'][0],
+        'instance_type': group['Keys'][1] if len(group['Keys']) > 1 else '',
+        'amount': float(metric['Amount']),
+        'unit': metric['Unit'],
+        'estimated': result['Estimated'],
+      })
+  return rows
+
+
+def _handler(store):
+
+  class Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+      url = urllib.parse.urlparse(self.path)
+      params = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+      try:
+        if url.path == '/instances':
+          self._instances(params)
+        elif url.path == '/cost':
+          self._cost(params)
+        elif url.path == '/health':
+          self._send(200, json.dumps({
+            'refreshed_at': store.refreshed_at.isoformat() if store.refreshed_at else None,
+            'refresh_seconds': store.refresh_seconds,
+            'instances': len(store.snapshot[0]),
+            'cost_rows': len(store.cost),
+          }).encode('utf-8'))
+        else:
+          self._send(404, b'{"error": "not found"}')
+      except ValueError as error:
+        self._send(400, json.dumps({'error': str(error)}).encode('utf-8'))
+
+    def _instances(self, params):
+      fmt = params.pop('format', 'json')
+      stopped_days = params.pop('stopped_days', None)
+      unknown = set(params) - set(INDEXED_FIELDS)
+      if unknown:
+        raise ValueError('Unknown query parameters: %s' % ', '.join(sorted(unknown)))
+      records = store.query(stopped_days=float(stopped_days) if stopped_days else None, **params)
+      if fmt == 'hosts':
+        self._send(200, '\n'.join(r['host'] for r in records).encode('utf-8'), 'text/plain')
+      else:
+        self._send(200, b'[' + b','.join(r['json'] for r in records) + b']')
+
+    def _cost(self, params):
+      if not params:
+        self._send(200, store.cost_json)
+        return
+      rows = [r for r in store.cost if all(str(r.get(k)) == v for k, v in params.items())]
+      self._send(200, json.dumps(rows).encode('utf-8'))
+
+    def _send(self, status, body, content_type='application/json'):
+      self.send_response(status)
+      self.send_header('Content-Type', content_type)
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      stats.incr('daemon_requests')
+
+  return Handler
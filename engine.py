@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+"""
+Asyncio execution engine for AWS fetches.
+
+boto3 clients are blocking, so every API call runs in a thread pool while the event loop
+schedules independent fetches (the EC2 inventory, Cost Explorer windows, enrichment lookups)
+concurrently. Calls are limited per service by a semaphore, throttled and transient failures are
+retried with jittered exponential backoff, and the first fatal error (anything else) cancels every
+other fetch of the same run.
+
+    eng = engine.Engine()
+    results = eng.run(instances=eng.fetch_instances(), cost=eng.fetch_cost(start, end, ...))
+
+"""
+
+import asyncio
+import concurrent.futures
+import datetime
+import random
+import sys
+import time
+
+from botocore.exceptions import ClientError
+from boto.exception import EC2ResponseError
+
+import backend
+import stats
+
+
+# Maximum number of concurrent in-flight calls per service
+SERVICE_CONCURRENCY = {
+  'ce': 2,
+  'cloudwatch': 4,
+  'ec2': 4,
+  # Route 53 applies one change batch per zone at a time, and rate limits accounts to 5 req/s
+  'route53': 1,
+}
+DEFAULT_CONCURRENCY = 4
+
+# The most values a single EC2 describe filter may carry
+FILTER_VALUES_PER_REQUEST = 200
+
+# The most groups DescribeAutoScalingGroups returns per page
+AUTO_SCALING_GROUPS_PER_PAGE = 100
+
+# The most record sets ListResourceRecordSets returns per page
+RECORD_SETS_PER_PAGE = 300
+
+# Number of granularity periods fetched per Cost Explorer request
+COST_PERIODS_PER_CHUNK = {
+  'DAILY': 14,
+  'WEEKLY': 4,
+  'MONTHLY': 1,
+}
+
+# The most metric queries a single GetMetricData request may carry
+METRIC_QUERIES_PER_REQUEST = 500
+
+# Backoff before the Nth retry: a random delay of up to RETRY_BASE_SECS * 2**N, capped
+RETRY_BASE_SECS = 0.5
+RETRY_MAX_DELAY_SECS = 20
+# Seconds after which the last retryable error is re-raised
+RETRY_MAX_TIMEOUT = 60
+
+# Error codes worth retrying; any other error, bar a 5xx, is raised at once
+RETRYABLE_CODES = frozenset([
+  'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException',
+  'RequestThrottled', 'RequestThrottledException', 'PriorRequestNotComplete',
+  'InternalError', 'InternalFailure', 'ServiceUnavailable', 'Unavailable',
+])
+
+
+def is_retryable(error):
+  """
+  :param error: An exception raised by an API call
+  :return: Whether the call may succeed if retried: throttling and server side errors
+  """
+  if isinstance(error, ClientError):
+    code = error.response.get('Error', {}).get('Code')
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+  elif isinstance(error, EC2ResponseError):
+    code, status = error.error_code, error.status
+  else:
+    return False
+  return code in RETRYABLE_CODES or (status or 0) >= 500
+
+
+def retry_delay(attempt):
+  """
+  :param attempt: The number of retries so far, from 0
+  :return: Seconds to wait before the next retry: exponential backoff with full jitter
+  """
+  return random.uniform(0, min(RETRY_MAX_DELAY_SECS, RETRY_BASE_SECS * 2 ** attempt))
+
+
+def cost_periods(start, end, granularity):
+  """
+  Splits a Cost Explorer time period into its granularity periods.
+
+  :param start: The inclusive start date, as YYYY-MM-DD
+  :param end: The exclusive end date, as YYYY-MM-DD
+  :param granularity: DAILY, WEEKLY or MONTHLY
+  :return: A list of (start, end) YYYY-MM-DD string tuples
+  """
+  day = datetime.datetime.strptime(start, '%Y-%m-%d').date()
+  last = datetime.datetime.strptime(end, '%Y-%m-%d').date()
+  periods = []
+  while day < last:
+    if granularity == 'MONTHLY':
+      following = (day.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+    elif granularity == 'WEEKLY':
+      following = day + datetime.timedelta(days=7)
+    else:
+      following = day + datetime.timedelta(days=1)
+    following = min(following, last)
+    periods.append((day.isoformat(), following.isoformat()))
+    day = following
+  return periods
+
+
+class Engine(object):
+  """
+  Runs AWS fetches concurrently on an event loop.
+
+  :param aws: The backend to take clients from; defaults to :py:func:`backend.get_backend`
+  :param concurrency: Per-service overrides of :py:data:`SERVICE_CONCURRENCY`
+  :param max_workers: The size of the thread pool blocking calls run in
+  """
+
+  def __init__(self, aws=None, concurrency=None, max_workers=16):
+    self.aws = aws
+    self.concurrency = dict(SERVICE_CONCURRENCY, **(concurrency or {}))
+    self.max_workers = max_workers
+    self._executor = None
+    self._semaphores = {}
+
+  def run(self, **fetches):
+    """
+    Runs fetches concurrently and waits for all of them.
+
+    :param fetches: Coroutines keyed by name, e.g. ``instances=eng.fetch_instances()``
+    :return: A dict of each fetch's result, keyed by the same names
+    """
+    return asyncio.run(self.gather(**fetches))
+
+  async def gather(self, **fetches):
+    """
+    Awaits several fetches, cancelling all of them as soon as one fails.
+
+    :param fetches: Coroutines keyed by name
+    :return: A dict of each fetch's result, keyed by the same names
+    """
+    own_executor = self._executor is None
+    if own_executor:
+      self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+      self._semaphores = {}
+    tasks = {asyncio.ensure_future(coro): name for name, coro in fetches.items()}
+    try:
+      done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+      failed = [task for task in done if not task.cancelled() and task.exception()]
+      if failed:
+        for task in pending:
+          task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        raise failed[0].exception()
+      return {tasks[task]: task.result() for task in done}
+    finally:
+      if own_executor:
+        self._executor.shutdown(wait=False)
+        self._executor = None
+
+  def _semaphore(self, service):
+    # Created lazily so that they belong to the running event loop.
+    if service not in self._semaphores:
+      self._semaphores[service] = asyncio.Semaphore(
+        self.concurrency.get(service, DEFAULT_CONCURRENCY))
+    return self._semaphores[service]
+
+  async def call(self, service, operation, **kwargs):
+    """
+    Calls one AWS API operation in the thread pool, retrying throttling and transient errors
+    (see :py:func:`is_retryable`) with backoff until :py:data:`RETRY_MAX_TIMEOUT`.
+
+    :param service: The boto3 service name, e.g. ec2
+    :param operation: The client method name, e.g. describe_instances
+    :param kwargs: The API call's parameters
+    :return: The API response
+    """
+    client = (self.aws or backend.get_backend()).client(service)
+    method = getattr(client, operation)
+    loop = asyncio.get_running_loop()
+    deadline = time.monotonic() + RETRY_MAX_TIMEOUT
+    attempt = 0
+    while True:
+      try:
+        async with self._semaphore(service):
+          return await loop.run_in_executor(self._executor, lambda: method(**kwargs))
+      except (ClientError, EC2ResponseError) as error:
+        delay = retry_delay(attempt)
+        if not is_retryable(error) or time.monotonic() + delay >= deadline:
+          raise
+        attempt += 1
+        stats.incr('api_retries', operation=operation)
+        # Standard output may be the report itself, e.g. a TSV piped elsewhere
+        print('Retrying %s in %.1fs: %s' % (operation, delay, error), file=sys.stderr)
+        await asyncio.sleep(delay)
+
+  async def paginate(self, service, operation, token_key='NextToken', request_token_key=None,
+                     on_page=None, **kwargs):
+    """
+    Follows a chain of pages of one API operation.
+
+    :param token_key: The response key holding the next page's token
+    :param request_token_key: The request parameter the token is passed back in, if different
+    :param on_page: If given, a coroutine function awaited with each page as it arrives instead of
+        keeping the pages
+    :return: A list of responses, one per page (empty if on_page is given)
+    """
+    request_token_key = request_token_key or token_key
+    pages = []
+    while True:
+      page = await self.call(service, operation, **kwargs)
+      stats.incr('api_pages', operation=operation)
+      if on_page is None:
+        pages.append(page)
+      else:
+        await on_page(page)
+      token = page.get(token_key)
+      if not token:
+        return pages
+      kwargs = dict(kwargs, **{request_token_key: token})
+
+  async def fetch_instances(self, filters=None, on_page=None):
+    """
+    Fetches the EC2 inventory.
+
+    :param filters: describe_instances filters, if any
+    :param on_page: If given, a coroutine function awaited with the list of instances of each page
+        as it arrives instead of keeping them, e.g. to stream them to :py:class:`pipeline.FanOut`
+    :return: A list of instance dicts (empty if on_page is given)
+    """
+    kwargs = {'Filters': filters} if filters else {}
+    instances = []
+
+    async def collect(page):
+      page_instances = [i for reservation in page['Reservations'] for i in reservation['Instances']]
+      if on_page is None:
+        instances.extend(page_instances)
+      else:
+        await on_page(page_instances)
+
+    with stats.span('fetch.instances'):
+      await self.paginate('ec2', 'describe_instances', on_page=collect, **kwargs)
+    return instances
+
+  async def fetch_by_ids(self, operation, filter_name, result_key, ids):
+    """
+    Fetches EC2 resources by ID, as few filter values per request as allowed and the requests
+    run concurrently. IDs that do not exist are left out rather than failing the request.
+
+    :param operation: The describe operation, e.g. describe_subnets
+    :param filter_name: The filter the IDs are matched with, e.g. subnet-id
+    :param result_key: The response key holding the resources, e.g. Subnets
+    :param ids: The resource IDs
+    :return: A list of resource dicts
+    """
+    ids = sorted(ids)
+    chunks = [ids[i:i + FILTER_VALUES_PER_REQUEST]
+              for i in range(0, len(ids), FILTER_VALUES_PER_REQUEST)]
+    chunk_pages = await asyncio.gather(*[
+      self.paginate('ec2', operation, Filters=[{'Name': filter_name, 'Values': chunk}])
+      for chunk in chunks])
+    return [resource for pages in chunk_pages for page in pages for resource in page[result_key]]
+
+  async def fetch_subnets(self, subnet_ids):
+    """
+    :return: The ``Subnets`` entries of the given subnet IDs
+    """
+    with stats.span('fetch.subnets'):
+      return await self.fetch_by_ids('describe_subnets', 'subnet-id', 'Subnets', subnet_ids)
+
+  async def fetch_vpcs(self, vpc_ids):
+    """
+    :return: The ``Vpcs`` entries of the given VPC IDs
+    """
+    with stats.span('fetch.vpcs'):
+      return await self.fetch_by_ids('describe_vpcs', 'vpc-id', 'Vpcs', vpc_ids)
+
+  async def fetch_security_groups(self, group_ids):
+    """
+    :return: The ``SecurityGroups`` entries of the given security group IDs
+    """
+    with stats.span('fetch.security_groups'):
+      return await self.fetch_by_ids('describe_security_groups', 'group-id', 'SecurityGroups',
+                                     group_ids)
+
+  async def fetch_images(self, image_ids):
+    """
+    :return: The ``Images`` entries of the given AMI IDs that still exist and are visible
+    """
+    with stats.span('fetch.images'):
+      return await self.fetch_by_ids('describe_images', 'image-id', 'Images', image_ids)
+
+  async def fetch_auto_scaling_groups(self):
+    """
+    Fetches every Auto Scaling group with its member instances.
+
+    :return: A list of ``AutoScalingGroups`` entries
+    """
+    with stats.span('fetch.auto_scaling_groups'):
+      pages = await self.paginate('autoscaling', 'describe_auto_scaling_groups',
+                                  MaxRecords=AUTO_SCALING_GROUPS_PER_PAGE)
+    return [group for page in pages for group in page['AutoScalingGroups']]
+
+  async def fetch_zone(self, name):
+    """
+    Fetches every record set of a Route 53 hosted zone.
+
+    :param name: The zone name, e.g. managed.compass.com
+    :return: A tuple of (hosted zone ID, list of ``ResourceRecordSets`` entries)
+    """
+    name = name.rstrip('.') + '.'
+    with stats.span('fetch.zone'):
+      response = await self.call('route53', 'list_hosted_zones_by_name', DNSName=name, MaxItems='1')
+      zones = [z['Id'] for z in response['HostedZones'] if z['Name'] == name]
+      if not zones:
+        raise ValueError('There is no hosted zone named %s' % name)
+
+      # Pages are chained by the name and type of the next record set rather than a token
+      record_sets = []
+      kwargs = {}
+      while True:
+        page = await self.call('route53', 'list_resource_record_sets', HostedZoneId=zones[0],
+                               MaxItems=str(RECORD_SETS_PER_PAGE), **kwargs)
+        stats.incr('api_pages', operation='list_resource_record_sets')
+        record_sets.extend(page['ResourceRecordSets'])
+        if not page.get('IsTruncated'):
+          return zones[0], record_sets
+        kwargs = {'StartRecordName': page['NextRecordName'],
+                  'StartRecordType': page['NextRecordType']}
+        if page.get('NextRecordIdentifier'):
+          kwargs['StartRecordIdentifier'] = page['NextRecordIdentifier']
+
+  async def change_record_sets(self, zone_id, batches, comment=None):
+    """
+    Submits Route 53 change batches, one at a time and in order.
+
+    :param zone_id: The hosted zone ID
+    :param batches: Lists of ``Changes`` entries, each small enough for one request
+    :param comment: The batches' comment
+    :return: The ``ChangeInfo`` of each batch
+    """
+    changes = []
+    with stats.span('route53.change'):
+      for batch in batches:
+        change_batch = {'Changes': batch}
+        if comment:
+          change_batch['Comment'] = comment
+        response = await self.call('route53', 'change_resource_record_sets', HostedZoneId=zone_id,
+                                   ChangeBatch=change_batch)
+        changes.append(response['ChangeInfo'])
+    return changes
+
+  async def fetch_reservations(self):
+    """
+    Fetches the active reserved instances.
+
+    :return: A list of ``ReservedInstances`` entries
+    """
+    with stats.span('fetch.reservations'):
+      response = await self.call('ec2', 'describe_reserved_instances',
+                                 Filters=[{'Name': 'state', 'Values': ['active']}])
+    return response['ReservedInstances']
+
+  async def fetch_savings_plans(self):
+    """
+    Fetches the active Savings Plans.
+
+    :return: A list of ``savingsPlans`` entries
+    """
+    with stats.span('fetch.savings_plans'):
+      pages = await self.paginate('savingsplans', 'describe_savings_plans', token_key='nextToken',
+                                  states=['active'])
+    return [plan for page in pages for plan in page['savingsPlans']]
+
+  async def fetch_metrics(self, instance_ids, metrics, start, end, period=3600,
+                          statistic='Average', namespace='AWS/EC2'):
+    """
+    Fetches EC2 metrics of many instances, packing as many metric queries into each GetMetricData
+    request as allowed and running the requests concurrently.
+
+    :param instance_ids: The instances to fetch metrics of
+    :param metrics: Metric names, e.g. ('CPUUtilization', 'NetworkIn')
+    :param start: The start of the time range, a datetime
+    :param end: The end of the time range, a datetime
+    :param period: The datapoint period in seconds
+    :param statistic: The statistic of each datapoint, e.g. Average or Maximum
+    :return: A dict of {instance ID: {metric name: [(timestamp, value)]}}
+    """
+    queries = [(instance_id, metric) for instance_id in instance_ids for metric in metrics]
+    batches = [queries[i:i + METRIC_QUERIES_PER_REQUEST]
+               for i in range(0, len(queries), METRIC_QUERIES_PER_REQUEST)]
+
+    async def fetch_batch(batch):
+      pages = await self.paginate('cloudwatch', 'get_metric_data', StartTime=start, EndTime=end,
+                                  MetricDataQueries=[{
+                                    'Id': 'q%d' % i,
+                                    'MetricStat': {
+                                      'Metric': {
+                                        'Namespace': namespace,
+                                        'MetricName': metric,
+                                        'Dimensions': [{'Name': 'InstanceId', 'Value': instance_id}],
+                                      },
+                                      'Period': period,
+                                      'Stat': statistic,
+                                    },
+                                    'ReturnData': True,
+                                  } for i, (instance_id, metric) in enumerate(batch)])
+      # A query's datapoints may be split over several pages
+      values = {}
+      for page in pages:
+        for result in page['MetricDataResults']:
+          values.setdefault(result['Id'], []).extend(zip(result['Timestamps'], result['Values']))
+      return batch, values
+
+    with stats.span('fetch.metrics'):
+      fetched = await asyncio.gather(*[fetch_batch(batch) for batch in batches])
+    results = {instance_id: {} for instance_id in instance_ids}
+    for batch, values in fetched:
+      for i, (instance_id, metric) in enumerate(batch):
+        results[instance_id][metric] = values.get('q%d' % i, [])
+    return results
+
+  async def fetch_cost(self, start, end, granularity='WEEKLY', metrics=('UnblendedCost',),
+                       group_by=(), cost_filter=None, periods_per_chunk=None, on_result=None):
+    """
+    Fetches Cost Explorer results, splitting the time period into chunks fetched concurrently.
+
+    :param start: The inclusive start date, as YYYY-MM-DD
+    :param end: The exclusive end date, as YYYY-MM-DD
+    :param granularity: DAILY, WEEKLY or MONTHLY
+    :param metrics: The cost metrics to fetch
+    :param group_by: Cost Explorer GroupBy definitions
+    :param cost_filter: A Cost Explorer filter expression, if any
+    :param periods_per_chunk: Granularity periods per request; see :py:data:`COST_PERIODS_PER_CHUNK`
+    :param on_result: If given, called with each ``ResultsByTime`` entry as its page arrives, so
+        that callers can summarize the results without holding them
+    :return: The ``ResultsByTime`` entries of all pages, in time order (empty if on_result is given)
+    """
+    periods = cost_periods(start, end, granularity)
+    size = periods_per_chunk or COST_PERIODS_PER_CHUNK.get(granularity, 1)
+    chunks = [(periods[i][0], periods[min(i + size, len(periods)) - 1][1])
+              for i in range(0, len(periods), size)]
+
+    kwargs = {'Granularity': granularity, 'Metrics': list(metrics), 'GroupBy': list(group_by)}
+    if cost_filter:
+      kwargs['Filter'] = cost_filter
+    on_page = None
+    if on_result is not None:
+      async def on_page(page):
+        for result in page['ResultsByTime']:
+          on_result(result)
+    with stats.span('fetch.cost'):
+      chunk_pages = await asyncio.gather(*[
+        self.paginate('ce', 'get_cost_and_usage', token_key='NextPageToken', on_page=on_page,
+                      TimePeriod={'Start': chunk_start, 'End': chunk_end}, **kwargs)
+        for chunk_start, chunk_end in chunks
+      ])
+    return [result for pages in chunk_pages for page in pages for result in page['ResultsByTime']]
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Parquet export of the inventory and cost datasets.
+
+The instance details written by :py:func:`utils.create_instance_detail_file` and the daily cost
+printed by ``print_pricing_per_instance_type`` are also written as typed Parquet datasets, so a
+warehouse loads them without parsing text. Low cardinality string columns (states, types,
+owners, accounts...) are dictionary encoded, and files are zstd compressed.
+
+Datasets are partitioned Hive style, instances by snapshot date and environment and cost by day,
+e.g. ``instances/date=2019-07-01/env=staging/instances-1561939200000000-0.parquet``. Each
+instance export adds new files rather than rewriting old ones, so snapshots accumulate (told
+apart by ``taken_at``); a cost export replaces the days it covers, as Cost Explorer restates
+recent days. Row groups are sized for large appends.
+
+"""
+
+import datetime
+
+import pricing
+import stats
+import utils
+
+try:
+  import pyarrow
+  import pyarrow.dataset
+except ImportError:
+  pyarrow = None
+
+
+# Rows per row group: large enough for efficient scans, small enough to bound writer memory
+ROW_GROUP_ROWS = 128 * 1024
+MAX_ROWS_PER_FILE = 8 * ROW_GROUP_ROWS
+
+INSTANCE_PARTITIONS = ('date', 'env')
+COST_PARTITIONS = ('date',)
+
+# The partition value of instances without an environment tag
+UNKNOWN_ENV = 'unknown'
+
+
+def _require_pyarrow():
+  if pyarrow is None:
+    raise RuntimeError('pyarrow is required to export Parquet datasets')
+
+
+def _strings():
+  return pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+
+
+def instance_schema(resource_costs=False, catalog=False, utilization=False):
+  """
+  :return: The schema of the instance dataset, with the optional column groups of
+      :py:func:`utils.create_instance_detail_file`
+  """
+  _require_pyarrow()
+  fields = [
+    ('date', pyarrow.string()),
+    ('env', pyarrow.string()),
+    ('taken_at', pyarrow.timestamp('s', tz='UTC')),
+    ('instance_id', pyarrow.string()),
+    ('hostname', pyarrow.string()),
+    ('key_name', _strings()),
+    ('state', _strings()),
+    ('volumes', pyarrow.list_(pyarrow.string())),
+    ('instance_type', _strings()),
+    ('launch_time', pyarrow.timestamp('s', tz='UTC')),
+    ('owner', _strings()),
+    ('name', pyarrow.string()),
+    ('purpose', _strings()),
+    ('role', _strings()),
+    ('stopped_time', pyarrow.timestamp('s', tz='UTC')),
+    ('days_since_stopped', pyarrow.int32()),
+  ]
+  if resource_costs:
+    fields.append(('month_to_date_cost', pyarrow.float64()))
+  if catalog:
+    fields.extend([('hourly_price', pyarrow.float64()), ('est_monthly_cost', pyarrow.float64())])
+  if utilization:
+    fields.extend([('cpu_p50', pyarrow.float64()), ('cpu_p95', pyarrow.float64()),
+                   ('cpu_max', pyarrow.float64()), ('network_p95_mb', pyarrow.float64()),
+                   ('rightsizing', _strings())])
+  return pyarrow.schema(fields)
+
+
+def cost_schema():
+  """
+  :return: The schema of the cost dataset
+  """
+  _require_pyarrow()
+  return pyarrow.schema([
+    ('date', pyarrow.string()),
+    ('linked_account', _strings()),
+    ('instance_type', _strings()),
+    ('amount', pyarrow.float64()),
+    ('unit', _strings()),
+    ('estimated', pyarrow.bool_()),
+  ])
+
+
+def instance_table(instances, now=None, resource_costs=None, catalog=None, utilization=None):
+  """
+  Lays out instance details as an Arrow table; the typed counterpart of the detail file.
+
+  :param instances: Instance dicts, as returned by describe_instances
+  :param now: The snapshot time, a UTC datetime; defaults to now
+  :param resource_costs: A dict of month-to-date cost per instance and volume ID
+  :param catalog: A :py:class:`pricing.PriceCatalog`
+  :param utilization: A dict of {instance ID: :py:class:`utilization.Utilization`}
+  :return: A :py:class:`pyarrow.Table` of :py:func:`instance_schema`
+  """
+  schema = instance_schema(resource_costs is not None, catalog is not None,
+                           utilization is not None)
+  now = now or datetime.datetime.now(datetime.timezone.utc)
+  metadata = utils._get_instance_metadata(instances)
+  columns = {name: [] for name in schema.names}
+  for instance in instances:
+    _id = instance['InstanceId']
+    attributes = utils.get_instance_attributes(instance)
+    stopped_time = None
+    if metadata[_id].stopped_time:
+      stopped_time = datetime.datetime.strptime(
+        metadata[_id].stopped_time, utils.STOPPED_TIME_FORMAT).replace(tzinfo=datetime.timezone.utc)
+    columns['date'].append(now.strftime('%Y-%m-%d'))
+    columns['env'].append(attributes['env'] or UNKNOWN_ENV)
+    columns['taken_at'].append(now)
+    columns['instance_id'].append(_id)
+    columns['hostname'].append(utils.generate_host(instance) or None)
+    columns['key_name'].append(instance.get('KeyName'))
+    columns['state'].append(instance['State']['Name'])
+    columns['volumes'].append(utils.get_volume_ids(instance))
+    columns['instance_type'].append(instance['InstanceType'])
+    columns['launch_time'].append(instance.get('LaunchTime'))
+    columns['owner'].append(utils.strip(metadata[_id].owner) or None)
+    columns['name'].append(utils.strip(metadata[_id].name) or None)
+    columns['purpose'].append(attributes['purpose'] or None)
+    columns['role'].append(attributes['role'] or None)
+    columns['stopped_time'].append(stopped_time)
+    columns['days_since_stopped'].append((now - stopped_time).days if stopped_time else None)
+    if resource_costs is not None:
+      columns['month_to_date_cost'].append(utils.get_instance_cost(instance, resource_costs))
+    if catalog is not None:
+      price = catalog.instance_price(instance)
+      running = instance['State']['Name'] == 'running'
+      columns['hourly_price'].append(price)
+      columns['est_monthly_cost'].append(
+        None if price is None else price * pricing.HOURS_PER_MONTH if running else 0.0)
+    if utilization is not None:
+      usage = utilization.get(_id)
+      columns['cpu_p50'].append(usage.cpu_p50 if usage else None)
+      columns['cpu_p95'].append(usage.cpu_p95 if usage else None)
+      columns['cpu_max'].append(usage.cpu_max if usage else None)
+      columns['network_p95_mb'].append(usage.network_p95 if usage else None)
+      columns['rightsizing'].append(usage.suggestion or None if usage else None)
+  return pyarrow.table(columns, schema=schema)
+
+
+def cost_table(results):
+  """
+  :param results: Cost Explorer ResultsByTime entries grouped by linked account and instance type
+  :return: A :py:class:`pyarrow.Table` of :py:func:`cost_schema`
+  """
+  schema = cost_schema()
+  columns = {name: [] for name in schema.names}
+  for result in results:
+    for group in result['Groups']:
+      keys = list(group['Keys']) + [None, None]
+      columns['date'].append(result['TimePeriod']['Start'])
+      columns['linked_account'].append(keys[0])
+      columns['instance_type'].append(keys[1])
+      columns['amount'].append(float(group['Metrics']['UnblendedCost']['Amount']))
+      columns['unit'].append(group['Metrics']['UnblendedCost']['Unit'])
+      columns['estimated'].append(bool(result.get('Estimated')))
+  return pyarrow.table(columns, schema=schema)
+
+
+def write_dataset(table, base_dir, partitions, prefix, replace_partitions=False):
+  """
+  Appends a table to a Hive partitioned Parquet dataset.
+
+  :param table: A :py:class:`pyarrow.Table`
+  :param base_dir: The dataset's root directory
+  :param partitions: The (string) columns to partition by, in directory order
+  :param prefix: The file name prefix; files are named <prefix>-<timestamp>-<n>.parquet, so
+      successive exports never overwrite each other
+  :param replace_partitions: Whether to delete what the partitions written to held before
+  :return: The number of rows written
+  """
+  _require_pyarrow()
+  with stats.span('export.write'):
+    partitioning = pyarrow.dataset.partitioning(
+      pyarrow.schema([table.schema.field(name) for name in partitions]), flavor='hive')
+    pyarrow.dataset.write_dataset(
+      table, base_dir, format='parquet', partitioning=partitioning,
+      basename_template='%s-%d-{i}.parquet' % (
+        prefix, int(datetime.datetime.now(datetime.timezone.utc).timestamp() * 1e6)),
+      existing_data_behavior='delete_matching' if replace_partitions else 'overwrite_or_ignore',
+      file_options=pyarrow.dataset.ParquetFileFormat().make_write_options(compression='zstd'),
+      min_rows_per_group=ROW_GROUP_ROWS, max_rows_per_group=ROW_GROUP_ROWS,
+      max_rows_per_file=MAX_ROWS_PER_FILE)
+  stats.incr('export_rows', table.num_rows)
+  return table.num_rows
+
+
+def export_instances(instances, base_dir, **kwargs):
+  """
+  Appends instance details to the instance dataset under base_dir.
+
+  :param kwargs: Passed to :py:func:`instance_table`
+  """
+  return write_dataset(instance_table(instances, **kwargs), base_dir, INSTANCE_PARTITIONS,
+                       'instances')
+
+
+def export_cost(results, base_dir):
+  """
+  Writes Cost Explorer results to the cost dataset under base_dir, replacing the days they cover.
+  """
+  return write_dataset(cost_table(results), base_dir, COST_PARTITIONS, 'cost',
+                       replace_partitions=True)
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""
+A small filter language for instance queries.
+
+    owner=~team-* and state=stopped and stopped_days>30 and type in (m3.*, m4.*)
+
+Terms compare a field (see :py:data:`FIELDS`, or ``tag:<Key>`` for any tag) with a value:
+
+    =, !=        equality
+    =~, !~       glob match (*, ?, [...])
+    <, <=, >, >= numeric comparison, of numeric fields only
+    in (a, b)    equality with any value, or glob match for values with wildcards
+
+and are combined with ``and``, ``or``, ``not`` and parentheses. Values with spaces or special
+characters can be quoted.
+
+An expression is compiled once into a predicate. The equality terms of its top level ``and``
+that EC2 can evaluate are also turned into describe_instances ``Filters``, so they narrow the
+inventory on the API side; only the remaining terms are evaluated locally, in a single pass.
+
+"""
+
+import datetime
+import fnmatch
+import operator
+import re
+
+import config
+import utils
+
+
+def _launch_days(instance, tags, now):
+  launch_time = instance.get('LaunchTime')
+  return (now - launch_time).days if launch_time else None
+
+
+def _stopped_days(instance, tags, now):
+  stopped_time = utils.get_stopped_time(instance)
+  if not stopped_time:
+    return None
+  return (now.replace(tzinfo=None) -
+          datetime.datetime.strptime(stopped_time, utils.STOPPED_TIME_FORMAT)).days
+
+
+# Field name -> function of (instance, tags, now) returning its value
+FIELDS = {
+  'id': lambda i, tags, now: i['InstanceId'],
+  'state': lambda i, tags, now: i['State']['Name'],
+  'type': lambda i, tags, now: i.get('InstanceType', ''),
+  'zone': lambda i, tags, now: i.get('Placement', {}).get('AvailabilityZone', ''),
+  'region': lambda i, tags, now: i.get('Placement', {}).get('AvailabilityZone', '')[:-1],
+  'key': lambda i, tags, now: i.get('KeyName') or '',
+  'ip': lambda i, tags, now: i.get('PrivateIpAddress') or '',
+  'image': lambda i, tags, now: i.get('ImageId', ''),
+  'subnet': lambda i, tags, now: i.get('SubnetId', ''),
+  'vpc': lambda i, tags, now: i.get('VpcId', ''),
+  'env': lambda i, tags, now: tags.get(config.INSTANCE_ENVIRONMENT_KEY, ''),
+  'purpose': lambda i, tags, now: tags.get(config.INSTANCE_PURPOSE_KEY, ''),
+  'owner': lambda i, tags, now: utils.strip(tags.get(config.INSTANCE_OWNER_KEY, '')),
+  'user': lambda i, tags, now: tags.get(config.INSTANCE_USER_KEY, ''),
+  'name': lambda i, tags, now: tags.get('Name', ''),
+  'role': lambda i, tags, now: utils.generate_role(i) or '',
+  'host': lambda i, tags, now: utils.generate_host(i) or '',
+  'launch_days': _launch_days,
+  'stopped_days': _stopped_days,
+}
+
+NUMERIC_FIELDS = frozenset(('launch_days', 'stopped_days'))
+
+# Fields describe_instances can filter on, and the filter names
+API_FILTERS = {
+  'id': 'instance-id',
+  'state': 'instance-state-name',
+  'type': 'instance-type',
+  'zone': 'availability-zone',
+  'key': 'key-name',
+  'image': 'image-id',
+  'subnet': 'subnet-id',
+  'vpc': 'vpc-id',
+  'env': 'tag:' + config.INSTANCE_ENVIRONMENT_KEY,
+  'purpose': 'tag:' + config.INSTANCE_PURPOSE_KEY,
+  'user': 'tag:' + config.INSTANCE_USER_KEY,
+  'name': 'tag:Name',
+}
+
+_TOKEN_RE = re.compile(r"""\s*(?:
+  (?P<punct>[(),]) |
+  (?P<op>=~|!~|!=|<=|>=|=|<|>) |
+  "(?P<dquoted>[^"]*)" |
+  '(?P<squoted>[^']*)' |
+  (?P<word>[^\s(),=!<>~"']+)
+)""", re.VERBOSE)
+
+_KEYWORDS = frozenset(('and', 'or', 'not', 'in'))
+
+_WILDCARD_RE = re.compile(r'[*?\[]')
+
+_NUMERIC_OPERATORS = {
+  '=': operator.eq,
+  '!=': operator.ne,
+  '<': operator.lt,
+  '<=': operator.le,
+  '>': operator.gt,
+  '>=': operator.ge,
+}
+
+
+def quote(value):
+  """
+  :return: value as a filter language literal
+  """
+  return '"%s"' % value if '"' not in value else "'%s'" % value
+
+
+def _tokenize(expression):
+  tokens = []
+  position = 0
+  expression = expression.rstrip()
+  while position < len(expression):
+    match = _TOKEN_RE.match(expression, position)
+    if not match or match.end() == position:
+      raise ValueError('Unexpected %r at position %d of filter %r' % (
+        expression[position:position + 10].strip(), position, expression))
+    position = match.end()
+    if match.group('punct') or match.group('op'):
+      tokens.append((match.group('punct') or match.group('op'), None))
+    elif match.group('word') is not None:
+      word = match.group('word')
+      tokens.append((word.lower(), None) if word.lower() in _KEYWORDS else ('value', word))
+    else:
+      quoted = match.group('dquoted')
+      tokens.append(('value', quoted if quoted is not None else match.group('squoted')))
+  return tokens
+
+
+class _Parser(object):
+  """
+  Recursive descent over the tokens of an expression, into a tree of tuples:
+  ('and', [nodes]), ('or', [nodes]), ('not', node), ('term', field, op, [values]).
+  """
+
+  def __init__(self, expression):
+    self.expression = expression
+    self.tokens = _tokenize(expression)
+    self.position = 0
+
+  def error(self, message):
+    raise ValueError('%s in filter %r' % (message, self.expression))
+
+  def peek(self):
+    return self.tokens[self.position][0] if self.position < len(self.tokens) else None
+
+  def take(self, kind):
+    if self.peek() != kind:
+      self.error('Expected %s, found %s' % (kind, self.peek() or 'the end'))
+    self.position += 1
+    return self.tokens[self.position - 1][1]
+
+  def parse(self):
+    node = self.disjunction()
+    if self.peek() is not None:
+      self.error('Unexpected %s' % self.peek())
+    return node
+
+  def disjunction(self):
+    nodes = [self.conjunction()]
+    while self.peek() == 'or':
+      self.take('or')
+      nodes.append(self.conjunction())
+    return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+  def conjunction(self):
+    nodes = [self.negation()]
+    while self.peek() == 'and':
+      self.take('and')
+      nodes.append(self.negation())
+    return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+  def negation(self):
+    if self.peek() == 'not':
+      self.take('not')
+      return ('not', self.negation())
+    if self.peek() == '(':
+      self.take('(')
+      node = self.disjunction()
+      self.take(')')
+      return node
+    return self.term()
+
+  def term(self):
+    field = self.take('value')
+    if field not in FIELDS and not field.startswith('tag:'):
+      self.error('Unknown field %r' % field)
+    op = self.peek()
+    if op == 'in':
+      self.take('in')
+      self.take('(')
+      values = [self.take('value')]
+      while self.peek() == ',':
+        self.take(',')
+        values.append(self.take('value'))
+      self.take(')')
+      return ('term', field, 'in', values)
+    if op not in ('=', '!=', '=~', '!~', '<', '<=', '>', '>='):
+      self.error('Expected an operator after %s' % field)
+    self.position += 1
+    value = self.take('value')
+    if op in ('<', '<=', '>', '>=') and field not in NUMERIC_FIELDS:
+      self.error('%s is not numeric; %s only compares %s' % (
+        field, op, ', '.join(sorted(NUMERIC_FIELDS))))
+    return ('term', field, op, [value])
+
+
+def _glob(pattern):
+  return re.compile(fnmatch.translate(pattern)).match
+
+
+def _number(field, value):
+  try:
+    return float(value)
+  except ValueError:
+    raise ValueError('%s compares with numbers, not %r' % (field, value))
+
+
+def _compile_term(field, op, values):
+  if field.startswith('tag:'):
+    key = field[len('tag:'):]
+    getter = lambda i, tags, now: tags.get(key, '')
+  else:
+    getter = FIELDS[field]
+
+  if field in NUMERIC_FIELDS:
+    if op == 'in':
+      numbers = frozenset(_number(field, v) for v in values)
+      return lambda i, tags, now: getter(i, tags, now) in numbers
+    if op not in _NUMERIC_OPERATORS:
+      raise ValueError('%s does not glob match; use a numeric comparison' % field)
+    compare = _NUMERIC_OPERATORS[op]
+    number = _number(field, values[0])
+    def numeric(i, tags, now):
+      actual = getter(i, tags, now)
+      # Instances without a value (e.g. stopped_days of a running one) only match !=
+      return compare(actual, number) if actual is not None else op == '!='
+    return numeric
+
+  if op == '=':
+    value = values[0]
+    return lambda i, tags, now: getter(i, tags, now) == value
+  if op == '!=':
+    value = values[0]
+    return lambda i, tags, now: getter(i, tags, now) != value
+  if op in ('=~', '!~'):
+    match = _glob(values[0])
+    if op == '=~':
+      return lambda i, tags, now: match(getter(i, tags, now)) is not None
+    return lambda i, tags, now: match(getter(i, tags, now)) is None
+  # in: a set lookup for literals, plus one combined pattern for globs
+  literals = frozenset(v for v in values if not _WILDCARD_RE.search(v))
+  patterns = [v for v in values if _WILDCARD_RE.search(v)]
+  match = re.compile('|'.join('(?:%s)' % fnmatch.translate(p) for p in patterns)).match \
+    if patterns else None
+  def within(i, tags, now):
+    actual = getter(i, tags, now)
+    return actual in literals or (match is not None and match(actual) is not None)
+  return within
+
+
+def _compile(node):
+  kind = node[0]
+  if kind == 'term':
+    return _compile_term(*node[1:])
+  if kind == 'not':
+    inner = _compile(node[1])
+    return lambda i, tags, now: not inner(i, tags, now)
+  children = [_compile(child) for child in node[1]]
+  if kind == 'and':
+    return lambda i, tags, now: all(child(i, tags, now) for child in children)
+  return lambda i, tags, now: any(child(i, tags, now) for child in children)
+
+
+def _api_filter(node):
+  """
+  :return: The describe_instances filter equivalent to a term, or None if there is none
+  """
+  if node[0] != 'term':
+    return None
+  field, op, values = node[1:]
+  name = field if field.startswith('tag:') else API_FILTERS.get(field)
+  if name is None or op not in ('=', 'in', '=~'):
+    return None
+  # EC2 filter values support * like a glob does, but ? matches zero or one character and there
+  # are no [...] classes, so only literals and * patterns are sent
+  if any('?' in v or '[' in v for v in values) or (op != '=~' and any('*' in v for v in values)):
+    return None
+  # Locally, a missing tag or attribute is the empty string, which EC2 filters never match: not
+  # as '' nor as a * pattern
+  if any(not v.strip('*') for v in values):
+    return None
+  return {'Name': name, 'Values': list(values)}
+
+
+class Filter(object):
+  """
+  A compiled filter expression.
+
+  :param expression: A filter expression, or None or '' to match every instance
+  :param now: The time day counts are relative to; defaults to now
+  """
+
+  def __init__(self, expression, now=None):
+    self.expression = expression or ''
+    self.now = now or datetime.datetime.now(datetime.timezone.utc)
+    self.api_filters = []
+    self._predicate = self._residual = None
+    if not self.expression.strip():
+      return
+
+    tree = _Parser(self.expression).parse()
+    self._predicate = _compile(tree)
+    conjuncts = tree[1] if tree[0] == 'and' else [tree]
+    residual = []
+    for node in conjuncts:
+      api_filter = _api_filter(node)
+      if api_filter is None:
+        residual.append(node)
+      else:
+        self.api_filters.append(api_filter)
+    if residual:
+      self._residual = _compile(('and', residual) if len(residual) > 1 else residual[0])
+
+  def __call__(self, instance):
+    """
+    :return: Whether the instance matches the whole expression
+    """
+    return self._predicate is None or self._predicate(instance, utils.get_tags(instance), self.now)
+
+  def apply(self, instances, fetched_with_api_filters=False):
+    """
+    Yields the matching instances.
+
+    :param instances: Instance dicts, as returned by describe_instances
+    :param fetched_with_api_filters: Whether the instances were fetched with
+        :py:attr:`api_filters`, so that only the other terms need to be evaluated
+    """
+    predicate = self._residual if fetched_with_api_filters else self._predicate
+    if predicate is None:
+      for instance in instances:
+        yield instance
+      return
+    now = self.now
+    for instance in instances:
+      if predicate(instance, utils.get_tags(instance), now):
+        yield instance
+
+
+def conjoin(expression=None, **fields):
+  """
+  Combines field=value terms and an expression with ``and``.
+
+  :param expression: A filter expression, or None
+  :param fields: Field values to match, e.g. env='staging'; None values are left out
+  :return: A filter expression
+  """
+  terms = ['%s=%s' % (field, quote(value)) for field, value in sorted(fields.items())
+           if value is not None]
+  if expression and expression.strip():
+    terms.append('(%s)' % expression if terms else expression)
+  return ' and '.join(terms)
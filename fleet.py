@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Synthetic EC2 fleets for benchmarks and offline runs.
+
+Instances are shaped like the ``Instances`` entries of a boto3 describe_instances response. Their
+environments, purposes and IAM roles are drawn from :py:mod:`config`, so they exercise the same
+code paths as the real inventory.
+
+"""
+
+import datetime
+import random
+import zlib
+
+import config
+
+
+INSTANCE_TYPES = (
+  ('m3.xlarge', 18), ('m3.medium', 4), ('m4.large', 8), ('m5.large', 16), ('m5.xlarge', 12),
+  ('m5.2xlarge', 6), ('c5.xlarge', 6), ('c5.4xlarge', 4), ('r5.large', 6), ('r5.2xlarge', 5),
+  ('r5.4xlarge', 2), ('i3.2xlarge', 3), ('t2.medium', 10), ('t3.micro', 6), ('t3.small', 4),
+)
+
+STATES = (('running', 78), ('stopped', 16), ('terminated', 4), ('pending', 1), ('stopping', 1))
+
+STATE_CODES = {'pending': 0, 'running': 16, 'terminated': 48, 'stopping': 64, 'stopped': 80}
+
+ENVIRONMENTS = (
+  (config.INSTANCE_ENVIRONMENT_PRODUCTION, 45),
+  (config.INSTANCE_ENVIRONMENT_STAGING, 30),
+  (config.INSTANCE_ENVIRONMENT_DEVELOPMENT, 22),
+  (config.INSTANCE_ENVIRONMENT_LOAD_TESTING, 3),
+)
+
+AVAILABILITY_ZONES = ('us-east-1a', 'us-east-1b', 'us-east-1c', 'us-east-1d')
+
+# Purposes that run as Auto Scaling groups of identical nodes
+ASG_PURPOSES = frozenset((
+  config.INSTANCE_PURPOSE_AIRFLOW_WORKER,
+  config.INSTANCE_PURPOSE_ELASTIC_SEARCH_INDEXER,
+  config.INSTANCE_PURPOSE_ELASTIC_SEARCH_SEARCHER,
+  config.INSTANCE_PURPOSE_INDEXER,
+  config.INSTANCE_PURPOSE_SEARCHER,
+  config.INSTANCE_PURPOSE_SEARCHER2,
+))
+
+OWNERS = tuple(['team-%s' % t for t in ('search', 'data', 'infra', 'listings', 'growth', 'agents')] +
+               ['user%02d' % n for n in range(40)])
+
+AMI_COUNT = 60
+
+# About this share of instances (in percent) sit in their environment's legacy subnets instead of
+# the one SUBNET_COMPATIBILITY_MAP expects
+MISPLACED_PERCENT = 1
+MISPLACED_GROUP = 'legacy'
+
+EPOCH = datetime.datetime(2019, 8, 1, tzinfo=datetime.timezone.utc)
+
+
+def _weighted(choices):
+  values = [c[0] for c in choices]
+  weights = [c[1] for c in choices]
+  return values, weights
+
+
+def _id(prefix, value, width=17):
+  return '%s-%0*x' % (prefix, width, value & ((1 << (4 * width)) - 1))
+
+
+def subnet_name(environment, purpose, zone):
+  """
+  :return: The Name tag the synthetic subnet of an environment/purpose/zone carries
+  """
+  group = config.SUBNET_COMPATIBILITY_MAP.get(environment, {}).get(purpose, purpose)
+  return '%s-%s-%s' % (environment, group, zone)
+
+
+def subnet_id(name):
+  """
+  :return: The deterministic subnet ID for a synthetic subnet name
+  """
+  return _id('subnet', zlib.crc32(name.encode('utf-8')), 8)
+
+
+def vpc_id(environment):
+  """
+  :return: The deterministic VPC ID for a synthetic environment
+  """
+  return _id('vpc', zlib.crc32(environment.encode('utf-8')), 8)
+
+
+def generate_fleet(count, seed=0, now=EPOCH):
+  """
+  Generates a realistic synthetic fleet.
+
+  Instances carry a realistic tag mix (some untagged or partially tagged), stopped and terminated
+  instances carry ``StateTransitionReason`` strings with a stop time, and ASG purposes are tagged
+  with an ``aws:autoscaling:groupName``.
+
+  :param count: The number of instances to generate
+  :param seed: The random seed, so that fleets are reproducible
+  :param now: The time the fleet is observed at; launch and stop times precede it
+  :return: A generator of instance dicts
+  """
+  rng = random.Random(seed)
+  types, type_weights = _weighted(INSTANCE_TYPES)
+  states, state_weights = _weighted(STATES)
+  environments, environment_weights = _weighted(ENVIRONMENTS)
+  purposes = {
+    env: sorted(config.ENVIRONMENT_PURPOSE_IAM_ROLES.get(env, config.KNOWN_INSTANCE_PURPOSES))
+    for env in environments
+  }
+  images = [_id('ami', rng.getrandbits(32), 8) for _ in range(AMI_COUNT)]
+
+  for n in range(count):
+    instance_id = _id('i', rng.getrandbits(68) ^ n)
+    environment = rng.choices(environments, environment_weights)[0]
+    purpose = rng.choice(purposes[environment])
+    state = rng.choices(states, state_weights)[0]
+    zone = rng.choice(AVAILABILITY_ZONES)
+    launch_time = now - datetime.timedelta(seconds=rng.randrange(1, 3 * 365 * 86400))
+    private_ip = '10.%d.%d.%d' % (rng.randrange(256), rng.randrange(256), rng.randrange(1, 255))
+
+    tags = []
+    if rng.random() < 0.93:
+      tags.append({'Key': config.INSTANCE_ENVIRONMENT_KEY, 'Value': environment})
+    if rng.random() < 0.91:
+      tags.append({'Key': config.INSTANCE_PURPOSE_KEY, 'Value': purpose})
+    if rng.random() < 0.7:
+      tags.append({'Key': config.INSTANCE_OWNER_KEY, 'Value': rng.choice(OWNERS)})
+    if rng.random() < 0.6:
+      tags.append({'Key': config.INSTANCE_USER_KEY, 'Value': config.INSTANCE_USER_DEFAULT})
+    if rng.random() < 0.8:
+      tags.append({'Key': 'Name', 'Value': '%s-%s' % (environment, purpose)})
+    if environment == config.INSTANCE_ENVIRONMENT_DEVELOPMENT and rng.random() < 0.3:
+      tags.append({'Key': 'cloud_dev_machine', 'Value': ' dev-%s\n' % rng.choice(OWNERS)})
+    if purpose in ASG_PURPOSES:
+      tags.append({'Key': 'aws:autoscaling:groupName', 'Value': '%s-%s' % (environment, purpose)})
+    rng.shuffle(tags)
+
+    reason = ''
+    if state in ('stopped', 'stopping', 'terminated'):
+      stopped = launch_time + (now - launch_time) * rng.random()
+      reason = 'User initiated (%s)' % stopped.strftime('%Y-%m-%d %H:%M:%S GMT')
+
+    volumes = []
+    if state != 'terminated':
+      for d in range(rng.choice((1, 1, 1, 2, 2, 3))):
+        volumes.append({
+          'DeviceName': '/dev/sd%s' % 'abcdefgh'[d] + ('1' if d == 0 else ''),
+          'Ebs': {
+            'AttachTime': launch_time,
+            'DeleteOnTermination': d == 0,
+            'Status': 'attached',
+            'VolumeId': _id('vol', rng.getrandbits(68)),
+          },
+        })
+
+    subnet = subnet_name(environment, purpose, zone)
+    group_id = _id('sg', zlib.crc32(subnet.encode('utf-8')), 8)
+    # Decided by the ID rather than drawn, so that the rest of the fleet stays the same
+    if zlib.crc32(instance_id.encode('utf-8')) % 100 < MISPLACED_PERCENT:
+      subnet = '%s-%s-%s' % (environment, MISPLACED_GROUP, zone)
+    role = config.ENVIRONMENT_PURPOSE_IAM_ROLES.get(environment, {}).get(purpose)
+    instance = {
+      'InstanceId': instance_id,
+      'ImageId': rng.choice(images),
+      'InstanceType': rng.choices(types, type_weights)[0],
+      'KeyName': config.MANAGED_AWS_KEY_PAIRS.get(environment, 'development'),
+      'LaunchTime': launch_time,
+      'Placement': {'AvailabilityZone': zone, 'GroupName': '', 'Tenancy': 'default'},
+      'PrivateDnsName': 'ip-%s.ec2.internal' % private_ip.replace('.', '-'),
+      'PrivateIpAddress': private_ip,
+      'PublicDnsName': '',
+      'State': {'Code': STATE_CODES[state], 'Name': state},
+      'StateTransitionReason': reason,
+      'SubnetId': subnet_id(subnet),
+      'VpcId': vpc_id(environment),
+      'Architecture': 'x86_64',
+      'BlockDeviceMappings': volumes,
+      'RootDeviceName': '/dev/sda1',
+      'RootDeviceType': 'ebs',
+      'SecurityGroups': [{'GroupName': '%s-%s' % (environment, purpose),
+                          'GroupId': group_id}],
+      'Tags': tags,
+    }
+    if role:
+      instance['IamInstanceProfile'] = {
+        'Arn': 'arn:aws:iam::123456789012:instance-profile/%s' % role,
+      }
+    if state == 'running' and rng.random() < 0.1:
+      instance['PublicDnsName'] = 'ec2-%s.compute-1.amazonaws.com' % private_ip.replace('.', '-')
+    if rng.random() < 0.01:
+      instance['Platform'] = 'windows'
+    yield instance
+
+
+def generate_network():
+  """
+  Generates the VPCs, subnets and security groups the instances of :py:func:`generate_fleet`
+  refer to: a VPC per environment, and a subnet and security group per subnet group (see
+  :py:func:`subnet_name`) and availability zone.
+
+  :return: A tuple of lists of (``Vpcs``, ``Subnets``, ``SecurityGroups``) entries, as returned by
+      describe_vpcs, describe_subnets and describe_security_groups
+  """
+  vpcs, subnets, groups = [], [], []
+  environments, _ = _weighted(ENVIRONMENTS)
+  for n, environment in enumerate(environments):
+    vpc = vpc_id(environment)
+    vpcs.append({'VpcId': vpc, 'CidrBlock': '10.%d.0.0/16' % n, 'State': 'available',
+                 'IsDefault': False, 'Tags': [{'Key': 'Name', 'Value': environment}]})
+    names = set()
+    for purpose in config.ENVIRONMENT_PURPOSE_IAM_ROLES.get(environment,
+                                                            config.KNOWN_INSTANCE_PURPOSES):
+      names.update(subnet_name(environment, purpose, zone) for zone in AVAILABILITY_ZONES)
+    names.update('%s-%s-%s' % (environment, MISPLACED_GROUP, zone) for zone in AVAILABILITY_ZONES)
+    for k, name in enumerate(sorted(names)):
+      zone = name[-len(AVAILABILITY_ZONES[0]):]
+      subnets.append({
+        'SubnetId': subnet_id(name), 'VpcId': vpc, 'AvailabilityZone': zone,
+        'CidrBlock': '10.%d.%d.%d/26' % (n, k // 4, k % 4 * 64), 'State': 'available',
+        'AvailableIpAddressCount': 59, 'Tags': [{'Key': 'Name', 'Value': name}],
+      })
+      groups.append({'GroupId': _id('sg', zlib.crc32(name.encode('utf-8')), 8), 'GroupName': name,
+                     'VpcId': vpc, 'Description': name})
+  return vpcs, subnets, groups
+
+
+def generate_reservations(instances, seed=0, coverage=0.6, now=EPOCH):
+  """
+  Generates active reserved instances covering part of a fleet: zonal reservations for exact
+  types, and regional ones bought in other sizes of the same family, as size flexibility allows.
+
+  :param instances: The fleet, e.g. from :py:func:`generate_fleet`
+  :param seed: The random seed, so that reservations are reproducible
+  :param coverage: The approximate share of running instances reserved
+  :param now: The time the reservations are observed at
+  :return: A list of ``ReservedInstances`` entries, as returned by describe_reserved_instances
+  """
+  rng = random.Random(seed)
+  sizes = {}
+  for instance_type, _ in INSTANCE_TYPES:
+    family, size = instance_type.split('.')
+    sizes.setdefault(family, []).append(size)
+
+  reservations = []
+  for instance in instances:
+    if instance['State']['Name'] != 'running' or rng.random() >= coverage:
+      continue
+    family, size = instance['InstanceType'].split('.')
+    platform = 'Windows' if instance.get('Platform') == 'windows' else 'Linux/UNIX'
+    reservation = {
+      'ReservedInstancesId': '%08x-%04x-%04x-%04x-%012x' % tuple(
+        rng.getrandbits(bits) for bits in (32, 16, 16, 16, 48)),
+      'InstanceType': instance['InstanceType'],
+      'InstanceCount': 1,
+      'InstanceTenancy': 'default',
+      'ProductDescription': platform,
+      'State': 'active',
+      'Start': now - datetime.timedelta(days=rng.randrange(1, 365)),
+      'Duration': 31536000,
+      'OfferingClass': 'standard',
+      'OfferingType': 'No Upfront',
+      'Scope': 'Region',
+    }
+    if rng.random() < 0.3:
+      reservation['Scope'] = 'Availability Zone'
+      reservation['AvailabilityZone'] = instance['Placement']['AvailabilityZone']
+    elif platform == 'Linux/UNIX' and rng.random() < 0.5:
+      # Bought as another size; size flexibility still applies it to this instance
+      reservation['InstanceType'] = '%s.%s' % (family, rng.choice(sizes[family]))
+    reservation['End'] = reservation['Start'] + datetime.timedelta(seconds=reservation['Duration'])
+    reservations.append(reservation)
+  return reservations
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Compacted instance state history.
+
+Successive inventory snapshots are folded into run-length encoded state intervals per instance,
+so a year of hourly snapshots of a stable fleet takes a few intervals per instance instead of
+8760 copies. Interval arithmetic on top answers how many instance-hours each role, owner, type,
+environment or purpose spent in a state over any window.
+
+An instance is taken to have been in the state it is observed in since the previous snapshot,
+so every gap between two snapshots is attributed to the later observation.
+
+"""
+
+import json
+import os
+
+import numpy
+
+import stats
+import utils
+
+
+VERSION = 1
+
+STATES = ('pending', 'running', 'shutting-down', 'terminated', 'stopping', 'stopped')
+
+# The instance attributes (see utils.get_instance_attributes) instance-hours can be grouped by;
+# the latest observed values are kept
+ATTRIBUTES = ('role', 'owner', 'type', 'env', 'purpose')
+
+
+class StateHistory(object):
+  """
+  Run-length encoded state intervals per instance, kept in a JSON file.
+
+  :param fname: The history file; created on :py:meth:`save` if missing
+  """
+
+  def __init__(self, fname):
+    self.fname = fname
+    self.last_snapshot = None
+    # instance ID -> {'attributes': {...}, 'intervals': [[state index, start, end], ...]}
+    self.instances = {}
+    if os.path.exists(fname):
+      with open(fname) as f:
+        state = json.load(f)
+      if state.get('version') != VERSION:
+        raise ValueError('%s has an unsupported history version' % fname)
+      self.last_snapshot = state['last_snapshot']
+      self.instances = state['instances']
+    self._arrays = None
+
+  def save(self):
+    tmp = self.fname + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump({'version': VERSION, 'last_snapshot': self.last_snapshot,
+                 'instances': self.instances}, f, separators=(',', ':'))
+    os.replace(tmp, self.fname)
+
+  def record(self, instances, at):
+    """
+    Folds an inventory snapshot into the history.
+
+    :param instances: Instance dicts, as returned by describe_instances
+    :param at: The snapshot time, as a POSIX timestamp; snapshots must be recorded in order. A
+        snapshot taken in the same second as the last one, e.g. by a manual run next to a cron
+        job, adds no time to any interval and is skipped.
+    :return: The number of new intervals, i.e. instances that appeared or changed state
+    """
+    at = int(at)
+    if at == self.last_snapshot:
+      stats.incr('history_snapshots_skipped')
+      return 0
+    if self.last_snapshot is not None and at < self.last_snapshot:
+      raise ValueError('Snapshot at %d is before the last one, at %d' % (at, self.last_snapshot))
+    previous = self.last_snapshot
+    started = 0
+    with stats.span('history.record'):
+      for instance in instances:
+        state = STATES.index(instance['State']['Name'])
+        entry = self.instances.get(instance['InstanceId'])
+        if entry is None:
+          entry = self.instances[instance['InstanceId']] = {'intervals': []}
+        entry['attributes'] = utils.get_instance_attributes(instance)
+        intervals = entry['intervals']
+        seen_last_time = bool(intervals) and intervals[-1][2] == previous
+        if seen_last_time and intervals[-1][0] == state:
+          intervals[-1][2] = at
+        else:
+          intervals.append([state, previous if seen_last_time else at, at])
+          started += 1
+    self.last_snapshot = at
+    self._arrays = None
+    stats.incr('history_intervals_started', started)
+    return started
+
+  def _flatten(self):
+    # Parallel arrays over every interval, built once per load or snapshot
+    if self._arrays is None:
+      ids = list(self.instances)
+      rows = [(position, state, start, end)
+              for position, instance_id in enumerate(ids)
+              for state, start, end in self.instances[instance_id]['intervals']]
+      columns = numpy.array(rows, dtype=numpy.int64).reshape(-1, 4)
+      self._arrays = (ids,) + tuple(columns.T)
+    return self._arrays
+
+  def instance_hours(self, since=None, until=None, group_by='role', states=('running',)):
+    """
+    Sums the hours instances spent in the given states within a window.
+
+    :param since: The window start, as a POSIX timestamp; defaults to the beginning of history
+    :param until: The window end, as a POSIX timestamp; defaults to the last snapshot
+    :param group_by: One of :py:data:`ATTRIBUTES`
+    :param states: The states to count
+    :return: A dict of {attribute value: hours}
+    """
+    if group_by not in ATTRIBUTES:
+      raise ValueError('Cannot group instance-hours by %r; expected one of %s' % (
+        group_by, ', '.join(ATTRIBUTES)))
+    with stats.span('history.instance_hours'):
+      ids, owners, interval_states, starts, ends = self._flatten()
+      if not len(starts):
+        return {}
+      since = starts.min() if since is None else since
+      until = ends.max() if until is None else until
+      seconds = numpy.clip(numpy.minimum(ends, until) - numpy.maximum(starts, since), 0, None)
+      seconds = numpy.where(numpy.isin(interval_states, [STATES.index(s) for s in states]),
+                            seconds, 0)
+
+      groups = {}
+      group_of_instance = numpy.array([
+        groups.setdefault(self.instances[i]['attributes'][group_by], len(groups)) for i in ids],
+        dtype=numpy.int64)
+      totals = numpy.bincount(group_of_instance[owners], weights=seconds, minlength=len(groups))
+    return {value: float(totals[index]) / 3600 for value, index in groups.items()
+            if totals[index]}
+
+  def states_at(self, at):
+    """
+    :param at: A POSIX timestamp
+    :return: A dict of {instance ID: state name} of the instances known at that time
+    """
+    result = {}
+    for instance_id, entry in self.instances.items():
+      for state, start, end in entry['intervals']:
+        if start <= at <= end:
+          result[instance_id] = STATES[state]
+          break
+    return result
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+AMI metadata enrichment of the inventory.
+
+An AMI never changes once registered, so the name and creation date of every AMI the inventory
+uses are cached in a JSON file for good. Only AMIs never seen before are fetched, in a few bulk
+describe_images calls. AMIs describe_images does not return (deregistered, or not or no longer
+shared with the account) are remembered as such along with when they were last asked for, and
+only asked for again once :py:data:`MISSING_RECHECK_DAYS` have passed, in case they were shared
+again or were not visible yet. After the first run, the enrichment is a dict lookup per instance.
+
+"""
+
+import datetime
+import json
+import os
+import sys
+import time
+
+import engine
+import stats
+
+
+VERSION = 2
+
+CREATION_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+# The name of AMIs describe_images no longer returns
+DEREGISTERED = 'deregistered'
+
+# Days after which AMIs describe_images did not return are asked for again
+MISSING_RECHECK_DAYS = 7
+
+
+class ImageCache(object):
+  """
+  AMI names and creation dates by ID, kept in a JSON file.
+
+  :param fname: The cache file, or None to only cache in memory
+  :param now: The time AMI ages are computed at, a naive UTC datetime; defaults to now
+  :param missing_recheck_days: Days after which AMIs describe_images did not return are fetched
+      again
+  """
+
+  def __init__(self, fname=None, now=None, missing_recheck_days=MISSING_RECHECK_DAYS):
+    self.fname = fname
+    self.now = now or datetime.datetime.utcnow()
+    self.missing_recheck = missing_recheck_days * 86400
+    # AMI ID -> [name, creation date]
+    self.entries = {}
+    # AMI ID -> when describe_images last did not return it, as a POSIX timestamp
+    self.missing = {}
+    self.changed = False
+    # AMI ID -> its formatted columns; thousands of instances share an AMI
+    self._columns = {}
+    if fname and os.path.exists(fname):
+      try:
+        with open(fname) as f:
+          state = json.load(f)
+      except ValueError:
+        state = None
+      version = state.get('version') if isinstance(state, dict) else None
+      if version == VERSION:
+        self.entries = state['entries']
+        self.missing = state['missing']
+      elif version == 1:
+        # Version 1 cached AMIs describe_images did not return as None, for good; they are due a
+        # recheck
+        self.entries = {i: e for i, e in state['entries'].items() if e is not None}
+        self.missing = {i: 0 for i, e in state['entries'].items() if e is None}
+        self.changed = True
+      else:
+        # A cache is never worth failing the run for; this one is rebuilt
+        print('Ignoring %s, which is not an image cache of a supported version' % fname,
+              file=sys.stderr)
+
+  def save(self):
+    if not self.fname or not self.changed:
+      return
+    tmp = self.fname + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump({'version': VERSION, 'entries': self.entries, 'missing': self.missing}, f,
+                separators=(',', ':'))
+    os.replace(tmp, self.fname)
+    self.changed = False
+
+  def stale(self, image_ids, now=None):
+    """
+    :param image_ids: AMI IDs
+    :return: The set of the AMIs not cached, or last not returned by describe_images more than
+        the recheck period ago
+    """
+    cutoff = (now or time.time()) - self.missing_recheck
+    return {i for i in image_ids
+            if i not in self.entries and self.missing.get(i, cutoff) <= cutoff}
+
+  def refresh(self, instances, eng=None, now=None):
+    """
+    Fetches the AMIs the instances were launched from that are not cached yet, or were missing
+    when last asked for and are due a recheck.
+
+    :param instances: Instance dicts, as returned by describe_instances
+    :param eng: The :py:class:`engine.Engine` to fetch with
+    :param now: The current time, as a POSIX timestamp; defaults to now
+    :return: The number of AMIs looked up
+    """
+    now = now or time.time()
+    stale = self.stale({i['ImageId'] for i in instances if i.get('ImageId')}, now)
+    stats.incr('image_cache_misses', len(stale))
+    if not stale:
+      return 0
+    eng = eng or engine.Engine()
+    found = eng.run(images=eng.fetch_images(stale))['images']
+    for image in found:
+      self.entries[image['ImageId']] = [image.get('Name', ''), image.get('CreationDate', '')]
+      self.missing.pop(image['ImageId'], None)
+    for image_id in stale.difference(self.entries):
+      self.missing[image_id] = now
+    self.changed = True
+    self._columns = {}
+    return len(stale)
+
+  def image(self, image_id):
+    """
+    :return: A tuple of (name, creation date), or None if the AMI is unknown or deregistered
+    """
+    entry = self.entries.get(image_id)
+    return tuple(entry) if entry else None
+
+  def created(self, image_id):
+    """
+    :return: The AMI's creation time as a naive UTC datetime, or None if unknown
+    """
+    entry = self.entries.get(image_id)
+    if not entry or not entry[1]:
+      return None
+    return datetime.datetime.strptime(entry[1], CREATION_DATE_FORMAT)
+
+  def columns(self, instance):
+    """
+    :param instance: An instance dict, as returned by describe_instances
+    :return: The instance's AMI columns, matching :py:data:`utils.IMAGE_COLUMNS`
+    """
+    image_id = instance.get('ImageId', '')
+    columns = self._columns.get(image_id)
+    if columns is None:
+      if image_id in self.missing:
+        columns = [image_id, DEREGISTERED, '', '']
+      elif image_id not in self.entries:
+        columns = [image_id, '', '', '']
+      else:
+        created = self.created(image_id)
+        columns = [image_id, self.entries[image_id][0],
+                   created.strftime('%Y-%m-%d') if created else '',
+                   str((self.now - created).days) if created else '']
+      self._columns[image_id] = columns
+    return list(columns)
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Queryable inventory history.
+
+Every inventory snapshot is bulk inserted into a local SQLite file in one transaction, one row
+per instance, and indexed by instance ID, environment, purpose, owner and snapshot time. Tags are
+normalized into their own table; each distinct set of tags is stored once and referenced by the
+instance rows, as tags rarely change between snapshots. Questions such as "who owned this
+instance last month" are then a couple of index lookups instead of a grep through old detail
+files:
+
+    inv = inventory.Inventory('inventory.sqlite')
+    inv.record(instances, time.time())
+    inv.as_of(time.time() - 30 * 86400, instance_id='i-0123456789abcdef0')
+
+"""
+
+import collections
+import datetime
+import hashlib
+import json
+import sqlite3
+
+import stats
+import utils
+
+
+COLUMNS = ('instance_id', 'state', 'instance_type', 'role', 'env', 'purpose', 'owner',
+           'availability_zone', 'private_ip', 'launch_time')
+
+# The columns :py:meth:`Inventory.as_of` can filter on
+WHERE_COLUMNS = ('instance_id', 'state', 'instance_type', 'role', 'env', 'purpose', 'owner')
+
+InventoryRow = collections.namedtuple('InventoryRow', ('taken_at',) + COLUMNS)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshot (
+  id INTEGER PRIMARY KEY,
+  taken_at INTEGER NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS instance (
+  snapshot_id INTEGER NOT NULL REFERENCES snapshot (id),
+  instance_id TEXT NOT NULL,
+  state TEXT NOT NULL,
+  instance_type TEXT NOT NULL,
+  role TEXT NOT NULL,
+  env TEXT NOT NULL,
+  purpose TEXT NOT NULL,
+  owner TEXT NOT NULL,
+  availability_zone TEXT NOT NULL,
+  private_ip TEXT NOT NULL,
+  launch_time TEXT NOT NULL,
+  tag_set_id INTEGER NOT NULL REFERENCES tag_set (id),
+  PRIMARY KEY (instance_id, snapshot_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS instance_snapshot_env ON instance (snapshot_id, env);
+CREATE INDEX IF NOT EXISTS instance_snapshot_purpose ON instance (snapshot_id, purpose);
+CREATE INDEX IF NOT EXISTS instance_snapshot_owner ON instance (snapshot_id, owner);
+CREATE TABLE IF NOT EXISTS tag_set (
+  id INTEGER PRIMARY KEY,
+  digest BLOB NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS tag (
+  tag_set_id INTEGER NOT NULL REFERENCES tag_set (id),
+  key TEXT NOT NULL,
+  value TEXT NOT NULL,
+  PRIMARY KEY (tag_set_id, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tag_key_value ON tag (key, value);
+"""
+
+
+def _tag_digest(tags):
+  return hashlib.blake2b(json.dumps(sorted(tags.items())).encode('utf-8'), digest_size=16).digest()
+
+
+def _timestamp(value):
+  return int(value.timestamp()) if isinstance(value, datetime.datetime) else int(value)
+
+
+class Inventory(object):
+  """
+  Inventory snapshots kept in a SQLite file.
+
+  :param fname: The SQLite file; created if missing
+  """
+
+  def __init__(self, fname):
+    self.fname = fname
+    self.db = sqlite3.connect(fname)
+    self.db.executescript(_SCHEMA)
+    # The tag set IDs by digest, while a snapshot is being recorded
+    self._tag_sets = None
+
+  def close(self):
+    self.db.close()
+
+  def record(self, instances, at):
+    """
+    Adds a snapshot. A snapshot already taken in the same second is replaced, e.g. when one run
+    records the same fetch twice.
+
+    :param instances: Instance dicts, as returned by describe_instances
+    :param at: The snapshot time, as a POSIX timestamp or datetime
+    :return: The snapshot's ID
+    """
+    with stats.span('inventory.record'):
+      snapshot_id = self.begin(at)
+      try:
+        self.add(snapshot_id, instances)
+      except BaseException:
+        self.rollback()
+        raise
+      self.commit()
+    return snapshot_id
+
+  def begin(self, at):
+    """
+    Starts a snapshot recorded in parts, e.g. one page of instances at a time as they are fetched:
+    instances are added with :py:meth:`add`, and the snapshot is only visible once
+    :py:meth:`commit` ends its transaction. A snapshot already taken in the same second is
+    replaced, as in :py:meth:`record`.
+
+    :param at: The snapshot time, as a POSIX timestamp or datetime
+    :return: The snapshot's ID
+    """
+    self._tag_sets = dict(self.db.execute('SELECT digest, id FROM tag_set'))
+    existing = self.db.execute('SELECT id FROM snapshot WHERE taken_at = ?',
+                               (_timestamp(at),)).fetchone()
+    if existing is not None:
+      self.db.execute('DELETE FROM instance WHERE snapshot_id = ?', (existing[0],))
+      stats.incr('inventory_snapshots_replaced')
+      return existing[0]
+    return self.db.execute('INSERT INTO snapshot (taken_at) VALUES (?)',
+                           (_timestamp(at),)).lastrowid
+
+  def add(self, snapshot_id, instances):
+    """
+    Adds instances to a snapshot started with :py:meth:`begin`.
+
+    :param snapshot_id: The ID :py:meth:`begin` returned
+    :param instances: Instance dicts, as returned by describe_instances
+    """
+    new_tags = []
+    new_tag_sets = 0
+    rows = []
+    for instance in instances:
+      tags = utils.get_tags(instance)
+      digest = _tag_digest(tags)
+      tag_set_id = self._tag_sets.get(digest)
+      if tag_set_id is None:
+        tag_set_id = self._tag_sets[digest] = self.db.execute(
+          'INSERT INTO tag_set (digest) VALUES (?)', (digest,)).lastrowid
+        new_tags.extend((tag_set_id, key, value) for key, value in tags.items())
+        new_tag_sets += 1
+      attributes = utils.get_instance_attributes(instance)
+      rows.append((
+        snapshot_id, instance['InstanceId'], instance['State']['Name'], attributes['type'],
+        attributes['role'], attributes['env'], attributes['purpose'], attributes['owner'],
+        instance.get('Placement', {}).get('AvailabilityZone', ''),
+        instance.get('PrivateIpAddress') or '', str(instance.get('LaunchTime', '')), tag_set_id))
+    self.db.executemany(
+      'INSERT INTO instance (snapshot_id, %s, tag_set_id) VALUES (?, %s, ?)' % (
+        ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))), rows)
+    self.db.executemany('INSERT INTO tag (tag_set_id, key, value) VALUES (?, ?, ?)', new_tags)
+    stats.incr('inventory_rows', len(rows))
+    stats.incr('inventory_tag_sets', new_tag_sets)
+
+  def commit(self):
+    """
+    Ends the snapshot started with :py:meth:`begin`, making it visible.
+    """
+    self.db.commit()
+    self._tag_sets = None
+
+  def rollback(self):
+    """
+    Drops the snapshot started with :py:meth:`begin`.
+    """
+    self.db.rollback()
+    self._tag_sets = None
+
+  def snapshot_at(self, at):
+    """
+    :param at: A POSIX timestamp or datetime
+    :return: A tuple of (snapshot ID, taken at) of the latest snapshot taken at or before that
+        time, or None if there is none
+    """
+    return self.db.execute(
+      'SELECT id, taken_at FROM snapshot WHERE taken_at <= ? ORDER BY taken_at DESC LIMIT 1',
+      (_timestamp(at),)).fetchone()
+
+  def as_of(self, at, **where):
+    """
+    The inventory as it was at a point in time.
+
+    :param at: A POSIX timestamp or datetime
+    :param where: Equality filters on :py:data:`WHERE_COLUMNS`, e.g. owner='bob'
+    :return: A list of :py:class:`InventoryRow` from the latest snapshot at or before that time
+    """
+    unknown = set(where) - set(WHERE_COLUMNS)
+    if unknown:
+      raise ValueError('Cannot filter the inventory by %s; expected one of %s' % (
+        ', '.join(sorted(unknown)), ', '.join(WHERE_COLUMNS)))
+    snapshot = self.snapshot_at(at)
+    if snapshot is None:
+      return []
+    snapshot_id, taken_at = snapshot
+    conditions = ['snapshot_id = ?'] + ['%s = ?' % column for column in where]
+    with stats.span('inventory.as_of'):
+      rows = self.db.execute(
+        'SELECT %s FROM instance WHERE %s ORDER BY instance_id' % (
+          ', '.join(COLUMNS), ' AND '.join(conditions)),
+        [snapshot_id] + list(where.values())).fetchall()
+    return [InventoryRow(taken_at, *row) for row in rows]
+
+  def tags_as_of(self, at, instance_id):
+    """
+    :return: The instance's tags as a dict, as they were at a point in time
+    """
+    snapshot = self.snapshot_at(at)
+    if snapshot is None:
+      return {}
+    return dict(self.db.execute(
+      'SELECT key, value FROM tag JOIN instance USING (tag_set_id) '
+      'WHERE instance_id = ? AND snapshot_id = ?', (instance_id, snapshot[0])))
+
+  def history(self, instance_id, since=None, until=None):
+    """
+    :param instance_id: An instance ID
+    :param since: POSIX timestamp or datetime of the first snapshot to return
+    :param until: POSIX timestamp or datetime of the last snapshot to return
+    :return: A list of :py:class:`InventoryRow`, one per snapshot the instance was in, oldest first
+    """
+    rows = self.db.execute(
+      'SELECT taken_at, %s FROM instance JOIN snapshot ON snapshot.id = snapshot_id '
+      'WHERE instance_id = ? AND taken_at >= ? AND taken_at <= ? ORDER BY taken_at' % (
+        ', '.join('instance.%s' % column for column in COLUMNS)),
+      (instance_id, _timestamp(since) if since is not None else 0,
+       _timestamp(until) if until is not None else 2 ** 62)).fetchall()
+    return [InventoryRow(*row) for row in rows]
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Indexed lookups over a cached inventory snapshot.
+
+Interactive questions ("what is host X", "which instances does owner Y have", "all staging
+bastions") are answered from a local snapshot instead of a full describe_instances fetch and
+scan. The snapshot is saved as a SQLite file, one row per instance, with its indexes already
+built, so a lookup opens the file and reads a few index pages rather than loading the whole
+snapshot:
+
+* indexes by instance ID, private IP and hostname (both :py:func:`utils.generate_host` and the
+  private DNS name)
+* an inverted index from every tag key and value to the instances carrying it
+* indexes on launch time and stop time, for range queries
+
+"""
+
+import collections
+import datetime
+import json
+import os
+import re
+import sqlite3
+import time
+
+import config
+import stats
+import utils
+
+
+VERSION = 2
+
+# Short names of the tags most lookups are by
+TAG_ALIASES = {
+  'env': config.INSTANCE_ENVIRONMENT_KEY,
+  'purpose': config.INSTANCE_PURPOSE_KEY,
+  'owner': config.INSTANCE_OWNER_KEY,
+  'user': config.INSTANCE_USER_KEY,
+}
+
+Entry = collections.namedtuple('Entry', [
+  'instance_id', 'host', 'private_dns', 'private_ip', 'state', 'instance_type', 'zone',
+  # POSIX timestamps; stopped_time is None unless the instance is stopped
+  'launch_time', 'stopped_time',
+  'tags',
+])
+
+_SCHEMA = """
+CREATE TABLE meta (
+  version INTEGER NOT NULL,
+  taken_at INTEGER NOT NULL
+);
+CREATE TABLE entry (
+  id INTEGER PRIMARY KEY,
+  instance_id TEXT NOT NULL,
+  host TEXT NOT NULL,
+  private_dns TEXT NOT NULL,
+  private_ip TEXT NOT NULL,
+  state TEXT NOT NULL,
+  instance_type TEXT NOT NULL,
+  zone TEXT NOT NULL,
+  launch_time INTEGER,
+  stopped_time INTEGER,
+  tags TEXT NOT NULL
+);
+CREATE TABLE tag (
+  key TEXT NOT NULL,
+  value TEXT NOT NULL,
+  entry_id INTEGER NOT NULL REFERENCES entry (id),
+  PRIMARY KEY (key, value, entry_id)
+) WITHOUT ROWID;
+CREATE TABLE tag_count (
+  key TEXT NOT NULL,
+  value TEXT NOT NULL,
+  count INTEGER NOT NULL,
+  PRIMARY KEY (key, value)
+) WITHOUT ROWID;
+"""
+
+# Built after the rows are inserted, which is faster than maintaining them row by row
+_INDEXES = """
+CREATE INDEX entry_instance_id ON entry (instance_id);
+CREATE INDEX entry_private_ip ON entry (private_ip);
+CREATE INDEX entry_host ON entry (lower(host));
+CREATE INDEX entry_private_dns ON entry (lower(private_dns));
+CREATE INDEX entry_launch_time ON entry (launch_time);
+CREATE INDEX entry_stopped_time ON entry (stopped_time);
+INSERT INTO tag_count (key, value, count) SELECT key, value, count(*) FROM tag GROUP BY key, value;
+"""
+
+_ENTRY_COLUMNS = ', '.join('entry.%s' % field for field in Entry._fields)
+
+
+def _timestamp(value):
+  if value is None:
+    return None
+  if value.tzinfo is None:
+    value = value.replace(tzinfo=datetime.timezone.utc)
+  return int(value.timestamp())
+
+
+def entry_from_instance(instance):
+  """
+  :param instance: An instance dict, as returned by describe_instances
+  :return: The instance's :py:class:`Entry`
+  """
+  stopped_time = utils.get_stopped_time(instance)
+  return Entry(
+    instance['InstanceId'],
+    utils.generate_host(instance) or '',
+    instance.get('PrivateDnsName') or '',
+    instance.get('PrivateIpAddress') or '',
+    instance['State']['Name'],
+    instance.get('InstanceType', ''),
+    instance.get('Placement', {}).get('AvailabilityZone', ''),
+    _timestamp(instance.get('LaunchTime')),
+    _timestamp(datetime.datetime.strptime(stopped_time, utils.STOPPED_TIME_FORMAT))
+    if stopped_time else None,
+    {key: utils.strip(value) for key, value in utils.get_tags(instance).items()},
+  )
+
+
+def _entry(row):
+  return Entry(*row[:-1], tags=json.loads(row[-1]))
+
+
+class InventoryIndex(object):
+  """
+  An indexed inventory snapshot, in a SQLite database.
+
+  :param db: A connection to a database of the index's schema, from :py:meth:`from_instances`
+      or :py:meth:`load`
+  """
+
+  def __init__(self, db):
+    self.db = db
+    version, self.taken_at = db.execute('SELECT version, taken_at FROM meta').fetchone()
+    if version != VERSION:
+      raise ValueError('Unsupported index version %s' % version)
+
+  @classmethod
+  def from_instances(cls, instances, taken_at=None):
+    """
+    Indexes instances, in memory until :py:meth:`save` is called.
+
+    :param instances: Instance dicts, as returned by describe_instances
+    :param taken_at: When they were fetched, as a POSIX timestamp; defaults to now
+    """
+    db = sqlite3.connect(':memory:')
+    with stats.span('lookup.index'), db:
+      db.executescript(_SCHEMA)
+      db.execute('INSERT INTO meta (version, taken_at) VALUES (?, ?)',
+                 (VERSION, int(taken_at if taken_at is not None else time.time())))
+      entries = [entry_from_instance(instance) for instance in instances]
+      db.executemany('INSERT INTO entry (id, %s) VALUES (?%s)' % (
+        ', '.join(Entry._fields), ', ?' * len(Entry._fields)),
+        ((entry_id,) + entry[:-1] + (json.dumps(entry.tags, separators=(',', ':')),)
+         for entry_id, entry in enumerate(entries)))
+      db.executemany('INSERT INTO tag (key, value, entry_id) VALUES (?, ?, ?)',
+                     ((key, value, entry_id) for entry_id, entry in enumerate(entries)
+                      for key, value in entry.tags.items()))
+      db.executescript(_INDEXES)
+    return cls(db)
+
+  @classmethod
+  def load(cls, fname):
+    """
+    Opens a saved index, read only; nothing is read until it is queried.
+    """
+    if not os.path.exists(fname):
+      raise ValueError('There is no index at %s' % fname)
+    db = sqlite3.connect('file:%s?mode=ro' % fname, uri=True)
+    try:
+      return cls(db)
+    except (sqlite3.DatabaseError, ValueError):
+      db.close()
+      raise ValueError('%s has an unsupported index version' % fname)
+
+  def save(self, fname):
+    tmp = fname + '.tmp'
+    if os.path.exists(tmp):
+      os.remove(tmp)
+    target = sqlite3.connect(tmp)
+    try:
+      self.db.backup(target)
+    finally:
+      target.close()
+    os.replace(tmp, fname)
+
+  def __len__(self):
+    return self.db.execute('SELECT count(*) FROM entry').fetchone()[0]
+
+  def get(self, key):
+    """
+    :param key: An instance ID, private IP, hostname or private DNS name
+    :return: The matching :py:class:`Entry`, or None
+    """
+    if not key:
+      return None
+    for condition, value in (('instance_id = ?', key), ('private_ip = ?', key),
+                             ('lower(host) = ?', key.lower()),
+                             ('lower(private_dns) = ?', key.lower())):
+      row = self.db.execute('SELECT %s FROM entry WHERE %s LIMIT 1' % (_ENTRY_COLUMNS, condition),
+                            (value,)).fetchone()
+      if row is not None:
+        return _entry(row)
+    return None
+
+  def tag_values(self, key):
+    """
+    :return: A dict of {value: number of instances} of a tag
+    """
+    return dict(self.db.execute('SELECT value, count FROM tag_count WHERE key = ?', (key,)))
+
+  def find(self, tags=None, launched=(None, None), stopped=(None, None)):
+    """
+    Finds the instances matching every condition given.
+
+    :param tags: A dict of {tag key or :py:data:`TAG_ALIASES` name: value}
+    :param launched: A (since, until) pair of POSIX timestamps, either None for unbounded
+    :param stopped: A (since, until) pair of POSIX timestamps, either None for unbounded
+    :return: A list of :py:class:`Entry`, in launch order
+    """
+    # The rarest tag value drives the query, and the others are checked per instance, so the
+    # cost follows the smallest posting list rather than the largest
+    terms = sorted((self._tag_count(TAG_ALIASES.get(key, key), value),
+                    TAG_ALIASES.get(key, key), value) for key, value in (tags or {}).items())
+    if terms and terms[0][0] == 0:
+      return []
+    conditions = []
+    parameters = []
+    if terms:
+      tables = 'tag CROSS JOIN entry ON entry.id = tag.entry_id'
+      conditions.append('tag.key = ? AND tag.value = ?')
+      parameters.extend(terms[0][1:])
+      for _, key, value in terms[1:]:
+        conditions.append('EXISTS (SELECT 1 FROM tag AS other WHERE other.key = ? AND '
+                          'other.value = ? AND other.entry_id = entry.id)')
+        parameters.extend((key, value))
+    else:
+      tables = 'entry'
+    for column, (since, until) in (('launch_time', launched), ('stopped_time', stopped)):
+      if since is not None:
+        conditions.append('entry.%s >= ?' % column)
+        parameters.append(since)
+      if until is not None:
+        conditions.append('entry.%s < ?' % column)
+        parameters.append(until)
+    return [_entry(row) for row in self.db.execute(
+      'SELECT %s FROM %s%s ORDER BY coalesce(entry.launch_time, 0), entry.id' % (
+        _ENTRY_COLUMNS, tables, ' WHERE ' + ' AND '.join(conditions) if conditions else ''),
+      parameters)]
+
+  def _tag_count(self, key, value):
+    row = self.db.execute('SELECT count FROM tag_count WHERE key = ? AND value = ?',
+                          (key, value)).fetchone()
+    return row[0] if row else 0
+
+
+# field op YYYY-MM-DD, e.g. stopped<=2024-01-01
+_RANGE_RE = re.compile(r'^\s*(launched|stopped)\s*(<=|>=|<|>)\s*(\S*)\s*$')
+
+
+def _day(value, term):
+  try:
+    day = datetime.datetime.strptime(value, '%Y-%m-%d')
+  except ValueError:
+    raise ValueError('Cannot parse lookup condition %r: dates are YYYY-MM-DD' % term)
+  return int(day.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+def search(index, expression):
+  """
+  Answers a lookup from an index.
+
+  :param index: An :py:class:`InventoryIndex`
+  :param expression: Either an instance ID, private IP or hostname, or comma separated
+      conditions: tag=value (or env=, purpose=, owner=, user=), and launched or stopped
+      compared with a YYYY-MM-DD day by <, <=, > or >=, e.g. stopped<=2024-01-01
+  :return: A list of matching :py:class:`Entry`
+  """
+  if not any(c in expression for c in '=<>'):
+    entry = index.get(expression.strip())
+    return [entry] if entry else []
+
+  tags = {}
+  ranges = {'launched': [None, None], 'stopped': [None, None]}
+  for term in expression.split(','):
+    match = _RANGE_RE.match(term)
+    if match:
+      field, op, value = match.groups()
+      # Dates are whole days: since is inclusive and until exclusive
+      day = _day(value, term)
+      if op in ('>=', '>'):
+        ranges[field][0] = day + (86400 if op == '>' else 0)
+      else:
+        ranges[field][1] = day + (86400 if op == '<=' else 0)
+      continue
+    key, found, value = term.partition('=')
+    if not found or not key.strip() or any(c in term for c in '<>'):
+      raise ValueError('Cannot parse lookup condition %r' % term)
+    tags[key.strip()] = value.strip()
+  return index.find(tags, launched=tuple(ranges['launched']), stopped=tuple(ranges['stopped']))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Subnet, VPC and security group enrichment of the inventory.
+
+The subnet, VPC and security group IDs of all instances are collected in one pass and the ones
+not already cached are fetched in a few bulk describe calls. They rarely change, so they are
+cached in a JSON file between runs and refetched only once older than the cache's max age.
+Each instance is then joined with its availability zone, subnet CIDR and name, VPC name and
+security group names, and checked against :py:data:`config.SUBNET_COMPATIBILITY_MAP`.
+
+Subnets are expected to be named ``<env>-<group>-<zone>``, the group being the instance's
+purpose unless :py:data:`config.SUBNET_COMPATIBILITY_MAP` maps it to a shared one.
+
+"""
+
+import json
+import os
+import sys
+import time
+
+import config
+import engine
+import stats
+import utils
+
+
+VERSION = 1
+
+DEFAULT_MAX_AGE_DAYS = 7
+
+# Cache section -> (fetch method of engine.Engine, ID key)
+KINDS = {
+  'subnets': ('fetch_subnets', 'SubnetId'),
+  'vpcs': ('fetch_vpcs', 'VpcId'),
+  'security_groups': ('fetch_security_groups', 'GroupId'),
+}
+
+# Subnet check outcomes
+SUBNET_OK = 'ok'
+SUBNET_UNKNOWN = ''
+
+# States of the instances whose subnet is worth checking; terminated ones keep their last subnet
+CHECKED_STATES = ('pending', 'running', 'stopped')
+
+
+def _name(resource):
+  return utils.get_tags(resource).get('Name', '')
+
+
+def _record(kind, resource):
+  # Only what the report needs is cached
+  if kind == 'subnets':
+    return {'name': _name(resource), 'zone': resource.get('AvailabilityZone', ''),
+            'cidr': resource.get('CidrBlock', ''), 'vpc': resource.get('VpcId', '')}
+  if kind == 'vpcs':
+    return {'name': _name(resource), 'cidr': resource.get('CidrBlock', '')}
+  return {'name': resource.get('GroupName', ''), 'vpc': resource.get('VpcId', '')}
+
+
+def instance_ids(instance):
+  """
+  :param instance: An instance dict, as returned by describe_instances
+  :return: A dict of {cache section: [IDs]} the instance refers to
+  """
+  return {
+    'subnets': [instance['SubnetId']] if instance.get('SubnetId') else [],
+    'vpcs': [instance['VpcId']] if instance.get('VpcId') else [],
+    'security_groups': [g['GroupId'] for g in instance.get('SecurityGroups') or []],
+  }
+
+
+def expected_subnet(instance):
+  """
+  :param instance: An instance dict, as returned by describe_instances
+  :return: The name, <env>-<group>, of the subnets the instance belongs in (less their zone
+      suffix), or None if its environment or purpose is unknown
+  """
+  tags = utils.get_tags(instance)
+  environment = tags.get(config.INSTANCE_ENVIRONMENT_KEY)
+  purpose = tags.get(config.INSTANCE_PURPOSE_KEY)
+  if not environment or not purpose:
+    return None
+  group = config.SUBNET_COMPATIBILITY_MAP.get(environment, {}).get(purpose, purpose)
+  return '%s-%s' % (environment, group)
+
+
+class NetworkCache(object):
+  """
+  Subnets, VPCs and security groups by ID, kept in a JSON file.
+
+  :param fname: The cache file, or None to only cache in memory
+  :param max_age_days: Days after which a cached entry is fetched again
+  """
+
+  def __init__(self, fname=None, max_age_days=DEFAULT_MAX_AGE_DAYS):
+    self.fname = fname
+    self.max_age = max_age_days * 86400
+    # section -> ID -> record, each with the time it was fetched at
+    self.entries = {kind: {} for kind in KINDS}
+    self.changed = False
+    if fname and os.path.exists(fname):
+      try:
+        with open(fname) as f:
+          state = json.load(f)
+      except ValueError:
+        state = None
+      if isinstance(state, dict) and state.get('version') == VERSION:
+        self.entries = state['entries']
+      else:
+        # A cache is never worth failing the run for; this one is rebuilt
+        print('Ignoring %s, which is not a network cache of a supported version' % fname,
+              file=sys.stderr)
+
+  def save(self):
+    if not self.fname or not self.changed:
+      return
+    tmp = self.fname + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump({'version': VERSION, 'entries': self.entries}, f, separators=(',', ':'))
+    os.replace(tmp, self.fname)
+    self.changed = False
+
+  def missing(self, ids, now=None):
+    """
+    :param ids: A dict of {cache section: IDs}
+    :return: A dict of {cache section: set of IDs} not cached or cached too long ago
+    """
+    cutoff = (now or time.time()) - self.max_age
+    return {kind: {i for i in kind_ids
+                   if i not in self.entries[kind] or self.entries[kind][i]['fetched_at'] < cutoff}
+            for kind, kind_ids in ids.items()}
+
+  def refresh(self, instances, eng=None):
+    """
+    Fetches whatever the instances refer to that is missing from the cache, concurrently.
+
+    :param instances: Instance dicts, as returned by describe_instances
+    :param eng: The :py:class:`engine.Engine` to fetch with
+    :return: The number of resources fetched
+    """
+    with stats.span('network.collect'):
+      ids = {kind: set() for kind in KINDS}
+      for instance in instances:
+        for kind, kind_ids in instance_ids(instance).items():
+          ids[kind].update(kind_ids)
+      missing = {kind: kind_ids for kind, kind_ids in self.missing(ids).items() if kind_ids}
+    stats.incr('network_cache_hits', sum(len(v) for v in ids.values()) -
+               sum(len(v) for v in missing.values()))
+    if not missing:
+      return 0
+
+    eng = eng or engine.Engine()
+    results = eng.run(**{kind: getattr(eng, KINDS[kind][0])(kind_ids)
+                         for kind, kind_ids in missing.items()})
+    now = time.time()
+    fetched = 0
+    for kind, resources in results.items():
+      for resource in resources:
+        self.entries[kind][resource[KINDS[kind][1]]] = dict(_record(kind, resource),
+                                                            fetched_at=now)
+        fetched += 1
+    self.changed = True
+    stats.incr('network_fetched', fetched)
+    return fetched
+
+  def subnet(self, subnet_id):
+    return self.entries['subnets'].get(subnet_id)
+
+  def vpc(self, vpc_id):
+    return self.entries['vpcs'].get(vpc_id)
+
+  def security_group(self, group_id):
+    return self.entries['security_groups'].get(group_id)
+
+  def check_subnet(self, instance):
+    """
+    :param instance: An instance dict, as returned by describe_instances
+    :return: :py:data:`SUBNET_OK`, :py:data:`SUBNET_UNKNOWN` if the instance's environment,
+        purpose or subnet is unknown, or otherwise the expected subnet name
+    """
+    expected = expected_subnet(instance)
+    subnet = self.subnet(instance.get('SubnetId'))
+    if expected is None or subnet is None or not subnet['name']:
+      return SUBNET_UNKNOWN
+    if subnet['name'] in (expected, '%s-%s' % (expected, subnet['zone'])):
+      return SUBNET_OK
+    return expected
+
+  def columns(self, instance):
+    """
+    :param instance: An instance dict, as returned by describe_instances
+    :return: The instance's network columns, matching :py:data:`utils.NETWORK_COLUMNS`
+    """
+    subnet = self.subnet(instance.get('SubnetId')) or {}
+    vpc = self.vpc(instance.get('VpcId')) or {}
+    groups = [self.security_group(g['GroupId']) for g in instance.get('SecurityGroups') or []]
+    check = self.check_subnet(instance)
+    return [
+      subnet.get('zone') or instance.get('Placement', {}).get('AvailabilityZone', ''),
+      subnet.get('cidr', ''),
+      subnet.get('name', ''),
+      vpc.get('name', ''),
+      ','.join(g['name'] for g in groups if g),
+      check if check in (SUBNET_OK, SUBNET_UNKNOWN) else 'expected %s' % check,
+    ]
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""
+Single-fetch, multi-output inventory pipeline.
+
+A cron job that needs the detail TSV, a printable table, a host list, a JSON dump and an
+inventory snapshot would otherwise fetch the inventory once per artifact. Instead, each page of
+describe_instances is handed to a :py:class:`FanOut` as it arrives, which feeds every sink at
+once:
+
+    with pipeline.FanOut(pipeline.from_spec('tsv=out.tsv,hosts=-,sqlite=inv.sqlite')) as fan_out:
+      eng.run(instances=eng.fetch_instances(on_page=fan_out.write))
+
+Each sink runs in its own thread behind a bounded queue of pages. A slow sink lets its queue fill
+up, after which :py:meth:`FanOut.write` waits for it and so throttles the fetch, rather than pages
+piling up in memory; the wait happens off the event loop, so concurrent fetches keep going. The
+pages are not kept once every sink has them: the TSV, hosts and JSON sinks write them as they
+come, the SQLite sink inserts them into a transaction committed at the end, and the table sink,
+which is sorted, keeps only its formatted rows.
+
+"""
+
+import asyncio
+import json
+import queue
+import sys
+import threading
+import time
+
+import inventory
+import stats
+import utils
+
+
+# Pages each sink may fall behind the fetch by before the fetch waits for it
+DEFAULT_BUFFER_PAGES = 8
+
+# The output spec name of each sink, see from_spec
+KINDS = ('tsv', 'table', 'hosts', 'json', 'sqlite')
+
+_DONE = object()
+_ABORT = object()
+
+
+class Sink(object):
+  """
+  An output fed instance pages by a :py:class:`FanOut`.
+
+  :param path: The file to write, or - for standard output
+  """
+
+  kind = None
+  # Whether the sink records the inventory, and so gets every instance regardless of filters
+  records = False
+
+  def __init__(self, path):
+    self.path = path
+    self.f = None
+
+  def open(self):
+    self.f = sys.stdout if self.path == '-' else open(self.path, 'w')
+
+  def write(self, instances):
+    """
+    :param instances: A list of instance dicts, one page of describe_instances
+    """
+    raise NotImplementedError
+
+  def close(self):
+    if self.f is sys.stdout:
+      self.f.flush()
+    elif self.f is not None:
+      self.f.close()
+
+  def abort(self):
+    """
+    Called instead of :py:meth:`close` when the fetch failed: the output is left unfinished.
+    """
+    Sink.close(self)
+
+  def __repr__(self):
+    return '%s=%s' % (self.kind, self.path)
+
+
+class TsvSink(Sink):
+  """
+  The instance detail file of :py:func:`utils.create_instance_detail_file`, written page by page.
+  """
+
+  kind = 'tsv'
+
+  def __init__(self, path, resource_costs=None, catalog=None):
+    super(TsvSink, self).__init__(path)
+    self.resource_costs = resource_costs
+    self.catalog = catalog
+
+  def open(self):
+    super(TsvSink, self).open()
+    self.f.write('\t'.join(utils.instance_detail_header(self.resource_costs, self.catalog)))
+
+  def write(self, instances):
+    for row in utils.instance_detail_rows(instances, self.resource_costs, self.catalog):
+      self.f.write('\n' + '\t'.join(row))
+
+
+class TableSink(Sink):
+  """
+  The table of :py:func:`utils.create_instance_details_table`. The table is sorted, so its rows
+  are kept until the fetch is done.
+  """
+
+  kind = 'table'
+
+  def __init__(self, path, catalog=None):
+    super(TableSink, self).__init__(path)
+    self.catalog = catalog
+    self.table = utils.new_instance_details_table(catalog)
+
+  def write(self, instances):
+    for instance in instances:
+      self.table.add_row(utils.instance_details_table_row(instance, self.catalog))
+
+  def close(self):
+    if self.f is not None:
+      self.f.write(self.table.get_string())
+      self.f.write('\n')
+    super(TableSink, self).close()
+
+
+class HostnameSink(Sink):
+  """
+  Host names, one per line, as printed by instance_query's raw output.
+  """
+
+  kind = 'hosts'
+
+  def write(self, instances):
+    for instance in instances:
+      print(utils.generate_host(instance), file=self.f)
+
+
+def _json_default(value):
+  # Instance dicts hold datetimes (LaunchTime, attach times...)
+  if hasattr(value, 'isoformat'):
+    return value.isoformat()
+  raise TypeError('%r is not JSON serializable' % value)
+
+
+class JsonSink(Sink):
+  """
+  The instance dicts as a JSON array, one instance per line.
+  """
+
+  kind = 'json'
+
+  def __init__(self, path):
+    super(JsonSink, self).__init__(path)
+    self.count = 0
+
+  def open(self):
+    super(JsonSink, self).open()
+    self.f.write('[')
+
+  def write(self, instances):
+    for instance in instances:
+      self.f.write(',\n' if self.count else '\n')
+      self.f.write(json.dumps(instance, default=_json_default, separators=(',', ':')))
+      self.count += 1
+
+  def close(self):
+    if self.f is not None:
+      self.f.write('\n]\n')
+    super(JsonSink, self).close()
+
+
+class SqliteSink(Sink):
+  """
+  An :py:class:`inventory.Inventory` snapshot. Each page is inserted as it arrives, in one
+  transaction that is only committed once the fetch completed.
+
+  :param at: The snapshot time, as a POSIX timestamp; defaults to when the sink is opened
+  """
+
+  kind = 'sqlite'
+  records = True
+
+  def __init__(self, path, at=None):
+    if path == '-':
+      raise ValueError('The sqlite output needs a file name')
+    super(SqliteSink, self).__init__(path)
+    self.at = at
+    self.inv = None
+    self.snapshot_id = None
+
+  def open(self):
+    # Opened in the sink's own thread, which every later call is made from
+    self.inv = inventory.Inventory(self.path)
+    self.snapshot_id = self.inv.begin(self.at if self.at is not None else time.time())
+
+  def write(self, instances):
+    try:
+      self.inv.add(self.snapshot_id, instances)
+    except Exception:
+      self.inv.rollback()
+      self.inv.close()
+      raise
+
+  def close(self):
+    try:
+      self.inv.commit()
+    finally:
+      self.inv.close()
+
+  def abort(self):
+    self.inv.rollback()
+    self.inv.close()
+
+
+def from_spec(spec, resource_costs=None, catalog=None, at=None):
+  """
+  Creates sinks from an output spec.
+
+  :param spec: Comma separated kind=path outputs, kind being one of :py:data:`KINDS` and path
+      - for standard output, e.g. tsv=instances.tsv,table=-,sqlite=inventory.sqlite
+  :param resource_costs: Month-to-date cost per instance and volume ID, for the TSV
+  :param catalog: A :py:class:`pricing.PriceCatalog`, for the TSV and table
+  :param at: The snapshot time of the SQLite output, as a POSIX timestamp
+  :return: A list of :py:class:`Sink`
+  """
+  sinks = []
+  for term in spec.split(','):
+    kind, _, path = term.partition('=')
+    kind, path = kind.strip(), path.strip() or '-'
+    if kind == 'tsv':
+      sinks.append(TsvSink(path, resource_costs, catalog))
+    elif kind == 'table':
+      sinks.append(TableSink(path, catalog))
+    elif kind == 'hosts':
+      sinks.append(HostnameSink(path))
+    elif kind == 'json':
+      sinks.append(JsonSink(path))
+    elif kind == 'sqlite':
+      sinks.append(SqliteSink(path, at))
+    else:
+      raise ValueError('Unknown output %r; expected one of %s' % (kind, ', '.join(KINDS)))
+  if sum(sink.path == '-' for sink in sinks) > 1:
+    raise ValueError('Only one output can be written to standard output')
+  return sinks
+
+
+class FanOut(object):
+  """
+  Feeds instance pages to several sinks at once, each in its own thread.
+
+  A sink that fails stops receiving pages, but the others run to completion; the first failure
+  is raised by :py:meth:`close`. Used as a context manager, a fetch that fails instead aborts
+  every sink, see :py:meth:`abort`.
+
+  :param sinks: A list of :py:class:`Sink`
+  :param buffer_pages: The pages each sink may fall behind by before :py:meth:`write` blocks
+  :param select: If given, called with each page for the instances the sinks that do not record
+      the inventory get, e.g. those matching a filter
+  """
+
+  def __init__(self, sinks, buffer_pages=DEFAULT_BUFFER_PAGES, select=None):
+    self.sinks = sinks
+    self.select = select
+    self.queues = [queue.Queue(maxsize=buffer_pages) for _ in sinks]
+    self.errors = [None] * len(sinks)
+    # Daemon threads, so an aborted fetch does not leave the process waiting on them
+    self.threads = [threading.Thread(target=self._drain, args=(n,), daemon=True)
+                    for n in range(len(sinks))]
+
+  def __enter__(self):
+    self.open()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.abort()
+
+  def open(self):
+    for thread in self.threads:
+      thread.start()
+
+  def _drain(self, n):
+    sink, pages = self.sinks[n], self.queues[n]
+    page = None
+    try:
+      with stats.span('pipeline.%s' % sink.kind):
+        sink.open()
+      while True:
+        page = pages.get()
+        if page is _DONE or page is _ABORT:
+          break
+        with stats.span('pipeline.%s' % sink.kind):
+          sink.write(page)
+      with stats.span('pipeline.%s' % sink.kind):
+        if page is _DONE:
+          sink.close()
+        else:
+          sink.abort()
+    except Exception as e:
+      self.errors[n] = e
+      # Keep consuming, so a failed sink never blocks the fetch
+      while page is not _DONE and page is not _ABORT:
+        page = pages.get()
+
+  async def write(self, instances):
+    """
+    Hands a page of instances to every sink, waiting for sinks whose buffer is full. Meant as the
+    ``on_page`` of :py:meth:`engine.Engine.fetch_instances`.
+
+    :param instances: A list of instance dicts
+    """
+    selected = self.select(instances) if self.select is not None else instances
+    stats.incr('pipeline_instances', len(selected))
+    for sink, pages in zip(self.sinks, self.queues):
+      page = instances if sink.records else selected
+      try:
+        pages.put_nowait(page)
+      except queue.Full:
+        stats.incr('pipeline_backpressure', sink=sink.kind)
+        # A blocking put would stall the event loop, and every other fetch with it
+        await asyncio.get_running_loop().run_in_executor(None, pages.put, page)
+
+  def close(self):
+    """
+    Waits for every sink to finish.
+    """
+    for pages in self.queues:
+      pages.put(_DONE)
+    for thread in self.threads:
+      thread.join()
+    for sink, error in zip(self.sinks, self.errors):
+      if error is not None:
+        print('Output %r failed: %s' % (sink, error), file=sys.stderr)
+    for error in self.errors:
+      if error is not None:
+        raise error
+
+  def abort(self):
+    """
+    Stops every sink after a failed fetch, without finishing their outputs: the SQLite snapshot is
+    rolled back, and the table and JSON are not written out. Errors of the sinks are dropped in
+    favor of the fetch's.
+    """
+    for pages in self.queues:
+      pages.put(_ABORT)
+    for thread in self.threads:
+      thread.join()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Offline EC2 on-demand price catalog.
+
+The AWS bulk pricing offer file for EC2 is several gigabytes of JSON. :py:func:`build_catalog`
+reduces it once to the hourly on-demand price per instance type, region, tenancy and operating
+system, reading it as a stream one product or term at a time, and writes those to a compact
+binary hash table. :py:class:`PriceCatalog` memory-maps
+that file, so opening it costs nothing and each lookup reads a couple of slots.
+
+File layout (little endian):
+
+    header  magic (8s) | version (I) | slot count (I) | entry count (I) | key area offset (Q)
+    slots   slot count x (key hash (Q) | key offset (I) | key length (H) | price (d)), 0 = empty
+    keys    the UTF-8 keys, type|region|tenancy|os
+
+"""
+
+import hashlib
+import json
+import mmap
+import struct
+
+import stats
+
+
+MAGIC = b'EC2PRICE'
+VERSION = 1
+
+HOURS_PER_MONTH = 730
+
+# Offer files before regionCode was added only name the location
+LOCATION_REGIONS = {
+  'US East (N. Virginia)': 'us-east-1',
+  'US East (Ohio)': 'us-east-2',
+  'US West (N. California)': 'us-west-1',
+  'US West (Oregon)': 'us-west-2',
+  'Canada (Central)': 'ca-central-1',
+  'EU (Ireland)': 'eu-west-1',
+  'EU (London)': 'eu-west-2',
+  'EU (Paris)': 'eu-west-3',
+  'EU (Frankfurt)': 'eu-central-1',
+  'EU (Stockholm)': 'eu-north-1',
+  'Asia Pacific (Tokyo)': 'ap-northeast-1',
+  'Asia Pacific (Seoul)': 'ap-northeast-2',
+  'Asia Pacific (Singapore)': 'ap-southeast-1',
+  'Asia Pacific (Sydney)': 'ap-southeast-2',
+  'Asia Pacific (Mumbai)': 'ap-south-1',
+  'South America (Sao Paulo)': 'sa-east-1',
+}
+
+# describe_instances Placement.Tenancy -> offer file tenancy
+TENANCIES = {
+  'default': 'Shared',
+  'dedicated': 'Dedicated',
+  'host': 'Host',
+}
+
+_HEADER = struct.Struct('<8sIIIQ')
+_SLOT = struct.Struct('<QIHd')
+
+_MAX_LOAD = 0.5
+
+_READ_SIZE = 1024 * 1024
+
+_NUMBER_CHARS = '0123456789+-.eE'
+
+
+def catalog_key(instance_type, region, tenancy='Shared', operating_system='Linux'):
+  return '|'.join((instance_type, region, tenancy, operating_system))
+
+
+def _hash(key):
+  # Stable across processes, unlike hash(); 0 marks an empty slot
+  return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little') or 1
+
+
+class _JsonStream(object):
+  """
+  Walks a JSON document from a file without loading all of it: the members of the objects it
+  descends into are yielded one at a time, and only their values are decoded whole.
+  """
+
+  def __init__(self, f):
+    self.f = f
+    self.buffer = ''
+    self.pos = 0
+    self.eof = False
+    self.decoder = json.JSONDecoder()
+
+  def _fill(self):
+    # Drop what was consumed, then append the next block
+    block = self.f.read(_READ_SIZE)
+    self.buffer = self.buffer[self.pos:] + block
+    self.pos = 0
+    self.eof = not block
+
+  def _peek(self):
+    while True:
+      while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+        self.pos += 1
+      if self.pos < len(self.buffer) or self.eof:
+        return self.buffer[self.pos:self.pos + 1]
+      self._fill()
+
+  def _expect(self, char):
+    if self._peek() != char:
+      raise ValueError('Expected %r at offset %d of the offer file' % (char, self.pos))
+    self.pos += 1
+
+  def value(self):
+    """
+    :return: The next value, decoded
+    """
+    self._peek()
+    while True:
+      try:
+        value, end = self.decoder.raw_decode(self.buffer, self.pos)
+      except ValueError:
+        # The value may run past the buffer
+        if self.eof:
+          raise
+        self._fill()
+        continue
+      # A number may also run past the buffer, and decode as a shorter one up to its cut, e.g. 1.
+      # of 1.5 or 2 of 2e-3
+      if not self.eof and (end == len(self.buffer) or (
+          isinstance(value, (int, float)) and not self.buffer[end:].lstrip(_NUMBER_CHARS))):
+        self._fill()
+        continue
+      self.pos = end
+      return value
+
+  def members(self):
+    """
+    Iterates over the members of the next object. Each member's value must be consumed, with
+    :py:meth:`value` or :py:meth:`members`, before the next one is yielded.
+
+    :return: An iterator of member names
+    """
+    self._expect('{')
+    if self._peek() == '}':
+      self.pos += 1
+      return
+    while True:
+      name = self.value()
+      self._expect(':')
+      yield name
+      if self._peek() == ',':
+        self.pos += 1
+      else:
+        self._expect('}')
+        return
+
+  def skip(self):
+    # Skips the next value, a member at a time if it is an object
+    if self._peek() == '{':
+      for _ in self.members():
+        self.value()
+    else:
+      self.value()
+
+
+def _product_key(product):
+  # The catalog key of a product, or None if describe_instances never reports it
+  attributes = product.get('attributes', {})
+  if product.get('productFamily') != 'Compute Instance':
+    return None
+  if attributes.get('preInstalledSw', 'NA') != 'NA':
+    return None
+  if attributes.get('capacitystatus', 'Used') != 'Used':
+    return None
+  if attributes.get('licenseModel') == 'Bring your own license':
+    return None
+  region = attributes.get('regionCode') or LOCATION_REGIONS.get(attributes.get('location'))
+  if not region or 'instanceType' not in attributes:
+    return None
+  return catalog_key(attributes['instanceType'], region, attributes.get('tenancy', 'Shared'),
+                     attributes.get('operatingSystem', 'Linux'))
+
+
+def _hourly_price(terms):
+  price = None
+  for term in terms.values():
+    for dimension in term['priceDimensions'].values():
+      if dimension.get('unit') == 'Hrs' and 'USD' in dimension['pricePerUnit']:
+        price = float(dimension['pricePerUnit']['USD'])
+  return price
+
+
+def read_offer_file(fname):
+  """
+  Extracts hourly on-demand prices from an EC2 bulk pricing offer file.
+
+  Only instances without pre-installed software, with license included and of capacity status
+  Used (i.e. not reserved capacity) are kept, as those are what describe_instances reports. The
+  file is streamed, so memory use is bounded by the prices kept rather than the file's size.
+
+  :param fname: A local copy of the offer file (offers/v1.0/aws/AmazonEC2/current/index.json)
+  :return: A dict of {catalog key: hourly USD price}
+  """
+  skus = {}
+  sku_prices = {}
+  with open(fname, encoding='utf-8') as f:
+    stream = _JsonStream(f)
+    for section in stream.members():
+      if section == 'products':
+        for sku in stream.members():
+          key = _product_key(stream.value())
+          if key is not None:
+            skus[sku] = key
+      elif section == 'terms':
+        for term_type in stream.members():
+          if term_type != 'OnDemand':
+            stream.skip()
+            continue
+          for sku in stream.members():
+            price = _hourly_price(stream.value())
+            if price is not None:
+              sku_prices[sku] = price
+      else:
+        stream.skip()
+  # Products usually come before terms, but the format does not promise it
+  return {skus[sku]: price for sku, price in sku_prices.items() if sku in skus}
+
+
+def write_catalog(prices, fname):
+  """
+  Writes prices to a binary catalog file.
+
+  :param prices: A dict of {catalog key: hourly price}
+  :param fname: The catalog file to write
+  """
+  slots = 8
+  while slots * _MAX_LOAD < len(prices):
+    slots *= 2
+
+  table = bytearray(_SLOT.size * slots)
+  keys = bytearray()
+  for key, price in prices.items():
+    encoded = key.encode('utf-8')
+    hashed = _hash(encoded)
+    slot = hashed % slots
+    while _SLOT.unpack_from(table, slot * _SLOT.size)[0]:
+      slot = (slot + 1) % slots
+    _SLOT.pack_into(table, slot * _SLOT.size, hashed, len(keys), len(encoded), price)
+    keys += encoded
+
+  with open(fname, 'wb') as f:
+    f.write(_HEADER.pack(MAGIC, VERSION, slots, len(prices), _HEADER.size + len(table)))
+    f.write(table)
+    f.write(keys)
+
+
+def build_catalog(offer_fname, fname):
+  """
+  Builds a binary catalog from an offer file.
+
+  :return: The number of prices written
+  """
+  with stats.span('pricing.build'):
+    prices = read_offer_file(offer_fname)
+    write_catalog(prices, fname)
+  return len(prices)
+
+
+class PriceCatalog(object):
+  """
+  A memory-mapped catalog written by :py:func:`write_catalog`.
+
+  :param fname: The catalog file
+  """
+
+  def __init__(self, fname):
+    with open(fname, 'rb') as f:
+      self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, self._slots, self.size, self._keys = _HEADER.unpack_from(self._map, 0)
+    if magic != MAGIC or version != VERSION:
+      raise ValueError('%s is not a version %d price catalog' % (fname, VERSION))
+
+  def close(self):
+    self._map.close()
+
+  def __len__(self):
+    return self.size
+
+  def price(self, instance_type, region, tenancy='Shared', operating_system='Linux'):
+    """
+    :return: The hourly on-demand USD price, or None if the catalog has none
+    """
+    encoded = catalog_key(instance_type, region, tenancy, operating_system).encode('utf-8')
+    hashed = _hash(encoded)
+    slot = hashed % self._slots
+    while True:
+      stored, offset, length, price = _SLOT.unpack_from(self._map, _HEADER.size + slot * _SLOT.size)
+      if not stored:
+        return None
+      if stored == hashed and self._map[self._keys + offset:self._keys + offset + length] == encoded:
+        return price
+      slot = (slot + 1) % self._slots
+
+  def instance_price(self, instance):
+    """
+    :param instance: An instance dict, as returned by describe_instances
+    :return: The instance's hourly on-demand price, or None if the catalog has none
+    """
+    placement = instance.get('Placement', {})
+    zone = placement.get('AvailabilityZone', '')
+    return self.price(
+      instance.get('InstanceType', ''),
+      zone[:-1] if zone else '',
+      TENANCIES.get(placement.get('Tenancy', 'default'), 'Shared'),
+      'Windows' if instance.get('Platform') == 'windows' else 'Linux')
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Reserved instance and Savings Plan coverage of the running fleet.
+
+Reservations are applied the way AWS bills them, in this order:
+
+1. Zonal reserved instances, to instances of the same type in the same availability zone
+2. Regional reserved instances, to instances of the same type
+3. What is left of regional Linux/UNIX, default tenancy reservations, to any size of the same
+   instance family, by normalization factor (a reserved m5.2xlarge covers two m5.large, or half
+   an m5.4xlarge), smallest instances first
+4. Savings Plans commitments (EC2 instance family plans, then Compute plans), spent on the
+   remaining on-demand cost
+
+Every step works on buckets of instances keyed by what a reservation can match, so a match is a
+dict lookup and the whole pass is linear in instances plus reservations.
+
+Savings Plans commit to dollars per hour, so step 4 needs hourly prices (see
+:py:mod:`pricing`). Prices are on-demand rates while Savings Plans rates are lower, so Savings
+Plans coverage is a conservative estimate.
+
+"""
+
+import collections
+import re
+
+import config
+import stats
+import utils
+
+
+# Normalization factors of instance sizes, for size flexible regional reservations
+NORMALIZATION_FACTORS = {
+  'nano': 0.25,
+  'micro': 0.5,
+  'small': 1.0,
+  'medium': 2.0,
+  'large': 4.0,
+  'xlarge': 8.0,
+}
+
+LINUX = 'Linux/UNIX'
+WINDOWS = 'Windows'
+
+HOURS_PER_DAY = 24
+
+_XLARGE_RE = re.compile(r'^(\d+)xlarge$')
+
+Coverage = collections.namedtuple('Coverage', [
+  # instance ID -> (hours covered by reserved instances, hours covered by Savings Plans), per hour
+  'covered',
+  # instance family -> normalized units of regional reservations per hour that matched nothing
+  'unused_units',
+  # instance type -> zonal or non size flexible reserved instances that matched nothing
+  'unused_instances',
+  # Savings Plan commitment in dollars per hour that was not spent
+  'unused_commitment',
+])
+
+
+def normalization_factor(instance_type):
+  """
+  :param instance_type: e.g. m5.2xlarge
+  :return: The size's normalization factor (e.g. 16.0), or None for sizes without one (metal)
+  """
+  size = instance_type.split('.')[-1]
+  if size in NORMALIZATION_FACTORS:
+    return NORMALIZATION_FACTORS[size]
+  match = _XLARGE_RE.match(size)
+  return 8.0 * int(match.group(1)) if match else None
+
+
+def instance_family(instance_type):
+  return instance_type.split('.')[0]
+
+
+def instance_platform(instance):
+  return WINDOWS if instance.get('Platform') == 'windows' else LINUX
+
+
+def reservation_platform(reservation):
+  # e.g. 'Linux/UNIX (Amazon VPC)' -> 'Linux/UNIX'
+  return reservation.get('ProductDescription', LINUX).replace(' (Amazon VPC)', '')
+
+
+def _tenancy(instance):
+  return instance.get('Placement', {}).get('Tenancy', 'default')
+
+
+def match(instances, reservations=(), savings_plans=(), catalog=None):
+  """
+  Applies reservations and Savings Plans to the running instances.
+
+  :param instances: Instance dicts, as returned by describe_instances
+  :param reservations: Active ``ReservedInstances`` entries
+  :param savings_plans: Active ``savingsPlans`` entries
+  :param catalog: A :py:class:`pricing.PriceCatalog`, needed to apply Savings Plans
+  :return: A :py:class:`Coverage`
+  """
+  with stats.span('coverage.match'):
+    running = [i for i in instances if i['State']['Name'] == 'running']
+    remaining = {i['InstanceId']: 1.0 for i in running}
+    reserved = dict.fromkeys(remaining, 0.0)
+
+    # 1. Zonal reservations
+    by_zone = collections.defaultdict(list)
+    for instance in running:
+      by_zone[(instance['InstanceType'], instance['Placement']['AvailabilityZone'],
+               instance_platform(instance), _tenancy(instance))].append(instance)
+    unused_instances = collections.Counter()
+    regional = []
+    for reservation in reservations:
+      if reservation.get('Scope') != 'Availability Zone':
+        regional.append(reservation)
+        continue
+      bucket = by_zone.get((reservation['InstanceType'], reservation.get('AvailabilityZone'),
+                            reservation_platform(reservation),
+                            reservation.get('InstanceTenancy', 'default')), [])
+      count = reservation['InstanceCount']
+      while count and bucket:
+        instance = bucket.pop()
+        remaining[instance['InstanceId']] = 0.0
+        reserved[instance['InstanceId']] = 1.0
+        count -= 1
+      unused_instances[reservation['InstanceType']] += count
+
+    # 2. Regional reservations of the exact type
+    by_type = collections.defaultdict(list)
+    for instance in running:
+      if remaining[instance['InstanceId']]:
+        by_type[(instance['InstanceType'], instance_platform(instance),
+                 _tenancy(instance))].append(instance)
+    units = collections.Counter()
+    for reservation in regional:
+      platform = reservation_platform(reservation)
+      tenancy = reservation.get('InstanceTenancy', 'default')
+      bucket = by_type.get((reservation['InstanceType'], platform, tenancy), [])
+      count = reservation['InstanceCount']
+      while count and bucket:
+        instance = bucket.pop()
+        remaining[instance['InstanceId']] = 0.0
+        reserved[instance['InstanceId']] = 1.0
+        count -= 1
+      factor = normalization_factor(reservation['InstanceType'])
+      if count and platform == LINUX and tenancy == 'default' and factor:
+        units[instance_family(reservation['InstanceType'])] += count * factor
+      else:
+        unused_instances[reservation['InstanceType']] += count
+
+    # 3. Size flexibility: the rest of the regional units, smallest instances first
+    if units:
+      flexible = collections.defaultdict(list)
+      for instance in running:
+        factor = normalization_factor(instance['InstanceType'])
+        family = instance_family(instance['InstanceType'])
+        if (remaining[instance['InstanceId']] and units.get(family) and factor and
+            instance_platform(instance) == LINUX and _tenancy(instance) == 'default'):
+          flexible[family].append((factor, instance['InstanceId']))
+      for family, candidates in flexible.items():
+        candidates.sort()
+        for factor, instance_id in candidates:
+          if units[family] <= 0:
+            break
+          used = min(units[family], remaining[instance_id] * factor)
+          units[family] -= used
+          remaining[instance_id] -= used / factor
+          reserved[instance_id] += used / factor
+
+    # 4. Savings Plans, spent on the remaining on-demand cost
+    saved = dict.fromkeys(remaining, 0.0)
+    family_commitments = collections.Counter()
+    compute_commitment = 0.0
+    for plan in savings_plans:
+      if plan.get('savingsPlanType') == 'EC2Instance':
+        family_commitments[(plan.get('ec2InstanceFamily'), plan.get('region'))] += float(
+          plan['commitment'])
+      elif plan.get('savingsPlanType') == 'Compute':
+        compute_commitment += float(plan['commitment'])
+    if catalog is not None and (family_commitments or compute_commitment):
+      for instance in running:
+        instance_id = instance['InstanceId']
+        price = catalog.instance_price(instance) if remaining[instance_id] else None
+        if not price:
+          continue
+        cost = remaining[instance_id] * price
+        key = (instance_family(instance['InstanceType']),
+               instance['Placement']['AvailabilityZone'][:-1])
+        spent = min(family_commitments.get(key, 0.0), cost)
+        if spent:
+          family_commitments[key] -= spent
+        spent_compute = min(compute_commitment, cost - spent)
+        compute_commitment -= spent_compute
+        saved[instance_id] = (spent + spent_compute) / price
+        remaining[instance_id] -= saved[instance_id]
+
+  stats.incr('coverage_instances', len(running))
+  stats.incr('coverage_reservations', len(reservations))
+  return Coverage(
+    covered={i: (reserved[i], saved[i]) for i in remaining},
+    unused_units={f: u for f, u in units.items() if u > 0},
+    unused_instances={t: c for t, c in unused_instances.items() if c},
+    unused_commitment=sum(family_commitments.values()) + compute_commitment,
+  )
+
+
+def summarize(instances, coverage):
+  """
+  Sums covered and uncovered instance-hours per day by environment and purpose.
+
+  :param instances: The instances coverage was matched for
+  :param coverage: A :py:class:`Coverage`
+  :return: A list of (env, purpose, instances, reserved hours, Savings Plans hours,
+      uncovered hours) tuples, most uncovered hours first
+  """
+  totals = collections.OrderedDict()
+  for instance in instances:
+    covered = coverage.covered.get(instance['InstanceId'])
+    if covered is None:
+      continue
+    tags = utils.get_tags(instance)
+    key = (tags.get(config.INSTANCE_ENVIRONMENT_KEY, ''), tags.get(config.INSTANCE_PURPOSE_KEY, ''))
+    count, reserved, saved = totals.get(key, (0, 0.0, 0.0))
+    totals[key] = (count + 1, reserved + covered[0], saved + covered[1])
+  rows = [key + (count, reserved * HOURS_PER_DAY, saved * HOURS_PER_DAY,
+                 (count - reserved - saved) * HOURS_PER_DAY)
+          for key, (count, reserved, saved) in totals.items()]
+  return sorted(rows, key=lambda row: row[-1], reverse=True)
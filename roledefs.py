@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Fabric roledefs generated from the live inventory.
+
+The running instances are grouped by :py:func:`utils.generate_role` in one pass, each as
+user@host with its :py:func:`utils.generate_host` managed hostname, and the static
+:py:data:`config.MANAGED_ENV_ROLEDEFS` entries are merged in. The result is kept in a local file
+and reused until it is older than its TTL, so a fabfile can do
+
+    env.roledefs = roledefs.RoledefCache('~/.cache/roledefs.json').get()
+
+on every invocation without sweeping EC2 each time.
+
+"""
+
+import json
+import os
+import sys
+import time
+
+import config
+import engine
+import stats
+import utils
+
+
+VERSION = 1
+
+DEFAULT_TTL = 300
+
+RUNNING_FILTER = [{'Name': 'instance-state-name', 'Values': ['running']}]
+
+
+def build(instances, static=None):
+  """
+  Groups running instances by role.
+
+  :param instances: Instance dicts, as returned by describe_instances
+  :param static: Roledefs to merge in; defaults to :py:data:`config.MANAGED_ENV_ROLEDEFS`
+  :return: A dict of {role: [user@host, ...]}, hosts sorted
+  """
+  roles = {}
+  with stats.span('roledefs.build'):
+    for instance in instances:
+      if instance['State']['Name'] != 'running':
+        continue
+      role = utils.generate_role(instance)
+      if role is None:
+        continue
+      user = utils.get_tags(instance).get(config.INSTANCE_USER_KEY) or config.INSTANCE_USER_DEFAULT
+      roles.setdefault(role, set()).add(utils.generate_host(instance, prepend_user=True, user=user))
+    for role, hosts in (config.MANAGED_ENV_ROLEDEFS if static is None else static).items():
+      roles.setdefault(role, set()).update(hosts)
+  return {role: sorted(hosts) for role, hosts in roles.items()}
+
+
+def fetch_running():
+  """
+  :return: The running instances, filtered on the API side
+  """
+  eng = engine.Engine()
+  return eng.run(instances=eng.fetch_instances(RUNNING_FILTER))['instances']
+
+
+class RoledefCache(object):
+  """
+  Roledefs kept in a JSON file and rebuilt from the inventory once older than a TTL.
+
+  :param fname: The cache file; created if missing
+  :param ttl: Seconds the roledefs are served for before they are rebuilt
+  """
+
+  def __init__(self, fname, ttl=DEFAULT_TTL):
+    self.fname = os.path.expanduser(fname)
+    self.ttl = ttl
+
+  def _load(self):
+    if not os.path.exists(self.fname):
+      return None
+    try:
+      with open(self.fname) as f:
+        state = json.load(f)
+    except ValueError:
+      state = None
+    if not isinstance(state, dict) or state.get('version') != VERSION:
+      # A cache is never worth failing the run for; this one is rebuilt
+      print('Ignoring %s, which is not a roledefs cache of a supported version' % self.fname,
+            file=sys.stderr)
+      return None
+    return state
+
+  def get(self, fetch=fetch_running, refresh=False):
+    """
+    :param fetch: Called without arguments for the instances on a cache miss
+    :param refresh: Whether to rebuild regardless of the cache's age
+    :return: A dict of {role: [user@host, ...]}, see :py:func:`build`
+    """
+    state = None if refresh else self._load()
+    if state is not None and time.time() - state['built_at'] < self.ttl:
+      stats.incr('roledef_cache', result='hit')
+      return state['roledefs']
+    stats.incr('roledef_cache', result='miss')
+    roledefs = build(fetch())
+    self.save(roledefs)
+    return roledefs
+
+  def save(self, roledefs, built_at=None):
+    tmp = self.fname + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump({'version': VERSION, 'built_at': built_at if built_at is not None else time.time(),
+                 'roledefs': roledefs}, f, separators=(',', ':'))
+    os.replace(tmp, self.fname)
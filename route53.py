@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Reconciliation of the managed DNS zone with the instance inventory.
+
+Every instance that is not terminated should have an A record from its
+:py:func:`utils.generate_host` name (``<env>-<purpose>-<id>.managed.compass.com``) to its private
+IP, and no other generated name should resolve. The zone is listed once, both sides are hashed by
+record name, and the differences become CREATE, UPSERT and DELETE changes, packed into as few
+ChangeResourceRecordSets batches as the Route 53 limits allow:
+
+    eng = engine.Engine()
+    results = eng.run(instances=eng.fetch_instances(),
+                      zone=eng.fetch_zone(config.MANAGED_SUBDOMAIN))
+    plan = route53.plan(results['instances'], results['zone'][1])
+    eng.run(changes=eng.change_record_sets(results['zone'][0], route53.batches(plan.changes)))
+
+Only A records whose first label ends with an instance ID are managed; the apex records and
+anything added by hand are left alone. An instance whose generated name would not be managed,
+e.g. because its purpose tag holds a dot or a space, gets no record and is reported instead.
+
+"""
+
+import collections
+import re
+
+import config
+import stats
+import utils
+
+
+DEFAULT_TTL = 300
+
+# ChangeResourceRecordSets limits: ResourceRecord elements (UPSERTs count twice) and characters
+# of record values per request
+MAX_BATCH_RECORDS = 1000
+MAX_BATCH_VALUE_CHARS = 32000
+
+# Instances in these states get no record
+UNADDRESSED_STATES = ('shutting-down', 'terminated')
+
+# Generated names end with the instance ID without its i- prefix: 8 or 17 hex digits
+_MANAGED_NAME_RE = re.compile(r'^(?:.+-)?(?:[0-9a-f]{8}|[0-9a-f]{17})\.')
+
+# A host name label: letters, digits and inner hyphens, at most 63 characters
+_LABEL_RE = re.compile(r'^(?!-)[a-z0-9-]{1,63}(?<!-)$')
+
+Plan = collections.namedtuple('Plan', ['changes', 'creates', 'updates', 'deletes', 'unchanged',
+                                       # Names of instances that get no record, see plan
+                                       'skipped'])
+
+
+def _fqdn(name):
+  return name.lower().rstrip('.') + '.'
+
+
+def is_managed(record_set, zone=config.MANAGED_SUBDOMAIN):
+  """
+  :return: Whether a record set is one of the generated instance records of the zone
+  """
+  name = _fqdn(record_set['Name'])
+  return (record_set['Type'] == 'A' and 'SetIdentifier' not in record_set and
+          name.endswith('.' + _fqdn(zone)) and name.count('.') == _fqdn(zone).count('.') + 1 and
+          _MANAGED_NAME_RE.match(name) is not None)
+
+
+def is_valid_name(name, zone=config.MANAGED_SUBDOMAIN):
+  """
+  :return: Whether a name is a host name in the zone, every label of it below the zone being a
+      valid host name label
+  """
+  name, zone = _fqdn(name), _fqdn(zone)
+  if not name.endswith('.' + zone):
+    return False
+  return all(_LABEL_RE.match(label) for label in name[:-len(zone) - 1].split('.'))
+
+
+def desired_record_sets(instances, ttl=DEFAULT_TTL, zone=config.MANAGED_SUBDOMAIN):
+  """
+  :param instances: Instance dicts, as returned by describe_instances
+  :param ttl: The records' TTL in seconds
+  :param zone: The zone name
+  :return: A tuple of (dict of {record name: ResourceRecordSet} for every addressable instance,
+      sorted list of the generated names that are not valid or would not be managed by
+      :py:func:`is_managed`, and so get no record)
+  """
+  record_sets = {}
+  skipped = set()
+  for instance in instances:
+    ip = instance.get('PrivateIpAddress')
+    if not ip or instance['State']['Name'] in UNADDRESSED_STATES:
+      continue
+    name = _fqdn(utils.generate_host(instance))
+    record_set = {'Name': name, 'Type': 'A', 'TTL': ttl, 'ResourceRecords': [{'Value': ip}]}
+    # Such a record would never be found among the managed ones, and be created on every run
+    if not is_valid_name(name, zone) or not is_managed(record_set, zone):
+      skipped.add(name)
+      continue
+    record_sets[name] = record_set
+  return record_sets, sorted(skipped)
+
+
+def plan(instances, record_sets, zone=config.MANAGED_SUBDOMAIN, ttl=DEFAULT_TTL):
+  """
+  Works out the changes that bring a zone in line with the inventory.
+
+  :param instances: Instance dicts, as returned by describe_instances; the whole inventory, as
+      managed records of instances missing from it are deleted
+  :param record_sets: The zone's ``ResourceRecordSets`` entries, e.g. from
+      :py:meth:`engine.Engine.fetch_zone`
+  :param zone: The zone name
+  :param ttl: The TTL of created and updated records
+  :return: A :py:class:`Plan`: the ``Changes`` entries, how many records are created, updated,
+      deleted and already correct, and the generated names skipped as not manageable
+  """
+  with stats.span('route53.plan'):
+    desired, skipped = desired_record_sets(instances, ttl, zone)
+    existing = {_fqdn(r['Name']): r for r in record_sets if is_managed(r, zone)}
+    changes = []
+    updates = unchanged = 0
+    for name in sorted(desired):
+      current = existing.get(name)
+      if current is None:
+        changes.append({'Action': 'CREATE', 'ResourceRecordSet': desired[name]})
+      elif (current.get('TTL') != desired[name]['TTL'] or
+            current.get('ResourceRecords') != desired[name]['ResourceRecords']):
+        changes.append({'Action': 'UPSERT', 'ResourceRecordSet': desired[name]})
+        updates += 1
+      else:
+        unchanged += 1
+    stale = sorted(set(existing) - set(desired))
+    # A DELETE must carry the record set exactly as it is
+    changes.extend({'Action': 'DELETE', 'ResourceRecordSet': existing[name]} for name in stale)
+  creates = len(changes) - updates - len(stale)
+  stats.incr('route53_changes', creates, action='CREATE')
+  stats.incr('route53_changes', updates, action='UPSERT')
+  stats.incr('route53_changes', len(stale), action='DELETE')
+  stats.incr('route53_skipped', len(skipped))
+  return Plan(changes, creates, updates, len(stale), unchanged, skipped)
+
+
+def batches(changes, max_records=MAX_BATCH_RECORDS, max_chars=MAX_BATCH_VALUE_CHARS):
+  """
+  Packs changes into as few ChangeResourceRecordSets requests as the limits allow. Each record
+  name appears in at most one change, so the batches can be applied in any order.
+
+  :param changes: ``Changes`` entries
+  :return: A list of lists of ``Changes`` entries
+  """
+  result = []
+  batch, records, chars = [], 0, 0
+  for change in changes:
+    values = [v['Value'] for v in change['ResourceRecordSet'].get('ResourceRecords', [])]
+    weight = max(len(values), 1) * (2 if change['Action'] == 'UPSERT' else 1)
+    size = sum(len(v) for v in values)
+    if batch and (records + weight > max_records or chars + size > max_chars):
+      result.append(batch)
+      batch, records, chars = [], 0, 0
+    batch.append(change)
+    records += weight
+    chars += size
+  if batch:
+    result.append(batch)
+  return result
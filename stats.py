@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Lightweight run instrumentation: stage spans, counters and latency histograms.
+
+Everything is recorded in a process-wide :py:data:`REGISTRY` and can be rendered as a
+human readable summary, as JSON, or in the Prometheus text exposition format (e.g. for the
+node_exporter textfile collector).
+
+"""
+
+import bisect
+import collections
+import contextlib
+import json
+import threading
+import time
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+PROMETHEUS_PREFIX = 'aws_usage_'
+
+
+class Histogram(object):
+  """
+  A fixed-bucket histogram, in the style of a Prometheus histogram.
+  """
+
+  def __init__(self, buckets=LATENCY_BUCKETS):
+    self.buckets = tuple(buckets)
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.count = 0
+    self.sum = 0.0
+    self.min = None
+    self.max = None
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.count += 1
+    self.sum += value
+    self.min = value if self.min is None else min(self.min, value)
+    self.max = value if self.max is None else max(self.max, value)
+
+  def quantile(self, q):
+    """
+    Estimates a quantile by interpolating linearly within the bucket it falls in.
+
+    :param q: The quantile, between 0 and 1
+    :return: The estimated value, or None if nothing has been observed
+    """
+    if not self.count:
+      return None
+    rank = q * self.count
+    seen = 0
+    for i, count in enumerate(self.counts):
+      if count and seen + count >= rank:
+        lower = self.buckets[i - 1] if i > 0 else 0.0
+        upper = self.buckets[i] if i < len(self.buckets) else self.max
+        return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+      seen += count
+    return self.max
+
+  def as_dict(self):
+    return {
+      'count': self.count,
+      'sum': self.sum,
+      'min': self.min,
+      'max': self.max,
+      'p50': self.quantile(0.5),
+      'p95': self.quantile(0.95),
+      'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts)),
+    }
+
+
+class Registry(object):
+  """
+  Holds all spans, counters and histograms of a run. Safe to use from several threads.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self.counters = collections.OrderedDict()
+      self.histograms = collections.OrderedDict()
+      self.spans = collections.OrderedDict()
+
+  def incr(self, name, value=1, **labels):
+    """
+    Increments a counter.
+
+    :param name: The counter name, e.g. api_calls
+    :param value: The amount to add
+    :param labels: Labels distinguishing series of the same counter, e.g. operation='...'
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with self._lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def observe(self, name, value, **labels):
+    """
+    Records a value, e.g. a latency in seconds, in a histogram.
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with self._lock:
+      if key not in self.histograms:
+        self.histograms[key] = Histogram()
+      self.histograms[key].observe(value)
+
+  @contextlib.contextmanager
+  def span(self, name):
+    """
+    Times a stage of a run. Spans with the same name accumulate.
+
+    :param name: The stage name, e.g. instance_query.describe_instances
+    """
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      elapsed = time.perf_counter() - start
+      with self._lock:
+        count, total = self.spans.get(name, (0, 0.0))
+        self.spans[name] = (count + 1, total + elapsed)
+
+  def as_dict(self):
+    with self._lock:
+      return {
+        'spans': {name: {'count': count, 'seconds': total}
+                  for name, (count, total) in self.spans.items()},
+        'counters': [dict(name=name, labels=dict(labels), value=value)
+                     for (name, labels), value in self.counters.items()],
+        'histograms': [dict(name=name, labels=dict(labels), **histogram.as_dict())
+                       for (name, labels), histogram in self.histograms.items()],
+      }
+
+  def to_json(self):
+    return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+  def summary(self):
+    lines = ['Stage\tCalls\tSeconds']
+    with self._lock:
+      for name, (count, total) in self.spans.items():
+        lines.append('%s\t%d\t%.3f' % (name, count, total))
+      lines.append('')
+      lines.append('Counter\tValue')
+      for (name, labels), value in self.counters.items():
+        lines.append('%s%s\t%s' % (name, _format_labels(labels), value))
+      lines.append('')
+      lines.append('Histogram\tCount\tp50\tp95\tMax')
+      for (name, labels), histogram in self.histograms.items():
+        lines.append('%s%s\t%d\t%.3f\t%.3f\t%.3f' % (
+          name, _format_labels(labels), histogram.count, histogram.quantile(0.5),
+          histogram.quantile(0.95), histogram.max))
+    return '\n'.join(lines)
+
+  def to_prometheus(self, prefix=PROMETHEUS_PREFIX):
+    lines = []
+    with self._lock:
+      if self.spans:
+        lines.append('# TYPE %sstage_seconds_total counter' % prefix)
+        for name, (_, total) in self.spans.items():
+          lines.append('%sstage_seconds_total%s %r' % (prefix, _format_labels({'stage': name}), total))
+        lines.append('# TYPE %sstage_runs_total counter' % prefix)
+        for name, (count, _) in self.spans.items():
+          lines.append('%sstage_runs_total%s %d' % (prefix, _format_labels({'stage': name}), count))
+
+      typed = set()
+      for (name, labels), value in self.counters.items():
+        if name not in typed:
+          lines.append('# TYPE %s%s_total counter' % (prefix, name))
+          typed.add(name)
+        lines.append('%s%s_total%s %r' % (prefix, name, _format_labels(labels), value))
+
+      for (name, labels), histogram in self.histograms.items():
+        if name not in typed:
+          lines.append('# TYPE %s%s histogram' % (prefix, name))
+          typed.add(name)
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+          cumulative += count
+          bucket_labels = dict(labels, le=str(bound))
+          lines.append('%s%s_bucket%s %d' % (prefix, name, _format_labels(bucket_labels), cumulative))
+        lines.append('%s%s_sum%s %r' % (prefix, name, _format_labels(labels), histogram.sum))
+        lines.append('%s%s_count%s %d' % (prefix, name, _format_labels(labels), histogram.count))
+    return '\n'.join(lines) + '\n'
+
+  def render(self, fmt='text'):
+    """
+    :param fmt: One of text, json or prometheus
+    :return: The recorded stats rendered in the requested format
+    """
+    if fmt == 'json':
+      return self.to_json()
+    if fmt == 'prometheus':
+      return self.to_prometheus()
+    return self.summary()
+
+
+def _format_labels(labels):
+  labels = dict(labels)
+  if not labels:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                           for k, v in sorted(labels.items()))
+
+
+REGISTRY = Registry()
+
+incr = REGISTRY.incr
+observe = REGISTRY.observe
+span = REGISTRY.span
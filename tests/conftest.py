@@ -0,0 +1,100 @@
+"""
+Shared fixtures. The modules under test live at the top of the repository and import each other
+by name, so the repository root is put on the path first.
+
+"""
+
+import csv
+import gzip
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import backend
+import config
+import cur
+import fleet
+
+
+def make_instance(instance_id, state='running', env=None, purpose=None, owner=None, ip=None,
+                  tags=None, **fields):
+  """
+  :return: A minimal describe_instances instance dict
+  """
+  all_tags = dict(tags or {})
+  for key, value in ((config.INSTANCE_ENVIRONMENT_KEY, env), (config.INSTANCE_PURPOSE_KEY, purpose),
+                     (config.INSTANCE_OWNER_KEY, owner)):
+    if value is not None:
+      all_tags[key] = value
+  instance = {'InstanceId': instance_id, 'State': {'Name': state}, 'InstanceType': 'm5.large',
+              'Tags': [{'Key': k, 'Value': v} for k, v in sorted(all_tags.items())]}
+  if ip is not None:
+    instance['PrivateIpAddress'] = ip
+  instance.update(fields)
+  return instance
+
+
+def cur_rows(count, seed=0):
+  """
+  :return: A list of CUR line items, as dicts keyed by :py:data:`cur.FIELDS`
+  """
+  rng = random.Random(seed)
+  rows = []
+  for n in range(count):
+    rows.append({
+      'line_item_type': rng.choice(['Usage', 'Usage', 'Tax', 'Credit']),
+      'usage_account': rng.choice(['111111111111', '222222222222']),
+      'resource_id': rng.choice(['i-%08x' % rng.randrange(20), 'vol-%08x' % rng.randrange(20),
+                                 'arn:aws:s3:::bucket', '']),
+      'usage_type': rng.choice(['BoxUsage:m5.large', 'EBS:VolumeUsage.gp2', 'DataTransfer-Out']),
+      'usage_start': '2019-07-%02dT%02d:00:00Z' % (rng.randrange(1, 31), rng.randrange(24)),
+      'instance_type': rng.choice(['m5.large', 'c5.xlarge', '']),
+      'unblended_cost': '%.6f' % rng.uniform(-1, 5) if n % 50 else '',
+      'environment': rng.choice(['staging', 'production', '']),
+      'purpose': rng.choice(['web', 'searcher', '']),
+      'owner': rng.choice(['bob', 'team-search', '']),
+      'user': '',
+    })
+  return rows
+
+
+def write_cur(path, rows):
+  """
+  Writes CUR line items as a report file, gzipped if the path ends with .gz.
+  """
+  with (gzip.open(path, 'wt', newline='') if path.endswith('.gz') else
+        open(path, 'w', newline='')) as f:
+    writer = csv.writer(f)
+    writer.writerow(['identity/LineItemId'] + list(cur.FIELDS.values()))
+    for n, row in enumerate(rows):
+      writer.writerow(['line-%d' % n] + [row[field] for field in cur.FIELDS])
+
+
+def cur_totals(rows, group_by, keep=lambda row: True):
+  """
+  :return: The costs of the rows keep accepts, summed the way :py:func:`cur.ingest` does
+  """
+  totals = {}
+  for row in rows:
+    if keep(row):
+      key = tuple(row['usage_start'][:10] if f == cur.USAGE_DATE else row[f] for f in group_by)
+      totals[key] = totals.get(key, 0.0) + float(row['unblended_cost'] or 0)
+  return totals
+
+
+@pytest.fixture
+def instances():
+  return list(fleet.generate_fleet(500, seed=7))
+
+
+@pytest.fixture
+def fake_backend(instances):
+  previous = backend._backend
+  fake = backend.FakeBackend(instances=instances, page_size=50)
+  backend.set_backend(fake)
+  yield fake
+  backend.set_backend(previous)
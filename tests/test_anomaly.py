@@ -0,0 +1,53 @@
+import datetime
+import random
+
+import anomaly
+
+
+def day(n):
+  return (datetime.date(2019, 7, 1) + datetime.timedelta(days=n)).isoformat()
+
+
+def flat_series(key, days, cost=100.0, seed=0, skip=()):
+  rng = random.Random(seed)
+  return [(day(n),) + key + (cost + rng.uniform(-2, 2),) for n in range(days) if n not in skip]
+
+
+def test_series_matrix_spans_every_day():
+  rows = [(day(0), 'a', 1.0), (day(3), 'a', 2.0), (day(3), 'a', 0.5), (day(1), 'b', 4.0)]
+  keys, days, matrix = anomaly.series_matrix(rows)
+  assert keys == [('a',), ('b',)]
+  assert days == [day(0), day(1), day(2), day(3)]
+  assert matrix.tolist() == [[1.0, 0.0, 0.0, 2.5], [0.0, 4.0, 0.0, 0.0]]
+  keys, days, matrix = anomaly.series_matrix([])
+  assert (keys, days, matrix.shape) == ([], [], (0, 0))
+
+
+def test_detect_a_jump():
+  rows = flat_series(('web',), 20) + flat_series(('search',), 19, seed=1)
+  rows.append((day(19), 'search', 300.0))
+  anomalies = anomaly.detect(rows, window=14)
+  assert [(a.day, a.key) for a in anomalies] == [(day(19), ('search',))]
+  assert anomalies[0].delta > 190 and anomalies[0].score > anomaly.DEFAULT_THRESHOLD
+  # Small increases are not worth reporting
+  assert anomaly.detect(rows, window=14, min_delta=500) == []
+
+
+def test_only_the_last_days_are_reported():
+  rows = flat_series(('web',), 20, skip=(16,)) + [(day(16), 'web', 400.0)]
+  assert anomaly.detect(rows, window=14) == []
+  assert [a.day for a in anomaly.detect(rows, window=14, last_days=4)] == [day(16)]
+
+
+def test_days_without_cost_count_as_zero():
+  # A series with no rows for two weeks, i.e. that cost nothing, then back at 300 a day
+  rows = [(day(n), 'batch', 100.0) for n in range(3)] + [(day(17), 'batch', 300.0)]
+  _, days, matrix = anomaly.series_matrix(rows)
+  assert len(days) == 18 and matrix[0].tolist().count(0.0) == 14
+  anomalies = anomaly.detect(rows, window=14)
+  assert [(a.day, a.baseline, a.delta) for a in anomalies] == [(day(17), 0.0, 300.0)]
+
+
+def test_too_few_days():
+  assert anomaly.detect(flat_series(('web',), 14), window=14) == []
+  assert anomaly.detect([], window=14) == []
@@ -0,0 +1,113 @@
+import collections
+import datetime
+
+import pytest
+
+import asg
+import engine
+import pricing
+from conftest import make_instance
+
+
+LAUNCHED = datetime.datetime(2019, 7, 1, tzinfo=datetime.timezone.utc)
+
+
+class FlatCatalog(object):
+  # One hourly price for every instance type but t3.micro, which has none
+
+  def instance_price(self, instance):
+    return None if instance['InstanceType'] == 't3.micro' else 0.1
+
+
+def member(instance_id, group=None, state='running', days=0, **fields):
+  tags = {asg.GROUP_TAG: group} if group else {}
+  fields.setdefault('LaunchTime', LAUNCHED + datetime.timedelta(days=days))
+  return make_instance(instance_id, state=state, env='production', purpose='searcher', tags=tags,
+                       **fields)
+
+
+def group(name, *instance_ids):
+  return {'AutoScalingGroupName': name, 'Instances': [{'InstanceId': i} for i in instance_ids]}
+
+
+def test_membership():
+  assert asg.membership([group('a', 'i-1', 'i-2'), group('b', 'i-3'), group('c')]) == {
+    'i-1': 'a', 'i-2': 'a', 'i-3': 'b'}
+
+
+def test_aggregate():
+  instances = [
+    member('i-1', days=3),
+    member('i-2', state='stopped', days=1, InstanceType='m5.xlarge'),
+    member('i-3', group='searchers-b', days=2),
+    member('i-4', group='searchers-b', days=5),
+    member('i-5'),
+  ]
+  summaries, ungrouped = asg.aggregate(instances, [group('searchers-a', 'i-1', 'i-2', 'i-3')])
+  assert [i['InstanceId'] for i in ungrouped] == ['i-5']
+  # Listed membership wins over the tag; largest group first
+  assert [(s.name, s.count) for s in summaries] == [('searchers-a', 3), ('searchers-b', 1)]
+  first = summaries[0]
+  assert (first.env, first.purpose) == ('production', 'searcher')
+  assert first.states == collections.Counter(running=2, stopped=1)
+  assert first.types == collections.Counter({'m5.large': 2, 'm5.xlarge': 1})
+  assert first.first_launch == LAUNCHED + datetime.timedelta(days=1)
+  assert first.last_launch == LAUNCHED + datetime.timedelta(days=3)
+  assert first.cost is None and first.monthly_cost is None
+  assert summaries[1].first_launch == summaries[1].last_launch == LAUNCHED + datetime.timedelta(
+    days=5)
+
+
+def test_ties_are_ordered_by_name():
+  instances = [member('i-%d' % n, group='group-%s' % name) for n, name in enumerate('cab')]
+  summaries, _ = asg.aggregate(instances)
+  assert [s.name for s in summaries] == ['group-a', 'group-b', 'group-c']
+
+
+def test_drilldown_keeps_members_as_instances():
+  instances = [member('i-1', group='a'), member('i-2', group='a'), member('i-3', group='b')]
+  summaries, ungrouped = asg.aggregate(instances, drilldown=['a'])
+  assert [s.name for s in summaries] == ['b']
+  assert [i['InstanceId'] for i in ungrouped] == ['i-1', 'i-2']
+
+
+def test_costs():
+  volume = {'DeviceName': '/dev/sda1', 'Ebs': {'VolumeId': 'vol-1'}}
+  instances = [
+    member('i-1', group='a', BlockDeviceMappings=[volume]),
+    member('i-2', group='a', state='stopped'),
+    member('i-3', group='a', InstanceType='t3.micro'),
+  ]
+  resource_costs = {'i-1': 10.0, 'vol-1': 2.5, 'i-2': 1.0, 'i-9': 100.0}
+  summaries, _ = asg.aggregate(instances, resource_costs=resource_costs, catalog=FlatCatalog())
+  assert summaries[0].cost == pytest.approx(13.5)
+  # Only running members with a price are estimated
+  assert summaries[0].monthly_cost == pytest.approx(0.1 * pricing.HOURS_PER_MONTH)
+  assert asg.summary_header(resource_costs, FlatCatalog())[-2:] == ['Month-to-date Cost',
+                                                                   'Est. Monthly Cost']
+  assert asg.summary_row(summaries[0], resource_costs, FlatCatalog()) == [
+    'a', 'production', 'searcher', '3', 'running:2,stopped:1', 'm5.large:2,t3.micro:1',
+    '2019-07-01 00:00:00 GMT', '2019-07-01 00:00:00 GMT', '13.50',
+    '%.2f' % (0.1 * pricing.HOURS_PER_MONTH)]
+
+
+def test_summary_row_without_costs():
+  instance = member('i-1', group='a')
+  del instance['LaunchTime']
+  summaries, _ = asg.aggregate([instance])
+  assert asg.summary_header() == asg.SUMMARY_COLUMNS
+  assert asg.summary_row(summaries[0]) == ['a', 'production', 'searcher', '1', 'running:1',
+                                           'm5.large:1', '', '']
+
+
+def test_aggregate_a_fleet(fake_backend, instances):
+  eng = engine.Engine()
+  groups = eng.run(groups=eng.fetch_auto_scaling_groups())['groups']
+  assert groups
+  summaries, ungrouped = asg.aggregate(instances, groups)
+  members = asg.membership(groups)
+  assert sum(s.count for s in summaries) + len(ungrouped) == len(instances)
+  # Terminated members are not listed by their group, but are still grouped by their tag
+  assert sum(s.count for s in summaries) >= len(members)
+  assert not [i for i in ungrouped if i['InstanceId'] in members]
+  assert [s.count for s in summaries] == sorted((s.count for s in summaries), reverse=True)
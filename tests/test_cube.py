@@ -0,0 +1,108 @@
+import collections
+import datetime
+import random
+
+import pytest
+
+import cube
+
+
+def day(n):
+  return (datetime.date(2019, 1, 1) + datetime.timedelta(days=n)).isoformat()
+
+
+@pytest.fixture
+def rows():
+  rng = random.Random(4)
+  return [(day(n), rng.choice(['111', '222']), rng.choice(['m5.large', 'c5.xlarge']),
+           rng.choice(['staging', 'production']), rng.choice(['web', 'searcher']),
+           rng.choice(['bob', 'alice']), round(rng.uniform(0, 10), 2))
+          for n in range(120) for _ in range(5)]
+
+
+@pytest.fixture
+def rollup(tmp_path, rows):
+  rollup = cube.Cube(str(tmp_path / 'cube.sqlite'))
+  rollup.update(rows, source='cur')
+  yield rollup
+  rollup.close()
+
+
+def totals(rows, group_by, since=None, until=None, **where):
+  # What a query should return, summed from the daily rows
+  result = collections.defaultdict(float)
+  for row in rows:
+    values = dict(zip(cube.DIMENSIONS, row))
+    if ((since is None or row[0] >= since) and (until is None or row[0] < until) and
+        all(values[d] == v for d, v in where.items())):
+      result[tuple(values[d] for d in group_by)] += row[-1]
+  return result
+
+
+@pytest.mark.parametrize('since,until,ranges', [
+  (None, None, [('cost_monthly', None, None)]),
+  ('2019-02-01', '2019-04-01', [('cost_monthly', '2019-02-01', '2019-04-01')]),
+  ('2019-01-15', '2019-04-10', [('cost_monthly', '2019-02-01', '2019-04-01'),
+                                ('cost', '2019-01-15', '2019-02-01'),
+                                ('cost', '2019-04-01', '2019-04-10')]),
+  ('2019-01-15', None, [('cost_monthly', '2019-02-01', None),
+                        ('cost', '2019-01-15', '2019-02-01')]),
+  (None, '2019-03-05', [('cost_monthly', None, '2019-03-01'),
+                        ('cost', '2019-03-01', '2019-03-05')]),
+  # Within a single month, or across one boundary without a whole month, days only
+  ('2019-02-03', '2019-02-20', [('cost', '2019-02-03', '2019-02-20')]),
+  ('2019-01-20', '2019-02-10', [('cost', '2019-01-20', '2019-02-10')]),
+  ('2019-12-15', '2020-02-01', [('cost_monthly', '2020-01-01', '2020-02-01'),
+                                ('cost', '2019-12-15', '2020-01-01')]),
+])
+def test_split_months(since, until, ranges):
+  assert cube._split_months(since, until) == ranges
+
+
+@pytest.mark.parametrize('since,until', [
+  (None, None), ('2019-01-15', '2019-04-10'), ('2019-02-01', '2019-03-01'),
+  ('2019-02-03', '2019-02-20'), ('2019-01-20', None), (None, '2019-03-05'),
+])
+@pytest.mark.parametrize('group_by,where', [
+  ((), {}), (('purpose',), {'env': 'staging'}), (('account', 'owner'), {}),
+  (('day',), {'owner': 'bob'}),
+])
+def test_rollups_match_the_daily_rows(rollup, rows, since, until, group_by, where):
+  result = rollup.query(group_by, since=since, until=until, **where)
+  expected = totals(rows, group_by, since, until, **where)
+  assert sorted(key for *key, _ in result) == sorted(list(key) for key in expected)
+  for *key, cost in result:
+    assert cost == pytest.approx(expected[tuple(key)])
+  assert [row[-1] for row in result] == sorted((row[-1] for row in result), reverse=True)
+
+
+def test_update_replaces_whole_days(rollup, rows):
+  restated = [(day(40), '111', 'm5.large', 'staging', 'web', 'bob', 1.0),
+              (day(40), '111', 'm5.large', 'staging', 'web', 'bob', 2.0)]
+  assert rollup.update(restated, source='cur') == 1
+  expected = [row for row in rows if row[0] != day(40)] + restated
+  assert rollup.query(('day',), since=day(40), until=day(41)) == [(day(40), 3.0)]
+  # The month was rolled up again
+  assert rollup.query(since='2019-02-01', until='2019-03-01')[0][0] == pytest.approx(
+    totals(expected, (), '2019-02-01', '2019-03-01')[()])
+  assert rollup.last_day() == day(119)
+
+
+def test_one_source_only(rollup):
+  assert rollup.source == 'cur'
+  with pytest.raises(ValueError):
+    rollup.update([], source='ce')
+
+
+def test_unknown_dimensions(rollup):
+  with pytest.raises(ValueError):
+    rollup.query(('colour',))
+  with pytest.raises(ValueError):
+    rollup.query(region='us-east-1')
+
+
+def test_rows_from_cost_results():
+  results = [{'TimePeriod': {'Start': '2019-07-01'}, 'Groups': [
+    {'Keys': ['111', 'm5.large'], 'Metrics': {'UnblendedCost': {'Amount': '1.5'}}}]}]
+  assert cube.rows_from_cost_results(results) == [
+    ('2019-07-01', '111', 'm5.large', '', '', '', 1.5)]
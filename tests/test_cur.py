@@ -0,0 +1,105 @@
+import pytest
+
+import config
+import cur
+from conftest import cur_rows, cur_totals, write_cur
+
+
+def assert_totals(actual, expected):
+  assert sorted(actual) == sorted(expected)
+  for key, cost in expected.items():
+    assert actual[key] == pytest.approx(cost)
+
+
+@pytest.fixture
+def rows():
+  return cur_rows(3000, seed=3)
+
+
+@pytest.fixture
+def report(tmp_path, rows):
+  path = str(tmp_path / 'report-1.csv.gz')
+  write_cur(path, rows)
+  return path
+
+
+def test_column_names():
+  assert cur.column_name('usage_type') == 'lineItem/UsageType'
+  assert cur.column_name(cur.USAGE_DATE) == 'lineItem/UsageStartDate'
+  assert cur.column_name('tag:Team') == 'resourceTags/user:Team'
+  assert cur.parquet_column_name('lineItem/UsageAccountId') == 'line_item_usage_account_id'
+  assert cur.parquet_column_name('resourceTags/user:Owner') == 'resource_tags_user_owner'
+  with pytest.raises(ValueError):
+    cur.column_name('colour')
+
+
+def test_default_query(report, rows):
+  assert_totals(cur.ingest([report], processes=1), cur_totals(rows, cur.DEFAULT_GROUP_BY))
+
+
+@pytest.mark.parametrize('processes,chunk_bytes', [(1, cur.CHUNK_BYTES), (2, 4096), (4, 1000)])
+def test_blocks_add_up_to_the_file(report, rows, processes, chunk_bytes):
+  query = cur.Query(group_by=('usage_type', 'environment'))
+  assert_totals(cur.ingest([report], query, processes=processes, chunk_bytes=chunk_bytes),
+                cur_totals(rows, query.group_by))
+
+
+def test_many_files(tmp_path, rows):
+  paths = []
+  for n in range(4):
+    paths.append(str(tmp_path / ('report-%d.csv%s' % (n, '.gz' if n % 2 else ''))))
+    write_cur(paths[-1], rows[n::4])
+  assert_totals(cur.ingest(paths, processes=2), cur_totals(rows, cur.DEFAULT_GROUP_BY))
+  each = cur.ingest_each(paths, processes=2)
+  assert sorted(each) == sorted(paths)
+  assert_totals(each[paths[1]], cur_totals(rows[1::4], cur.DEFAULT_GROUP_BY))
+
+
+def test_query_filters(report, rows):
+  purpose = 'tag:' + config.INSTANCE_PURPOSE_KEY
+  query = cur.Query(group_by=(cur.USAGE_DATE, purpose, 'tag:Missing'),
+                    line_item_types=('Usage', 'Credit'), since='2019-07-10', until='2019-07-20',
+                    resource_prefixes=('i-', 'vol-'))
+  expected = cur_totals(
+    [dict(row, **{purpose: row['purpose'], 'tag:Missing': ''}) for row in rows],
+    query.group_by, lambda row: (row['line_item_type'] in ('Usage', 'Credit') and
+                                 '2019-07-10' <= row['usage_start'][:10] < '2019-07-20' and
+                                 row['resource_id'].startswith(('i-', 'vol-'))))
+  assert_totals(cur.ingest([report], query, processes=2, chunk_bytes=8192), expected)
+
+
+def test_resource_costs(report, rows):
+  expected = {key[0]: cost for key, cost in cur_totals(
+    rows, ('resource_id',), lambda row: (row['resource_id'].startswith(('i-', 'vol-')) and
+                                         row['usage_start'][:10] >= '2019-07-15')).items()}
+  assert_totals(cur.resource_costs([report], since='2019-07-15', processes=1), expected)
+
+
+def test_missing_column(tmp_path):
+  path = str(tmp_path / 'report.csv')
+  with open(path, 'w') as f:
+    f.write('lineItem/UsageType,lineItem/UnblendedCost\nBoxUsage,1.0\n')
+  assert cur.ingest([path], cur.Query(group_by=('usage_type',)), processes=1) == {
+    ('BoxUsage',): 1.0}
+  with pytest.raises(ValueError):
+    cur.ingest([path], cur.Query(group_by=('usage_account',)), processes=1)
+
+
+def test_merge():
+  total = {('a',): 1.0}
+  assert cur.merge(total, {('a',): 2.0, ('b',): 0.5}) is total
+  assert total == {('a',): 3.0, ('b',): 0.5}
+
+
+def test_parquet_matches_csv(tmp_path, rows):
+  pyarrow = pytest.importorskip('pyarrow')
+  import pyarrow.parquet
+  path = str(tmp_path / 'report.parquet')
+  # Parquet reports type the cost as a double, and leave it null rather than empty
+  table = pyarrow.table({cur.parquet_column_name(column): [
+    (float(row[field]) if row[field] else None) if field == 'unblended_cost' else row[field]
+    for row in rows] for field, column in cur.FIELDS.items()})
+  pyarrow.parquet.write_table(table, path, row_group_size=500)
+  query = cur.Query(group_by=('usage_account', cur.USAGE_DATE), line_item_types=('Usage',))
+  expected = cur_totals(rows, query.group_by, lambda row: row['line_item_type'] == 'Usage')
+  assert_totals(cur.ingest([path], query, processes=2), expected)
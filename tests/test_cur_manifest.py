@@ -0,0 +1,112 @@
+import json
+import os
+
+import pytest
+
+import cur
+import cur_manifest
+from conftest import cur_rows, cur_totals, write_cur
+
+
+def write_assembly(directory, assembly_id, parts, period='20190701'):
+  """
+  Writes report files under <directory>/<assembly ID>/ and the manifest listing them.
+
+  :param parts: A list of lists of CUR line items, one per report file
+  :return: The manifest's path
+  """
+  os.makedirs(os.path.join(directory, assembly_id), exist_ok=True)
+  keys = []
+  for n, rows in enumerate(parts):
+    key = 'cur/report/%s-%s/%s/report-%d.csv.gz' % (period, '20190801', assembly_id, n + 1)
+    write_cur(os.path.join(directory, assembly_id, os.path.basename(key)), rows)
+    keys.append(key)
+  fname = os.path.join(directory, 'report-%s-Manifest.json' % period)
+  with open(fname, 'w') as f:
+    json.dump({'assemblyId': assembly_id, 'reportKeys': keys,
+               'billingPeriod': {'start': '%sT000000.000Z' % period,
+                                 'end': '20190801T000000.000Z'}}, f)
+  return fname
+
+
+def assert_totals(actual, expected):
+  expected = {key: cost for key, cost in expected.items() if abs(cost) >= 1e-9}
+  assert sorted(actual) == sorted(expected)
+  for key, cost in expected.items():
+    assert actual[key] == pytest.approx(cost)
+
+
+@pytest.fixture
+def parts():
+  rows = cur_rows(1200, seed=5)
+  return [rows[:400], rows[400:800], rows[800:]]
+
+
+def test_read_manifest(tmp_path, parts):
+  manifest = write_assembly(str(tmp_path), 'assembly-1', parts)
+  period, assembly_id, paths = cur_manifest.read_manifest(manifest)
+  assert (period, assembly_id) == ('20190701', 'assembly-1')
+  assert paths == [str(tmp_path / 'assembly-1' / ('report-%d.csv.gz' % n)) for n in (1, 2, 3)]
+  os.remove(paths[1])
+  with pytest.raises(IOError):
+    cur_manifest.read_manifest(manifest)
+
+
+def test_refresh_parses_only_new_content(tmp_path, parts):
+  state = str(tmp_path / 'state.json')
+  incremental = cur_manifest.IncrementalCur(state)
+  assert incremental.refresh([write_assembly(str(tmp_path), 'assembly-1', parts)],
+                             processes=2) == 3
+  assert_totals(incremental.totals, cur_totals(sum(parts, []), cur.DEFAULT_GROUP_BY))
+  incremental.save()
+
+  # A new assembly rewrites every file, but only the last one's content changed
+  changed = parts[:2] + [parts[2][:-100] + cur_rows(50, seed=6)]
+  incremental = cur_manifest.IncrementalCur(state)
+  assert incremental.refresh([write_assembly(str(tmp_path), 'assembly-2', changed)],
+                             processes=2) == 1
+  assert_totals(incremental.totals, cur_totals(sum(changed, []), cur.DEFAULT_GROUP_BY))
+  assert incremental.periods['20190701']['assembly_id'] == 'assembly-2'
+  assert len(incremental.contributions) == 3
+
+  # The same assembly again parses nothing
+  assert incremental.refresh([os.path.join(str(tmp_path), 'report-20190701-Manifest.json')]) == 0
+  assert_totals(incremental.totals, cur_totals(sum(changed, []), cur.DEFAULT_GROUP_BY))
+
+
+def test_periods_are_independent(tmp_path, parts):
+  incremental = cur_manifest.IncrementalCur(str(tmp_path / 'state.json'))
+  july = write_assembly(str(tmp_path / 'july'), 'assembly-7', parts[:2])
+  august = write_assembly(str(tmp_path / 'august'), 'assembly-8', parts[2:], period='20190801')
+  incremental.refresh([july, august], processes=1)
+  assert sorted(incremental.periods) == ['20190701', '20190801']
+  # August shrinking to nothing retracts only its own contribution
+  incremental.refresh([write_assembly(str(tmp_path / 'august'), 'assembly-9', [],
+                                      period='20190801')], processes=1)
+  assert_totals(incremental.totals, cur_totals(parts[0] + parts[1], cur.DEFAULT_GROUP_BY))
+
+
+def test_state_is_tied_to_its_query(tmp_path, parts):
+  state = str(tmp_path / 'state.json')
+  query = cur.Query(group_by=('usage_type',), line_item_types=('Usage',))
+  incremental = cur_manifest.IncrementalCur(state, query)
+  incremental.refresh([write_assembly(str(tmp_path), 'assembly-1', parts)], processes=1)
+  incremental.save()
+
+  loaded = cur_manifest.IncrementalCur(state, cur.Query(group_by=('usage_type',),
+                                                        line_item_types=['Usage']))
+  assert loaded.totals == incremental.totals
+  for other in (cur.Query(group_by=('usage_account',), line_item_types=('Usage',)),
+                cur.Query(group_by=('usage_type',)),
+                cur.Query(group_by=('usage_type',), line_item_types=('Usage',), since='2019-07-02'),
+                cur.Query(group_by=('usage_type',), line_item_types=('Usage',),
+                          resource_prefixes=('i-',))):
+    with pytest.raises(ValueError):
+      cur_manifest.IncrementalCur(state, other)
+
+
+def test_unsupported_version(tmp_path):
+  state = tmp_path / 'state.json'
+  state.write_text(json.dumps({'version': cur_manifest.STATE_VERSION - 1}))
+  with pytest.raises(ValueError):
+    cur_manifest.IncrementalCur(str(state))
@@ -0,0 +1,119 @@
+import datetime
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+import daemon
+from conftest import make_instance
+
+
+LAUNCHED = datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc)
+
+COST = [{'TimePeriod': {'Start': '2019-07-01'}, 'Estimated': False, 'Groups': [
+  {'Keys': ['111', 'm5.large'], 'Metrics': {'UnblendedCost': {'Amount': '1.5', 'Unit': 'USD'}}},
+  {'Keys': ['111', 'c5.large'], 'Metrics': {'UnblendedCost': {'Amount': '2', 'Unit': 'USD'}}}]}]
+
+
+def stopped(instance_id, days_ago, **tags):
+  at = datetime.datetime.utcnow() - datetime.timedelta(days=days_ago)
+  return make_instance(instance_id, state='stopped', LaunchTime=LAUNCHED,
+                       StateTransitionReason='User initiated (%s)' % at.strftime(
+                         '%Y-%m-%d %H:%M:%S GMT'), **tags)
+
+
+@pytest.fixture
+def store():
+  store = daemon.InventoryStore()
+  store.update([
+    make_instance('i-1', env='staging', purpose='web', owner='bob', LaunchTime=LAUNCHED),
+    make_instance('i-2', env='staging', purpose='searcher', owner='bob', LaunchTime=LAUNCHED),
+    stopped('i-3', 45, env='staging', purpose='searcher', owner='alice'),
+    stopped('i-4', 5, env='production', purpose='searcher', owner='alice'),
+  ], COST)
+  return store
+
+
+@pytest.fixture
+def url(store):
+  server = daemon.Daemon(port=0)
+  server.server.RequestHandlerClass = daemon._handler(store)
+  thread = threading.Thread(target=server.server.serve_forever, daemon=True)
+  thread.start()
+  yield 'http://%s:%d' % server.server.server_address
+  server.server.shutdown()
+  server.server.server_close()
+
+
+def get(url):
+  try:
+    with urllib.request.urlopen(url) as response:
+      return response.status, response.read()
+  except urllib.error.HTTPError as error:
+    return error.code, error.read()
+
+
+def ids(records):
+  return [r['id'] for r in records]
+
+
+def test_query(store):
+  assert ids(store.query()) == ['i-1', 'i-2', 'i-3', 'i-4']
+  assert ids(store.query(env='staging', purpose='searcher')) == ['i-2', 'i-3']
+  assert ids(store.query(owner='alice', state='stopped', env=None)) == ['i-3', 'i-4']
+  assert ids(store.query(stopped_days=30)) == ['i-3']
+  assert ids(store.query(stopped_days=1, env='production')) == ['i-4']
+  assert store.query(env='staging', owner='carol') == []
+
+
+def test_update_swaps_the_snapshot(store):
+  records = store.snapshot[0]
+  store.update([make_instance('i-9', env='staging', LaunchTime=LAUNCHED)])
+  assert ids(store.query(env='staging')) == ['i-9']
+  assert ids(records) == ['i-1', 'i-2', 'i-3', 'i-4']
+  # Cost is kept unless given
+  assert len(store.cost) == 2
+
+
+def test_instances(url):
+  status, body = get(url + '/instances?env=staging&purpose=searcher')
+  assert status == 200
+  records = json.loads(body)
+  assert ids(records) == ['i-2', 'i-3']
+  assert 'stopped_at' not in records[0] and records[1]['stopped_time']
+  assert ids(json.loads(get(url + '/instances?state=stopped&stopped_days=30')[1])) == ['i-3']
+  assert json.loads(get(url + '/instances?owner=nobody')[1]) == []
+
+
+def test_hosts(url):
+  status, body = get(url + '/instances?owner=bob&format=hosts')
+  assert status == 200 and len(body.decode('utf-8').split('\n')) == 2
+
+
+def test_bad_requests(url):
+  status, body = get(url + '/instances?colour=red')
+  assert status == 400 and 'colour' in json.loads(body)['error']
+  assert get(url + '/instances?stopped_days=soon')[0] == 400
+  assert get(url + '/nothing')[0] == 404
+
+
+def test_cost_and_health(url):
+  assert [r['instance_type'] for r in json.loads(get(url + '/cost')[1])] == ['m5.large',
+                                                                            'c5.large']
+  rows = json.loads(get(url + '/cost?instance_type=c5.large')[1])
+  assert rows == [{'start': '2019-07-01', 'account': '111', 'instance_type': 'c5.large',
+                   'amount': 2.0, 'unit': 'USD', 'estimated': False}]
+  health = json.loads(get(url + '/health')[1])
+  assert (health['instances'], health['cost_rows']) == (4, 2)
+
+
+def test_refresh_from_the_fake_backend(fake_backend, instances):
+  server = daemon.Daemon(port=0)
+  try:
+    server.refresh()
+  finally:
+    server.server.server_close()
+  assert len(server.store.query()) == len(instances)
+  assert server.store.refresh_seconds > 0 and server.store.cost
@@ -0,0 +1,101 @@
+import pytest
+from boto.exception import EC2ResponseError
+from botocore.exceptions import ClientError
+
+import backend
+import engine
+import stats
+
+
+def client_error(code, status=400):
+  return ClientError({'Error': {'Code': code, 'Message': code},
+                      'ResponseMetadata': {'HTTPStatusCode': status}}, 'Operation')
+
+
+class Failing(object):
+  """
+  A backend whose ec2 client raises the given errors, then answers.
+  """
+
+  def __init__(self, *errors):
+    self.errors = list(errors)
+    self.calls = 0
+
+  def client(self, service):
+    return self
+
+  def describe_regions(self):
+    self.calls += 1
+    if self.errors:
+      raise self.errors.pop(0)
+    return {'Regions': []}
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+  monkeypatch.setattr(engine, 'retry_delay', lambda attempt: 0)
+
+
+@pytest.mark.parametrize('error,retryable', [
+  (client_error('Throttling'), True),
+  (client_error('ThrottlingException'), True),
+  (client_error('RequestLimitExceeded', 503), True),
+  (client_error('InternalError', 500), True),
+  (client_error('SomethingNew', 502), True),
+  (client_error('InvalidChangeBatch'), False),
+  (client_error('AccessDenied', 403), False),
+  (client_error('InvalidInstanceID.NotFound'), False),
+  (EC2ResponseError(503, 'Service Unavailable'), True),
+  (EC2ResponseError(400, 'Bad Request'), False),
+  (ValueError('no'), False),
+])
+def test_is_retryable(error, retryable):
+  assert engine.is_retryable(error) is retryable
+
+
+def test_retry_delay_is_jittered_and_capped(monkeypatch):
+  monkeypatch.undo()
+  delays = [engine.retry_delay(attempt) for attempt in range(20) for _ in range(20)]
+  assert all(0 <= d <= engine.RETRY_MAX_DELAY_SECS for d in delays)
+  assert max(delays[:20]) <= engine.RETRY_BASE_SECS
+  assert len(set(delays)) > 300
+
+
+def test_throttling_is_retried():
+  aws = Failing(client_error('Throttling'), client_error('ServiceUnavailable', 503))
+  eng = engine.Engine(aws=aws)
+  assert eng.run(r=eng.call('ec2', 'describe_regions'))['r'] == {'Regions': []}
+  assert aws.calls == 3
+
+
+def test_other_errors_are_raised_at_once():
+  aws = Failing(client_error('AccessDenied', 403))
+  eng = engine.Engine(aws=aws)
+  with pytest.raises(ClientError):
+    eng.run(r=eng.call('ec2', 'describe_regions'))
+  assert aws.calls == 1
+
+
+def test_retries_stop_at_the_deadline(monkeypatch):
+  monkeypatch.setattr(engine, 'RETRY_MAX_TIMEOUT', 0)
+  aws = Failing(client_error('Throttling'), client_error('Throttling'))
+  eng = engine.Engine(aws=aws)
+  with pytest.raises(ClientError):
+    eng.run(r=eng.call('ec2', 'describe_regions'))
+  assert aws.calls == 1
+
+
+def test_throttled_fetch_completes(instances):
+  aws = backend.FakeBackend(instances=instances, page_size=20, throttle_rate=0.3, seed=1)
+  eng = engine.Engine(aws=aws)
+  stats.REGISTRY.reset()
+  fetched = eng.run(instances=eng.fetch_instances())['instances']
+  assert sum(v for (name, _), v in stats.REGISTRY.counters.items() if name == 'api_retries')
+  assert [i['InstanceId'] for i in fetched] == [i['InstanceId'] for i in instances]
+
+
+def test_retries_are_reported_on_stderr(capsys):
+  eng = engine.Engine(aws=Failing(client_error('Throttling')))
+  eng.run(r=eng.call('ec2', 'describe_regions'))
+  out, err = capsys.readouterr()
+  assert out == '' and 'Retrying describe_regions' in err
@@ -0,0 +1,95 @@
+import datetime
+
+import pytest
+
+import export
+import utilization
+from conftest import make_instance
+
+pyarrow = pytest.importorskip('pyarrow')
+import pyarrow.dataset
+
+
+NOW = datetime.datetime(2019, 7, 1, 12, tzinfo=datetime.timezone.utc)
+
+
+class FlatCatalog(object):
+
+  def instance_price(self, instance):
+    return 0.1
+
+
+def cost_results(days, amount='1.5'):
+  return [{'TimePeriod': {'Start': day}, 'Estimated': day == days[-1], 'Groups': [
+    {'Keys': ['111', 'm5.large'], 'Metrics': {'UnblendedCost': {'Amount': amount, 'Unit': 'USD'}}},
+    {'Keys': ['222'], 'Metrics': {'UnblendedCost': {'Amount': '2', 'Unit': 'USD'}}}]}
+          for day in days]
+
+
+def read(base_dir):
+  return pyarrow.dataset.dataset(base_dir, format='parquet', partitioning='hive').to_table()
+
+
+def test_instance_schema():
+  names = export.instance_schema().names
+  assert names[:4] == ['date', 'env', 'taken_at', 'instance_id']
+  assert 'month_to_date_cost' not in names and 'cpu_p95' not in names
+  full = export.instance_schema(resource_costs=True, catalog=True, utilization=True)
+  assert full.names[len(names):] == ['month_to_date_cost', 'hourly_price', 'est_monthly_cost',
+                                     'cpu_p50', 'cpu_p95', 'cpu_max', 'network_p95_mb',
+                                     'rightsizing']
+  assert full.field('state').type == pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+  assert full.field('launch_time').type == pyarrow.timestamp('s', tz='UTC')
+
+
+def test_instance_table():
+  volume = {'DeviceName': '/dev/sda1', 'Ebs': {'VolumeId': 'vol-1'}}
+  instances = [
+    make_instance('i-1', env='staging', purpose='web', owner='bob', LaunchTime=NOW,
+                  PublicDnsName='', BlockDeviceMappings=[volume]),
+    make_instance('i-2', state='stopped', LaunchTime=NOW, PublicDnsName='',
+                  StateTransitionReason='User initiated (2019-06-01 12:00:00 GMT)'),
+  ]
+  usage = {'i-1': utilization.Utilization(10.0, 20.0, 30.0, 1.0, '')}
+  table = export.instance_table(instances, now=NOW, resource_costs={'i-1': 5.0, 'vol-1': 1.0},
+                                catalog=FlatCatalog(), utilization=usage)
+  assert table.schema == export.instance_schema(True, True, True)
+  rows = table.to_pylist()
+  assert [(r['date'], r['env'], r['state']) for r in rows] == [
+    ('2019-07-01', 'staging', 'running'), ('2019-07-01', export.UNKNOWN_ENV, 'stopped')]
+  assert rows[0]['volumes'] == ['vol-1'] and rows[0]['month_to_date_cost'] == 6.0
+  assert rows[0]['est_monthly_cost'] == pytest.approx(73.0) and rows[1]['est_monthly_cost'] == 0.0
+  assert rows[0]['cpu_p95'] == 20.0 and rows[0]['rightsizing'] is None
+  assert rows[1]['cpu_p95'] is None and rows[1]['purpose'] is None
+  assert rows[1]['days_since_stopped'] == 30
+
+
+def test_empty_input(tmp_path):
+  assert export.instance_table([], now=NOW).num_rows == 0
+  assert export.instance_table([], now=NOW).schema == export.instance_schema()
+  assert export.cost_table([]).schema == export.cost_schema()
+  assert export.export_instances([], str(tmp_path / 'instances'), now=NOW) == 0
+  assert export.export_cost([], str(tmp_path / 'cost')) == 0
+
+
+def test_instance_snapshots_accumulate(tmp_path, instances):
+  base_dir = str(tmp_path / 'instances')
+  assert export.export_instances(instances, base_dir, now=NOW) == len(instances)
+  assert export.export_instances(instances[:10], base_dir,
+                                 now=NOW + datetime.timedelta(days=1)) == 10
+  table = read(base_dir)
+  assert table.num_rows == len(instances) + 10
+  assert sorted(set(table.column('date').to_pylist())) == ['2019-07-01', '2019-07-02']
+  assert list((tmp_path / 'instances').glob('date=2019-07-01/env=*/instances-*.parquet'))
+
+
+def test_cost_export_replaces_the_days_it_covers(tmp_path):
+  base_dir = str(tmp_path / 'cost')
+  export.export_cost(cost_results(['2019-07-01', '2019-07-02']), base_dir)
+  export.export_cost(cost_results(['2019-07-02', '2019-07-03'], amount='9'), base_dir)
+  rows = sorted(read(base_dir).to_pylist(), key=lambda r: (r['date'], r['linked_account']))
+  assert [(r['date'], r['linked_account'], r['amount']) for r in rows] == [
+    ('2019-07-01', '111', 1.5), ('2019-07-01', '222', 2.0),
+    ('2019-07-02', '111', 9.0), ('2019-07-02', '222', 2.0),
+    ('2019-07-03', '111', 9.0), ('2019-07-03', '222', 2.0)]
+  assert rows[1]['instance_type'] is None and rows[-1]['estimated']
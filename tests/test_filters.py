@@ -0,0 +1,119 @@
+import datetime
+
+import pytest
+
+import config
+import engine
+import filters
+import fleet
+from conftest import make_instance
+
+
+NOW = fleet.EPOCH
+
+
+def ids(instances):
+  return sorted(i['InstanceId'] for i in instances)
+
+
+def matching(expression, instances):
+  return ids(filters.Filter(expression, now=NOW).apply(instances))
+
+
+def test_empty_expression_matches_everything(instances):
+  assert matching('', instances) == ids(instances)
+  assert matching(None, instances) == ids(instances)
+  assert filters.Filter('').api_filters == []
+
+
+def test_terms_and_boolean_operators():
+  fleet_ = [
+    make_instance('i-1', env='staging', purpose='web', owner='team-search'),
+    make_instance('i-2', env='staging', purpose='searcher', owner='bob', state='stopped'),
+    make_instance('i-3', env='production', purpose='web', InstanceType='m3.xlarge'),
+  ]
+  assert matching('env=staging', fleet_) == ['i-1', 'i-2']
+  assert matching('env!=staging', fleet_) == ['i-3']
+  assert matching('owner=~team-*', fleet_) == ['i-1']
+  assert matching('owner!~team-*', fleet_) == ['i-2', 'i-3']
+  assert matching('type in (m3.*, c5.large)', fleet_) == ['i-3']
+  assert matching('env=staging and not state=stopped', fleet_) == ['i-1']
+  assert matching('purpose=searcher or (env=production and purpose=web)', fleet_) == ['i-2', 'i-3']
+  assert matching('"tag:%s"=\'web\'' % config.INSTANCE_PURPOSE_KEY, fleet_) == ['i-1', 'i-3']
+
+
+def test_missing_tags_are_the_empty_string():
+  fleet_ = [make_instance('i-1', env='staging'), make_instance('i-2')]
+  assert matching('env=""', fleet_) == ['i-2']
+  assert matching('tag:Team=""', fleet_) == ['i-1', 'i-2']
+
+
+def test_day_counts():
+  launched = NOW - datetime.timedelta(days=40)
+  fleet_ = [
+    make_instance('i-1', state='stopped', LaunchTime=launched,
+                  StateTransitionReason='User initiated (%s)' % (
+                    NOW - datetime.timedelta(days=31)).strftime('%Y-%m-%d %H:%M:%S GMT')),
+    make_instance('i-2', LaunchTime=NOW - datetime.timedelta(days=2)),
+  ]
+  assert matching('stopped_days>30', fleet_) == ['i-1']
+  assert matching('launch_days>=40', fleet_) == ['i-1']
+  # Instances without a stop time only match !=
+  assert matching('stopped_days!=31', fleet_) == ['i-2']
+
+
+@pytest.mark.parametrize('expression', [
+  'env=',
+  'colour=red',
+  'env=staging and',
+  'env<staging',
+  'stopped_days>many',
+  'stopped_days=~3*',
+  '(env=staging',
+])
+def test_bad_expressions(expression):
+  with pytest.raises(ValueError):
+    filters.Filter(expression)
+
+
+def test_api_filters_take_top_level_equality_terms():
+  query = filters.Filter('env=staging and purpose in (web, searcher) and name=~web-* and '
+                         'owner=bob and type=m5.*')
+  assert query.api_filters == [
+    {'Name': 'tag:' + config.INSTANCE_ENVIRONMENT_KEY, 'Values': ['staging']},
+    {'Name': 'tag:' + config.INSTANCE_PURPOSE_KEY, 'Values': ['web', 'searcher']},
+    {'Name': 'tag:Name', 'Values': ['web-*']},
+  ]
+  # Terms under or/not and negations stay local
+  assert filters.Filter('env=staging or env=production').api_filters == []
+  assert filters.Filter('not env=staging').api_filters == []
+  assert filters.Filter('env!=staging').api_filters == []
+
+
+@pytest.mark.parametrize('expression', ['tag:Team=""', 'env=""', 'name=~*', 'env in (staging, "")',
+                                        'name=~web?', 'name=~[ab]*'])
+def test_api_filters_leave_out_what_ec2_matches_differently(expression):
+  assert filters.Filter(expression).api_filters == []
+
+
+@pytest.mark.parametrize('expression', [
+  'env=staging',
+  'env=staging and state=stopped',
+  'purpose in (searcher, indexer) and owner=~team-*',
+  'state=running and type=~m5.* and launch_days>100',
+  'env=production or purpose=searcher',
+])
+def test_api_and_local_evaluation_agree(fake_backend, instances, expression):
+  query = filters.Filter(expression, now=NOW)
+  eng = engine.Engine()
+  fetched = eng.run(instances=eng.fetch_instances(query.api_filters))['instances']
+  assert ids(query.apply(fetched, fetched_with_api_filters=True)) == matching(expression, instances)
+  if query.api_filters:
+    assert len(fetched) < len(instances)
+
+
+def test_conjoin():
+  assert filters.conjoin() == ''
+  assert filters.conjoin('owner=bob') == 'owner=bob'
+  assert filters.conjoin('owner=bob or owner=alice', env='staging', purpose=None) == \
+    'env="staging" and (owner=bob or owner=alice)'
@@ -0,0 +1,108 @@
+import json
+
+import pytest
+
+import history
+from conftest import make_instance
+
+
+HOUR = 3600
+
+
+def snapshot(states, **attributes):
+  return [make_instance(instance_id, state=state, **attributes.get(instance_id, {}))
+          for instance_id, state in sorted(states.items())]
+
+
+def test_stable_states_extend_one_interval(tmp_path):
+  states = history.StateHistory(str(tmp_path / 'history.json'))
+  assert states.record(snapshot({'i-1': 'running', 'i-2': 'stopped'}), 0) == 2
+  for hour in range(1, 24):
+    assert states.record(snapshot({'i-1': 'running', 'i-2': 'stopped'}), hour * HOUR) == 0
+  assert states.instances['i-1']['intervals'] == [[history.STATES.index('running'), 0, 23 * HOUR]]
+  assert states.instances['i-2']['intervals'] == [[history.STATES.index('stopped'), 0, 23 * HOUR]]
+
+
+def test_state_changes_start_intervals_at_the_previous_snapshot(tmp_path):
+  states = history.StateHistory(str(tmp_path / 'history.json'))
+  states.record(snapshot({'i-1': 'running'}), 0)
+  states.record(snapshot({'i-1': 'running'}), HOUR)
+  assert states.record(snapshot({'i-1': 'stopped'}), 2 * HOUR) == 1
+  running, stopped = history.STATES.index('running'), history.STATES.index('stopped')
+  assert states.instances['i-1']['intervals'] == [[running, 0, HOUR], [stopped, HOUR, 2 * HOUR]]
+  assert states.states_at(HOUR // 2) == {'i-1': 'running'}
+  assert states.states_at(2 * HOUR) == {'i-1': 'stopped'}
+
+
+def test_instances_missing_from_a_snapshot_start_a_new_interval(tmp_path):
+  states = history.StateHistory(str(tmp_path / 'history.json'))
+  states.record(snapshot({'i-1': 'running', 'i-2': 'running'}), 0)
+  states.record(snapshot({'i-1': 'running'}), HOUR)
+  states.record(snapshot({'i-1': 'running', 'i-2': 'running'}), 2 * HOUR)
+  running = history.STATES.index('running')
+  assert states.instances['i-2']['intervals'] == [[running, 0, 0], [running, 2 * HOUR, 2 * HOUR]]
+  assert states.instance_hours(group_by='role') == {'': 2.0}
+
+
+def test_snapshots_must_be_recorded_in_order(tmp_path):
+  states = history.StateHistory(str(tmp_path / 'history.json'))
+  states.record(snapshot({'i-1': 'running'}), HOUR)
+  with pytest.raises(ValueError):
+    states.record(snapshot({'i-1': 'running'}), 0)
+
+
+def test_snapshots_in_the_same_second_are_skipped(tmp_path):
+  fname = str(tmp_path / 'history.json')
+  states = history.StateHistory(fname)
+  states.record(snapshot({'i-1': 'running'}), HOUR)
+  states.save()
+  # e.g. a manual run in the same second as the cron job, recording in its own process
+  states = history.StateHistory(fname)
+  assert states.record(snapshot({'i-1': 'stopped', 'i-2': 'running'}), HOUR + 0.5) == 0
+  assert sorted(states.instances) == ['i-1']
+  assert states.record(snapshot({'i-1': 'stopped'}), 2 * HOUR) == 1
+  assert states.instance_hours(states=('stopped',)) == {'': 1.0}
+
+
+def test_instance_hours_by_attribute_and_window(tmp_path):
+  states = history.StateHistory(str(tmp_path / 'history.json'))
+  attributes = {'i-1': {'owner': 'alice'}, 'i-2': {'owner': 'bob'}, 'i-3': {'owner': 'bob'}}
+  for hour in range(11):
+    states.record(snapshot({'i-1': 'running', 'i-2': 'running' if hour < 5 else 'stopped',
+                            'i-3': 'stopped'}, **attributes), hour * HOUR)
+  assert states.instance_hours(group_by='owner') == {'alice': 10.0, 'bob': 4.0}
+  assert states.instance_hours(group_by='owner', states=('stopped',)) == {'bob': 16.0}
+  assert states.instance_hours(since=2 * HOUR, until=6 * HOUR, group_by='owner') == {
+    'alice': 4.0, 'bob': 2.0}
+  assert states.instance_hours(since=20 * HOUR, group_by='owner') == {}
+  with pytest.raises(ValueError):
+    states.instance_hours(group_by='colour')
+
+
+def test_instance_hours_over_a_fleet(tmp_path, instances):
+  states = history.StateHistory(str(tmp_path / 'history.json'))
+  for hour in range(3):
+    states.record(instances, hour * HOUR)
+  running = sum(1 for i in instances if i['State']['Name'] == 'running')
+  assert sum(states.instance_hours(group_by='type').values()) == pytest.approx(2 * running)
+
+
+def test_save_and_load(tmp_path):
+  fname = str(tmp_path / 'history.json')
+  states = history.StateHistory(fname)
+  states.record(snapshot({'i-1': 'running'}, **{'i-1': {'env': 'staging'}}), 0)
+  states.record(snapshot({'i-1': 'running'}, **{'i-1': {'env': 'staging'}}), HOUR)
+  states.save()
+  loaded = history.StateHistory(fname)
+  assert loaded.last_snapshot == HOUR
+  assert loaded.instances == states.instances
+  assert loaded.instance_hours(group_by='env') == {'staging': 1.0}
+  # Recording continues where the saved history left off
+  assert loaded.record(snapshot({'i-1': 'running'}, **{'i-1': {'env': 'staging'}}), 2 * HOUR) == 0
+
+
+def test_unsupported_version(tmp_path):
+  fname = tmp_path / 'history.json'
+  fname.write_text(json.dumps({'version': history.VERSION + 1}))
+  with pytest.raises(ValueError):
+    history.StateHistory(str(fname))
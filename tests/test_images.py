@@ -0,0 +1,130 @@
+import asyncio
+import datetime
+import json
+
+import pytest
+
+import images
+import utils
+from conftest import make_instance
+
+
+NOW = datetime.datetime(2019, 7, 31)
+DAY = 86400
+
+
+class Registry(object):
+  # Stands in for an engine.Engine, answering describe_images from a dict of AMI ID -> image
+
+  def __init__(self, available):
+    self.available = available
+    self.asked = []
+
+  async def fetch_images(self, image_ids):
+    self.asked.append(sorted(image_ids))
+    return [self.available[i] for i in sorted(image_ids) if i in self.available]
+
+  def run(self, **coros):
+    return {name: asyncio.run(coro) for name, coro in coros.items()}
+
+
+def ami(image_id, name='base', created='2019-06-30T12:00:00.000Z'):
+  return {'ImageId': image_id, 'Name': name, 'CreationDate': created}
+
+
+def launched_from(*image_ids):
+  return [make_instance('i-%d' % n, ImageId=image_id) for n, image_id in enumerate(image_ids)]
+
+
+def test_columns():
+  cache = images.ImageCache(now=NOW)
+  registry = Registry({'ami-1': ami('ami-1'), 'ami-2': ami('ami-2', created='')})
+  assert cache.refresh(launched_from('ami-1', 'ami-2', 'ami-3', 'ami-1'), registry, now=DAY) == 3
+  assert cache.columns({'ImageId': 'ami-1'}) == ['ami-1', 'base', '2019-06-30', '30']
+  assert cache.columns({'ImageId': 'ami-2'}) == ['ami-2', 'base', '', '']
+  assert cache.columns({'ImageId': 'ami-3'}) == ['ami-3', images.DEREGISTERED, '', '']
+  assert cache.columns({'ImageId': 'ami-9'}) == ['ami-9', '', '', '']
+  assert cache.columns({}) == ['', '', '', '']
+  assert len(cache.columns({})) == len(utils.IMAGE_COLUMNS)
+  assert cache.image('ami-1') == ('base', '2019-06-30T12:00:00.000Z')
+  assert cache.image('ami-3') is None and cache.created('ami-3') is None
+
+
+def test_found_images_are_never_fetched_again():
+  cache = images.ImageCache(now=NOW)
+  registry = Registry({'ami-1': ami('ami-1')})
+  cache.refresh(launched_from('ami-1'), registry, now=DAY)
+  assert cache.refresh(launched_from('ami-1'), registry, now=1000 * DAY) == 0
+  assert registry.asked == [['ami-1']]
+
+
+def test_missing_images_are_rechecked_after_the_ttl():
+  cache = images.ImageCache(now=NOW, missing_recheck_days=2)
+  registry = Registry({'ami-1': ami('ami-1')})
+  instances = launched_from('ami-1', 'ami-2')
+  cache.refresh(instances, registry, now=10 * DAY)
+  assert cache.missing == {'ami-2': 10 * DAY}
+  assert cache.refresh(instances, registry, now=11 * DAY) == 0
+
+  # Shared again since: found on the next recheck
+  registry.available['ami-2'] = ami('ami-2', name='shared')
+  assert cache.refresh(instances, registry, now=12 * DAY) == 1
+  assert registry.asked == [['ami-1', 'ami-2'], ['ami-2']]
+  assert cache.missing == {}
+  assert cache.columns({'ImageId': 'ami-2'})[1] == 'shared'
+
+
+def test_a_recheck_that_finds_nothing_restarts_the_ttl():
+  cache = images.ImageCache(now=NOW, missing_recheck_days=2)
+  registry = Registry({})
+  cache.refresh(launched_from('ami-2'), registry, now=10 * DAY)
+  cache.refresh(launched_from('ami-2'), registry, now=13 * DAY)
+  assert cache.missing == {'ami-2': 13 * DAY}
+  assert cache.stale(['ami-2'], now=14 * DAY) == set()
+  assert cache.stale(['ami-2', 'ami-3'], now=15 * DAY) == {'ami-2', 'ami-3'}
+
+
+def test_save_and_load(tmp_path):
+  fname = str(tmp_path / 'images.json')
+  cache = images.ImageCache(fname, now=NOW)
+  cache.refresh(launched_from('ami-1', 'ami-2'), Registry({'ami-1': ami('ami-1')}), now=DAY)
+  cache.save()
+  assert not cache.changed
+
+  loaded = images.ImageCache(fname, now=NOW)
+  assert loaded.entries == cache.entries and loaded.missing == {'ami-2': DAY}
+  assert loaded.stale(['ami-1', 'ami-2'], now=DAY + 1) == set()
+
+
+def test_version_1_is_migrated(tmp_path):
+  fname = tmp_path / 'images.json'
+  fname.write_text(json.dumps({'version': 1, 'entries': {
+    'ami-1': ['base', '2019-06-30T12:00:00.000Z'], 'ami-2': None}}))
+  cache = images.ImageCache(str(fname), now=NOW)
+  assert cache.columns({'ImageId': 'ami-2'})[1] == images.DEREGISTERED
+  # AMIs version 1 had given up on are asked for again
+  registry = Registry({'ami-2': ami('ami-2', name='shared')})
+  assert cache.refresh(launched_from('ami-1', 'ami-2'), registry, now=30 * DAY) == 1
+  assert cache.image('ami-2') == ('shared', '2019-06-30T12:00:00.000Z')
+  cache.save()
+  assert json.loads(fname.read_text())['version'] == images.VERSION
+
+
+@pytest.mark.parametrize('content', [json.dumps({'version': images.VERSION + 1}), '{"vers', '[]'])
+def test_unsupported_caches_are_rebuilt(tmp_path, capsys, content):
+  fname = tmp_path / 'images.json'
+  fname.write_text(content)
+  cache = images.ImageCache(str(fname), now=NOW)
+  assert 'Ignoring' in capsys.readouterr().err
+  cache.refresh(launched_from('ami-1'), Registry({'ami-1': ami('ami-1')}), now=DAY)
+  cache.save()
+  assert images.ImageCache(str(fname)).image('ami-1') == ('base', '2019-06-30T12:00:00.000Z')
+
+
+def test_fake_backend_images(fake_backend, instances):
+  cache = images.ImageCache(now=NOW)
+  image_ids = {i['ImageId'] for i in instances if i.get('ImageId')}
+  assert cache.refresh(instances) == len(image_ids)
+  assert cache.entries and cache.missing
+  assert set(cache.entries) | set(cache.missing) == image_ids
+  assert cache.refresh(instances) == 0
@@ -0,0 +1,87 @@
+import datetime
+
+import pytest
+
+import config
+import inventory
+from conftest import make_instance
+
+
+DAY = 86400
+
+
+@pytest.fixture
+def inv(tmp_path):
+  inv = inventory.Inventory(str(tmp_path / 'inventory.sqlite'))
+  yield inv
+  inv.close()
+
+
+def fleet_on(day, *owners):
+  return [make_instance('i-%d' % n, env='staging', purpose='web', owner=owner,
+                        tags={'Day': str(day)}) for n, owner in enumerate(owners)]
+
+
+def test_as_of(inv):
+  inv.record(fleet_on(1, 'bob', 'alice'), DAY)
+  inv.record(fleet_on(2, 'carol'), 2 * DAY)
+  assert inv.as_of(DAY - 1) == []
+  assert [(r.instance_id, r.owner) for r in inv.as_of(DAY)] == [('i-0', 'bob'), ('i-1', 'alice')]
+  assert [(r.taken_at, r.owner) for r in inv.as_of(2 * DAY - 1, instance_id='i-0')] == [
+    (DAY, 'bob')]
+  assert [r.owner for r in inv.as_of(datetime.datetime.now(datetime.timezone.utc))] == ['carol']
+  assert inv.as_of(DAY, owner='alice', env='staging')[0].instance_id == 'i-1'
+  with pytest.raises(ValueError):
+    inv.as_of(DAY, colour='red')
+
+
+def test_tags_are_stored_once_per_set(inv):
+  inv.record(fleet_on(1, 'bob', 'bob'), DAY)
+  inv.record(fleet_on(1, 'bob'), 2 * DAY)
+  assert inv.db.execute('SELECT COUNT(*) FROM tag_set').fetchone()[0] == 1
+  inv.record(fleet_on(3, 'bob'), 3 * DAY)
+  assert inv.tags_as_of(2 * DAY, 'i-0') == {config.INSTANCE_ENVIRONMENT_KEY: 'staging',
+                                            config.INSTANCE_PURPOSE_KEY: 'web',
+                                            config.INSTANCE_OWNER_KEY: 'bob', 'Day': '1'}
+  assert inv.tags_as_of(3 * DAY, 'i-0')['Day'] == '3'
+  assert inv.tags_as_of(0, 'i-0') == {}
+
+
+def test_same_second_snapshots_are_replaced(inv):
+  assert inv.record(fleet_on(1, 'bob', 'alice'), DAY) == inv.record(fleet_on(1, 'carol'), DAY + 0.5)
+  assert [r.owner for r in inv.as_of(DAY)] == ['carol']
+  assert inv.db.execute('SELECT COUNT(*) FROM snapshot').fetchone()[0] == 1
+
+
+def test_snapshot_in_parts(inv):
+  snapshot_id = inv.begin(DAY)
+  inv.add(snapshot_id, fleet_on(1, 'bob'))
+  inv.add(snapshot_id, [make_instance('i-9', owner='alice')])
+  inv.commit()
+  assert [r.instance_id for r in inv.as_of(DAY)] == ['i-0', 'i-9']
+
+  # A failed recording leaves the previous snapshot as it was
+  snapshot_id = inv.begin(DAY)
+  inv.add(snapshot_id, fleet_on(1, 'carol'))
+  inv.rollback()
+  assert [r.owner for r in inv.as_of(DAY)] == ['bob', 'alice']
+  with pytest.raises(KeyError):
+    inv.record([{'InstanceId': 'i-broken'}], 2 * DAY)
+  assert inv.snapshot_at(2 * DAY) == (snapshot_id, DAY)
+
+
+def test_history(inv):
+  for day in range(1, 5):
+    inv.record(fleet_on(day, 'bob') if day != 3 else [], day * DAY)
+  assert [r.taken_at for r in inv.history('i-0')] == [DAY, 2 * DAY, 4 * DAY]
+  assert [r.taken_at for r in inv.history('i-0', since=2 * DAY, until=3 * DAY)] == [2 * DAY]
+  assert inv.history('i-9') == []
+
+
+def test_fleet_round_trip(inv, instances):
+  inv.record(instances, DAY)
+  rows = inv.as_of(DAY)
+  assert [r.instance_id for r in rows] == sorted(i['InstanceId'] for i in instances)
+  by_id = {i['InstanceId']: i for i in instances}
+  for row in rows:
+    assert row.state == by_id[row.instance_id]['State']['Name']
@@ -0,0 +1,99 @@
+import datetime
+
+import pytest
+
+import config
+import lookup
+import utils
+from conftest import make_instance
+
+
+def day(value):
+  return int(datetime.datetime.strptime(value, '%Y-%m-%d').replace(
+    tzinfo=datetime.timezone.utc).timestamp())
+
+
+def ids(entries):
+  return sorted(e.instance_id for e in entries)
+
+
+@pytest.fixture
+def index(instances):
+  return lookup.InventoryIndex.from_instances(instances, taken_at=0)
+
+
+def test_get(index, instances):
+  instance = next(i for i in instances if i.get('PrivateIpAddress') and i.get('PrivateDnsName'))
+  for key in (instance['InstanceId'], instance['PrivateIpAddress'],
+              utils.generate_host(instance).upper(), instance['PrivateDnsName']):
+    assert index.get(key).instance_id == instance['InstanceId']
+    assert lookup.search(index, ' %s ' % key) == [index.get(key)]
+  assert index.get('i-missing') is None
+  assert lookup.search(index, 'i-missing') == []
+
+
+def test_tag_conditions_match_a_scan(index, instances):
+  def scan(**tags):
+    return sorted(i['InstanceId'] for i in instances
+                  if all(utils.strip(utils.get_tags(i).get(lookup.TAG_ALIASES.get(k, k))) == v
+                         for k, v in tags.items()))
+  env = config.INSTANCE_ENVIRONMENT_STAGING
+  searcher = config.INSTANCE_PURPOSE_SEARCHER
+  assert ids(lookup.search(index, 'env=%s' % env)) == scan(env=env)
+  assert ids(lookup.search(index, 'env=%s, purpose=%s' % (env, searcher))) == \
+    scan(env=env, purpose=searcher)
+  assert ids(lookup.search(index, '%s=%s' % (config.INSTANCE_PURPOSE_KEY, searcher))) == \
+    scan(purpose=searcher)
+  assert lookup.search(index, 'env=nowhere,purpose=%s' % searcher) == []
+  assert sum(index.tag_values(config.INSTANCE_ENVIRONMENT_KEY).values()) == len(scan()) - len(
+    [i for i in instances if config.INSTANCE_ENVIRONMENT_KEY not in utils.get_tags(i)])
+
+
+def test_results_are_in_launch_order(index):
+  entries = lookup.search(index, 'env=%s' % config.INSTANCE_ENVIRONMENT_PRODUCTION)
+  assert [e.launch_time for e in entries] == sorted(e.launch_time for e in entries)
+
+
+def test_range_operators():
+  stopped = [make_instance('i-%d' % n, state='stopped', StateTransitionReason=(
+    'User initiated (2024-01-0%d 12:00:00 GMT)' % n)) for n in (1, 2, 3)]
+  index = lookup.InventoryIndex.from_instances(stopped + [make_instance('i-9')])
+  assert ids(lookup.search(index, 'stopped<2024-01-02')) == ['i-1']
+  assert ids(lookup.search(index, 'stopped<=2024-01-02')) == ['i-1', 'i-2']
+  assert ids(lookup.search(index, 'stopped>2024-01-02')) == ['i-3']
+  assert ids(lookup.search(index, 'stopped >= 2024-01-02')) == ['i-2', 'i-3']
+  assert ids(lookup.search(index, 'stopped>=2024-01-02,stopped<2024-01-03')) == ['i-2']
+
+
+def test_launch_ranges_match_a_scan(index, instances):
+  since, until = day('2018-01-01'), day('2018-07-01')
+  expected = sorted(i['InstanceId'] for i in instances
+                    if since <= i['LaunchTime'].timestamp() < until)
+  assert ids(lookup.search(index, 'launched>=2018-01-01,launched<2018-07-01')) == expected
+
+
+@pytest.mark.parametrize('expression', ['stopped<=yesterday', 'stopped=>2024-01-01',
+                                        'env=staging,purpose', 'env=staging,=web',
+                                        'owner=bob,launched<', 'env<>x'])
+def test_bad_conditions(index, expression):
+  with pytest.raises(ValueError):
+    lookup.search(index, expression)
+
+
+def test_save_and_load(tmp_path, index, instances):
+  fname = str(tmp_path / 'index.sqlite')
+  index.save(fname)
+  index.save(fname)
+  loaded = lookup.InventoryIndex.load(fname)
+  assert len(loaded) == len(instances) and loaded.taken_at == 0
+  assert lookup.search(loaded, 'env=%s' % config.INSTANCE_ENVIRONMENT_STAGING) == \
+    lookup.search(index, 'env=%s' % config.INSTANCE_ENVIRONMENT_STAGING)
+
+
+def test_load_rejects_what_is_not_an_index(tmp_path):
+  with pytest.raises(ValueError):
+    lookup.InventoryIndex.load(str(tmp_path / 'missing.sqlite'))
+  other = tmp_path / 'index.json'
+  other.write_text('{"version": 1}')
+  with pytest.raises(ValueError):
+    lookup.InventoryIndex.load(str(other))
@@ -0,0 +1,121 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+import config
+import network
+from conftest import make_instance
+
+
+PRODUCTION = config.INSTANCE_ENVIRONMENT_PRODUCTION
+
+
+class Describer(object):
+  # Stands in for an engine.Engine, answering the describe calls of network.KINDS
+
+  def __init__(self):
+    self.asked = []
+
+  async def fetch_subnets(self, ids):
+    self.asked.append(('subnets', sorted(ids)))
+    return [{'SubnetId': i, 'AvailabilityZone': 'us-east-1a', 'CidrBlock': '10.0.0.0/24',
+             'VpcId': 'vpc-1', 'Tags': [{'Key': 'Name', 'Value': 'name-of-%s' % i}]} for i in ids]
+
+  async def fetch_vpcs(self, ids):
+    self.asked.append(('vpcs', sorted(ids)))
+    return [{'VpcId': i, 'CidrBlock': '10.0.0.0/16', 'Tags': []} for i in ids]
+
+  async def fetch_security_groups(self, ids):
+    self.asked.append(('security_groups', sorted(ids)))
+    return [{'GroupId': i, 'GroupName': 'group-%s' % i, 'VpcId': 'vpc-1'} for i in ids]
+
+  def run(self, **coros):
+    return {name: asyncio.run(coro) for name, coro in coros.items()}
+
+
+def in_subnet(instance_id, subnet, env=PRODUCTION, purpose='web', zone='us-east-1a'):
+  return make_instance(instance_id, env=env, purpose=purpose, SubnetId='subnet-1',
+                       VpcId='vpc-1', SecurityGroups=[{'GroupId': 'sg-1'}, {'GroupId': 'sg-2'}],
+                       Placement={'AvailabilityZone': zone}), {
+    'name': subnet, 'zone': zone, 'cidr': '10.0.0.0/24', 'vpc': 'vpc-1', 'fetched_at': 0}
+
+
+def test_expected_subnet():
+  assert network.expected_subnet(make_instance('i-1', env='staging', purpose='web')) == \
+    'staging-web'
+  # Purposes sharing a subnet
+  for purpose in (config.INSTANCE_PURPOSE_DB, config.INSTANCE_PURPOSE_FRONTEND_PROXY):
+    assert network.expected_subnet(make_instance('i-1', env=PRODUCTION, purpose=purpose)) == \
+      '%s-%s' % (PRODUCTION, config.SUBNET_COMPATIBILITY_MAP[PRODUCTION][purpose])
+  # The map is per environment
+  staging = config.SUBNET_COMPATIBILITY_MAP['staging'][config.INSTANCE_PURPOSE_FRONTEND_PROXY]
+  assert network.expected_subnet(make_instance(
+    'i-1', env='staging', purpose=config.INSTANCE_PURPOSE_FRONTEND_PROXY)) == 'staging-' + staging
+  assert network.expected_subnet(make_instance(
+    'i-1', env='sandbox', purpose=config.INSTANCE_PURPOSE_FRONTEND_PROXY)) == \
+    'sandbox-%s' % config.INSTANCE_PURPOSE_FRONTEND_PROXY
+  assert network.expected_subnet(make_instance('i-1', env='staging')) is None
+  assert network.expected_subnet(make_instance('i-1', purpose='web')) is None
+
+
+@pytest.mark.parametrize('subnet,purpose,check', [
+  ('production-web', 'web', network.SUBNET_OK),
+  ('production-web-us-east-1a', 'web', network.SUBNET_OK),
+  ('production-frontend-us-east-1a', config.INSTANCE_PURPOSE_FRONTEND_PROXY, network.SUBNET_OK),
+  ('production-web-us-east-1b', 'web', 'production-web'),
+  ('production-jobs', 'web', 'production-web'),
+  ('production-web', config.INSTANCE_PURPOSE_FRONTEND_PROXY, 'production-frontend'),
+  ('', 'web', network.SUBNET_UNKNOWN),
+])
+def test_check_subnet(subnet, purpose, check):
+  instance, record = in_subnet('i-1', subnet, purpose=purpose)
+  cache = network.NetworkCache()
+  cache.entries['subnets']['subnet-1'] = record
+  assert cache.check_subnet(instance) == check
+
+
+def test_unknown_subnets_are_not_checked():
+  cache = network.NetworkCache()
+  assert cache.check_subnet(in_subnet('i-1', 'production-web')[0]) == network.SUBNET_UNKNOWN
+  instance, record = in_subnet('i-1', 'production-web', env='')
+  cache.entries['subnets']['subnet-1'] = record
+  assert cache.check_subnet(instance) == network.SUBNET_UNKNOWN
+
+
+def test_refresh_and_columns(tmp_path):
+  fname = str(tmp_path / 'network.json')
+  describer = Describer()
+  cache = network.NetworkCache(fname)
+  instance = in_subnet('i-1', 'production-web')[0]
+  assert cache.refresh([instance, make_instance('i-2')], describer) == 4
+  assert sorted(describer.asked) == [('security_groups', ['sg-1', 'sg-2']),
+                                     ('subnets', ['subnet-1']), ('vpcs', ['vpc-1'])]
+  assert cache.columns(instance) == ['us-east-1a', '10.0.0.0/24', 'name-of-subnet-1', '',
+                                     'group-sg-1,group-sg-2', 'expected production-web']
+  cache.save()
+
+  # Cached entries are not fetched again until they are older than the max age
+  describer.asked = []
+  assert network.NetworkCache(fname).refresh([instance], describer) == 0
+  assert describer.asked == []
+  stale = network.NetworkCache(fname, max_age_days=0)
+  assert stale.missing({'vpcs': ['vpc-1']}, now=time.time() + 1) == {'vpcs': {'vpc-1'}}
+
+
+def test_refresh_from_the_fake_backend(fake_backend, instances):
+  cache = network.NetworkCache()
+  assert cache.refresh(instances) > 0
+  live = [i for i in instances if i['State']['Name'] in network.CHECKED_STATES]
+  assert all(cache.subnet(i['SubnetId']) for i in live if i.get('SubnetId'))
+  assert cache.refresh(instances) == 0
+
+
+@pytest.mark.parametrize('content', [json.dumps({'version': network.VERSION + 1}), '{"vers', '[]'])
+def test_unsupported_caches_are_rebuilt(tmp_path, capsys, content):
+  fname = tmp_path / 'network.json'
+  fname.write_text(content)
+  cache = network.NetworkCache(str(fname))
+  assert 'Ignoring' in capsys.readouterr().err
+  assert cache.entries == {kind: {} for kind in network.KINDS}
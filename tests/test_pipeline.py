@@ -0,0 +1,179 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+import backend
+import engine
+import inventory
+import pipeline
+import utils
+
+
+class SlowSink(pipeline.Sink):
+  # Takes a while per page, so its buffer fills up
+
+  kind = 'slow'
+
+  def __init__(self, delay):
+    super(SlowSink, self).__init__(None)
+    self.delay = delay
+    self.count = 0
+
+  def open(self):
+    pass
+
+  def write(self, instances):
+    time.sleep(self.delay)
+    self.count += len(instances)
+
+  def close(self):
+    pass
+
+
+class FailingSink(SlowSink):
+
+  kind = 'failing'
+
+  def write(self, instances):
+    raise IOError('disk full')
+
+
+class FailingBackend(backend.FakeBackend):
+  # Denies a describe_instances call part-way through the fetch
+
+  def call(self, operation):
+    super(FailingBackend, self).call(operation)
+    if operation == 'DescribeInstances' and self.calls[operation] == 4:
+      raise ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Denied'}}, operation)
+
+
+def test_from_spec(tmp_path):
+  sinks = pipeline.from_spec('tsv=a.tsv, table=-,hosts=h.txt,json=j.json,sqlite=inv.sqlite',
+                             at=100)
+  assert [(s.kind, s.path) for s in sinks] == [('tsv', 'a.tsv'), ('table', '-'),
+                                               ('hosts', 'h.txt'), ('json', 'j.json'),
+                                               ('sqlite', 'inv.sqlite')]
+  assert sinks[-1].at == 100 and sinks[-1].records
+  assert pipeline.from_spec('hosts')[0].path == '-'
+  for spec in ('csv=a.csv', 'table=-,hosts', 'sqlite=-', 'sqlite'):
+    with pytest.raises(ValueError):
+      pipeline.from_spec(spec)
+
+
+def test_every_output_from_one_fetch(fake_backend, instances, tmp_path):
+  paths = {kind: str(tmp_path / kind) for kind in pipeline.KINDS}
+  sinks = pipeline.from_spec(','.join('%s=%s' % item for item in sorted(paths.items())), at=100)
+  eng = engine.Engine()
+  with pipeline.FanOut(sinks, buffer_pages=2) as fan_out:
+    assert eng.run(instances=eng.fetch_instances(on_page=fan_out.write))['instances'] == []
+  assert fake_backend.calls['DescribeInstances'] == len(instances) // 50
+
+  ids = sorted(i['InstanceId'] for i in instances)
+  with open(paths['tsv']) as f:
+    lines = f.read().split('\n')
+  assert lines[0].split('\t') == utils.instance_detail_header()
+  assert sorted(line.split('\t')[0] for line in lines[1:]) == ids
+  with open(paths['hosts']) as f:
+    assert sorted(f.read().split()) == sorted(utils.generate_host(i) for i in instances)
+  with open(paths['json']) as f:
+    assert sorted(i['InstanceId'] for i in json.load(f)) == ids
+  with open(paths['table']) as f:
+    table = f.read()
+  assert all(instance_id in table for instance_id in ids)
+  inv = inventory.Inventory(paths['sqlite'])
+  assert [r.instance_id for r in inv.as_of(100)] == ids
+  inv.close()
+
+
+def test_select_spares_recording_sinks(instances, tmp_path):
+  hosts, fname = pipeline.HostnameSink(str(tmp_path / 'hosts')), str(tmp_path / 'inv.sqlite')
+  running = lambda page: [i for i in page if i['State']['Name'] == 'running']
+  with pipeline.FanOut([hosts, pipeline.SqliteSink(fname, at=100)], select=running) as fan_out:
+    for n in range(0, len(instances), 50):
+      asyncio.run(fan_out.write(instances[n:n + 50]))
+  with open(hosts.path) as f:
+    assert len(f.read().split()) == len(running(instances)) < len(instances)
+  inv = inventory.Inventory(fname)
+  assert len(inv.as_of(100)) == len(instances)
+  inv.close()
+
+
+def test_slow_sinks_do_not_stall_the_event_loop(instances):
+  slow = SlowSink(0.02)
+  gaps = []
+
+  async def tick(done):
+    last = time.perf_counter()
+    while not done.is_set():
+      await asyncio.sleep(0.001)
+      now = time.perf_counter()
+      gaps.append(now - last)
+      last = now
+
+  async def fetch():
+    done = threading.Event()
+    ticker = asyncio.ensure_future(tick(done))
+    for n in range(0, len(instances), 25):
+      await fan_out.write(instances[n:n + 25])
+    done.set()
+    await ticker
+
+  with pipeline.FanOut([slow], buffer_pages=1) as fan_out:
+    asyncio.run(fetch())
+  assert slow.count == len(instances)
+  # The writes waited for the sink for about 0.4s, but never by blocking the loop
+  assert max(gaps) < 0.015
+
+
+def test_a_failed_sink_does_not_stop_the_others(instances, tmp_path, capsys):
+  json_sink = pipeline.JsonSink(str(tmp_path / 'instances.json'))
+  fan_out = pipeline.FanOut([FailingSink(0), json_sink], buffer_pages=1)
+  fan_out.open()
+  for n in range(0, len(instances), 50):
+    asyncio.run(fan_out.write(instances[n:n + 50]))
+  with pytest.raises(IOError):
+    fan_out.close()
+  assert 'disk full' in capsys.readouterr().err
+  with open(json_sink.path) as f:
+    assert len(json.load(f)) == len(instances)
+
+
+def test_a_failed_fetch_commits_no_snapshot(instances, tmp_path):
+  fname = str(tmp_path / 'inv.sqlite')
+  with pytest.raises(RuntimeError):
+    with pipeline.FanOut([pipeline.SqliteSink(fname, at=100)]) as fan_out:
+      asyncio.run(fan_out.write(instances[:50]))
+      raise RuntimeError('fetch failed')
+  inv = inventory.Inventory(fname)
+  assert inv.as_of(100) == []
+  inv.close()
+
+
+def test_a_fetch_failing_part_way_is_aborted(instances, tmp_path):
+  previous = backend._backend
+  backend.set_backend(FailingBackend(instances=instances, page_size=50))
+  fname = str(tmp_path / 'inv.sqlite')
+  json_sink = pipeline.JsonSink(str(tmp_path / 'instances.json'))
+  fan_out = pipeline.FanOut([pipeline.SqliteSink(fname, at=100), json_sink])
+  fan_out.open()
+  try:
+    eng = engine.Engine()
+    with pytest.raises(ClientError):
+      try:
+        eng.run(instances=eng.fetch_instances(on_page=fan_out.write))
+      except BaseException:
+        fan_out.abort()
+        raise
+  finally:
+    backend.set_backend(previous)
+  assert not any(thread.is_alive() for thread in fan_out.threads)
+  assert json_sink.f.closed
+  # Nothing was committed, and the file is not left locked
+  inv = inventory.Inventory(fname)
+  assert inv.as_of(100) == []
+  inv.record(instances, 200)
+  inv.close()
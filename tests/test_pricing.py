@@ -0,0 +1,119 @@
+import io
+import json
+
+import pytest
+
+import pricing
+
+
+def offer(products_first=True):
+  products = {
+    'SKU1': {'productFamily': 'Compute Instance', 'attributes': {
+      'instanceType': 'm5.large', 'location': 'US East (N. Virginia)', 'tenancy': 'Shared',
+      'operatingSystem': 'Linux', 'preInstalledSw': 'NA', 'capacitystatus': 'Used'}},
+    'SKU2': {'productFamily': 'Compute Instance', 'attributes': {
+      'instanceType': 'm5.large', 'regionCode': 'eu-west-1', 'tenancy': 'Dedicated',
+      'operatingSystem': 'Windows', 'preInstalledSw': 'NA'}},
+    # Not what describe_instances reports
+    'SKU3': {'productFamily': 'Compute Instance', 'attributes': {
+      'instanceType': 'm5.large', 'regionCode': 'us-east-1', 'preInstalledSw': 'SQL Std'}},
+    'SKU4': {'productFamily': 'Storage', 'attributes': {'regionCode': 'us-east-1'}},
+  }
+
+  def term(price):
+    return {'T': {'priceDimensions': {'D': {'unit': 'Hrs', 'pricePerUnit': {'USD': price}}}}}
+
+  terms = {'OnDemand': {'SKU1': term('0.096'), 'SKU2': term('0.25'), 'SKU3': term('1.0'),
+                        'SKU9': term('9.0')},
+           'Reserved': {'SKU1': term('0.06')}}
+  sections = [('products', products), ('terms', terms)]
+  if not products_first:
+    sections.reverse()
+  return json.dumps(dict([('formatVersion', 'v1.0'), ('offerCode', 'AmazonEC2')] + sections +
+                         [('attributesList', {})]), indent=1)
+
+
+EXPECTED = {'m5.large|us-east-1|Shared|Linux': 0.096,
+            'm5.large|eu-west-1|Dedicated|Windows': 0.25}
+
+
+@pytest.mark.parametrize('read_size', [1, 2, 3, 7, 64, pricing._READ_SIZE])
+def test_json_stream_across_chunk_boundaries(monkeypatch, read_size):
+  monkeypatch.setattr(pricing, '_READ_SIZE', read_size)
+  document = {'a': 12345.678, 'b': {'nested': [1, 2, {'x': 'y'}], 'empty': {}},
+              'c': 'a "quoted" é string', 'd': {}, 'e': -0.5e-3, 'f': True, 'g': None}
+  stream = pricing._JsonStream(io.StringIO(json.dumps(document, indent=2)))
+  decoded = {}
+  for name in stream.members():
+    if name == 'b':
+      decoded[name] = {}
+      for member in stream.members():
+        decoded[name][member] = stream.value()
+    elif name == 'd':
+      stream.skip()
+    else:
+      decoded[name] = stream.value()
+  assert decoded == {k: v for k, v in document.items() if k != 'd'}
+
+
+@pytest.mark.parametrize('read_size', [1, 5, 4096])
+@pytest.mark.parametrize('products_first', [True, False])
+def test_read_offer_file(tmp_path, monkeypatch, read_size, products_first):
+  monkeypatch.setattr(pricing, '_READ_SIZE', read_size)
+  fname = tmp_path / 'index.json'
+  fname.write_text(offer(products_first), encoding='utf-8')
+  assert pricing.read_offer_file(str(fname)) == EXPECTED
+
+
+def test_malformed_offer_file(tmp_path):
+  fname = tmp_path / 'index.json'
+  fname.write_text('{"products": {"SKU1": {}', encoding='utf-8')
+  with pytest.raises(ValueError):
+    pricing.read_offer_file(str(fname))
+
+
+def test_catalog_lookups(tmp_path):
+  fname = str(tmp_path / 'ec2.prices')
+  prices = {pricing.catalog_key('t%d.size%d' % (n % 7, n), 'us-east-1'): n / 100.0
+            for n in range(1000)}
+  pricing.write_catalog(prices, fname)
+  catalog = pricing.PriceCatalog(fname)
+  assert len(catalog) == 1000
+  for n in range(1000):
+    assert catalog.price('t%d.size%d' % (n % 7, n), 'us-east-1') == n / 100.0
+  assert catalog.price('t1.size1', 'us-west-2') is None
+  assert catalog.price('x1.nothing', 'us-east-1') is None
+  catalog.close()
+
+
+def test_colliding_keys(tmp_path, monkeypatch):
+  # Every key hashes to one of two values, so lookups have to probe past the others
+  monkeypatch.setattr(pricing, '_hash', lambda key: 1 + len(key) % 2)
+  fname = str(tmp_path / 'ec2.prices')
+  prices = {pricing.catalog_key('m5.%dxlarge' % n, 'us-east-1'): float(n) for n in range(20)}
+  pricing.write_catalog(prices, fname)
+  catalog = pricing.PriceCatalog(fname)
+  for n in range(20):
+    assert catalog.price('m5.%dxlarge' % n, 'us-east-1') == float(n)
+  assert catalog.price('m5.99xlarge', 'us-east-1') is None
+  catalog.close()
+
+
+def test_instance_price(tmp_path):
+  fname = str(tmp_path / 'ec2.prices')
+  pricing.write_catalog(EXPECTED, fname)
+  catalog = pricing.PriceCatalog(fname)
+  assert catalog.instance_price({'InstanceType': 'm5.large',
+                                 'Placement': {'AvailabilityZone': 'us-east-1c'}}) == 0.096
+  assert catalog.instance_price({'InstanceType': 'm5.large', 'Platform': 'windows',
+                                 'Placement': {'AvailabilityZone': 'eu-west-1a',
+                                               'Tenancy': 'dedicated'}}) == 0.25
+  assert catalog.instance_price({'InstanceType': 'm5.large'}) is None
+  catalog.close()
+
+
+def test_not_a_catalog(tmp_path):
+  fname = tmp_path / 'ec2.prices'
+  fname.write_bytes(b'NOTPRICE' + bytes(pricing._HEADER.size))
+  with pytest.raises(ValueError):
+    pricing.PriceCatalog(str(fname))
@@ -0,0 +1,102 @@
+import pytest
+
+import reservations
+from conftest import make_instance
+
+
+class FlatCatalog(object):
+  # $0.10 an hour per normalized unit
+
+  def instance_price(self, instance):
+    return 0.1 * reservations.normalization_factor(instance['InstanceType'])
+
+
+def running(instance_id, instance_type='m5.large', zone='us-east-1a', env='production', **fields):
+  return make_instance(instance_id, env=env, purpose='web', InstanceType=instance_type,
+                       Placement={'AvailabilityZone': zone, 'Tenancy': 'default'}, **fields)
+
+
+def reserved(instance_type, count, zone=None, platform='Linux/UNIX (Amazon VPC)'):
+  reservation = {'InstanceType': instance_type, 'InstanceCount': count,
+                 'ProductDescription': platform, 'InstanceTenancy': 'default',
+                 'Scope': 'Availability Zone' if zone else 'Region'}
+  if zone:
+    reservation['AvailabilityZone'] = zone
+  return reservation
+
+
+def covered(coverage):
+  return {i: tuple(pytest.approx(c) for c in cover) for i, cover in coverage.covered.items()}
+
+
+def test_normalization_factor():
+  assert reservations.normalization_factor('m5.large') == 4.0
+  assert reservations.normalization_factor('m5.12xlarge') == 96.0
+  assert reservations.normalization_factor('m5.metal') is None
+
+
+def test_zonal_then_regional():
+  instances = [running('i-1', zone='us-east-1a'), running('i-2', zone='us-east-1b'),
+               running('i-3', zone='us-east-1b'), running('i-4', state='stopped')]
+  coverage = reservations.match(instances, [reserved('m5.large', 1), reserved('c5.large', 2),
+                                            reserved('m5.large', 2, zone='us-east-1b')])
+  assert covered(coverage) == {'i-1': (1.0, 0.0), 'i-2': (1.0, 0.0), 'i-3': (1.0, 0.0)}
+  # Unused regional Linux reservations are left as normalized units of their family
+  assert coverage.unused_units == {'c5': 8.0}
+  assert coverage.unused_instances == {}
+
+
+def test_zonal_reservations_stay_in_their_zone():
+  coverage = reservations.match([running('i-1', zone='us-east-1a')],
+                                [reserved('m5.large', 1, zone='us-east-1b')])
+  assert covered(coverage) == {'i-1': (0.0, 0.0)}
+  assert coverage.unused_instances == {'m5.large': 1}
+
+
+def test_size_flexibility_covers_smallest_first():
+  instances = [running('i-1', 'm5.xlarge'), running('i-2', 'm5.large'), running('i-3', 'm5.large'),
+               running('i-4', 'c5.large')]
+  # Two of three reserved m5.large match exactly; the third's 4 units cover half the m5.xlarge
+  coverage = reservations.match(instances, [reserved('m5.large', 3)])
+  assert covered(coverage) == {'i-1': (0.5, 0.0), 'i-2': (1.0, 0.0), 'i-3': (1.0, 0.0),
+                               'i-4': (0.0, 0.0)}
+  assert coverage.unused_units == {}
+
+
+def test_windows_reservations_are_not_size_flexible():
+  coverage = reservations.match([running('i-1', 'm5.large', Platform='windows')],
+                                [reserved('m5.xlarge', 1, platform='Windows')])
+  assert covered(coverage) == {'i-1': (0.0, 0.0)}
+  assert coverage.unused_instances == {'m5.xlarge': 1} and coverage.unused_units == {}
+
+
+def test_savings_plans():
+  instances = [running('i-1', 'm5.large'), running('i-2', 'c5.xlarge'), running('i-3', 'c5.large')]
+  plans = [{'savingsPlanType': 'EC2Instance', 'ec2InstanceFamily': 'c5', 'region': 'us-east-1',
+            'commitment': '0.6'},
+           {'savingsPlanType': 'Compute', 'commitment': '0.3'}]
+  coverage = reservations.match(instances, [reserved('m5.large', 1)], plans, FlatCatalog())
+  # The m5.large is reserved; $1.20 an hour of c5 is left against $0.90 of commitments
+  assert covered(coverage) == {'i-1': (1.0, 0.0), 'i-2': (0.0, 1.0), 'i-3': (0.0, 0.25)}
+  assert coverage.unused_commitment == pytest.approx(0.0)
+  # Family commitments only apply to their family and region
+  coverage = reservations.match(instances[:1], (), plans, FlatCatalog())
+  assert covered(coverage) == {'i-1': (0.0, 0.75)}
+  assert coverage.unused_commitment == pytest.approx(0.6)
+  # Savings Plans need prices
+  assert covered(reservations.match(instances, (), plans)) == {
+    'i-1': (0.0, 0.0), 'i-2': (0.0, 0.0), 'i-3': (0.0, 0.0)}
+
+
+def test_summarize_a_subset_of_the_fleet():
+  fleet = [running('i-1', env='production'), running('i-2', env='staging'),
+           running('i-3', env='staging')]
+  coverage = reservations.match(fleet, [reserved('m5.large', 1)])
+  # Matched against the whole fleet, the one reservation goes to a single instance
+  assert sum(reserved for reserved, _ in coverage.covered.values()) == 1.0
+  staging = reservations.summarize(fleet[1:], coverage)
+  assert [row[:3] for row in staging] == [('staging', 'web', 2)]
+  assert staging[0][3] + staging[0][5] == 2 * reservations.HOURS_PER_DAY
+  rows = reservations.summarize(fleet, coverage)
+  assert sum(row[3] for row in rows) == reservations.HOURS_PER_DAY
+  assert rows == sorted(rows, key=lambda row: row[-1], reverse=True)
@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+import config
+import roledefs
+from conftest import make_instance
+
+
+SUBDOMAIN = config.MANAGED_SUBDOMAIN
+
+
+@pytest.fixture
+def instances():
+  return [
+    make_instance('i-000a', env='staging', purpose='web-api'),
+    make_instance('i-000b', env='staging', purpose='web-api',
+                  tags={config.INSTANCE_USER_KEY: 'deploy'}),
+    make_instance('i-000c', env='staging', purpose='web-api', state='stopped'),
+    make_instance('i-000d', env='production', purpose='searcher'),
+    make_instance('i-000e', purpose='searcher'),
+  ]
+
+
+def test_build(instances):
+  assert roledefs.build(instances, static={'gerrit': ['admin@gerrit.example.com']}) == {
+    'staging_web_api': sorted([
+      '%s@staging-web-api-000a.%s' % (config.INSTANCE_USER_DEFAULT, SUBDOMAIN),
+      'deploy@staging-web-api-000b.%s' % SUBDOMAIN]),
+    'production_searcher': ['%s@production-searcher-000d.%s' % (config.INSTANCE_USER_DEFAULT,
+                                                                SUBDOMAIN)],
+    'gerrit': ['admin@gerrit.example.com'],
+  }
+
+
+def test_static_roledefs_are_merged(instances):
+  built = roledefs.build(instances[3:4], static={'production_searcher': ['extra@host']})
+  assert built['production_searcher'][0] == 'extra@host' and len(built['production_searcher']) == 2
+  assert set(config.MANAGED_ENV_ROLEDEFS).issubset(roledefs.build([]))
+
+
+def test_every_host_has_a_user(fake_backend):
+  built = roledefs.build(roledefs.fetch_running())
+  hosts = [host for role, hosts in built.items() if role not in config.MANAGED_ENV_ROLEDEFS
+           for host in hosts]
+  assert hosts and all(host.count('@') == 1 and host.split('@')[0] for host in hosts)
+
+
+def test_ttl(tmp_path, monkeypatch, instances):
+  now = [1000.0]
+  monkeypatch.setattr(roledefs.time, 'time', lambda: now[0])
+  fetches = []
+
+  def fetch():
+    fetches.append(now[0])
+    return instances
+
+  cache = roledefs.RoledefCache(str(tmp_path / 'roledefs.json'), ttl=60)
+  built = cache.get(fetch)
+  now[0] += 59
+  assert cache.get(fetch) == built
+  assert fetches == [1000.0]
+  now[0] += 1
+  cache.get(fetch)
+  assert fetches == [1000.0, 1060.0]
+  cache.get(fetch, refresh=True)
+  assert len(fetches) == 3
+
+
+def test_unsupported_caches_are_rebuilt(tmp_path, capsys, instances):
+  fname = tmp_path / 'roledefs.json'
+  fname.write_text(json.dumps({'version': roledefs.VERSION + 1, 'roledefs': {}}))
+  cache = roledefs.RoledefCache(str(fname))
+  assert 'staging_web_api' in cache.get(lambda: instances)
+  assert 'Ignoring' in capsys.readouterr().err
+  assert json.loads(fname.read_text())['version'] == roledefs.VERSION
+
+
+def test_home_directory_paths(tmp_path, monkeypatch):
+  monkeypatch.setenv('HOME', str(tmp_path))
+  assert roledefs.RoledefCache('~/roledefs.json').fname == str(tmp_path / 'roledefs.json')
@@ -0,0 +1,118 @@
+import pytest
+
+import config
+import engine
+import route53
+import utils
+from conftest import make_instance
+
+
+ZONE = config.MANAGED_SUBDOMAIN
+
+
+def record(name, ip, ttl=route53.DEFAULT_TTL):
+  return {'Name': name, 'Type': 'A', 'TTL': ttl, 'ResourceRecords': [{'Value': ip}]}
+
+
+def host(instance_id, env='staging', purpose='web'):
+  return '%s-%s-%s.%s.' % (env, purpose, instance_id.split('-')[-1], ZONE)
+
+
+def actions(plan):
+  return sorted((c['Action'], c['ResourceRecordSet']['Name']) for c in plan.changes)
+
+
+def test_is_managed():
+  assert route53.is_managed(record(host('i-0123456789abcdef0'), '10.0.0.1'))
+  assert route53.is_managed(record('0123abcd.%s' % ZONE, '10.0.0.1'))
+  assert route53.is_managed(record('STAGING-WEB-0123ABCD.%s' % ZONE.upper(), '10.0.0.1'))
+  assert not route53.is_managed(record(ZONE + '.', '10.0.0.1'))
+  assert not route53.is_managed(record('web.%s.' % ZONE, '10.0.0.1'))
+  assert not route53.is_managed(record('a.staging-web-0123abcd.%s.' % ZONE, '10.0.0.1'))
+  assert not route53.is_managed(record('staging-web-0123abcd.example.com.', '10.0.0.1'))
+  assert not route53.is_managed(dict(record(host('i-0123abcd'), '10.0.0.1'), Type='CNAME'))
+  assert not route53.is_managed(dict(record(host('i-0123abcd'), '10.0.0.1'), SetIdentifier='a'))
+
+
+def test_plan():
+  instances = [
+    make_instance('i-0000000a', env='staging', purpose='web', ip='10.0.0.1'),
+    make_instance('i-0000000b', env='staging', purpose='web', ip='10.0.0.2'),
+    make_instance('i-0000000c', env='staging', purpose='web', ip='10.0.0.3'),
+    make_instance('i-0000000d', env='staging', purpose='web', ip='10.0.0.4', state='terminated'),
+    make_instance('i-0000000e', env='staging', purpose='web'),
+  ]
+  existing = [
+    record(host('i-0000000b'), '10.0.0.2'),
+    record(host('i-0000000c'), '10.9.9.9'),
+    record(host('i-0000000d'), '10.0.0.4'),
+    record(host('i-0000000f'), '10.0.0.6'),
+    record('web.%s.' % ZONE, '10.0.0.7'),
+    {'Name': ZONE + '.', 'Type': 'SOA', 'TTL': 900, 'ResourceRecords': [{'Value': 'ns'}]},
+  ]
+  plan = route53.plan(instances, existing)
+  assert (plan.creates, plan.updates, plan.deletes, plan.unchanged) == (1, 1, 2, 1)
+  assert plan.skipped == []
+  assert actions(plan) == [('CREATE', host('i-0000000a')), ('DELETE', host('i-0000000d')),
+                           ('DELETE', host('i-0000000f')), ('UPSERT', host('i-0000000c'))]
+  # Deletes carry the record set exactly as it is
+  deleted = [c['ResourceRecordSet'] for c in plan.changes if c['Action'] == 'DELETE']
+  assert record(host('i-0000000f'), '10.0.0.6') in deleted
+  # A TTL change is an update too
+  assert route53.plan(instances[1:2], existing[:1], ttl=60).updates == 1
+
+
+@pytest.mark.parametrize('purpose', ['a.b', 'my app', 'x_y', 'caf\u00e9', 'w' * 64])
+def test_plan_skips_names_that_cannot_be_managed(purpose):
+  instances = [make_instance('i-0000000a', env='staging', purpose='web', ip='10.0.0.1'),
+               make_instance('i-0000000b', env='staging', purpose=purpose, ip='10.0.0.2')]
+  plan = route53.plan(instances, [])
+  assert actions(plan) == [('CREATE', host('i-0000000a'))]
+  assert plan.skipped == [host('i-0000000b', purpose=purpose.lower())]
+  # Nothing is planned for them once the rest is applied either
+  applied = [c['ResourceRecordSet'] for c in plan.changes]
+  assert route53.plan(instances, applied).changes == []
+
+
+def test_batches():
+  changes = [{'Action': 'CREATE', 'ResourceRecordSet': record('a%d.%s.' % (n, ZONE), '10.0.0.1')}
+             for n in range(5)]
+  changes += [{'Action': 'UPSERT', 'ResourceRecordSet': record('b%d.%s.' % (n, ZONE), '10.0.0.2')}
+              for n in range(3)]
+  assert route53.batches([]) == []
+  assert route53.batches(changes) == [changes]
+  # UPSERTs count twice towards the record limit
+  assert [len(b) for b in route53.batches(changes, max_records=4)] == [4, 2, 2]
+  assert [len(b) for b in route53.batches(changes, max_chars=30)] == [3, 3, 2]
+  assert [c for b in route53.batches(changes, max_records=3) for c in b] == changes
+
+
+def test_batches_respect_the_route53_limits(instances):
+  plan = route53.plan(instances * 3, [])
+  for batch in route53.batches(plan.changes):
+    values = [v['Value'] for c in batch for v in c['ResourceRecordSet']['ResourceRecords']]
+    assert len(values) <= route53.MAX_BATCH_RECORDS
+    assert sum(len(v) for v in values) <= route53.MAX_BATCH_VALUE_CHARS
+
+
+def test_reconcile_against_the_fake_zone(fake_backend, instances):
+  eng = engine.Engine()
+  zone_id, record_sets = eng.run(zone=eng.fetch_zone(ZONE))['zone']
+  plan = route53.plan(instances, record_sets)
+  addressable = [i for i in instances if i.get('PrivateIpAddress') and
+                 i['State']['Name'] not in route53.UNADDRESSED_STATES]
+  assert plan.creates == len(addressable) - len(plan.skipped) and plan.deletes == 0
+  eng.run(changes=eng.change_record_sets(zone_id, route53.batches(plan.changes, max_records=100)))
+
+  # Applied, the zone is in line, and whatever was not managed is still there
+  _, record_sets = eng.run(zone=eng.fetch_zone(ZONE))['zone']
+  assert route53.plan(instances, record_sets).changes == []
+  assert len([r for r in record_sets if not route53.is_managed(r)]) == \
+    len(config.MANAGED_SUBDOMAIN_RECORDS)
+
+  # Terminated instances lose their record; others whose IP changed are updated
+  moved = dict(addressable[0], PrivateIpAddress='10.255.255.254')
+  gone = dict(addressable[1], State={'Name': 'terminated'})
+  plan = route53.plan([moved, gone] + addressable[2:], record_sets)
+  assert actions(plan) == sorted([('UPSERT', utils.generate_host(moved) + '.'),
+                                  ('DELETE', utils.generate_host(gone) + '.')])
@@ -0,0 +1,85 @@
+import collections
+import random
+
+import pytest
+
+import topk
+
+
+def zipf_stream(count, keys, seed=0):
+  rng = random.Random(seed)
+  weights = [1.0 / (n + 1) for n in range(keys)]
+  return [('key-%d' % n, rng.uniform(0, 2)) for n in rng.choices(range(keys), weights, k=count)]
+
+
+def test_exact_within_capacity():
+  summary = topk.SpaceSaving(3, capacity=10)
+  stream = zipf_stream(2000, 10)
+  totals = collections.Counter()
+  for key, cost in stream:
+    summary.add(key, cost)
+    totals[key] += cost
+  assert summary.exact
+  top = summary.top()
+  assert [key for key, _, _ in top] == [key for key, _ in totals.most_common(3)]
+  for key, cost, error in top:
+    assert cost == pytest.approx(totals[key]) and error == 0.0
+
+
+def test_eviction_inherits_the_minimum():
+  summary = topk.SpaceSaving(1, capacity=2)
+  summary.update({'a': 5.0, 'b': 1.0})
+  summary.add('c', 2.0)
+  # b, the cheapest, was evicted; c may have had up to b's cost before
+  assert summary.counters == {'a': [5.0, 0.0], 'c': [3.0, 1.0]}
+  assert not summary.exact
+  assert summary.top() == [('a', 5.0, 0.0)]
+
+
+def test_error_bounds_beyond_capacity():
+  capacity = 50
+  summary = topk.SpaceSaving(10, capacity=capacity)
+  stream = zipf_stream(20000, 1000, seed=1)
+  totals = collections.Counter()
+  for key, cost in stream:
+    summary.add(key, cost)
+    totals[key] += cost
+  assert len(summary.counters) == capacity
+  for key, (cost, error) in summary.counters.items():
+    # An estimate never undercounts, and overcounts by at most its error
+    assert cost >= totals[key] - 1e-9
+    assert cost - error <= totals[key] + 1e-9
+  # Every key costing more than total / capacity is monitored
+  threshold = sum(totals.values()) / capacity
+  assert all(key in summary.counters for key, cost in totals.items() if cost > threshold)
+  # The heap of stale entries stays bounded
+  assert len(summary._heap) <= 4 * capacity + 1
+
+
+def test_negative_costs_only_reduce_monitored_keys():
+  summary = topk.SpaceSaving(2, capacity=2)
+  summary.update({'a': 5.0, 'credit': -3.0})
+  summary.add('a', -1.0)
+  assert summary.counters == {'a': [4.0, 0.0]}
+  assert summary.top() == [('a', 4.0, 0.0)]
+
+
+def test_capacity_is_at_least_k():
+  assert topk.SpaceSaving(20, capacity=5).capacity == 20
+
+
+def test_cost_explorer_group_by():
+  assert topk.cost_explorer_group_by(['instance_type', 'tag:Owner']) == [
+    {'Type': 'DIMENSION', 'Key': 'INSTANCE_TYPE'}, {'Type': 'TAG', 'Key': 'Owner'}]
+  with pytest.raises(ValueError):
+    topk.cost_explorer_group_by(['a', 'b', 'c'])
+
+
+def test_cost_explorer_updater():
+  summary = topk.SpaceSaving(2)
+  on_result = topk.cost_explorer_updater(summary)
+  for amount in ('1.5', '2.5'):
+    on_result({'Groups': [
+      {'Keys': ['m5.large', 'Owner$bob'], 'Metrics': {'UnblendedCost': {'Amount': amount}}},
+      {'Keys': ['c5.large', 'Owner$'], 'Metrics': {'UnblendedCost': {'Amount': '1'}}}]})
+  assert summary.top() == [(('m5.large', 'bob'), 4.0, 0.0), (('c5.large', ''), 2.0, 0.0)]
@@ -0,0 +1,89 @@
+import asyncio
+import datetime
+
+import pytest
+
+import utilization
+from conftest import make_instance
+
+
+NOW = datetime.datetime(2019, 7, 31, 12, 30, tzinfo=datetime.timezone.utc)
+
+
+class CloudWatch(object):
+  # Stands in for an engine.Engine, answering GetMetricData with a constant per instance
+
+  def __init__(self, cpu):
+    self.cpu = cpu
+    self.asked = []
+
+  async def fetch_metrics(self, instance_ids, metrics, start, end, period):
+    self.asked.append((sorted(instance_ids), start))
+    hours = int((end - start).total_seconds()) // period
+    timestamps = [start + datetime.timedelta(seconds=period * h) for h in range(hours)]
+    return {instance_id: {'CPUUtilization': [(t, self.cpu[instance_id]) for t in timestamps],
+                          'NetworkIn': [(t, 1e6) for t in timestamps],
+                          'NetworkOut': [(t, 1e6) for t in timestamps]}
+            for instance_id in instance_ids}
+
+  def run(self, **coros):
+    return {name: asyncio.run(coro) for name, coro in coros.items()}
+
+
+def test_resize():
+  assert utilization.resize('m5.2xlarge', 0.5) == 'm5.xlarge'
+  assert utilization.resize('m5.8xlarge', 2) == 'm5.16xlarge'
+  assert utilization.resize('m5.nano', 0.5) is None
+  assert utilization.resize('unknown', 0.5) is None
+
+
+@pytest.mark.parametrize('cpu_p95,cpu_max,network_p95,suggestion', [
+  (1, 2, 1, 'idle'),
+  (1, 2, 50, 'downsize to m5.large'),
+  (30, 60, 1, ''),
+  (90, 100, 1, 'upsize to m5.2xlarge'),
+])
+def test_suggest(cpu_p95, cpu_max, network_p95, suggestion):
+  assert utilization.suggest('m5.xlarge', cpu_p95, cpu_max, network_p95) == suggestion
+
+
+def test_summarize_leaves_gaps_out():
+  values = {'CPUUtilization': [10, [10.0, None, 30.0]], 'NetworkIn': [10, [1e6, 2e6, 3e6]],
+            'NetworkOut': [11, [1e6, None]]}
+  summary = utilization.summarize('m5.large', values)
+  assert (summary.cpu_p50, summary.cpu_max) == (20.0, 30.0)
+  assert summary.network_p95 == pytest.approx(3.0)
+  assert utilization.summarize('m5.large', {}) is None
+
+
+def test_only_new_hours_are_fetched():
+  cache = utilization.MetricCache()
+  cloudwatch = CloudWatch({'i-1': 50.0})
+  instances = [make_instance('i-1'), make_instance('i-2', state='stopped')]
+  summaries = utilization.collect(instances, days=2, cache=cache, eng=cloudwatch, now=NOW)
+  assert list(summaries) == ['i-1'] and summaries['i-1'].cpu_p95 == 50.0
+  utilization.collect(instances, days=2, cache=cache, eng=cloudwatch, now=NOW)
+  utilization.collect(instances, days=2, cache=cache, eng=cloudwatch,
+                      now=NOW + datetime.timedelta(hours=3))
+  # The last cached hour is fetched again
+  assert cloudwatch.asked == [(['i-1'], datetime.datetime(2019, 7, 29, 12, tzinfo=NOW.tzinfo)),
+                              (['i-1'], datetime.datetime(2019, 7, 31, 11, tzinfo=NOW.tzinfo))]
+
+
+def test_filtered_runs_keep_the_rest_of_the_cache(tmp_path):
+  fname = str(tmp_path / 'utilization.json')
+  cloudwatch = CloudWatch({'i-1': 10.0, 'i-2': 90.0, 'i-3': 50.0})
+  fleet = [make_instance('i-%d' % n) for n in (1, 2, 3)]
+  utilization.collect(fleet, days=2, cache=utilization.MetricCache(fname), eng=cloudwatch, now=NOW)
+
+  # A run over part of the fleet, in which i-3 also stopped
+  subset = [fleet[0], make_instance('i-3', state='stopped')]
+  utilization.collect(subset, days=2, cache=utilization.MetricCache(fname), eng=cloudwatch,
+                      now=NOW)
+  assert sorted(utilization.MetricCache(fname).entries) == ['i-1', 'i-2']
+  assert len(cloudwatch.asked) == 1
+
+  # Instances no run has seen for the whole window are forgotten
+  utilization.collect(fleet[:1], days=2, cache=utilization.MetricCache(fname), eng=cloudwatch,
+                      now=NOW + datetime.timedelta(days=3))
+  assert sorted(utilization.MetricCache(fname).entries) == ['i-1']
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Streaming top-K cost heavy hitters.
+
+Answers "which 20 instances, types or owners cost the most" over a stream of (key, cost) updates,
+e.g. Cost Explorer pages as they arrive or CUR chunk aggregates as workers finish them, while
+holding at most a fixed number of keys in memory. Uses the weighted Space-Saving algorithm: when
+the summary is full, the cheapest key is evicted and its cost is inherited, as an upper bound on
+error, by the newcomer. While the number of distinct keys stays within capacity, the result is
+exact.
+
+"""
+
+import heapq
+
+import stats
+
+
+# Enough to rank every instance, instance type or owner of most fleets exactly
+DEFAULT_CAPACITY = 10000
+
+
+class SpaceSaving(object):
+  """
+  A bounded summary of the heaviest keys of a weighted stream.
+
+  :param k: The number of heavy hitters wanted
+  :param capacity: The number of keys monitored; see :py:data:`DEFAULT_CAPACITY`
+  """
+
+  def __init__(self, k, capacity=DEFAULT_CAPACITY):
+    self.k = k
+    self.capacity = max(capacity, k)
+    # key -> [estimated cost, maximum overestimation]
+    self.counters = {}
+    # Lazy min-heap of (estimated cost, key); stale entries are skipped when popped
+    self._heap = []
+
+  def add(self, key, cost):
+    """
+    Adds the cost of one row. Negative costs (e.g. credits) only reduce keys already monitored.
+    """
+    counters = self.counters
+    counter = counters.get(key)
+    if counter is not None:
+      counter[0] += cost
+    elif cost <= 0:
+      return
+    elif len(counters) < self.capacity:
+      counter = counters[key] = [cost, 0.0]
+    else:
+      evicted, minimum = self._pop_min()
+      del counters[evicted]
+      stats.incr('topk_evictions')
+      counter = counters[key] = [minimum + cost, minimum]
+    heapq.heappush(self._heap, (counter[0], key))
+    if len(self._heap) > 4 * self.capacity:
+      self._heap = [(c[0], k) for k, c in counters.items()]
+      heapq.heapify(self._heap)
+
+  def update(self, partial):
+    """
+    Adds a partial aggregate, e.g. one CUR chunk from :py:func:`cur.iter_partials`.
+
+    :param partial: A dict of {key: cost}
+    """
+    for key, cost in partial.items():
+      self.add(key, cost)
+
+  def _pop_min(self):
+    while True:
+      cost, key = heapq.heappop(self._heap)
+      counter = self.counters.get(key)
+      if counter is not None and counter[0] == cost:
+        return key, cost
+
+  @property
+  def exact(self):
+    """
+    Whether nothing has been evicted, i.e. the estimates are the true totals.
+    """
+    return all(error == 0.0 for _, error in self.counters.values())
+
+  def top(self):
+    """
+    :return: A list of up to k (key, estimated cost, maximum overestimation) tuples, most
+        expensive first
+    """
+    return [(key, cost, error) for key, (cost, error) in heapq.nlargest(
+      self.k, self.counters.items(), key=lambda item: item[1][0])]
+
+
+def cost_explorer_group_by(fields):
+  """
+  Converts fields to Cost Explorer GroupBy definitions; Cost Explorer allows at most two.
+
+  :param fields: Dimension names (e.g. INSTANCE_TYPE, LINKED_ACCOUNT) or ``tag:<Key>``
+  :return: A list of GroupBy definitions
+  """
+  if len(fields) > 2:
+    raise ValueError('Cost Explorer can group by at most two dimensions, not %d' % len(fields))
+  return [{'Type': 'TAG', 'Key': f[len('tag:'):]} if f.startswith('tag:')
+          else {'Type': 'DIMENSION', 'Key': f.upper()} for f in fields]
+
+
+def cost_explorer_updater(summary, metric='UnblendedCost'):
+  """
+  :param summary: A :py:class:`SpaceSaving` to feed
+  :param metric: The cost metric to rank by
+  :return: A callback adding each Cost Explorer ResultsByTime entry to the summary, e.g. for
+      :py:meth:`engine.Engine.fetch_cost`'s ``on_result``
+  """
+  def on_result(result):
+    for group in result['Groups']:
+      # Tag keys come back as <tag key>$<value>
+      key = tuple(k.split('$', 1)[1] if '$' in k else k for k in group['Keys'])
+      summary.add(key, float(group['Metrics'][metric]['Amount']))
+  return on_result
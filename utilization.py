@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+CloudWatch utilization of running instances, for rightsizing.
+
+Hourly CPU and network datapoints of every running instance are fetched with as few
+GetMetricData requests as the API allows (see :py:meth:`engine.Engine.fetch_metrics`), cached
+per instance by timestamp, and summarized as p50/p95/max with a rightsizing suggestion. Each run
+only fetches the hours since the previous one; datapoints that fall out of the window are dropped.
+
+"""
+
+import collections
+import datetime
+import json
+import os
+
+import numpy
+
+import engine
+import reservations
+import stats
+
+
+METRICS = ('CPUUtilization', 'NetworkIn', 'NetworkOut')
+
+VERSION = 1
+
+DEFAULT_DAYS = 14
+PERIOD = 3600
+
+# Rightsizing thresholds, in CPU percent and network MB per datapoint
+IDLE_CPU_MAX = 5.0
+IDLE_NETWORK_P95 = 5.0
+DOWNSIZE_CPU_P95 = 20.0
+DOWNSIZE_CPU_MAX = 50.0
+UPSIZE_CPU_P95 = 80.0
+
+Utilization = collections.namedtuple('Utilization', [
+  'cpu_p50', 'cpu_p95', 'cpu_max', 'network_p95', 'suggestion'])
+
+
+class MetricCache(object):
+  """
+  Hourly datapoints per instance, kept in a JSON file between runs.
+
+  :param fname: The cache file, or None to only cache in memory
+  """
+
+  def __init__(self, fname=None):
+    self.fname = fname
+    # instance ID -> {'until': epoch seconds fetched up to, 'points': {metric: series}}, each
+    # series [first hour since the epoch, [hourly value, or None where there is no datapoint]]
+    self.entries = {}
+    self.changed = False
+    if fname and os.path.exists(fname):
+      with open(fname) as f:
+        state = json.load(f)
+      if not isinstance(state, dict) or state.get('version') != VERSION:
+        raise ValueError('%s has an unsupported utilization cache version' % fname)
+      self.entries = state['entries']
+
+  def get(self, instance_id):
+    """
+    :return: A dict of {metric name: [first hour since the epoch, [values]]}, or None if not
+        cached
+    """
+    entry = self.entries.get(instance_id)
+    return entry['points'] if entry else None
+
+  def fetched_until(self, instance_id):
+    """
+    :return: The epoch seconds datapoints of the instance were fetched up to, or None
+    """
+    entry = self.entries.get(instance_id)
+    return entry['until'] if entry else None
+
+  def put(self, instance_id, values, since, until):
+    """
+    Merges newly fetched datapoints in, forgetting those before the window.
+
+    :param values: A dict of {metric name: [(timestamp, value)]}
+    :param since: The epoch seconds of the window's start; older datapoints are dropped
+    :param until: The epoch seconds datapoints were fetched up to
+    """
+    entry = self.entries.setdefault(instance_id, {'until': until, 'points': {}})
+    entry['until'] = until
+    first_hour = int(since) // PERIOD
+    for metric in set(entry['points']).union(values):
+      first, series = entry['points'].get(metric, (0, []))
+      hours = {first + i: value for i, value in enumerate(series)
+               if value is not None and first + i >= first_hour}
+      for timestamp, value in values.get(metric, ()):
+        hour = int(timestamp.timestamp()) // PERIOD
+        if hour >= first_hour:
+          # Two decimals are plenty for percentages and bytes, and keep the file small
+          hours[hour] = round(value, 2)
+      if hours:
+        first = min(hours)
+        entry['points'][metric] = [first, [hours.get(h) for h in range(first, max(hours) + 1)]]
+      else:
+        entry['points'].pop(metric, None)
+    self.changed = True
+
+  def prune(self, instance_ids, since):
+    """
+    Forgets the given instances, e.g. those no longer running, and those fetched up to before
+    since, whose datapoints have all fallen out of the window. Instances a run does not see, e.g.
+    terminated or filtered out, are kept until then, so that runs with different filters share
+    the cache.
+
+    :param instance_ids: Instance IDs to forget
+    :param since: The epoch seconds of the window's start
+    """
+    instance_ids = set(instance_ids)
+    gone = [i for i, e in self.entries.items() if i in instance_ids or e['until'] < since]
+    for instance_id in gone:
+      del self.entries[instance_id]
+    if gone:
+      self.changed = True
+
+  def save(self):
+    if not self.fname or not self.changed:
+      return
+    tmp = self.fname + '.tmp'
+    with open(tmp, 'w') as f:
+      # json.dumps encodes in C, json.dump does not
+      f.write(json.dumps({'version': VERSION, 'entries': self.entries}, separators=(',', ':')))
+    os.replace(tmp, self.fname)
+    self.changed = False
+
+
+def window(days=DEFAULT_DAYS, now=None):
+  """
+  The time range utilization is summarized over. It ends at the start of the current UTC hour,
+  so that runs within the hour share cached datapoints.
+
+  :return: A tuple of (start, end) datetimes
+  """
+  now = now or datetime.datetime.now(datetime.timezone.utc)
+  end = now.replace(minute=0, second=0, microsecond=0)
+  return end - datetime.timedelta(days=days), end
+
+
+def resize(instance_type, ratio):
+  """
+  :param instance_type: e.g. m5.2xlarge
+  :param ratio: The wanted capacity relative to the current size, e.g. 0.5
+  :return: The instance type of the size with that normalization factor, or None if there is none
+  """
+  factor = reservations.normalization_factor(instance_type)
+  if not factor:
+    return None
+  wanted = factor * ratio
+  family = reservations.instance_family(instance_type)
+  for size, size_factor in reservations.NORMALIZATION_FACTORS.items():
+    if size_factor == wanted:
+      return '%s.%s' % (family, size)
+  if wanted > 8 and wanted % 8 == 0:
+    return '%s.%dxlarge' % (family, wanted // 8)
+  return None
+
+
+def suggest(instance_type, cpu_p95, cpu_max, network_p95):
+  """
+  :return: A rightsizing suggestion, e.g. 'downsize to m5.large', or '' if the size looks right
+  """
+  if cpu_max < IDLE_CPU_MAX and network_p95 < IDLE_NETWORK_P95:
+    return 'idle'
+  if cpu_p95 < DOWNSIZE_CPU_P95 and cpu_max < DOWNSIZE_CPU_MAX:
+    smaller = resize(instance_type, 0.5)
+    return 'downsize to %s' % smaller if smaller else ''
+  if cpu_p95 > UPSIZE_CPU_P95:
+    larger = resize(instance_type, 2)
+    return 'upsize to %s' % larger if larger else ''
+  return ''
+
+
+def _series(values, metric):
+  # A metric's first hour and hourly datapoints, NaN for gaps
+  first, series = values.get(metric) or (0, [])
+  return first, numpy.array(series, dtype=float)
+
+
+def summarize(instance_type, values):
+  """
+  :param instance_type: The instance's type
+  :param values: A dict of {metric name: [first hour, [hourly datapoints, None for gaps]]}, as
+      kept by :py:class:`MetricCache`
+  :return: A :py:class:`Utilization`, or None without CPU datapoints
+  """
+  cpu = _series(values, 'CPUUtilization')[1]
+  cpu = cpu[~numpy.isnan(cpu)]
+  if not cpu.size:
+    return None
+  # Traffic in and out of the same hour are added up; hours missing either are left out
+  in_first, network_in = _series(values, 'NetworkIn')
+  out_first, network_out = _series(values, 'NetworkOut')
+  first = max(in_first, out_first)
+  last = min(in_first + network_in.size, out_first + network_out.size)
+  network = (network_in[first - in_first:max(first, last) - in_first] +
+             network_out[first - out_first:max(first, last) - out_first]) / 1e6
+  network = network[~numpy.isnan(network)]
+  p50, p95 = numpy.percentile(cpu, [50, 95])
+  cpu_max = float(cpu.max())
+  network_p95 = float(numpy.percentile(network, 95)) if network.size else 0.0
+  return Utilization(float(p50), float(p95), cpu_max, network_p95,
+                     suggest(instance_type, p95, cpu_max, network_p95))
+
+
+def collect(instances, days=DEFAULT_DAYS, cache=None, eng=None, now=None):
+  """
+  Summarizes the utilization of the running instances.
+
+  :param instances: Instance dicts, as returned by describe_instances
+  :param days: The number of days to summarize
+  :param cache: A :py:class:`MetricCache`; only the hours it is missing are fetched
+  :param eng: The :py:class:`engine.Engine` to fetch with
+  :return: A dict of {instance ID: :py:class:`Utilization`}
+  """
+  cache = cache or MetricCache()
+  start, end = window(days, now)
+  running = [i for i in instances if i['State']['Name'] == 'running']
+
+  # Instances fetched up to the same time share GetMetricData requests. The last cached hour is
+  # fetched again, as CloudWatch may still have been aggregating it.
+  since = {}
+  for instance in running:
+    until = cache.fetched_until(instance['InstanceId'])
+    if until is not None and until >= end.timestamp():
+      continue
+    fetch_from = start if until is None else max(start, datetime.datetime.fromtimestamp(
+      until - PERIOD, datetime.timezone.utc))
+    since.setdefault(fetch_from, []).append(instance['InstanceId'])
+  stats.incr('utilization_cache_hits', sum(1 for i in running
+                                           if cache.fetched_until(i['InstanceId']) is not None))
+  if since:
+    eng = eng or engine.Engine()
+    fetches = {'%d' % n: eng.fetch_metrics(instance_ids, METRICS, fetch_from, end, PERIOD)
+               for n, (fetch_from, instance_ids) in enumerate(sorted(since.items()))}
+    for fetched in eng.run(**fetches).values():
+      for instance_id, values in fetched.items():
+        cache.put(instance_id, values, start.timestamp(), end.timestamp())
+  cache.prune((i['InstanceId'] for i in instances if i['State']['Name'] != 'running'),
+              start.timestamp())
+  cache.save()
+
+  with stats.span('utilization.summarize'):
+    summaries = {}
+    for instance in running:
+      summary = summarize(instance['InstanceType'], cache.get(instance['InstanceId']) or {})
+      if summary is not None:
+        summaries[instance['InstanceId']] = summary
+  return summaries
@@ -18,10 +18,24 @@ from matplotlib import colors
 from boto.ec2.instance import Instance
 from boto.ec2.ec2object import TaggedEC2Object
 import config
+import pricing
+import stats
 from boto.exception import EC2ResponseError
 
 _CLOUD_DEV_MACHINE = 'cloud_dev_machine'
 
+STOPPED_TIME_FORMAT = '%Y-%m-%d %H:%M:%S GMT'
+
+_STOPPED_TIME_RE = re.compile(r'.*\((.*)\)')
+
+PRICE_COLUMNS = ['Hourly Price', 'Est. Monthly Cost']
+
+UTILIZATION_COLUMNS = ['CPU p50', 'CPU p95', 'CPU Max', 'Network p95 (MB)', 'Rightsizing']
+
+NETWORK_COLUMNS = ['Zone', 'Subnet CIDR', 'Subnet', 'VPC', 'Security Groups', 'Subnet Check']
+
+IMAGE_COLUMNS = ['AMI', 'AMI Name', 'AMI Created', 'AMI Age (days)']
+
 def strip(x): return x.replace('\n','').strip() if x else ''
 
 
@@ -63,7 +77,7 @@ def generate_role(obj):
   :return: A roledef string or None if the object is not fully configured
   """
   if isinstance(obj, dict):
-    tags = obj.get('Tags', {})
+    tags = get_tags(obj)
   elif isinstance(obj, TaggedEC2Object):
     tags = obj.tags
   else:
@@ -103,7 +117,7 @@ def generate_host(obj, prepend_user=False, use_ip=False, user=None):
     if user is None and config.INSTANCE_OWNER_KEY in tags:
       user = tags.get(config.INSTANCE_OWNER_KEY, '')
     if user is not None:
-      host_user = user + ':'
+      host_user = user + '@'
 
   environment = ''
   if config.INSTANCE_ENVIRONMENT_KEY in tags:
@@ -130,31 +144,107 @@ def generate_host(obj, prepend_user=False, use_ip=False, user=None):
       subdomain=config.MANAGED_SUBDOMAIN
     )
 
-def create_instance_details_table(instances):
+def get_tags(obj):
+  """
+  :param obj: An instance dict, as returned by describe_instances
+  :return: The instance's tags as a dict
+  """
+  return {i['Key'] : i['Value'] for i in obj.get('Tags', [])}
+
+def get_instance_attributes(instance):
+  """
+  :param instance: An instance dict, as returned by describe_instances
+  :return: A dict of the instance's role, owner, type, env and purpose; '' where unknown
+  """
+  tags = get_tags(instance)
+  return {
+    'role': generate_role(instance) or '',
+    'owner': strip(tags.get(config.INSTANCE_OWNER_KEY, '')),
+    'type': instance.get('InstanceType', ''),
+    'env': tags.get(config.INSTANCE_ENVIRONMENT_KEY, ''),
+    'purpose': tags.get(config.INSTANCE_PURPOSE_KEY, ''),
+  }
+
+def get_stopped_time(instance):
+  """
+  Extracts the time a stopped instance was stopped at from its StateTransitionReason, e.g.
+  'User initiated (2019-07-01 12:00:00 GMT)'.
+
+  :param instance: An instance dict, as returned by describe_instances
+  :return: The stop time string in :py:data:`STOPPED_TIME_FORMAT`, or '' if unknown
+  """
+  reason = instance.get('StateTransitionReason')
+  if reason and instance['State']['Name'] == 'stopped' and '(' in reason:
+    return _STOPPED_TIME_RE.findall(reason)[0]
+  return ''
+
+def get_price_columns(instance, catalog):
+  """
+  :param instance: An instance dict, as returned by describe_instances
+  :param catalog: A :py:class:`pricing.PriceCatalog`
+  :return: The instance's hourly on-demand price and estimated monthly cost (zero unless it is
+      running), formatted for output
+  """
+  hourly = catalog.instance_price(instance)
+  if hourly is None:
+    return ['unknown', 'unknown']
+  running = instance['State']['Name'] == 'running'
+  return ['%.4f' % hourly, '%.2f' % (hourly * pricing.HOURS_PER_MONTH if running else 0.0)]
+
+def get_utilization_columns(utilization):
+  """
+  :param utilization: A :py:class:`utilization.Utilization`, or None if unknown
+  :return: The instance's CPU and network utilization and rightsizing suggestion, formatted for
+      output
+  """
+  if utilization is None:
+    return [''] * len(UTILIZATION_COLUMNS)
+  return ['%.1f' % utilization.cpu_p50, '%.1f' % utilization.cpu_p95, '%.1f' % utilization.cpu_max,
+          '%.1f' % utilization.network_p95, utilization.suggestion]
+
+def create_instance_details_table(instances, catalog=None):
   """
   Create a PrettyTable of the most commonly useful instance details.
 
   :param instances: A list of instances to generate from
+  :param catalog: A :py:class:`pricing.PriceCatalog`; if given, estimated cost columns are added
   :return: A PrettyTable object
   """
+  table = new_instance_details_table(catalog)
+  for instance in instances:
+    table.add_row(instance_details_table_row(instance, catalog))
+  return table
+
+def new_instance_details_table(catalog=None):
+  """
+  :param catalog: A :py:class:`pricing.PriceCatalog`; if given, estimated cost columns are added
+  :return: An empty PrettyTable with the columns of :py:func:`create_instance_details_table`
+  """
   # TODO(ltd): Move to utils
-  table = prettytable.PrettyTable(['ID', 'Role', 'Hostname', 'State', 'Instance Type',
-                                   'Launch date'], sortby='Role', reversesort=True,
+  columns = ['ID', 'Role', 'Hostname', 'State', 'Instance Type', 'Launch date']
+  if catalog is not None:
+    columns.extend(PRICE_COLUMNS)
+  table = prettytable.PrettyTable(columns, sortby='Role', reversesort=True,
                                   sort_key=operator.itemgetter(2, 6))
 
   table.align['ID'] = 'l'
   table.align['Role'] = 'l'
   table.align['Hostname'] = 'r'
   table.padding_width = 2
-
-  for instance in instances:
-    role = generate_role(instance)
-    host = generate_host(instance)
-    table.add_row([instance['InstanceId'], role if role else 'unknown', host if host else 'unknown',
-                   instance['State']['Name'], instance['InstanceType'], instance['LaunchTime']])
-
   return table
 
+def instance_details_table_row(instance, catalog=None):
+  """
+  :return: The row of :py:func:`create_instance_details_table` for one instance
+  """
+  role = generate_role(instance)
+  host = generate_host(instance)
+  row = [instance['InstanceId'], role if role else 'unknown', host if host else 'unknown',
+         instance['State']['Name'], instance['InstanceType'], instance['LaunchTime']]
+  if catalog is not None:
+    row.extend(get_price_columns(instance, catalog))
+  return row
+
 
 def _get_instance_metadata(instances):
   """
@@ -168,13 +258,9 @@ def _get_instance_metadata(instances):
  
   # 'id', 'name', 'owner', 'state', 'private_dns', 'public_dns', 'stopped_time'
   for instance in instances:
+    tags = get_tags(instance)
     if instance['State']['Name'] in ('running', 'stopped'):
-      tags = instance.get('Tags', [])
-      tags = {i['Key'] : i['Value'] for i in tags}
-      stop_time = ''
-      if instance['StateTransitionReason'] and instance['State']['Name'] == 'stopped':
-        if '(' in  instance['StateTransitionReason']:
-          stop_time = re.findall('.*\((.*)\)', instance['StateTransitionReason'])[0]
+      stop_time = get_stopped_time(instance)
       metadata[instance['InstanceId']] = InstanceMetadata(
         instance['InstanceId'],
         tags.get(_CLOUD_DEV_MACHINE, ''),
@@ -191,11 +277,75 @@ def _get_instance_metadata(instances):
 
   return metadata
 
-def create_instance_detail_file(instances, fname):
-  metadata = _get_instance_metadata(instances)
-  f = open(fname,"w+")
-  f.write('\t'.join(['ID', 'Hostname','Environment', 'State','Attached Volumes(Ebs)', 'Instance Type', 'Launch date', 
-    'Owner', 'Name', 'Stopped Time','Days since Stopped']))
+def get_volume_ids(instance):
+  """
+  :param instance: An instance dict, as returned by describe_instances
+  :return: The IDs of the EBS volumes attached to the instance
+  """
+  return [i['Ebs']['VolumeId'] for i in instance.get('BlockDeviceMappings') or [] if 'Ebs' in i]
+
+def get_instance_cost(instance, resource_costs):
+  """
+  :param instance: An instance dict, as returned by describe_instances
+  :param resource_costs: A dict of {resource ID: cost}, e.g. from :py:func:`cur.resource_costs`
+  :return: The cost of the instance itself plus that of its attached EBS volumes
+  """
+  return resource_costs.get(instance['InstanceId'], 0.0) + sum(
+    resource_costs.get(v, 0.0) for v in get_volume_ids(instance))
+
+def create_instance_detail_file(instances, fname, resource_costs=None, catalog=None,
+                                utilization=None, network=None, images=None):
+  """
+  Writes a TSV of instance details.
+
+  :param instances: A list of instance dicts, as returned by describe_instances
+  :param fname: The file to write
+  :param resource_costs: A dict of month-to-date cost per instance and volume ID, e.g. from
+      :py:func:`cur.resource_costs`. If given, a cost column is appended.
+  :param catalog: A :py:class:`pricing.PriceCatalog`. If given, estimated cost columns are appended.
+  :param utilization: A dict of {instance ID: :py:class:`utilization.Utilization`}, e.g. from
+      :py:func:`utilization.collect`. If given, utilization columns are appended.
+  :param network: A :py:class:`network.NetworkCache` refreshed for the instances. If given, zone,
+      subnet, VPC and security group columns are appended.
+  :param images: An :py:class:`images.ImageCache` refreshed for the instances. If given, AMI name,
+      creation date and age columns are appended.
+  """
+  with stats.span('detail_file.write'), open(fname, 'w+') as f:
+    f.write('\t'.join(instance_detail_header(resource_costs, catalog, utilization, network,
+                                              images)))
+    for row in instance_detail_rows(instances, resource_costs, catalog, utilization, network,
+                                    images):
+      f.write('\n' + '\t'.join(row))
+
+def instance_detail_header(resource_costs=None, catalog=None, utilization=None, network=None,
+                           images=None):
+  """
+  :return: The column names of the instance detail file, with the optional column groups of
+      :py:func:`create_instance_detail_file`
+  """
+  header = ['ID', 'Hostname','Environment', 'State','Attached Volumes(Ebs)', 'Instance Type', 'Launch date', 
+    'Owner', 'Name', 'Stopped Time','Days since Stopped']
+  if resource_costs is not None:
+    header.append('Month-to-date Cost')
+  if catalog is not None:
+    header.extend(PRICE_COLUMNS)
+  if utilization is not None:
+    header.extend(UTILIZATION_COLUMNS)
+  if network is not None:
+    header.extend(NETWORK_COLUMNS)
+  if images is not None:
+    header.extend(IMAGE_COLUMNS)
+  return header
+
+def instance_detail_rows(instances, resource_costs=None, catalog=None, utilization=None,
+                         network=None, images=None):
+  """
+  Formats instance details, one row per instance; see :py:func:`create_instance_detail_file`.
+
+  :return: A generator of lists of column values, matching :py:func:`instance_detail_header`
+  """
+  with stats.span('detail_file.metadata'):
+    metadata = _get_instance_metadata(instances)
   for instance in instances:
     block_devices = instance['BlockDeviceMappings'] if instance['BlockDeviceMappings'] else []
     ebs = ['{}:{}'.format(i['DeviceName'], i['Ebs']['VolumeId']) for i in block_devices]
@@ -204,11 +354,20 @@ def create_instance_detail_file(instances, fname):
     env = instance['KeyName']
     stop_days = 0
     if metadata[_id].stopped_time:
-      delta = datetime.datetime.utcnow() - datetime.datetime.strptime(metadata[_id].stopped_time, '%Y-%m-%d %H:%M:%S GMT')
+      delta = datetime.datetime.utcnow() - datetime.datetime.strptime(metadata[_id].stopped_time, STOPPED_TIME_FORMAT)
       stop_days = delta.days
     row = [_id, host if host else 'unknown', env,
       metadata[_id].state, ','.join(ebs), instance['InstanceType'], 
       instance['LaunchTime'].strftime('%Y-%m-%d %H:%M:%S GMT')]
     row.extend([strip(metadata[_id].owner), strip(metadata[_id].name), metadata[_id].stopped_time, str(stop_days)])
-    f.write('\n' + '\t'.join(row))
-  f.close() 
+    if resource_costs is not None:
+      row.append('%.2f' % get_instance_cost(instance, resource_costs))
+    if catalog is not None:
+      row.extend(get_price_columns(instance, catalog))
+    if utilization is not None:
+      row.extend(get_utilization_columns(utilization.get(_id)))
+    if network is not None:
+      row.extend(network.columns(instance))
+    if images is not None:
+      row.extend(images.columns(instance))
+    yield row